@@ -73,5 +73,6 @@ def classic_align_pairwise(s1, s2, Sd, d, e, local, return_score=False, **kw):
 def local_pairwise(s1, s2, S, d, e, return_score=False):
     return classic_align_pairwise(s1, s2, S, d, e, True, return_score=return_score)
 
-def global_pairwise(s1, s2, S, d, e, return_score=False):
-    return classic_align_pairwise(s1, s2, S, d, e, False, return_score=return_score)
+def global_pairwise(s1, s2, S, d, e, return_score=False, band=None):
+    return classic_align_pairwise(s1, s2, S, d, e, False,
+            return_score=return_score, band=band)
@@ -89,6 +89,7 @@ class FwdDefn(CalculationDefn):
 
 class EdgeSumAndAlignDefn(CalculationDefn):
     name = 'pair'
+    band = None
     def calc(self, pog1, pog2, length1, length2, bin):
         edge = Edge(pog1, pog2, length1+length2, [bin])
         def _getaln():
@@ -96,23 +97,24 @@ class EdgeSumAndAlignDefn(CalculationDefn):
                 ratio = length1/(length1+length2)
             except (ZeroDivisionError, FloatingPointError):
                 ratio = 1.
-            return edge.getViterbiPath().getAlignable(ratio)
+            return edge.getViterbiPath(band=self.band).getAlignable(ratio)
         edge.getaln = _getaln
         return edge
 
 
 class EdgeSumAndAlignDefnWithBins(CalculationDefn):
     name = 'pair'
+    band = None
     def calc(self, pog1, pog2, length1, length2, switch, bprobs, *bin_data):
         edge = Edge(pog1, pog2, length1+length2, bin_data, switch, bprobs)
         def _getaln():
             ratio = length1/(length1+length2)
-            (vtScore, result) = edge.getViterbiScoreAndAlignable(ratio)
-            return result
+            return edge.getViterbiPath(band=self.band).getAlignable(ratio)
         edge.getaln = _getaln
         return edge
 
-def _recursive_defns(edge, subst, leaf, edge_defn_constructor, bin_args):
+def _recursive_defns(edge, subst, leaf, edge_defn_constructor, bin_args,
+        band=None):
     """A defn which calculates a fwd score with an .edge
     attribute which can provide a viterbi alignment which can be
     provided to a similar defn"""
@@ -123,7 +125,7 @@ def _recursive_defns(edge, subst, leaf, edge_defn_constructor, bin_args):
             args.append(leaf.selectFromDimension('edge', child.Name))
         else:
             (child_defn, scores2) = _recursive_defns(
-                    child, subst, leaf, edge_defn_constructor, bin_args)
+                    child, subst, leaf, edge_defn_constructor, bin_args, band)
             child_defn = ViterbiPogDefn(child_defn)
             scores.extend(scores2)
             args.append(child_defn)
@@ -133,13 +135,15 @@ def _recursive_defns(edge, subst, leaf, edge_defn_constructor, bin_args):
     args.extend(child_lengths)
     args.extend(bin_args)
     edge_defn = edge_defn_constructor(*args)
+    edge_defn.band = band
     #fwd = FwdDefn(edge_defn)
     #scores.append(fwd)
     return (edge_defn, scores)
 
 def makeForwardTreeDefn(subst_model, tree, bin_names,
-        with_indel_params=True, kn=True):
-    """Pairwise Fwd"""
+        with_indel_params=True, kn=True, band=None):
+    """Pairwise Fwd.  'band' is passed on to the Viterbi alignment at
+    each node, see DPFlags"""
     indel = makeIndelModelDefn(with_indel_params, kn)
     subst = subst_model.makeFundamentalParamControllerDefns(bin_names)
     leaf = NonParamDefn('leaf', dimensions=('edge',))
@@ -161,7 +165,7 @@ def makeForwardTreeDefn(subst_model, tree, bin_names,
     edge_args.extend(bin_data)
     
     (top, scores) = _recursive_defns(tree, subst, leaf, edge_defn_constructor,
-        edge_args)
+        edge_args, band)
     defn = FwdDefn(top)
     #defn = SumDefn(*scores)
     return AnnotateFloatDefn(defn, top)
@@ -7,6 +7,12 @@ produced by the same code."""
 # Should probably set to about half of physical memory / PointerEncoder.bytes
 HIRSCHBERG_LIMIT = 10**8
 
+# Starting half-width of the band used by banded alignment when none is
+# specified.  Quadrupled whenever a path leaving the band could score better
+# than the best path within it.
+BAND_WIDTH = 32
+
+import bisect
 import numpy
 
 # setting global state on module load is bad practice and can be ineffective,
@@ -172,6 +178,109 @@ def py_calc_rows(plan, x_index, y_index, i_low, i_high, j_low, j_high,
         best_score = numpy.log(best_score)
     return best + (best_score,)
 
+def seed_anchors(seq1, seq2, k, word_length=1):
+    """Colinear chain of (i, j) positions of k-mers which occur exactly once
+    in each sequence, maximising the number of such seeds.  Positions are
+    in motifs of word_length characters."""
+    def _unique_words(seq):
+        n = len(seq) // word_length - k + 1
+        positions = {}
+        for p in range(max(n, 0)):
+            word = seq[p*word_length:(p+k)*word_length]
+            positions[word] = None if word in positions else p
+        return positions
+    words2 = _unique_words(seq2)
+    matches = []
+    for (word, i) in _unique_words(seq1).items():
+        j = words2.get(word, None)
+        if i is not None and j is not None:
+            matches.append((i, j))
+    matches.sort()
+    # longest increasing subsequence of j, by patience sorting
+    tails = []
+    tail_indices = []
+    back = []
+    for (m, (i, j)) in enumerate(matches):
+        t = bisect.bisect_left(tails, j)
+        back.append(tail_indices[t-1] if t else None)
+        if t == len(tails):
+            tails.append(j)
+            tail_indices.append(m)
+        else:
+            tails[t] = j
+            tail_indices[t] = m
+    chain = []
+    m = tail_indices[-1] if tail_indices else None
+    while m is not None:
+        chain.append(matches[m])
+        m = back[m]
+    chain.reverse()
+    return chain
+
+def band_limits(centres, width, N):
+    """Per row [low, high) column limits of a band of half-width 'width'
+    around 'centres', the column at the middle of the band for each row.
+    Consecutive rows are made to overlap so that the band stays connected
+    from (0, 0) to the last row and column."""
+    low = numpy.floor(centres - width).astype(int)
+    high = numpy.ceil(centres + width).astype(int) + 1
+    low = numpy.clip(low, 0, N-2)
+    high = numpy.clip(high, 1, N-1)
+    low[0] = 0
+    high[-1] = N-1
+    high = numpy.maximum.accumulate(high)
+    low[1:] = numpy.minimum(low[1:], high[:-1])
+    return (low, high)
+
+class BandedViterbiTrack(object):
+    """Log Viterbi scores for only the cells inside a band.  Indexed like
+    a full [row, column, state] track array it gives traceback pointers,
+    worked out from the scores of each cell's sources the same way that
+    calcRows does."""
+    
+    def __init__(self, pair, low, high, T, state_directions, encoding):
+        self.pair = pair
+        self.low = low
+        self.high = high
+        self.T = T
+        self.encoding = encoding
+        self.shape = tuple(pair.size) + (len(T),)
+        self.data = numpy.empty([self.shape[0], max(high - low), len(T)])
+        self.data[:] = -numpy.inf
+        self.directions = dict((state, (dx, dy))
+                for (state, bin, dx, dy) in state_directions)
+        self.directions[len(T)-1] = (1, 1)  # END
+    
+    def setRow(self, i, row):
+        self.data[i, :self.high[i]-self.low[i]] = row[self.low[i]:self.high[i]]
+    
+    def _score(self, i, j, state):
+        if state == 0:
+            return [-numpy.inf, 0.0][i == j == 0]
+        k = j - self.low[i]
+        if 0 <= k < self.high[i] - self.low[i]:
+            return self.data[i, k, state]
+        return -numpy.inf
+    
+    def __getitem__(self, index):
+        (i, j, state) = index
+        if state == 0:
+            return 0  # BEGIN has no source, as in an unwritten track cell
+        (dx, dy) = self.directions[state]
+        (best, pointer) = (-numpy.inf, (0, 0, len(self.T)))  # ERROR
+        i_sources = [[i], self.pair.children[0][i]][dx]
+        j_sources = [[j], self.pair.children[1][j]][dy]
+        for (a, prev_i) in enumerate(i_sources):
+            for (b, prev_j) in enumerate(j_sources):
+                for prev_state in range(prev_j > 0, len(self.T)):
+                    score = self._score(prev_i, prev_j, prev_state) + \
+                            self.T[prev_state, state]
+                    if score > best:
+                        best = score
+                        pointer = (a+dx, b+dy, prev_state)
+        return self.encoding.encode(*pointer)
+    
+
 class TrackBack(object):
     def __init__(self, tlist):
         self.tlist = tlist
@@ -327,6 +436,62 @@ class Pair(object):
             exponents = None
         return (mantissas, exponents)
     
+    def getBandCentres(self):
+        """Column at the middle of the band for each row but the last.
+        Follows a chain of shared k-mer seeds if both alignables are plain
+        sequences, otherwise the diagonal."""
+        (M, N) = self.size
+        anchors = []
+        seqs = [getattr(child, 'seq', None) for child in self.children]
+        if self.both_seqs and None not in seqs:
+            # long enough to be mostly unique in random sequence
+            k = int(numpy.ceil(numpy.log(4.0 * max(M, N)) /
+                    numpy.log(max(len(self.alphabet), 2))))
+            word_length = self.alphabet.getMotifLen()
+            seqs = [str(seq) for seq in seqs]
+            anchors = [(i+1, j+1) for (i, j) in
+                    seed_anchors(seqs[0], seqs[1], k, word_length)]
+        (xs, ys) = zip(*([(0, 0)] + anchors + [(M-2, N-2)]))
+        return numpy.interp(numpy.arange(M-1), xs, ys)
+    
+    def calcBandedRows(self, i_low, i_high, low, high, state_directions,
+            T, scores, rows, track, valid, **kw):
+        """calcRows one row at a time, row i only for columns low[i] to
+        high[i], copying each row of scores into 'track' if it isn't None.
+        Score cells outside the band which may be read are set to
+        impossible first.  'valid' maps score array rows to the range of
+        columns which currently hold real or impossible scores, and should
+        be shared between calls for the same DP."""
+        (mantissas, exponents) = rows
+        impossible = [0.0, -numpy.inf][bool(kw['use_logs'])]
+        # leftmost predecessor of each column
+        first_pred = numpy.array([min(pred or [j])
+                for (j, pred) in enumerate(self.children[1])])
+        
+        def _clear(r, a, b):
+            if a < b:
+                mantissas[r, a:b] = impossible
+                if exponents is not None:
+                    exponents[r, a:b] = -10000
+        
+        for i in range(i_low, i_high):
+            (lo, hi) = (low[i], high[i])
+            need_lo = min(first_pred[lo:hi].min(), lo)
+            for prev_i in self.children[0][i]:
+                r = self.plan[prev_i]
+                (vlo, vhi) = valid[r]
+                _clear(r, need_lo, min(vlo, hi))
+                _clear(r, max(vhi, need_lo), hi)
+                valid[r] = (min(vlo, need_lo), max(vhi, hi))
+            r = self.plan[i]
+            _clear(r, need_lo, lo)
+            valid[r] = (need_lo, hi)
+            result = self.calcRows(i, i+1, lo, hi, state_directions, T,
+                    scores, rows, None, None, **kw)
+            if track is not None:
+                track.setRow(i, mantissas[r])
+        return result
+    
     def calcRows(self, i_low, i_high, j_low, j_high, state_directions,
             T, scores, rows, track, track_encoding, viterbi, **kw):
         (match_scores, (xscores, yscores)) = scores
@@ -715,6 +880,10 @@ class PairEmissionProbs(object):
         backward - run algorithm in reverse order.
         """
         (state_directions, T) = TM
+        if dp_options.band is not None and dp_options.use_logs and (
+                cells is None and not dp_options.local and
+                not (backward or dp_options.backward)):
+            return self.bandedViterbi(TM, dp_options)
         if dp_options.viterbi and cells is None:
             encoder = self.pair.getPointerEncoding(len(T))
             problem_dimensions = self.pair.size + [len(T)]
@@ -788,6 +957,121 @@ class PairEmissionProbs(object):
                 result = (score, tb)
         return result
     
+    def bandedViterbi(self, TM, dp_options):
+        """Global Viterbi score and traceback computed only for the cells
+        within a band, using logs.  The band is widened and the DP repeated
+        while some path leaving the band might score better than the best
+        path within it, so the result is the same as from the full DP, which
+        is used instead once the band would cover half of the cells.  That
+        happens sooner the longer and more divergent the sequences are."""
+        (state_directions, T) = TM
+        pair = self.pair
+        (M, N) = pair.size
+        encoder = pair.getPointerEncoding(len(T))
+        kw = dict(use_scaling=False, use_logs=True, viterbi=True)
+        T = numpy.log(T)
+        scores = self._getEmissionProbs(
+                dp_options.use_logs, dp_options.use_cost_function)
+        end_state_only = numpy.array([(len(T)-1, 0, 1, 1)])
+        width = dp_options.band
+        if width is True:
+            width = BAND_WIDTH
+        centres = pair.getBandCentres()
+        while True:
+            (low, high) = band_limits(centres, width, N)
+            if 2 * (high - low).sum() >= (M-1) * (N-1):
+                # not worth banding, the full DP is faster
+                full_options = DPFlags(viterbi=True, use_logs=True,
+                        use_cost_function=dp_options.use_cost_function)
+                return self.dp(TM, full_options)
+            low = numpy.append(low, N-1)
+            high = numpy.append(high, N)
+            track = BandedViterbiTrack(pair, low, high, T,
+                    state_directions, encoder)
+            memory = track.data.size * track.data.itemsize / 10**6
+            if memory > 500:
+                warnings.warn('Banded dp will use > %sMb.' % memory)
+            rows = pair.getEmptyScoreArrays(len(T), dp_options)
+            valid = {}
+            pair.calcBandedRows(0, M-1, low, high, state_directions, T,
+                    scores, rows, track, valid, **kw)
+            (maxpos, state, score) = pair.calcBandedRows(M-1, M, low, high,
+                    end_state_only, T, scores, rows, None, valid, **kw)
+            tb = pair.traceback(track, encoder, maxpos, state,
+                    skip_last=True)
+            complete = (low[:-1] == 0).all() and (high[:-1] == N-1).all()
+            if complete or not self._mayLeaveBand(track, low, high, T,
+                    state_directions, scores, score):
+                return (score, tb)
+            width *= 4
+    
+    def _mayLeaveBand(self, track, low, high, T, state_directions, scores,
+            score):
+        """Could a path which leaves the band score better than 'score'?
+        Such a path first leaves from a cell in the band with a successor
+        outside it.  Its score is at most the banded Viterbi score of that
+        cell plus an optimistic bound on the rest of the path: for each row
+        and column still to come, the best score of any step which could
+        consume it, a match step counting half to its row and half to its
+        column."""
+        pair = self.pair
+        (M, N) = pair.size
+        (match_scores, (xscores, yscores)) = scores
+        # best transition into each state, and out to END
+        into = T[:-1].max(axis=0)
+        to_end = T[:-1, -1].max()
+        row_best = numpy.empty([M]); row_best[:] = -numpy.inf
+        col_best = numpy.empty([N]); col_best[:] = -numpy.inf
+        x_index = numpy.asarray(pair.x_index)
+        y_index = numpy.asarray(pair.y_index)
+        for (state, bin, dx, dy) in state_directions:
+            if dx and dy:
+                m = match_scores[bin, :, 1:-1].max(axis=1)[x_index] / 2
+                row_best = numpy.maximum(row_best, m + into[state] / 2)
+                m = match_scores[bin, 1:-1, :].max(axis=0)[y_index] / 2
+                col_best = numpy.maximum(col_best, m + into[state] / 2)
+            elif dx:
+                row_best = numpy.maximum(row_best,
+                        xscores[bin][x_index] + into[state])
+            elif dy:
+                col_best = numpy.maximum(col_best,
+                        yscores[bin][y_index] + into[state])
+        if not pair.both_seqs:
+            # positions of a POG can be skipped
+            row_best = numpy.maximum(row_best, 0.0)
+            col_best = numpy.maximum(col_best, 0.0)
+        # bound on the rest of a path from each row and column, excluding
+        # BEGIN and END
+        row_rest = numpy.zeros([M])
+        row_rest[:M-2] = row_best[M-2:0:-1].cumsum()[::-1]
+        col_rest = numpy.zeros([N])
+        col_rest[:N-2] = col_best[N-2:0:-1].cumsum()[::-1]
+        
+        # the furthest rows and columns each can step to
+        last_row = numpy.arange(M)
+        for i in range(M-1):
+            for p in pair.children[0][i]:
+                last_row[p] = max(last_row[p], i)
+        last_col = numpy.arange(N)
+        for j in range(N-1):
+            for p in pair.children[1][j]:
+                last_col[p] = max(last_col[p], j)
+        
+        for i in range(M-1):
+            (lo, hi) = (low[i], high[i])
+            left = low[i:last_row[i]+1].max()
+            right = high[i:last_row[i]+1].min()
+            cols = numpy.arange(lo, hi)
+            leaving = (cols < left) | (last_col[lo:hi] >= right)
+            if not leaving.any():
+                continue
+            cell_scores = track.data[i, :hi-lo, :-1][leaving].max(axis=1)
+            bound = cell_scores + col_rest[cols[leaving]] + row_rest[i] + \
+                    to_end
+            if bound.max() > score:
+                return True
+        return False
+    
     def getAlignable(self, aligned_positions, ratio=None):
         assert ratio is None, "already 2-branched"
         children = self.pair.children # alignables
@@ -859,7 +1143,8 @@ class ReversiblePairEmissionProbs(object):
 
 class DPFlags(object):
     def __init__(self, viterbi, local=False, use_logs=None,
-            use_cost_function=True, use_scaling=None, backward=False):
+            use_cost_function=True, use_scaling=None, backward=False,
+            band=None):
         if use_logs is None:
             use_logs = viterbi and not use_scaling
         if use_scaling is None:
@@ -873,9 +1158,14 @@ class DPFlags(object):
         self.use_scaling = bool(use_scaling)
         self.viterbi = bool(viterbi)
         self.backward = bool(backward)
+        # None for full DP, True or a half-width for banded Viterbi, which
+        # gives the same result, see PairEmissionProbs.bandedViterbi
+        self.band = band
         self.as_tuple = tuple(n for n in 
                 ['viterbi', 'local', 'use_logs', 'use_cost_function', 'use_scaling', 'backward']
                 if getattr(self, n))
+        if band is not None:
+            self.as_tuple += ('band=%s' % band,)
                 
     def __repr__(self):
         return '%s(%s)' % (type(self).__name__, ', '.join(self.as_tuple))
@@ -4,7 +4,10 @@ from __future__ import with_statement
 from cogent import LoadTree
 from cogent.phylo import nj as NJ
 from cogent.phylo.distance import EstimateDistances
+from cogent.phylo.kmer_distance import kmer_distances
 from cogent.core.info import Info
+from cogent.align import dp_calculation
+from cogent.util import parallel
 from cogent.util import progress_display as UI
 
 __author__ = "Peter Maxwell"
@@ -16,17 +19,63 @@ __maintainer__ = "Peter Maxwell"
 __email__ = "pm67nz@gmail.com"
 __status__ = "Production"
 
+def _align_up_tree(LF, band=None):
+    """Alignment of the sequences of a SequenceLikelihoodFunction by
+    pair-HMM alignment at each node of its tree, from the tips up.
+    
+    Nodes of the same height don't depend on each other, so each such
+    set is aligned with parallel.map, spreading disjoint clades over the
+    available CPUs.  The child alignments come back from the workers as
+    pickled AlignablePOGs."""
+    bin_data = [LF.getParamValue('BinData')]
+    nodes = {}
+    heights = {}
+    alignables = {}
+    for node in LF.tree.postorder():
+        nodes[node.Name] = node
+        if node.istip():
+            heights[node.Name] = 0
+            alignables[node.Name] = LF.getParamValue('leaf', edge=node.Name)
+        else:
+            heights[node.Name] = 1 + max(
+                    heights[child.Name] for child in node.Children)
+    
+    def _viterbi_path(name):
+        children = [child.Name for child in nodes[name].Children]
+        (pog1, pog2) = [alignables[child] for child in children]
+        (length1, length2) = [LF.getParamValue('length', edge=child)
+                for child in children]
+        edge = dp_calculation.Edge(pog1, pog2, length1+length2, bin_data)
+        try:
+            ratio = length1/(length1+length2)
+        except (ZeroDivisionError, FloatingPointError):
+            ratio = 1.
+        return (edge.getViterbiPath(band=band), ratio)
+    
+    def _alignable(name):
+        (vpath, ratio) = _viterbi_path(name)
+        return vpath.getAlignable(ratio)
+    
+    root = LF.tree.Name
+    for height in range(1, heights[root]):
+        names = [name for name in sorted(heights) if heights[name] == height]
+        for (name, alignable) in zip(names,
+                parallel.map(_alignable, names)):
+            alignables[name] = alignable
+    (vpath, ratio) = _viterbi_path(root)
+    return vpath.getAlignment()
+
 @UI.display_wrap
 def TreeAlign(model, seqs, tree=None, indel_rate=0.01, indel_length=0.01,
-    ui = None, ests_from_pairwise=True, param_vals=None):
+    ui = None, ests_from_pairwise=True, param_vals=None, band=None,
+    guide_distances='pairwise'):
     """Returns a multiple alignment and tree.
     
     Uses the provided substitution model and a tree for determining the
     progressive order. If a tree is not provided a Neighbour Joining tree is
     constructed from pairwise distances estimated from pairwise aligning the
-    sequences. If running in parallel, only the distance estimation is
-    parallelised and only the master CPU returns the alignment and tree, other
-    CPU's return None, None.
+    sequences. If running in parallel, the distance estimation is
+    parallelised, as is the alignment of disjoint subtrees of the guide tree.
     
     Arguments:
         - model: a substitution model
@@ -36,6 +85,15 @@ def TreeAlign(model, seqs, tree=None, indel_rate=0.01, indel_length=0.01,
           of the substitution model parameters are used
         - param_vals: named key, value pairs for model parameters. These
           override ests_from_pairwise.
+        - band: if not None, use banded pair-HMM alignment, True for the
+          default starting width or a half-width in positions. The band
+          widens until no better alignment could lie outside it, so the
+          results are those of the full DP. Only faster for closely related
+          sequences.
+        - guide_distances: if no tree provided, 'pairwise' to build it from
+          pair-HMM alignments of every pair of sequences, or 'kmer' to build
+          it from k-mer distances. With 'kmer' only each sequence and its
+          nearest neighbour are aligned for ests_from_pairwise.
     """
     _exclude_params = ['mprobs', 'rate', 'bin_switch']
     if param_vals:
@@ -67,13 +125,21 @@ def TreeAlign(model, seqs, tree=None, indel_rate=0.01, indel_length=0.01,
         else:
             est_params = None
         
-        dcalc = EstimateDistances(seqs, model, do_pair_align=True,
-                                    est_params=est_params)
-        dcalc.run()
-        dists = dcalc.getPairwiseDistances()
+        assert guide_distances in ['pairwise', 'kmer'], guide_distances
+        kmer = guide_distances == 'kmer'
+        if ests_from_pairwise or not kmer:
+            dcalc = EstimateDistances(seqs, model, do_pair_align=True,
+                    est_params=est_params, band=band,
+                    kmer_neighbours=[None, 1][kmer])
+            dcalc.run()
+        if kmer:
+            dists = kmer_distances(seqs, moltype=model.MolType)
+        else:
+            dists = dcalc.getPairwiseDistances()
         tree = NJ.nj(dists)
     
-    LF = model.makeLikelihoodFunction(tree.bifurcating(name_unnamed=True), aligned=False)
+    LF = model.makeLikelihoodFunction(tree.bifurcating(name_unnamed=True),
+            aligned=False, band=band)
     if ests_from_pairwise and not param_vals:
         # we use the Median to avoid the influence of outlier pairs
         param_vals = {}
@@ -90,8 +156,7 @@ def TreeAlign(model, seqs, tree=None, indel_rate=0.01, indel_length=0.01,
         LF.setParamRule('indel_rate', value=indel_rate, is_constant=True)
         LF.setParamRule('indel_length', value=indel_length, is_constant=True)
         LF.setSequences(seqs)
-    edge = LF.getLogLikelihood().edge
-    align = edge.getViterbiPath().getAlignment()
+    align = _align_up_tree(LF, band=band)
     info = Info()
     info["AlignParams"] = param_vals
     info["AlignParams"].update(dict(indel_length=indel_length, indel_rate=indel_rate))
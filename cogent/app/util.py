@@ -1,6 +1,10 @@
 #!/usr/bin/env python
-from sys import platform
+from sys import platform, exc_info
 from os import remove,system,mkdir,getcwd,close,sep
+from subprocess import Popen, PIPE
+from tempfile import TemporaryFile
+from Queue import Queue
+import threading
 from random import choice
 from os.path import isabs, exists
 from numpy import zeros, array, nonzero, max
@@ -30,6 +34,12 @@ class ApplicationError(OSError):
    
 class ApplicationNotFoundError(ApplicationError):
     pass
+
+class ApplicationTimeoutError(ApplicationError):
+    pass
+
+class ApplicationCancelledError(ApplicationError):
+    pass
    
 class ResultPath(object):
     """ Hold a file path a boolean value specifying whether file was written
@@ -745,3 +755,289 @@ def guess_input_handler(seqs, add_seq_names=False):
     return '_input_as_lines'
 
 
+
+def split_seqs(seqs, chunk_size):
+    """Returns list of FASTA strings of up to chunk_size sequences each.
+
+    seqs: SequenceCollection, dict of {name:seq} or list of (name, seq).
+    """
+    if hasattr(seqs, 'NamedSeqs'):
+        pairs = [(name, seqs.NamedSeqs[name]) for name in seqs.Names]
+    elif hasattr(seqs, 'items'):
+        pairs = seqs.items()
+    else:
+        pairs = list(seqs)
+    return ['\n'.join(['>%s\n%s' % (name, seq) for name, seq in 
+        pairs[i:i+chunk_size]]) for i in range(0, len(pairs), chunk_size)]
+
+#input handlers set app._input_filename, so apps are shared between
+#threads by writing inputs one at a time
+_input_lock = threading.Lock()
+
+class ApplicationJob(object):
+    """A run of a CommandLineApplication on data in a subprocess.
+
+    The application's stdout is piped to parser, if given, and otherwise 
+    read into a string; its stderr is kept for error messages. Generators
+    returned by parser are read into lists.
+    
+    Unlike CommandLineApplication.__call__, result files from 
+    _get_result_paths are not opened: apps should write to stdout, or to 
+    files named from data rather than from Parameters.
+    """
+    def __init__(self, app, data=None, parser=None, timeout=None,
+        InputHandler=None):
+        """Initialize the ApplicationJob object.
+
+            app: the CommandLineApplication to run.
+            data: passed to app's input handler, as for __call__.
+            parser: f(stdout) -> result; default returns stdout as a string.
+            timeout: seconds after which the application is killed 
+                (default: no limit).
+            InputHandler: name of the input handler to use instead of
+                app.InputHandler.
+        """
+        self.App = app
+        self.Data = data
+        self.Parser = parser
+        self.Timeout = timeout
+        self.InputHandler = InputHandler or app.InputHandler
+        self.Command = None
+        self.ExitStatus = None
+        self._process = None
+        self._result = None
+        self._error = None
+        self._cancelled = False
+        self._timed_out = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def run(self):
+        """Runs the application, keeping its result or error."""
+        if self._done.isSet():  #cancelled before starting
+            return
+        try:
+            self._result = self._run()
+        except Exception:
+            self._error = exc_info()
+        self._done.set()
+
+    def _run(self):
+        app = self.App
+        _input_lock.acquire()
+        try:
+            input_filename = None
+            if self.Data is None:
+                input_arg = ''
+            else:
+                app._input_filename = None
+                input_arg = getattr(app, self.InputHandler)(self.Data)
+                input_filename = app._input_filename
+                app._input_filename = None
+        finally:
+            _input_lock.release()
+        command = self.Command = app._command_delimiter.join(filter(None, 
+            [app.BaseCommand, str(input_arg)]))
+        errfile = TemporaryFile()
+        try:
+            if app.HaltExec: 
+                raise AssertionError, "Halted exec with command:\n" + command
+            self._lock.acquire()
+            try:
+                if self._cancelled:
+                    raise ApplicationCancelledError, command
+                preexec_fn = None
+                if platform != 'win32':
+                    #own process group, so the shell and its children are
+                    #killed together
+                    from os import setsid as preexec_fn
+                self._process = process = Popen(command, shell=True, 
+                    stdout=PIPE, stderr=errfile, 
+                    close_fds=platform != 'win32', preexec_fn=preexec_fn)
+            finally:
+                self._lock.release()
+            timer = None
+            if self.Timeout is not None:
+                timer = threading.Timer(self.Timeout, self._expire)
+                timer.start()
+            try:
+                try:
+                    if self.Parser is None:
+                        result = process.stdout.read()
+                    else:
+                        result = self.Parser(process.stdout)
+                        if hasattr(result, 'next'):
+                            result = list(result)
+                        #let the application finish writing
+                        process.stdout.read()
+                except Exception:
+                    if not (self._cancelled or self._timed_out):
+                        self._kill()
+                        process.wait()
+                        raise
+                exit_status = self.ExitStatus = process.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                process.stdout.close()
+            if self._cancelled:
+                raise ApplicationCancelledError, command
+            if self._timed_out:
+                raise ApplicationTimeoutError, \
+                    'Application killed after %s seconds\nCommand:\n%s' % \
+                    (self.Timeout, command)
+            if not app._accept_exit_status(exit_status):
+                errfile.seek(0)
+                raise ApplicationError, \
+                 'Unacceptable application exit status: %s\n' % exit_status+\
+                 'Command:\n%s\nStdErr:\n%s\n' % (command, errfile.read())
+            return result
+        finally:
+            errfile.close()
+            if input_filename:
+                remove(input_filename)
+
+    def _kill(self):
+        try:
+            if platform == 'win32':
+                self._process.kill()
+            else:
+                from os import killpg
+                from signal import SIGKILL
+                killpg(self._process.pid, SIGKILL)
+        except OSError:     #already finished
+            pass
+
+    def _expire(self):
+        self._lock.acquire()
+        try:
+            if not self._done.isSet():
+                self._timed_out = True
+                self._kill()
+        finally:
+            self._lock.release()
+
+    def cancel(self):
+        """Stops the job, killing the application if running.
+        
+        Returns False if the job had already finished.
+        """
+        self._lock.acquire()
+        try:
+            if self._done.isSet():
+                return False
+            self._cancelled = True
+            if self._process is not None:
+                self._kill()
+            else:
+                try:
+                    raise ApplicationCancelledError, "Cancelled before start"
+                except ApplicationCancelledError:
+                    self._error = exc_info()
+                self._done.set()
+            return True
+        finally:
+            self._lock.release()
+
+    def done(self):
+        """Returns True if the job has finished, failed or been cancelled."""
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """Returns the parsed output, waiting up to timeout seconds.
+
+        Raises the job's error if it failed, ApplicationCancelledError if 
+        it was cancelled and ApplicationTimeoutError if it ran too long.
+        """
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise ApplicationTimeoutError, \
+                'Job not finished after %s seconds' % timeout
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+class ApplicationPool(object):
+    """Runs CommandLineApplication jobs concurrently, in subprocesses.
+
+    Up to MaxWorkers applications run at once; jobs are started in the 
+    order submitted. Use as a context manager, or call shutdown() when done.
+    """
+    def __init__(self, max_workers=2, timeout=None):
+        """Initialize the ApplicationPool object.
+
+            max_workers: number of applications to run at once.
+            timeout: default seconds after which jobs are killed.
+        """
+        self.MaxWorkers = max_workers
+        self.Timeout = timeout
+        self._queue = Queue()
+        self._threads = []
+        self._jobs = []
+
+    def submit(self, app, data=None, parser=None, timeout=None,
+        InputHandler=None):
+        """Queues a run of app on data; returns its ApplicationJob.
+        
+        Arguments are as for ApplicationJob; timeout defaults to the pool's.
+        """
+        if timeout is None:
+            timeout = self.Timeout
+        job = ApplicationJob(app, data, parser, timeout, InputHandler)
+        self._jobs = [j for j in self._jobs if not j.done()] + [job]
+        self._queue.put(job)
+        if len(self._threads) < self.MaxWorkers:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return job
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def map(self, app, data, parser=None, timeout=None, InputHandler=None):
+        """Returns list of results of running app on each item in data.
+
+        If any job fails, the rest are cancelled and its error is raised.
+        """
+        jobs = [self.submit(app, d, parser, timeout, InputHandler) 
+            for d in data]
+        try:
+            return [job.result() for job in jobs]
+        except:
+            for job in jobs:
+                job.cancel()
+            raise
+
+    def mapSeqs(self, app, seqs, chunk_size=1000, parser=None, 
+        timeout=None):
+        """Returns list of results of running app on chunks of seqs.
+
+        seqs: SequenceCollection, dict or list of (name, seq) pairs, passed 
+            to app chunk_size at a time as FASTA files.
+        """
+        return self.map(app, split_seqs(seqs, chunk_size), parser, timeout,
+            InputHandler='_input_as_multiline_string')
+
+    def shutdown(self, cancel=False):
+        """Waits for the workers to finish, first cancelling jobs if cancel."""
+        if cancel:
+            for job in self._jobs:
+                job.cancel()
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._jobs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(cancel=exc_type is not None)
@@ -8,9 +8,17 @@ to the array as input. Can also generate this type of input from a Dict2D using
 inputs_from_dict2D function.
 
 Both return a PhyloNode object of the UPGMA cluster
+
+cluster takes either of these, or a condensed (upper triangle) distance array,
+and clusters with a nearest-neighbour chain in O(n^2) time and memory, using
+UPGMA, WPGMA, single or complete linkage. upgma and UPGMA_cluster use it with
+WPGMA: they have always averaged the rows of the two joined clusters without
+weighting by cluster size.
 """
 
-from numpy import array, ravel, argmin, take, sum, average, ma, diag
+from numpy import array, ravel, argmin, take, sum, average, ma, diag, \
+    asarray, arange, empty, ones, inf, minimum, maximum
+from itertools import chain, imap
 from cogent.core.tree import PhyloNode
 from cogent.util.dict2d import Dict2D
 
@@ -34,28 +42,7 @@ def upgma(pairwise_distances):
     pairwise_distances: a dictionary with pair tuples mapped to a distance
     returns a PhyloNode object of the UPGMA cluster
     """
-    items_in_matrix = []
-    for i in pairwise_distances:
-        if i[0] not in items_in_matrix:
-            items_in_matrix.append(i[0])
-        if i[1] not in items_in_matrix:
-            items_in_matrix.append(i[1])
-    dict2d_input = [(i[0], i[1], pairwise_distances[i]) for i in \
-            pairwise_distances]
-    dict2d_input.extend([(i[1], i[0], pairwise_distances[i]) for i in \
-            pairwise_distances])
-    dict2d_input = Dict2D(dict2d_input, RowOrder=items_in_matrix, \
-            ColOrder=items_in_matrix, Pad=True, Default=BIG_NUM)
-    matrix_a, node_order = inputs_from_dict2D(dict2d_input)
-    tree = UPGMA_cluster(matrix_a, node_order, BIG_NUM)
-    index = 0
-    for node in tree.traverse():
-        if not node.Parent:
-            node.Name = 'root'
-        elif not node.Name:
-            node.Name = 'edge.' + str(index)
-            index += 1
-    return tree
+    return cluster(pairwise_distances, method='wpgma')
 
 def find_smallest_index(matrix):
     """returns the index of the smallest element in a numpy array
@@ -136,27 +123,12 @@ def UPGMA_cluster(matrix, node_order, large_number):
     
     matrix is a numpy array.
     node_order is a list of PhyloNode objects corresponding to the matrix.
-    large_number will be assigned to the matrix during the process and
-    should be much larger than any value already in the matrix.
-    
-    WARNING: Changes matrix in-place.
-    WARNING: Expects matrix to already have diagonals assigned to large_number
-             before this function is called.
+    large_number is kept for compatibility: the diagonal of matrix is 
+    ignored, so it need not be assigned before this function is called.
     """
-    num_entries = len(node_order)
-    tree = None
-    for i in range(num_entries - 1):
-        smallest_index = find_smallest_index(matrix)
-        index1, index2 = smallest_index
-        #if smallest_index is on the diagonal set the diagonal to large_number
-        if index1 == index2:
-            matrix[diag([True]*len(matrix))] = large_number
-            smallest_index = find_smallest_index(matrix)
-        row_order = condense_node_order(matrix, smallest_index, \
-                node_order)
-        matrix = condense_matrix(matrix, smallest_index, large_number)
-        tree = node_order[smallest_index[0]]
-    return tree
+    merges = nn_chain_linkage(condensed_from_square(matrix), 
+        len(node_order), 'wpgma')
+    return tree_from_merges(merges, list(node_order))
 
 def inputs_from_dict2D(dict2d_matrix):
     """makes inputs for UPGMA_cluster from a Dict2D object
@@ -175,3 +147,163 @@ def inputs_from_dict2D(dict2d_matrix):
     for i in row_order:
         PhyloNode_order.append(PhyloNode(Name=i))
     return matrix, PhyloNode_order
+
+def _lance_williams_upgma(d_i, d_j, size_i, size_j):
+    return (size_i*d_i + size_j*d_j)/(size_i + size_j)
+
+def _lance_williams_wpgma(d_i, d_j, size_i, size_j):
+    return (d_i + d_j)/2.0
+
+def _lance_williams_single(d_i, d_j, size_i, size_j):
+    return minimum(d_i, d_j)
+
+def _lance_williams_complete(d_i, d_j, size_i, size_j):
+    return maximum(d_i, d_j)
+
+#f(distances to i, distances to j, size of i, size of j) -> distances to i+j
+LINKAGES = {
+    'upgma': _lance_williams_upgma,
+    'wpgma': _lance_williams_wpgma,
+    'single': _lance_williams_single,
+    'complete': _lance_williams_complete,
+}
+
+def condensed_index(n, i, j):
+    """Returns index of item i,j (i < j) in a condensed n x n matrix."""
+    return n*i - i*(i+1)//2 + j - i - 1
+
+def condensed_from_square(matrix):
+    """Returns upper triangle of square matrix, row by row, as a 1D array."""
+    matrix = asarray(matrix)
+    n = len(matrix)
+    result = empty(n*(n-1)//2, matrix.dtype)
+    for i in range(n-1):
+        start = condensed_index(n, i, i+1)
+        result[start:start+n-i-1] = matrix[i, i+1:]
+    return result
+
+def _distance_row(distances, n, i):
+    """Returns distances from i to every item in a condensed matrix."""
+    row = empty(n, distances.dtype)
+    row[:i] = distances[condensed_index(n, arange(i), i)]
+    row[i] = inf
+    if i < n-1:
+        start = condensed_index(n, i, i+1)
+        row[i+1:] = distances[start:start+n-i-1]
+    return row
+
+def _set_distance_row(distances, n, i, row):
+    """Sets distances from i to every other item in a condensed matrix."""
+    distances[condensed_index(n, arange(i), i)] = row[:i]
+    if i < n-1:
+        start = condensed_index(n, i, i+1)
+        distances[start:start+n-i-1] = row[i+1:]
+
+def nn_chain_linkage(distances, n, method='upgma'):
+    """Returns list of (i, j, distance) joins from a nearest-neighbour chain.
+
+    distances: condensed distance matrix of n items (see condensed_index).
+    method: key of LINKAGES.
+
+    Each join puts clusters i < j together in position i. Joins are listed
+    in the order the chain finds them, which need not be by distance.
+    WARNING: Changes distances in-place.
+    """
+    update_f = LINKAGES[method]
+    sizes = ones(n)
+    active = ones(n, bool)
+    chain = []
+    merges = []
+    for remaining in range(n-1):
+        if not chain:
+            chain.append(active.argmax())
+        while True:
+            a = chain[-1]
+            row = _distance_row(distances, n, a)
+            row[~active] = inf
+            b = row.argmin()
+            #on ties go back down the chain, so that it cannot cycle
+            if len(chain) > 1 and row[chain[-2]] <= row[b]:
+                break
+            chain.append(b)
+        b = chain.pop(-2)
+        chain.pop()
+        i, j = min(a, b), max(a, b)
+        distance = row[b]
+        row_i = _distance_row(distances, n, i)
+        row_j = _distance_row(distances, n, j)
+        active[j] = False
+        _set_distance_row(distances, n, i, 
+            update_f(row_i, row_j, sizes[i], sizes[j]))
+        sizes[i] += sizes[j]
+        merges.append((i, j, distance))
+    return merges
+
+def tree_from_merges(merges, nodes):
+    """Returns root PhyloNode joining nodes as listed in merges.
+
+    merges: (i, j, distance) joins, e.g. from nn_chain_linkage.
+    nodes: list of PhyloNode objects, one per item; changed in place.
+    Each join is placed at half its distance above the tips.
+    """
+    heights = [0.0]*len(nodes)
+    for i, j, distance in merges:
+        height = distance/2.0
+        parent = PhyloNode()
+        for index in i, j:
+            nodes[index].Length = height - heights[index]
+            parent.append(nodes[index])
+        nodes[i], nodes[j] = parent, None
+        heights[i] = height
+    return nodes[0]
+
+def cluster(distances, names=None, method='upgma'):
+    """Returns PhyloNode tree clustering items by their distances.
+
+    distances: a dictionary with pair tuples mapped to a distance, a square
+    array, or a condensed array as from condensed_from_square.
+    names: names of the items, in array order (default: their indices);
+    ignored for a dictionary.
+    method: 'upgma' (average linkage), 'wpgma', 'single' or 'complete'.
+
+    Internal nodes are named as by upgma. Missing pairs of a dictionary are
+    given a very large distance (BIG_NUM).
+    """
+    if isinstance(distances, dict):
+        pair_names = list(chain.from_iterable(distances))
+        names = []
+        positions = {}
+        for name in pair_names:
+            if name not in positions:
+                positions[name] = len(names)
+                names.append(name)
+        n = len(names)
+        indices = numpy.fromiter(imap(positions.__getitem__, pair_names), 
+            int, len(pair_names)).reshape(-1, 2)
+        condensed = empty(n*(n-1)//2, Float)
+        condensed.fill(BIG_NUM)
+        values = array(distances.values(), Float)
+        i, j = indices.min(axis=1), indices.max(axis=1)
+        off_diagonal = i != j
+        i, j = i[off_diagonal], j[off_diagonal]
+        condensed[condensed_index(n, i, j)] = values[off_diagonal]
+    else:
+        distances = asarray(distances)
+        if distances.ndim == 2:
+            condensed = condensed_from_square(distances).astype(Float)
+            n = len(distances)
+        else:
+            condensed = array(distances, Float)
+            n = int(round((1 + (1 + 8*len(condensed))**0.5)/2))
+        if names is None:
+            names = map(str, range(n))
+    merges = nn_chain_linkage(condensed, n, method)
+    tree = tree_from_merges(merges, map(PhyloNode, names))
+    index = 0
+    for node in tree.traverse():
+        if not node.Parent:
+            node.Name = 'root'
+        elif not node.Name:
+            node.Name = 'edge.' + str(index)
+            index += 1
+    return tree
@@ -18,12 +18,18 @@ algorithms to obtain them. The differences in sign do not affect the overall
 results as they are just a different reflection. R's cmdscale documentation
 also confirms the possibility of obtaining different signs between different R
 platforms. Please feel free to send questions to jai.rideout@gmail.com.
+
+For large matrices, truncated_principal_coordinates_analysis finds only the
+leading axes by randomized subspace iteration (Halko, Martinsson & Tropp 2011,
+SIAM Review 53:217), centring the matrix in place if asked, so that it also
+works on a numpy.memmap.
 """
-from numpy import shape, add, sum, sqrt, argsort, transpose, newaxis
-from numpy.linalg import eigh
-from cogent.util.dict2d import Dict2D
+from itertools import chain, imap
+from numpy import shape, add, sum, sqrt, argsort, transpose, newaxis, zeros, \
+    asarray, dot, trace, fromiter
+from numpy.linalg import eigh, qr
+from numpy.random import RandomState, standard_normal
 from cogent.util.table import Table
-from cogent.cluster.UPGMA import inputs_from_dict2D
 
 __author__ = "Catherine Lozupone"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -36,27 +42,36 @@ __maintainer__ = "Catherine Lozupone"
 __email__ = "lozupone@colorado.edu"
 __status__ = "Production"
 
-def PCoA(pairwise_distances):
+def PCoA(pairwise_distances, num_axes=None):
     """runs principle coordinates analysis on a distance matrix
     
     Takes a dictionary with tuple pairs mapped to distances as input. 
     Returns a cogent Table object.
+
+    If num_axes is given, only that many leading axes are computed, using
+    truncated_principal_coordinates_analysis.
     """
+    pair_items = list(chain.from_iterable(pairwise_distances))
     items_in_matrix = []
-    for i in pairwise_distances:
-        if i[0] not in items_in_matrix:
-            items_in_matrix.append(i[0])
-        if i[1] not in items_in_matrix:
-            items_in_matrix.append(i[1])
-    dict2d_input = [(i[0], i[1], pairwise_distances[i]) for i in \
-            pairwise_distances]
-    dict2d_input.extend([(i[1], i[0], pairwise_distances[i]) for i in \
-            pairwise_distances])
-    dict2d_input = Dict2D(dict2d_input, RowOrder=items_in_matrix, \
-            ColOrder=items_in_matrix, Pad=True, Default=0.0)
-    matrix_a, node_order = inputs_from_dict2D(dict2d_input)
-    point_matrix, eigvals = principal_coordinates_analysis(matrix_a)
-    return output_pca(point_matrix, eigvals, items_in_matrix)
+    positions = {}
+    for item in pair_items:
+        if item not in positions:
+            positions[item] = len(items_in_matrix)
+            items_in_matrix.append(item)
+    indices = fromiter(imap(positions.__getitem__, pair_items), int,
+        len(pair_items)).reshape(-1, 2)
+    distances = asarray(pairwise_distances.values(), float)
+    matrix_a = zeros((len(items_in_matrix), len(items_in_matrix)))
+    #both cells of a pair at once, so the last of (a,b) and (b,a) wins
+    matrix_a[indices.ravel(), indices[:,::-1].ravel()] = \
+        distances.repeat(2)
+    if num_axes is None:
+        point_matrix, eigvals = principal_coordinates_analysis(matrix_a)
+        return output_pca(point_matrix, eigvals, items_in_matrix)
+    point_matrix, eigvals, proportions = \
+        truncated_principal_coordinates_analysis(matrix_a, num_axes, 
+            in_place=True)
+    return output_pca(point_matrix, eigvals, items_in_matrix, proportions)
 
 def principal_coordinates_analysis(distance_matrix):
     """Takes a distance matrix and returns principal coordinate results
@@ -134,13 +149,61 @@ def get_principal_coordinates(eigvals, eigvecs):
     #must take the absolute value of the eigvals since they can be negative
     return eigvecs * sqrt(abs(eigvals))[:,newaxis]
 
-def output_pca(PCA_matrix, eigvals, names):
+def truncated_principal_coordinates_analysis(distance_matrix, num_axes=10, 
+    in_place=False, num_iterations=4, oversample=10, seed=None):
+    """Returns leading principal coordinates of a distance matrix.
+
+    distance_matrix: square array, which may be a numpy.memmap.
+    num_axes: number of axes to return.
+    in_place: if True, distance_matrix is overwritten by its F matrix rather
+    than copied.
+    num_iterations: power iterations, each sharpening the separation of
+    the leading axes from the rest.
+    oversample: extra directions searched beyond num_axes.
+    seed: seed for the random start (default: numpy's global state).
+
+    Returns point_matrix (num_axes rows, one per axis, largest eigenvalue
+    first), their eigenvalues, and the proportion of the total variation 
+    (the trace of the F matrix) that each explains.
+
+    Only a num_points x (num_axes + oversample) basis is held besides the
+    matrix itself. Axes with large negative eigenvalues (from non-Euclidean 
+    distances) also compete for the basis, so increase oversample if those
+    are expected.
+    """
+    if in_place:
+        E_matrix = distance_matrix
+        E_matrix *= E_matrix
+        E_matrix /= -2.0
+    else:
+        E_matrix = make_E_matrix(asarray(distance_matrix))
+    F_matrix = make_F_matrix(E_matrix)
+    num_points = len(F_matrix)
+    num_axes = min(num_axes, num_points)
+    basis_size = min(num_axes + oversample, num_points)
+    if seed is None:
+        normal = standard_normal
+    else:
+        normal = RandomState(seed).standard_normal
+    basis = qr(dot(F_matrix, normal((num_points, basis_size))))[0]
+    for i in range(num_iterations):
+        basis = qr(dot(F_matrix, basis))[0]
+    #Rayleigh-Ritz: solve the small problem projected onto the basis
+    eigvals, small_eigvecs = eigh(dot(basis.T, dot(F_matrix, basis)))
+    order = eigvals.argsort()[::-1][:num_axes]
+    eigvals = eigvals[order]
+    eigvecs = dot(basis, small_eigvecs[:,order]).T
+    point_matrix = get_principal_coordinates(eigvals, eigvecs)
+    return point_matrix, eigvals, eigvals/trace(F_matrix)
+
+def output_pca(PCA_matrix, eigvals, names, proportions=None):
     """Creates a string output for principal coordinates analysis results. 
 
     PCA_matrix and eigvals are generated with the get_principal_coordinates 
     function. Names is a list of names that corresponds to the columns in the
     PCA_matrix. It is the order that samples were represented in the initial
-    distance matrix.
+    distance matrix. proportions of the variation explained by each axis
+    default to eigvals / sum(eigvals), which needs every eigenvalue.
     
     returns a cogent Table object"""
     
@@ -166,7 +229,9 @@ def output_pca(PCA_matrix, eigvals, names):
     # make the eigenvalue header line and append to output
     header = ['Label']+vec_num_header
     rows = [['eigenvalues']+[eigvals[vec_i] for vec_i in vector_order]]
-    pcnts = (eigvals/sum(eigvals))*100
+    if proportions is None:
+        proportions = eigvals/sum(eigvals)
+    pcnts = proportions*100
     rows += [['var explained (%)']+[pcnts[vec_i] for vec_i in vector_order]]
     eigenvalues = Table(header=header,rows=rows,digits=2,space=2, 
                     title='Eigenvalues')
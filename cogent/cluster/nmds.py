@@ -4,15 +4,21 @@
 see, for example: Jan de Leeuw 2004 (monotone regression), 
 Rencher 2002: Methods of multivariate analysis, and the original work: 
 Kruskal 1964: Nonmetric multidimensional scaling
+
+Distances and pseudo-distances (dhats) are held as condensed arrays over the
+point pairs i < j, so stress and its gradient are whole-array operations.
 """
 from __future__ import division
 from numpy import array, multiply, sum, zeros, size, shape, diag, dot, mean,\
-    sqrt, transpose, trace, argsort, newaxis, finfo, all
+    sqrt, transpose, trace, argsort, newaxis, finfo, all, asarray, \
+    triu_indices, empty_like, ones, add, concatenate, nonzero, repeat, \
+    bincount, where
 from numpy.random import seed, normal as random_gauss
 from numpy.linalg import norm, svd
-from operator import itemgetter
 import cogent.maths.scipy_optimize as optimize
-from cogent.cluster.metric_scaling import principal_coordinates_analysis
+from cogent.cluster.metric_scaling import \
+    truncated_principal_coordinates_analysis
+from cogent.util import parallel
 
 __author__ = "Justin Kuczynski"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -23,6 +29,42 @@ __maintainer__ = "Justin Kuczynski"
 __email__ = "justinak@gmail.com"
 __status__ = "Development"
 
+#rounds of pooling all adjacent violators at once, before finishing the
+#monotone regression one block at a time
+MAX_POOLING_ROUNDS = 32
+
+def monotone_regression(values):
+    """Returns least squares nondecreasing fit to values, as an array.
+
+    Pool adjacent violators (Jan de Leeuw 2004): neighbouring blocks whose
+    means decrease are averaged together until the block means increase.
+    Up to MAX_POOLING_ROUNDS rounds pool every violating pair at once; any
+    blocks still out of order are then pooled one at a time, which is linear
+    in the number of blocks.
+    """
+    totals = array(values, float)
+    sizes = ones(len(totals), int)
+    means = totals
+    for i in range(MAX_POOLING_ROUNDS):
+        violating = means[:-1] >= means[1:]
+        if not violating.any():
+            return repeat(means, sizes)
+        starts = nonzero(concatenate(([True], ~violating)))[0]
+        totals = add.reduceat(totals, starts)
+        sizes = add.reduceat(sizes, starts)
+        means = totals / sizes
+    blocklist = []
+    for top_total, top_size in zip(totals, sizes):
+        top_mean = top_total / top_size
+        while blocklist and top_mean <= blocklist[-1][0]:
+            (mean, total, size) = blocklist.pop()
+            top_total += total
+            top_size += size
+            top_mean = top_total / top_size
+        blocklist.append((top_mean, top_total, top_size))
+    means, totals, sizes = zip(*blocklist)
+    return repeat(means, sizes)
+
 class NMDS(object):
     """Generates points using nonmetric scaling
     
@@ -97,16 +139,17 @@ class NMDS(object):
         # note that in the rest of the code, only the order matters, the values
         # of the dissimilarity matrix aren't used
         
-        if initial_pts == "random":
+        if not isinstance(initial_pts, str):
+            self.points = initial_pts
+        elif initial_pts == "random":
             self.points = self._get_initial_pts(dimension, point_range)
         elif initial_pts == "pcoa":
-            pcoa_pts, pcoa_eigs = principal_coordinates_analysis(\
-                dissimilarity_mtx)
-            order = argsort(pcoa_eigs)[::-1] # pos to small/neg
-            pcoa_pts = pcoa_pts[order].T
-            self.points = pcoa_pts[:,:dimension]
-        else:
-            self.points = initial_pts
+            # only the leading axes are needed; the fixed seed leaves the
+            # global random state alone
+            pcoa_pts, pcoa_eigs, proportions = \
+                truncated_principal_coordinates_analysis(dissimilarity_mtx,
+                    dimension, seed=0)
+            self.points = pcoa_pts.T
         self.points = self._center(self.points)
         
         self._rescale()
@@ -161,15 +204,21 @@ class NMDS(object):
     def dhats(self):
         """The dhats in order."""
         # Probably not required, but here in case needed for backward
-        # compatibility.  self._dhats is the full 2D array
-        return [self._dhats[i,j] for (i,j) in self.order]
+        # compatibility.  self._dhats is the condensed array
+        return list(self._dhats[self._order])
         
     @property
     def dists(self):
         """The dists in order"""
         # Probably not required, but here in case needed for backward
-        # compatibility.  self._dists is the full 2D array
-        return [self._dists[i,j] for (i,j) in self.order]
+        # compatibility.  self._dists is the condensed array
+        return list(self._dists[self._order])
+
+    @property
+    def order(self):
+        """[i, j] point pairs, in order of increasing dissimilarity"""
+        return [[i, j] for (i, j) in 
+            zip(self._rows[self._order], self._cols[self._order])]
 
     def getPoints(self):
         """Returns (ordered in a list) the n points in k space 
@@ -202,46 +251,31 @@ class NMDS(object):
         return result
     
     def _calc_dissim_order(self, dissim_mtx, point_range):
-        """calculates the order of the dissim_mtx entries, puts in self.order
+        """calculates the order of the dissim_mtx entries, puts in self._order
         
-        First creates a list of dissim elements with structure [i, j, value],
-        then sorts that by value and strips the value subelemnt.
-        i and j correspond to the row and column of the input dissim matrix 
+        self._rows and self._cols hold i < j for each pair, in the order of
+        the condensed arrays; self._order indexes the pairs by increasing
+        dissimilarity, keeping ties in row order.
         """
-        
-        dissim_list = []
-        for i in point_range:
-            for j in point_range:
-                if j > i:
-                    dissim_list.append([i, j, dissim_mtx[i,j]])
-        dissim_list.sort(key = itemgetter(2))
-        for elem in dissim_list:
-            elem.pop()
-        self.order = dissim_list
+        self._rows, self._cols = triu_indices(len(point_range), 1)
+        dissims = asarray(dissim_mtx)[self._rows, self._cols]
+        self._order = dissims.argsort(kind='mergesort')
 
     def _get_initial_pts(self, dimension, pt_range):
         """Generates points randomly with a gaussian distribution (sigma = 1)
         """
-        
-        # nested list comprehension.  Too dense for good readability?
-        points = [[random_gauss(0., 1) for axis in range(dimension)] \
-            for pt_idx in pt_range]
-        return array(points, 'd')
+        return random_gauss(0., 1, (len(pt_range), dimension))
 
     def _calc_distances(self):
         """Update distances between the points"""
-        diffv = self.points[newaxis, :, :] - self.points[:, newaxis, :]
-        squared_dists = (diffv**2).sum(axis=-1)
-        self._dists = sqrt(squared_dists)
-        self._squared_dist_sums = squared_dists.sum(axis=-1)
+        diffv = self.points[self._rows] - self.points[self._cols]
+        self._dists = sqrt((diffv**2).sum(axis=-1))
              
     def _update_dhats(self):
         """Update dhats based on distances"""
-        new_dhats = self._dists.copy()
-        ordered_dhats = [new_dhats[i,j] for (i,j) in self.order]
-        ordered_dhats = self._do_monotone_regression(ordered_dhats)
-        for ((i,j),d) in zip(self.order, ordered_dhats):
-            new_dhats[i,j] = new_dhats[j, i] = d
+        new_dhats = empty_like(self._dists)
+        new_dhats[self._order] = self._do_monotone_regression(
+            self._dists[self._order])
         self._dhats = new_dhats
         
     def _do_monotone_regression(self, dhats):
@@ -249,61 +283,47 @@ class NMDS(object):
         
         Assuming the input dhats are the values of the pairwise point 
         distances, this algorithm minimizes the stress while enforcing
-        monotonicity of the dhats.
-        Jan de Leeuw 2004 (monotone regression) has a rough outline of the
-        algorithm.  Basically, as we proceed along the ordered list, 
-        if an element is smaller than its preceeding one, the two are averaged
-        and grouped together in a block.  The process is repeated until
-        the blocks are monotonic, that is block i <= block i+1.
+        monotonicity of the dhats. See monotone_regression.
         """
-        
-        blocklist = []
-        for top_dhat in dhats:
-            top_total = top_dhat
-            top_size = 1
-            while blocklist and top_dhat <= blocklist[-1][0]:
-                (dhat, total, size) = blocklist.pop()
-                top_total += total
-                top_size += size
-                top_dhat = top_total / top_size
-            blocklist.append((top_dhat, top_total, top_size))
-        result_dhats = []
-        for (val, total, size) in blocklist:
-            result_dhats.extend([val]*size)
-        return result_dhats
+        return monotone_regression(dhats)
         
     def _calc_stress(self):
         """calculates the stress, or badness of fit between the distances and dhats
         Caches some intermediate values for gradient calculations.
         """
-        diffs = (self._dists - self._dhats)
-        diffs **= 2
-        self._squared_diff_sums = diffs.sum(axis=-1)
-        self._total_squared_diff = self._squared_diff_sums.sum() / 2
-        self._total_squared_dist = self._squared_dist_sums.sum() / 2
+        self._total_squared_diff = ((self._dists - self._dhats)**2).sum()
+        self._total_squared_dist = (self._dists**2).sum()
         self.stress = sqrt(self._total_squared_diff/self._total_squared_dist)
+
+    def _stress_gradient(self):
+        """Returns derivatives of stress with respect to self.points
         
-    def _nudged_stress(self, v, d, epsilon):
-        """Calculates the stress with point v moved epsilon in the dth dimension
+        dhats are held fixed. Uses the values cached by _calc_stress.
         """
-        delta_epsilon = zeros([self.dimension], float)
-        delta_epsilon[d] = epsilon
-        moved_point = self.points[v] + delta_epsilon
-        squared_dists = ((moved_point - self.points)**2).sum(axis=-1)
-        squared_dists[v] = 0.0
-        delta_squared_dist = squared_dists.sum() - self._squared_dist_sums[v]
-        diffs = sqrt(squared_dists) - self._dhats[v]
-        diffs **= 2
-        delta_squared_diff = diffs.sum() - self._squared_diff_sums[v]
-        return sqrt(
-            (self._total_squared_diff + delta_squared_diff) /
-            (self._total_squared_dist + delta_squared_dist))
+        gradient = zeros(self.points.shape)
+        squared_diff = self._total_squared_diff
+        squared_dist = self._total_squared_dist
+        if not squared_diff or not squared_dist:
+            return gradient
+        dists = self._dists
+        safe_dists = where(dists > 0, dists, 1)
+        # d stress/d dist for each pair, divided by dist
+        coefficients = self.stress * ((dists - self._dhats) / safe_dists / 
+            squared_diff - 1 / squared_dist)
+        pair_gradients = coefficients[:,newaxis] * \
+            (self.points[self._rows] - self.points[self._cols])
+        num_points = len(self.points)
+        for axis in range(self.dimension):
+            gradient[:,axis] = \
+                bincount(self._rows, pair_gradients[:,axis], num_points) - \
+                bincount(self._cols, pair_gradients[:,axis], num_points)
+        return gradient
 
     def _rescale(self):
         """ assumes centered, rescales to mean ot-origin dist of 1
         """
     
-        factor = array([norm(vec) for vec in self.points]).mean()
+        factor = sqrt((self.points**2).sum(axis=-1)).mean()
         self.points = self.points/factor
 
     def _move_points(self):
@@ -362,15 +382,13 @@ class NMDS(object):
         of steepest descent.  The default parameters are only shown to work on
         a few simple cases, and aren't optimized.
         
-        The gradient is calculated discretely, not via formula.  Each variable
-        (there are n points * k dimensions of variables), is adjusted, 
-        the stress measured, and the variable returned to its prior value.
+        The gradient of stress is calculated analytically, with the dhats
+        held fixed.
         
         If a local minimum is larger than step_size, the algorithm cannot 
         escape.
         """
-        num_rows, num_cols = shape(self.points)
-        avg_point_dist = sum([norm(point) for point in self.points])/num_rows
+        avg_point_dist = sqrt((self.points**2).sum(axis=-1)).mean()
         step_size = avg_point_dist*rel_step_size
 
             
@@ -378,24 +396,13 @@ class NMDS(object):
             
             # initial values
             prestep_stress = self.stress.copy()
-            gradient = zeros((num_rows, num_cols))
-            
-            # get gradient
-            for i in range(num_rows):
-                for j in range(num_cols):
-                    self.points[i,j] += step_size
-                    self._calc_distances()
-                    self._calc_stress()
-                    delta_stress = self.stress - prestep_stress
-                    gradient[i,j] = delta_stress/step_size
-                    self.points[i,j] -= step_size
-            
+            gradient = self._stress_gradient()
             grad_mag = norm(gradient)
+            if not grad_mag:
+                break
             
             # step in the direction of the negative gradient
-            for i in range(num_rows):
-                for j in range(num_cols):
-                    self.points[i,j] -= step_size*gradient[i,j]/grad_mag
+            self.points = self.points - step_size*gradient/grad_mag
             self._calc_distances()
             self._calc_stress()
             newstress = self.stress.copy()
@@ -424,15 +431,9 @@ class NMDS(object):
         return self.stress
     
     def _calc_stress_gradients(self, pts):
-        """Approx first derivatives of stress at pts, for optimisers"""
-        epsilon = sqrt(finfo(float).eps)
-        f0 = self._recalc_stress_from_pts(pts)
-        grad = zeros(pts.shape, float)
-        for k in range(len(pts)):
-            (point, dim) = divmod(k, self.dimension)
-            f1 = self._nudged_stress(point, dim, epsilon)
-            grad[k] = (f1 - f0)/epsilon
-        return grad
+        """First derivatives of stress at pts, for optimisers"""
+        self._recalc_stress_from_pts(pts)
+        return self._stress_gradient().ravel()
 
 
 def metaNMDS(iters, *args, **kwargs):
@@ -441,14 +442,24 @@ def metaNMDS(iters, *args, **kwargs):
     returns NMDS object with lowest stress
     args, kwargs is passed to NMDS(), but must not have initial_pts
     must supply distance matrix
+
+    The runs are shared out with cogent.util.parallel. Random starting points
+    are all drawn first (after seeding with rand_seed, if given), so the
+    result does not depend on the number of CPUs.
     """
-    results = []
-    kwargs['initial_pts'] = "pcoa"
-    res1 = NMDS(*args,**kwargs)
-    results.append(res1)
-    kwargs['initial_pts'] = "random"
-    for i in range(iters):
-        results.append(NMDS(*args, **kwargs))
+    rand_seed = kwargs.pop('rand_seed', None)
+    if rand_seed is not None:
+        seed(rand_seed)
+    if args:
+        num_points = len(args[0])
+    else:
+        num_points = len(kwargs['dissimilarity_mtx'])
+    dimension = kwargs.get('dimension', 2)
+    starts = ["pcoa"] + [random_gauss(0., 1, (num_points, dimension)) 
+        for i in range(iters)]
+    def run_nmds(initial_pts):
+        return NMDS(initial_pts=initial_pts, *args, **kwargs)
+    results = parallel.map(run_nmds, starts)
     stresses = [nmds.getStress() for nmds in results]
     bestidx = stresses.index(min(stresses))
     return results[bestidx]
@@ -381,6 +381,10 @@ class JointEnumeration(Enumeration):
         #remember to reset shape after superclass init
         self.Shape = tuple(sub_enum_lengths)
     
+    def __getnewargs__(self):
+        # pickle protocol 2 rebuilds tuple subclasses via __new__
+        return (self.SubEnumerations,)
+    
     def _coerce_enumerations(cls, enums):
         """Coerces putative enumerations into Enumeration objects.
         
@@ -10,6 +10,86 @@ __maintainer__ = "Gavin Huttley"
 __email__ = "gavin.huttley@anu.edu.au"
 __status__ = "Production"
 
+class AnnotationIndex(object):
+    """Finds annotations by type, or by overlap with a region.
+    
+    Intervals (annotation map Start to End) are grouped by length into 
+    powers of two and sorted by start within each group, so those 
+    overlapping a region are found by binary search: O(log n + k).  Results
+    keep the order of annotations.  Short lists are just scanned.
+    """
+    MinIndexed = 64
+    
+    def __init__(self, annotations):
+        self.Annotations = annotations
+        self._length = len(annotations)
+        self._by_type = None
+        self._bins = {}
+    
+    def __len__(self):
+        return self._length
+    
+    def _ofTypePositions(self, annotation_type):
+        if self._by_type is None:
+            by_type = {}
+            for (i, annot) in enumerate(self.Annotations):
+                by_type.setdefault(annot.type, []).append(i)
+            self._by_type = by_type
+        try:
+            return self._by_type.get(annotation_type, [])
+        except TypeError:   # unhashable, so can't match
+            return []
+    
+    def _positions(self, annotation_type):
+        if annotation_type is None:
+            return range(self._length)
+        return self._ofTypePositions(annotation_type)
+    
+    def ofType(self, annotation_type):
+        """Annotations of annotation_type"""
+        return [self.Annotations[i] 
+                for i in self._ofTypePositions(annotation_type)]
+    
+    def _getBins(self, annotation_type):
+        if annotation_type in self._bins:
+            return self._bins[annotation_type]
+        located = [(i, annot.map.Start, annot.map.End) 
+                for (i, annot) in [(i, self.Annotations[i]) 
+                    for i in self._positions(annotation_type)]
+                if annot.map.useful]
+        bins = []
+        if located:
+            (positions, starts, ends) = [numpy.array(a) for a in zip(*located)]
+            lengths = numpy.maximum(ends - starts, 1)
+            groups = numpy.log2(lengths).astype(int)
+            for group in numpy.unique(groups):
+                selected = groups == group
+                order = numpy.argsort(starts[selected], kind='mergesort')
+                bins.append((starts[selected][order], ends[selected][order],
+                        positions[selected][order], lengths[selected].max()))
+        self._bins[annotation_type] = bins
+        return bins
+    
+    def overlapping(self, start, end, annotation_type=None):
+        """Annotations (of annotation_type) overlapping start to end"""
+        positions = self._positions(annotation_type)
+        if len(positions) < self.MinIndexed:
+            annots = [self.Annotations[i] for i in positions]
+            return [annot for annot in annots if annot.map.useful and 
+                    annot.map.Start < end and annot.map.End > start]
+        found = []
+        for (starts, ends, positions, max_length) in \
+                self._getBins(annotation_type):
+            # only intervals starting after start-max_length can reach start
+            lo = numpy.searchsorted(starts, start - max_length, 'right')
+            hi = numpy.searchsorted(starts, end, 'left')
+            if lo < hi:
+                found.append(positions[lo:hi][ends[lo:hi] > start])
+        if not found:
+            return []
+        return [self.Annotations[i] for i in numpy.sort(numpy.concatenate(found))]
+    
+
 class _Annotatable(object):
     # default
     annotations = ()
@@ -27,14 +107,11 @@ class _Annotatable(object):
             #    print "Annotations dropped because %s" % detail
             #    return []
             if slicemap.useful:
-                for annot in self.annotations:
-                    if not annot.map.useful:
-                        continue
-                    if annot.map.Start < slicemap.End and \
-                            annot.map.End > slicemap.Start:
-                        annot = annot.remappedTo(new, newmap)
-                        if annot.map.useful:
-                            result.append(annot)
+                index = self.getAnnotationIndex()
+                for annot in index.overlapping(slicemap.Start, slicemap.End):
+                    annot = annot.remappedTo(new, newmap)
+                    if annot.map.useful:
+                        result.append(annot)
         return result
     
     def _shiftedAnnotations(self, new, shift):
@@ -80,6 +157,14 @@ class _Annotatable(object):
     def _mapped(self, map):
         raise NotImplementedError
     
+    def getAnnotationIndex(self):
+        """An AnnotationIndex of self.annotations, kept until they change"""
+        index = self.__dict__.get('_annotation_index')
+        if index is None or index.Annotations is not self.annotations or \
+                len(index) != len(self.annotations):
+            index = self._annotation_index = AnnotationIndex(self.annotations)
+        return index
+    
     def getAnnotationTracks(self, policy):
         result = []
         for annot in self.annotations:
@@ -100,6 +185,7 @@ class _Annotatable(object):
         if self.annotations is self.__class__.annotations:
             self.annotations = []
         self.annotations.extend(annots)
+        self.__dict__.pop('_annotation_index', None)
         for annot in annots:
             annot.attached = True
     
@@ -111,15 +197,15 @@ class _Annotatable(object):
             if annot.attached:
                 self.annotations.remove(annot)
                 annot.attached = False
+        self.__dict__.pop('_annotation_index', None)
     
     def addFeature(self, type, Name, spans):
         return self.addAnnotation(Feature, type, Name, spans)
     
     def getAnnotationsMatching(self, annotation_type, Name=None):
         result = []
-        for annotation in self.annotations:
-            if annotation_type == annotation.type and (
-                    Name is None or Name == annotation.Name):
+        for annotation in self.getAnnotationIndex().ofType(annotation_type):
+            if Name is None or Name == annotation.Name:
                 result.append(annotation)
         return result
     
@@ -711,7 +711,7 @@ class TreeNode(object):
         in the array"""
         #get a list of internal nodes
         node_list = [node for node in self.traverse() if node.Children]
-        node_list.sort()
+        node_list.sort(key=lambda node: node.Name)
         
         #get a list of tips() Name if one is not supplied
         if not dec_list:
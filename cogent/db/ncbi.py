@@ -5,12 +5,12 @@
     (http://www.ncbi..nih.gov/entrez/eutils) 
     search and fetch for sets of sequence information
 """
-from urllib import urlopen, urlretrieve
+from urllib import urlopen, urlretrieve, quote_plus
 from xml.dom.minidom import parseString
 from xml.etree.ElementTree import parse
 from cogent.db.util import UrlGetter, expand_slice,\
-    make_lists_of_expanded_slices_of_set_size,make_lists_of_accessions_of_set_size
-from time import sleep
+    make_lists_of_expanded_slices_of_set_size,make_lists_of_accessions_of_set_size,\
+    UrlFetcher, ResponseCache, read_url, normalised_url
 from StringIO import StringIO
 from cogent.parse.record_finder import DelimitedRecordFinder, never_ignore
 from string import strip
@@ -33,6 +33,9 @@ eutils_base='http://www.ncbi.nlm.nih.gov/entrez/eutils'
 default_tool_string = 'PyCogent'
 default_email_address = 'Michael.Robeson@colorado.edu'
 
+#seconds before EUtils first retries a failed request, doubling after that
+default_backoff = 1.0
+
 #databases last updated 7/22/05
 valid_databases=dict.fromkeys(["pubmed", "protein", "nucleotide", "structure",\
     "genome", "books", "cancerchromosomes", "cdd", "domains", "gene", \
@@ -214,12 +217,36 @@ def ELinkResultParser(text):
     return result
 
 
+#parameters that differ between sessions for the same query: left out of the
+#cache keys for fetched records
+session_params = ('tool', 'email', 'WebEnv', 'query_key')
+
 class EUtils(object):
-    """Retrieves records from NCBI using EUtils."""
-    def __init__(self, filename=None, wait=0.5, retmax=100, url_limit=400, DEBUG=False, max_recs=None, **kwargs):
+    """Retrieves records from NCBI using EUtils.
+    
+    Requests are spaced at least wait seconds apart on average, with up to 
+    max_workers in flight at once and failures retried retries times, 
+    after backoff seconds (default: default_backoff) doubling for each 
+    retry. If cache (a ResponseCache or directory name) is given, 
+    responses are kept for cache_ttl seconds (default: forever) and repeated
+    queries are answered from it. transport replaces read_url for making 
+    requests.
+    """
+    def __init__(self, filename=None, wait=0.5, retmax=100, url_limit=400, DEBUG=False, max_recs=None, cache=None, cache_ttl=None, max_workers=3, retries=3, backoff=None, transport=read_url, **kwargs):
         self.__dict__.update(kwargs)
         self.filename = filename
         self.wait = wait
+        if isinstance(cache, basestring):
+            cache = ResponseCache(cache, ttl=cache_ttl)
+        if backoff is None:
+            backoff = default_backoff
+        if wait:
+            requests_per_second = 1.0 / wait
+        else:
+            requests_per_second = None
+        self.fetcher = UrlFetcher(transport, cache=cache, 
+            requests_per_second=requests_per_second, max_workers=max_workers,
+            retries=retries, backoff=backoff)
         self.retstart = 0  # was originally set to 1
         self.DEBUG = DEBUG
         self.retmax = retmax
@@ -277,61 +304,35 @@ class EUtils(object):
             self.term=query
             search_query = ESearch(**self.__dict__)
             search_query.retmax = 0 #don't want the ids, just want to post search
-            if self.DEBUG:
-                print 'SEARCH QUERY:'
-                print str(search_query)
-            cookie = search_query.read()
-            if self.DEBUG:
-                print 'COOKIE:'
-                print `cookie`
-            search_result = ESearchResultParser(cookie)
-            if self.DEBUG:
-                print 'SEARCH RESULT:'
-                print search_result
-            try:
-                self.query_key = search_result.QueryKey
-                self.WebEnv = search_result.WebEnv
-            except AttributeError:
-                #The query_key and/or WebEnv not Found!
-                #GenBank occiasionally does not return these when user attempts
-                # to only fetch data by Accession or UID. So we just
-                #move on to extract UID list directly from the search result
-                try:
-                    self.id = ','.join(search_result.IdList)
-                except AttributeError:
-                    raise QueryNotFoundError,\
-                        "WebEnv or query_key not Found! Query %s returned no results.\nURL was:\n%s" % \
-                    (repr(query),str(search_query))
-
+            search_url = str(search_query)
+            search_cached = self.fetcher.isCached(search_url)
+            search_result = self._search(query, search_url)
             count = search_result.Count
 
-            #wrap the fetch in a loop so we get all the results
-            fetch_query = EFetch(**self.__dict__)
-            curr_rec = 0
-            #check if we need to get additional ids
-
+            #split the fetch into windows so we get all the results
             if self.max_recs:    #cut off at max_recs if set
                 count = min(count, self.max_recs)
                 retmax = min(self.retmax, self.max_recs)
             else:
                 retmax = self.retmax
-
-            while curr_rec < count:
-                #do the fetch
-                if count - curr_rec < self.retmax:
-                    fetch_query.retmax = count - curr_rec
-                fetch_query.retstart = curr_rec
-                if self.DEBUG:
-                    print 'FETCH QUERY'
-                    print 'CURR REC:', curr_rec, 'COUNT:', count
-                    print str(fetch_query)
-                #return the result of the fetch
-                curr = fetch_query.read()
+            windows = [(curr_rec, min(self.retmax, count - curr_rec))
+                for curr_rec in range(0, count, retmax)]
+            fetch_urls = self._fetch_urls(windows)
+            #the session in the query's results expires, so key on the query
+            keys = ['%s&term=%s' % (normalised_url(url, session_params),
+                quote_plus(str(query))) for url in fetch_urls]
+            missing = [key for key in keys if not self.fetcher.isCached(None, key)]
+            if missing and search_cached:
+                #cached session may have expired: start a new one
+                self._search(query, search_url, refresh=True)
+                fetch_urls = self._fetch_urls(windows)
+            if self.DEBUG:
+                print 'FETCH QUERIES, COUNT:', count
+                print '\n'.join(fetch_urls)
+            for curr in self.fetcher.readMany(fetch_urls, keys):
                 result.write(curr)
                 if not curr.endswith('\n'):
                     result.write('\n')
-                curr_rec += retmax
-                sleep(self.wait)
             #clean up after retrieval
         if self.filename:
             result.close()
@@ -340,6 +341,48 @@ class EUtils(object):
             result.seek(0)
             return result
 
+    def _search(self, query, search_url, refresh=False):
+        """Posts search for query; sets the session or ids to fetch.
+        
+        Returns the parsed search result.
+        """
+        if self.DEBUG:
+            print 'SEARCH QUERY:'
+            print search_url
+        cookie = self.fetcher.read(search_url, refresh=refresh)
+        if self.DEBUG:
+            print 'COOKIE:'
+            print `cookie`
+        search_result = ESearchResultParser(cookie)
+        if self.DEBUG:
+            print 'SEARCH RESULT:'
+            print search_result
+        try:
+            self.query_key = search_result.QueryKey
+            self.WebEnv = search_result.WebEnv
+        except AttributeError:
+            #The query_key and/or WebEnv not Found!
+            #GenBank occiasionally does not return these when user attempts
+            # to only fetch data by Accession or UID. So we just
+            #move on to extract UID list directly from the search result
+            try:
+                self.id = ','.join(search_result.IdList)
+            except AttributeError:
+                raise QueryNotFoundError,\
+                    "WebEnv or query_key not Found! Query %s returned no results.\nURL was:\n%s" % \
+                (repr(query),search_url)
+        return search_result
+
+    def _fetch_urls(self, windows):
+        """Returns EFetch urls for list of (retstart, retmax) windows."""
+        fetch_query = EFetch(**self.__dict__)
+        urls = []
+        for retstart, retmax in windows:
+            fetch_query.retstart = retstart
+            fetch_query.retmax = retmax
+            urls.append(str(fetch_query))
+        return urls
+
 #The following are convenience wrappers for some of the above functionality
 
 def get_primary_ids(term, retmax=100, max_recs=None, **kwargs):
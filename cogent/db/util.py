@@ -1,7 +1,19 @@
 #!/usr/bin/env python
 """Retrieve information from web databases.
+
+UrlFetcher adds an on-disk ResponseCache, a RateLimiter, retries with
+backoff and concurrent fetching to URL retrieval; UrlGetter objects use one
+if given as their fetcher attribute.
 """
-from urllib import urlopen, urlretrieve, quote_plus
+import os
+import threading
+from Queue import Queue
+from hashlib import sha1
+from tempfile import mkstemp
+from time import time, sleep
+from urllib import urlopen, urlretrieve, quote_plus, urlencode
+from urllib2 import urlopen as urlopen2, HTTPError
+from urlparse import urlsplit, parse_qsl
 
 __author__ = "Rob Knight"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -40,7 +52,16 @@ class UrlGetter(object):
         return result
 
     def read(self, **kwargs):
-        """Gets URL and reads into memory, temporarily overriding kwargs."""
+        """Gets URL and reads into memory, temporarily overriding kwargs.
+        
+        If self.fetcher is set, reads through that UrlFetcher.
+        """
+        fetcher = self.__dict__.get('fetcher')
+        if fetcher is not None:
+            self._temp_args = kwargs
+            url = str(self)
+            self._temp_args = {}
+            return fetcher.read(url)
         result = self.open(**kwargs)
         data = result.read()
         result.close()
@@ -54,6 +75,212 @@ class UrlGetter(object):
         urlretrieve(str(self), fname)
         self._temp_args = None
         
+class ErrorResponse(str):
+    """Body of an HTTP error response: returned by UrlFetcher, never cached.
+
+    Code is the HTTP status.
+    """
+    def __new__(cls, body, code=None):
+        result = str.__new__(cls, body)
+        result.Code = code
+        return result
+
+def read_url(url):
+    """Returns the body at url.
+
+    Raises IOError on failure to connect, or for HTTP statuses worth trying
+    again (429 and 5xx); bodies of other HTTP errors are returned as an 
+    ErrorResponse, as by urllib.urlopen.
+    """
+    try:
+        handle = urlopen2(url)
+    except HTTPError, e:
+        if e.code == 429 or e.code >= 500:
+            raise
+        try:
+            return ErrorResponse(e.read(), e.code)
+        finally:
+            e.close()
+    try:
+        return handle.read()
+    finally:
+        handle.close()
+
+def normalised_url(url, ignore=('tool', 'email')):
+    """Returns url with query parameters sorted and those in ignore dropped.
+
+    Equivalent queries then give the same string, e.g. for cache keys.
+    """
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    params = sorted([(k, v) for k, v in parse_qsl(query, True) 
+        if k not in ignore])
+    return '%s://%s%s?%s' % (scheme, netloc, path, urlencode(params))
+
+class ResponseCache(object):
+    """Stores responses on disk, in files named by the hash of their key.
+
+    dirname: directory for the cache, created if needed.
+    ttl: seconds for which responses stay valid (default: forever).
+    """
+    def __init__(self, dirname, ttl=None):
+        self.Dirname = dirname
+        self.Ttl = ttl
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    def _path(self, key):
+        digest = sha1(key).hexdigest()
+        return os.path.join(self.Dirname, digest[:2], digest)
+
+    def __contains__(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return False
+        return self.Ttl is None or os.path.getmtime(path) + self.Ttl > time()
+
+    def get(self, key, default=None):
+        """Returns stored response for key, or default if absent or expired."""
+        if key not in self:
+            return default
+        infile = open(self._path(key), 'rb')
+        try:
+            return infile.read()
+        finally:
+            infile.close()
+
+    def put(self, key, data):
+        """Stores data as the response for key."""
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:     #made by another thread meanwhile
+                pass
+        #write then rename, so that readers never see part of a response
+        fd, temp_path = mkstemp(dir=dirname)
+        outfile = os.fdopen(fd, 'wb')
+        outfile.write(data)
+        outfile.close()
+        os.rename(temp_path, path)
+
+class RateLimiter(object):
+    """Spaces out calls to wait() to at most requests_per_second.
+
+    Safe to share between threads.
+    """
+    def __init__(self, requests_per_second, sleep=sleep):
+        self.Interval = 1.0 / requests_per_second
+        self._sleep = sleep
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Returns when the next request is allowed."""
+        self._lock.acquire()
+        try:
+            now = time()
+            start = max(now, self._next)
+            self._next = start + self.Interval
+        finally:
+            self._lock.release()
+        if start > now:
+            self._sleep(start - now)
+
+class UrlFetcher(object):
+    """Reads URLs through a cache, within a rate limit, retrying failures.
+
+    transport: f(url) -> body, raising IOError on failure (default: 
+    read_url); replace to use a stand-in server or another client. Bodies
+    returned as an ErrorResponse are passed on but not cached.
+    cache: ResponseCache, or None to always fetch.
+    requests_per_second: budget shared by all requests (default: no limit).
+    max_workers: number of requests readMany makes at once.
+    retries: number of further attempts after an IOError.
+    backoff: seconds before the first retry, doubling for each one after.
+
+    Responses are cached under their normalised URL unless another key is 
+    given.
+    """
+    def __init__(self, transport=read_url, cache=None, 
+        requests_per_second=None, max_workers=1, retries=3, backoff=1.0, 
+        sleep=sleep):
+        self.Transport = transport
+        self.Cache = cache
+        if requests_per_second:
+            self.RateLimiter = RateLimiter(requests_per_second, sleep)
+        else:
+            self.RateLimiter = None
+        self.MaxWorkers = max_workers
+        self.Retries = retries
+        self.Backoff = backoff
+        self._sleep = sleep
+
+    def isCached(self, url, key=None):
+        """Returns True if the response for url (or key) is in the cache."""
+        if self.Cache is None:
+            return False
+        return (key or normalised_url(url)) in self.Cache
+
+    def read(self, url, key=None, refresh=False):
+        """Returns body at url, from the cache unless refresh is True."""
+        if key is None:
+            key = normalised_url(url)
+        if self.Cache is not None and not refresh:
+            data = self.Cache.get(key)
+            if data is not None:
+                return data
+        delay = self.Backoff
+        for attempt in range(self.Retries + 1):
+            if self.RateLimiter is not None:
+                self.RateLimiter.wait()
+            try:
+                data = self.Transport(url)
+                break
+            except IOError:
+                if attempt == self.Retries:
+                    raise
+                self._sleep(delay)
+                delay *= 2
+        if self.Cache is not None and not isinstance(data, ErrorResponse):
+            self.Cache.put(key, data)
+        return data
+
+    def readMany(self, urls, keys=None):
+        """Returns list of bodies at urls, reading up to MaxWorkers at once.
+
+        keys, if given, are the cache keys for urls. The first error raised
+        by any read is raised again here.
+        """
+        if keys is None:
+            keys = [None] * len(urls)
+        if self.MaxWorkers <= 1 or len(urls) <= 1:
+            return [self.read(url, key) for url, key in zip(urls, keys)]
+        results = [None] * len(urls)
+        errors = []
+        jobs = Queue()
+        for job in enumerate(zip(urls, keys)):
+            jobs.put(job)
+        def worker():
+            while not errors:
+                try:
+                    i, (url, key) = jobs.get_nowait()
+                except Exception:   #queue empty
+                    return
+                try:
+                    results[i] = self.read(url, key)
+                except Exception, e:
+                    errors.append(e)
+        threads = [threading.Thread(target=worker) 
+            for i in range(min(self.MaxWorkers, len(urls)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
 def expand_slice(s):
     """Takes a start and end accession, and gets the whole range.
 
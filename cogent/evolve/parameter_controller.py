@@ -169,6 +169,9 @@ class _LikelihoodParameterController(_LF):
             self.used_as_calculator = True
             return self
         else:
+            if 'processes' in kw:
+                # loci and bins are independent up to their site likelihoods
+                kw.setdefault('split_at', ['lh'])
             return super(_LF, self).makeCalculator(**kw)
     
     def _process_scope_info(self, edge=None, tip_names=None, edges=None,
@@ -367,12 +370,12 @@ class SequenceLikelihoodFunction(_LikelihoodParameterController):
         pass
     
     def makeLikelihoodDefn(self, sites_independent=None,
-            with_indel_params=True, kn=True):
+            with_indel_params=True, kn=True, band=None):
         assert sites_independent is None or not sites_independent
         assert len(self.locus_names) == 1
         return dp_calculation.makeForwardTreeDefn(
                 self.model, self.tree, self.bin_names,
-                with_indel_params=with_indel_params, kn=kn)
+                with_indel_params=with_indel_params, kn=kn, band=band)
     
     def setSequences(self, seqs, locus=None):
         leaves = {}
@@ -386,6 +386,10 @@ class _ContinuousSubstitutionModel(_SubstitutionModel):
     _exponentiator = None
     _default_expm_setting = 'either'
     
+    # subclasses may provide calcQBatch(arg_lists) to build several Qs,
+    # eg: for edges with their own rate parameter values, in one go
+    calcQBatch = None
+    
     @extend_docstring_from(_SubstitutionModel)
     def __init__(self, alphabet, with_rate=False, ordered_param=None, 
             distribution=None, partitioned_params=None, do_scaling=None, **kw):
@@ -499,7 +503,8 @@ class _ContinuousSubstitutionModel(_SubstitutionModel):
     
     def makeQdDefn(self, word_probs, mprobs_matrix, rate_params):
         """Diagonalized Q, ie: rate matrix prepared for exponentiation"""
-        Q = CalcDefn(self.calcQ, name='Q')(word_probs, mprobs_matrix, *rate_params)
+        Q = CalcDefn(self.calcQ, name='Q', batch_calc=self.calcQBatch)(
+                word_probs, mprobs_matrix, *rate_params)
         expm = NonParamDefn('expm')
         exp = ExpDefn(expm)
         Qd = CallDefn(exp, Q, name='Qd')
@@ -718,13 +723,104 @@ class SubstitutionModel(_ContinuousSubstitutionModel):
             warnings.warn('Model not reversible')
         (self.scale_masks, scale_order) = self._adaptPredicates(scales or [])
         self.checkParamsExist()
-            
+        self._compilePredicates()
+    
+    def _compilePredicates(self):
+        """Precompute, for each instantaneous cell of Q, the indices of the
+        parameters which multiply it, so that building Q is a gather and a
+        scatter rather than a pass over every predicate mask."""
+        N = len(self.alphabet)
+        cells = numpy.flatnonzero(self._instantaneous_mask)
+        # an index of len(params) stands for a factor of 1.0
+        param_index = [numpy.empty(N*N, int)]
+        param_index[0].fill(len(self.predicate_indices))
+        depth = numpy.zeros(N*N, int)
+        for (i, indices) in enumerate(self.predicate_indices):
+            flat = numpy.ravel_multi_index(indices, (N, N))
+            for level in numpy.unique(depth[flat]):
+                while level >= len(param_index):
+                    param_index.append(param_index[0].copy())
+                    param_index[-1].fill(len(self.predicate_indices))
+                at_level = flat[depth[flat] == level]
+                param_index[level][at_level] = i
+            depth[flat] += 1
+        self._Q_cells = cells
+        self._Q_diagonal = numpy.arange(N) * (N+1)
+        self._Q_param_index = [index[cells] for index in param_index]
+        self._Q_rows = cells // N
+        self._Q_cols = cells % N
+    
+    def _calcCellRates(self, params):
+        """Exchangeabilities of the instantaneous cells of Q, for each row
+        of params"""
+        params = numpy.asarray(params, float)
+        assert params.shape[-1] == len(self.predicate_indices), \
+                self.parameter_order
+        factors = numpy.ones(params.shape[:-1] + (params.shape[-1]+1,))
+        factors[..., :-1] = params
+        rates = factors.take(self._Q_param_index[0], axis=-1)
+        for index in self._Q_param_index[1:]:
+            rates *= factors.take(index, axis=-1)
+        return rates
+    
     def calcExchangeabilityMatrix(self, mprobs, *params):
-        assert len(params) == len(self.predicate_indices), self.parameter_order
-        R = self._instantaneous_mask_f.copy()
-        for (indices, par) in zip(self.predicate_indices, params):
-            R[indices] *= par
-        return R
+        N = len(self.alphabet)
+        R = numpy.zeros(N*N)
+        R[self._Q_cells] = self._calcCellRates(params)
+        return R.reshape([N, N])
+    
+    def _calcCellWeights(self, mprobs_matrix):
+        """mprobs_matrix at the instantaneous cells of Q, which may also be
+        given as a vector of column weights"""
+        mprobs_matrix = numpy.asarray(mprobs_matrix)
+        if mprobs_matrix.ndim == 1:
+            return mprobs_matrix.take(self._Q_cols)
+        return mprobs_matrix.take(self._Q_cells)
+    
+    def calcQ(self, word_probs, mprobs_matrix, *params):
+        N = len(self.alphabet)
+        rates = self._calcCellRates(params)
+        rates *= self._calcCellWeights(mprobs_matrix)
+        row_totals = numpy.bincount(self._Q_rows, rates, N)
+        Q = numpy.zeros(N*N)
+        Q[self._Q_cells] = rates
+        Q[self._Q_diagonal] = -row_totals
+        if self._do_scaling:
+            Q *= 1.0 / numpy.dot(word_probs, row_totals)
+        return Q.reshape([N, N])
+    
+    def calcQs(self, word_probs, mprobs_matrix, params):
+        """Rate matrices, as from calcQ, for each row of params, eg: for
+        edges which differ only in their rate parameter values."""
+        N = len(self.alphabet)
+        rates = self._calcCellRates(params)
+        rates *= self._calcCellWeights(mprobs_matrix)
+        B = len(rates)
+        rows = self._Q_rows if B == 1 else (
+                self._Q_rows + N * numpy.arange(B)[:, None]).ravel()
+        row_totals = numpy.bincount(rows, rates.ravel(), B*N).reshape([B, N])
+        Qs = numpy.zeros((B, N*N))
+        Qs[:, self._Q_cells] = rates
+        Qs[:, self._Q_diagonal] = -row_totals
+        if self._do_scaling:
+            Qs *= 1.0 / numpy.dot(row_totals, word_probs)[:, None]
+        return Qs.reshape([B, N, N])
+    
+    def calcQBatch(self, arg_lists):
+        """calcQ for each list of arguments, batched by calcQs for those
+        which share their motif probabilities"""
+        groups = {}
+        for (i, args) in enumerate(arg_lists):
+            key = (id(args[0]), id(args[1]))
+            groups.setdefault(key, []).append(i)
+        result = [None] * len(arg_lists)
+        for indices in groups.values():
+            (word_probs, mprobs_matrix) = arg_lists[indices[0]][:2]
+            Qs = self.calcQs(word_probs, mprobs_matrix,
+                    [arg_lists[i][2:] for i in indices])
+            for (i, Q) in zip(indices, Qs):
+                result[i] = Q
+        return result
     
     def asciiArt(self, delim='', delim2='|', max_width=70):
         """An ASCII-art table representing the model.  'delim' delimits
@@ -18,6 +18,13 @@ docstring for specifics):
     and if strict==False, errors or misleading return values may result
     * functions prefaced with "binary" consider only presense/absense in
     input data (qualitative rather than quantitative)
+    * input may also be a sparse matrix (anything with a tocsr method, such
+    as a scipy.sparse matrix); it is only densified a block of rows at a time
+    * rows are compared a block at a time (block_size rows, by default sized
+    so a block holds at most MAX_BLOCK_ELEMENTS).  Nonnegative input with at
+    most SPARSE_DENSITY nonzero entries is compared only over the columns
+    where both rows are nonzero, where the metric allows it.  dtype='f'
+    computes in and returns float32 to halve memory use on large tables.
 
 TRANSFORM FUNCTIONS
 * For transform functions, very little error checking exists.  0/0 evals
@@ -57,7 +64,9 @@ import numpy
 from numpy import (array, zeros, logical_and, logical_or, logical_xor, where,
     mean, std, argsort, take, ravel, logical_not, shape, sqrt, abs, 
     sum, square, asmatrix, asarray, multiply, min, rank, any, all, isfinite,
-    nonzero, nan_to_num, geterr, seterr, isnan)
+    nonzero, nan_to_num, geterr, seterr, isnan, dot, newaxis, minimum,
+    maximum, add, repeat, arange, diff, searchsorted, unique, union1d,
+    flatnonzero, concatenate, fill_diagonal, count_nonzero, ix_, ones, finfo)
 # any, all from numpy override built in any, all, preventing:
 # ValueError: The truth value of an array with more than one element is 
 # ambiguous. Use a.any() or a.all()
@@ -158,7 +167,260 @@ def trans_hellinger(m):
 
 
 
-def dist_bray_curtis(datamtx, strict=True):
+DEFAULT_BLOCK_SIZE = 256
+MAX_BLOCK_ELEMENTS = 2**22
+CHUNK_ELEMENTS = 2**16
+SPARSE_DENSITY = 0.1
+
+def _is_sparse(datamtx):
+    """True if datamtx is a sparse matrix, i.e. has a tocsr method"""
+    return hasattr(datamtx, 'tocsr')
+
+def _prepare(datamtx, strict, allow_negative=False):
+    """checks datamtx as described in the module docstring
+    
+    returns datamtx as an ndarray (or in csr form if sparse), or None if it
+    has no rows or columns, or is not 2D and strict==False.
+    """
+    if _is_sparse(datamtx):
+        datamtx = datamtx.tocsr()
+        values = datamtx.data
+    else:
+        datamtx = asarray(datamtx)
+        values = datamtx
+    if strict:
+        if not all(isfinite(values)):
+            raise ValueError("non finite number in input matrix")
+        if not allow_negative and any(values<0.0):
+            raise ValueError("negative value in input matrix")
+        if len(shape(datamtx)) != 2:
+            raise ValueError("input matrix not 2D")
+        numrows, numcols = shape(datamtx)
+    else:
+        try:
+            numrows, numcols = shape(datamtx)
+        except ValueError:
+            return None
+    if numrows == 0 or numcols == 0:
+        return None
+    return datamtx
+
+def _row_blocks(numrows, numcols, block_size=None):
+    """returns (start, end) bounds of the row blocks"""
+    if block_size is None:
+        # min from numpy shadows the builtin here
+        block_size = max(1, MAX_BLOCK_ELEMENTS // numcols)
+        if block_size > DEFAULT_BLOCK_SIZE:
+            block_size = DEFAULT_BLOCK_SIZE
+    return [(i, i + block_size if i + block_size < numrows else numrows) 
+        for i in range(0, numrows, block_size)]
+
+def _dense_rows(datamtx, start, end, dtype='d', columns=None):
+    """returns rows start:end of datamtx as a dense array
+
+    columns, if given, is a sorted array of column indices to keep; for
+    sparse input it must include every nonzero column of the rows.
+    """
+    if not _is_sparse(datamtx):
+        block = datamtx[start:end]
+        if columns is not None:
+            block = block[:,columns]
+        return asarray(block, dtype)
+    lo, hi = datamtx.indptr[start], datamtx.indptr[end]
+    cols = datamtx.indices[lo:hi]
+    rows = repeat(arange(end-start), diff(datamtx.indptr[start:end+1]))
+    if columns is None:
+        width = datamtx.shape[1]
+    else:
+        width = len(columns)
+        cols = searchsorted(columns, cols)
+    block = zeros((end-start, width), dtype)
+    numpy.add.at(block, (rows, cols), datamtx.data[lo:hi])
+    return block
+
+def _occupied_columns(datamtx, start, end):
+    """returns sorted indices of columns nonzero in rows start:end"""
+    if _is_sparse(datamtx):
+        lo, hi = datamtx.indptr[start], datamtx.indptr[end]
+        return unique(datamtx.indices[lo:hi])
+    return flatnonzero(datamtx[start:end].any(axis=0))
+
+def _reduce_rows(datamtx, f, block_size=None):
+    """returns f(rows) for datamtx, applied to blocks of rows if sparse"""
+    if not _is_sparse(datamtx):
+        return f(asarray(datamtx, 'd'))
+    bounds = _row_blocks(*datamtx.shape, block_size=block_size)
+    return concatenate([f(_dense_rows(datamtx, start, end))
+        for start, end in bounds])
+
+def _reduce_columns(datamtx, f, combine, block_size=None):
+    """returns f(rows) for datamtx, combining blocks of rows if sparse"""
+    if not _is_sparse(datamtx):
+        return f(asarray(datamtx, 'd'))
+    bounds = _row_blocks(*datamtx.shape, block_size=block_size)
+    return reduce(combine, [f(_dense_rows(datamtx, start, end))
+        for start, end in bounds])
+
+def _pairwise(datamtx, pair_f, block_size=None, dtype='d', row_f=None,
+    compress=False):
+    """returns the symmetric row-row matrix of datamtx, by blocks of rows
+    
+    pair_f(a, b, ia, ib) gets dense blocks of rows a and b, and the slices
+    of datamtx they came from, and returns the (len(a), len(b)) distances.
+    row_f(block, ia, columns) transforms each block before it is compared.
+    If compress, blocks are restricted to the columns nonzero in either, which
+    is only valid if such columns contribute nothing to pair_f (and row_f
+    maps zeros to zeros).  The diagonal is always 0.
+    """
+    numrows, numcols = datamtx.shape
+    if row_f is not None and not _is_sparse(datamtx):
+        # dense input is already held in memory, so transform it just once
+        datamtx = row_f(asarray(datamtx, dtype), slice(0, numrows), None)
+        row_f = None
+    bounds = _row_blocks(numrows, numcols, block_size)
+    if compress:
+        occupied = [_occupied_columns(datamtx, start, end) 
+            for start, end in bounds]
+    dists = zeros((numrows, numrows), dtype)
+    for i, (start_a, end_a) in enumerate(bounds):
+        ia = slice(start_a, end_a)
+        for j, (start_b, end_b) in enumerate(bounds[:i+1]):
+            ib = slice(start_b, end_b)
+            columns = None
+            if compress:
+                columns = union1d(occupied[i], occupied[j])
+            a = _dense_rows(datamtx, start_a, end_a, dtype, columns)
+            b = _dense_rows(datamtx, start_b, end_b, dtype, columns)
+            if row_f is not None:
+                a, b = row_f(a, ia, columns), row_f(b, ib, columns)
+            block = pair_f(a, b, ia, ib)
+            dists[ia,ib] = block
+            dists[ib,ia] = block.T
+    fill_diagonal(dists, 0.0)
+    return dists
+
+def _summed_terms(terms_f, a, b):
+    """returns sums over columns of terms_f for each pair of rows in a, b
+    
+    terms_f gets broadcastable (len(a), 1, cols) and (1, len(b), cols) arrays
+    and returns a tuple of arrays of terms.  Columns are taken in chunks so
+    that the temporaries stay under CHUNK_ELEMENTS, which keeps them in cache.
+    """
+    step = max(1, CHUNK_ELEMENTS // max(1, len(a)*len(b)))
+    sums = None
+    for start in range(0, max(1, a.shape[1]), step):
+        a3 = a[:,newaxis,start:start+step]
+        b3 = b[newaxis,:,start:start+step]
+        terms = [t.sum(axis=2) for t in terms_f(a3, b3)]
+        if sums is None:
+            sums = terms
+        else:
+            sums = [s + t for s, t in zip(sums, terms)]
+    return sums
+
+def _ratio(num, den):
+    """returns num/den, or 0 where den is 0"""
+    nonzero_den = den != 0
+    return where(nonzero_den, num / where(nonzero_den, den, 1), 0.0)
+
+def _with_empty_rows(dists, a_empty, b_empty):
+    """sets dists to 0 between two empty rows, 1 where only one is empty"""
+    a_empty, b_empty = a_empty[:,newaxis], b_empty[newaxis,:]
+    dists[a_empty | b_empty] = 1.0
+    dists[a_empty & b_empty] = 0.0
+    return dists
+
+def _scaled_rows(scale):
+    """returns a row_f dividing rows by scale (with 0 for empty rows)"""
+    scale = where(scale == 0, 1.0, scale)
+    def row_f(block, rows, columns):
+        return block / scale[rows,newaxis]
+    return row_f
+
+def _abs_diff_terms(a, b):
+    return (abs(a - b),)
+
+def _min_terms(a, b):
+    return (minimum(a, b),)
+
+def _euclidean_pairs(a, b, ia, ib):
+    """returns euclidean distances between the rows of a and b
+    
+    computed from dot products; pairs whose squared distance is lost to
+    cancellation (near duplicate rows) are recomputed from their differences.
+    """
+    a_sq = square(a).sum(axis=1)[:,newaxis]
+    b_sq = square(b).sum(axis=1)[newaxis,:]
+    sq_dists = a_sq + b_sq - 2*dot(a, b.T)
+    tolerance = sqrt(finfo(sq_dists.dtype).eps)
+    a_index, b_index = nonzero(sq_dists <= tolerance * (a_sq + b_sq))
+    step = max(1, CHUNK_ELEMENTS // max(1, a.shape[1]))
+    for start in range(0, len(a_index), step):
+        i, j = a_index[start:start+step], b_index[start:start+step]
+        sq_dists[i,j] = square(a[i] - b[j]).sum(axis=1)
+    return sqrt(maximum(sq_dists, 0.0))
+
+def _nonzero_by_column(datamtx):
+    """returns rows, columns and values of the nonzero entries, by column"""
+    if _is_sparse(datamtx):
+        rows = repeat(arange(datamtx.shape[0]), diff(datamtx.indptr))
+        order = argsort(datamtx.indices, kind='mergesort')
+        return rows[order], datamtx.indices[order], datamtx.data[order]
+    cols, rows = nonzero(datamtx.T)
+    return rows, cols, datamtx[rows,cols]
+
+def _use_cooccurrence(datamtx):
+    """True if datamtx is nonnegative and sparse enough for co-occurrences"""
+    if _is_sparse(datamtx):
+        values = datamtx.data
+        num_nonzero = len(values)
+    else:
+        values = datamtx
+        num_nonzero = count_nonzero(datamtx)
+    numrows, numcols = datamtx.shape
+    return (num_nonzero <= SPARSE_DENSITY * numrows * numcols and 
+        not any(values < 0))
+
+def _cooccurrence_sums(datamtx, terms_f, dtype='d'):
+    """returns sums of terms_f over the columns where both rows are nonzero
+    
+    terms_f gets (r, 1) and (1, r) arrays of the r nonzero values in a column
+    and returns a tuple of (r, r) arrays of terms.  The cost grows with the
+    sum over columns of r**2, not with rows**2 * columns.
+    """
+    numrows = datamtx.shape[0]
+    rows, cols, vals = _nonzero_by_column(datamtx)
+    vals = asarray(vals, dtype)
+    bounds = concatenate(([0], flatnonzero(diff(cols)) + 1, [len(cols)]))
+    sums = None
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        curr_rows, curr_vals = rows[start:end], vals[start:end]
+        terms = terms_f(curr_vals[:,newaxis], curr_vals[newaxis,:])
+        if sums is None:
+            sums = [zeros((numrows, numrows), dtype) for t in terms]
+        index = ix_(curr_rows, curr_rows)
+        for total, t in zip(sums, terms):
+            total[index] += t
+    return sums
+
+def _min_sums(datamtx, block_size=None, dtype='d'):
+    """returns sum on i( min(a_i, b_i) ) for all pairs of rows in datamtx
+
+    the diagonal is not meaningful.
+    """
+    if _use_cooccurrence(datamtx):
+        return _cooccurrence_sums(datamtx, _min_terms, dtype)[0]
+    def pair_f(a, b, ia, ib):
+        return _summed_terms(_min_terms, a, b)[0]
+    return _pairwise(datamtx, pair_f, block_size, dtype, compress=True)
+
+def _finished(dists, dtype='d'):
+    """returns dists with a zero diagonal, as dtype"""
+    dists = asarray(dists, dtype)
+    fill_diagonal(dists, 0.0)
+    return dists
+
+def dist_bray_curtis(datamtx, strict=True, block_size=None, dtype='d'):
     """ returns bray curtis distance (normalized manhattan distance) btw rows
     
     dist(a,b) = manhattan distance / sum on i( (a_i + b_i) )
@@ -180,40 +442,19 @@ def dist_bray_curtis(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
 
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i,:]
-        for j in range(i):
-            r2 = datamtx[j,:]
-            abs_v = float(sum(abs(r1 - r2)))
-            v = sum(r1 + r2)
-            cur_d = 0.0 
-            if v > 0:
-                cur_d = abs_v/v
-
-            dists[i][j] = dists[j][i] = cur_d
-    return dists
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    totals = rowsums[:,newaxis] + rowsums[newaxis,:]
+    minsums = _min_sums(datamtx, block_size, dtype)
+    return _finished(_ratio(totals - 2*minsums, totals), dtype)
 
 dist_bray_curtis_faith = dist_bray_curtis
 
-def dist_bray_curtis_magurran(datamtx, strict=True):
+def dist_bray_curtis_magurran(datamtx, strict=True,
+    block_size=None, dtype='d'):
     """ returns bray curtis distance (quantitative sorensen) btw rows
     
     dist(a,b) = 2*sum on i( min( a_i, b_i)) / sum on i( (a_i + b_i) )
@@ -234,40 +475,17 @@ def dist_bray_curtis_magurran(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not numpy.all(numpy.isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if numpy.any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if numpy.rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = numpy.shape(datamtx)
-    else:
-        try:
-            numrows, numcols = numpy.shape(datamtx)
-        except ValueError:
-            return numpy.zeros((0,0),'d')
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
+        return zeros((0,0),'d')
 
-    if numrows == 0 or numcols == 0:
-        return numpy.zeros((0,0),'d')
-
-    dists = numpy.zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i,:]
-        r1sum = r1.sum()
-        for j in range(i):
-            r2 = datamtx[j,:]
-            r2sum = r2.sum()
-            minvals = numpy.min([r1,r2],axis=0)
-
-            if (r1sum + r2sum) == 0:
-                dists[i][j] = dists[j][i] = 0.0
-            else:
-                dissim = 1 - ( (2*minvals.sum()) / (r1sum + r2sum) )
-                dists[i][j] = dists[j][i] = dissim
-    return dists
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    totals = rowsums[:,newaxis] + rowsums[newaxis,:]
+    minsums = _min_sums(datamtx, block_size, dtype)
+    dists = where(totals == 0, 0.0, 1 - _ratio(2*minsums, totals))
+    return _finished(dists, dtype)
 
-def dist_canberra(datamtx, strict=True):
+def dist_canberra(datamtx, strict=True, block_size=None, dtype='d'):
     """returns a row-row canberra dist matrix
     
     see for example:
@@ -289,39 +507,35 @@ def dist_canberra(datamtx, strict=True):
     * chisq dist normalizes by column sums - empty columns (all zeros) are
     ignored here
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    oldstate = seterr(invalid='ignore',divide='ignore')
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i]
-        for j in range(i):
-            r2 = datamtx[j]
-            dist = 0.0
-            net = abs( r1 - r2 ) / (r1 + r2)
-
-            net = nan_to_num(net)
-            num_nonzeros = nonzero(net)[0].size
-            dists[i,j] = dists[j,i] = nan_to_num(net.sum()/num_nonzeros)
-            
-    seterr(**oldstate)
-    return dists
 
-def dist_chisq(datamtx, strict=True):
+    def terms_f(a, b):
+        net = nan_to_num(abs(a - b) / (a + b))
+        return net, net != 0
+    def pair_f(a, b, ia, ib):
+        net, num_nonzeros = _summed_terms(terms_f, a, b)
+        return nan_to_num(net / num_nonzeros)
+    def shared_terms_f(a, b):
+        net = abs(a - b) / (a + b)
+        return net, net != 0, ones(net.shape)
+    oldstate = seterr(invalid='ignore',divide='ignore')
+    try:
+        if not _use_cooccurrence(datamtx):
+            return _pairwise(datamtx, pair_f, block_size, dtype, 
+                compress=True)
+        # columns where only one row is nonzero each add 1 to both sums
+        net, num_nonzeros, shared = _cooccurrence_sums(datamtx, 
+            shared_terms_f, dtype)
+        occupied = _reduce_rows(datamtx, lambda m: (m != 0).sum(axis=1))
+        unshared = occupied[:,newaxis] + occupied[newaxis,:] - 2*shared
+        dists = nan_to_num((net + unshared) / (num_nonzeros + unshared))
+        return _finished(dists, dtype)
+    finally:
+        seterr(**oldstate)
+
+def dist_chisq(datamtx, strict=True, block_size=None, dtype='d'):
     """returns a row-row chisq dist matrix
 
     see for example:
@@ -344,47 +558,25 @@ def dist_chisq(datamtx, strict=True):
     * chisq dist normalizes by column sums - empty columns (all zeros) are
     ignored here
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    sqrt_grand_sum = sqrt(sum(datamtx))
-    rowsums, colsums = sum(datamtx, axis=1), sum(datamtx, axis=0)
-    if not colsums.all():
-        for i in range(len(colsums)):
-            if colsums[i] == 0.0:
-                colsums[i] = 1.0
-    for i in range(numrows):
-        r1 = datamtx[i]
-        r1sum = rowsums[i]
-        for j in range(i):
-            r2 = datamtx[j]
-            r2sum = rowsums[j]
-            if r1sum == 0.0 or r2sum == 0.0:
-                if r1sum == 0.0 and r2sum == 0.0:
-                    dist = 0.0
-                else: dist = 1.0
-            else:
-                dist = sqrt_grand_sum *\
-                    sqrt(sum( multiply((1./colsums) ,
-                    square(r1/r1sum - r2/r2sum)) ))
-            dists[i,j] = dists[j,i] = dist
-    return dists
 
-def dist_chord(datamtx, strict=True):
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    colsums = _reduce_columns(datamtx, lambda m: m.sum(axis=0), add)
+    sqrt_grand_sum = sqrt(colsums.sum())
+    empty = rowsums == 0.0
+    rowsums = where(empty, 1.0, rowsums)
+    colsums = sqrt(where(colsums == 0.0, 1.0, colsums))
+    def row_f(block, rows, columns):
+        cols = colsums if columns is None else colsums[columns]
+        return block / rowsums[rows,newaxis] / cols
+    def pair_f(a, b, ia, ib):
+        dists = sqrt_grand_sum * _euclidean_pairs(a, b, ia, ib)
+        return _with_empty_rows(dists, empty[ia], empty[ib])
+    return _pairwise(datamtx, pair_f, block_size, dtype, row_f)
+
+def dist_chord(datamtx, strict=True, block_size=None, dtype='d'):
     """returns a row-row chord dist matrix
 
     attributed to Orloci (with accent).  see Legendre 2001,
@@ -403,38 +595,18 @@ def dist_chord(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict, allow_negative=True)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i] # cache here
-        r1norm = norm(r1)
-        for j in range(i):
-            r2 = datamtx[j]
-            r2norm = norm(r2)
-            if r1norm == 0.0 or r2norm == 0.0:
-                if r1norm == 0.0 and r2norm == 0.0:
-                    dist = 0.0
-                else: dist = 1.0
-            else:
-                dist = norm(r1/r1norm - r2/r2norm)
-            dists[i,j] = dists[j,i] = dist
 
-    return dists
+    norms = _reduce_rows(datamtx, lambda m: sqrt(square(m).sum(axis=1)))
+    empty = norms == 0.0
+    def pair_f(a, b, ia, ib):
+        dists = _euclidean_pairs(a, b, ia, ib)
+        return _with_empty_rows(dists, empty[ia], empty[ib])
+    return _pairwise(datamtx, pair_f, block_size, dtype, _scaled_rows(norms))
 
-def dist_euclidean(datamtx, strict=True):
+def dist_euclidean(datamtx, strict=True, block_size=None, dtype='d'):
     """returns a row by row euclidean dist matrix
     
     returns the euclidean norm of row1 - row2 for all rows in datamtx
@@ -449,32 +621,16 @@ def dist_euclidean(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    datamtx = asarray(datamtx, 'd')
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict, allow_negative=True)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for r in range(numrows):
-        for c in range(r):
-            dist = norm(datamtx[r] - datamtx[c])
-            if isnan(dist):
-                raise RuntimeError('ERROR: overflow when computing euclidean distance')
-            dists[r,c] = dists[c,r] = dist
 
+    dists = _pairwise(datamtx, _euclidean_pairs, block_size, dtype)
+    if isnan(dists).any():
+        raise RuntimeError('ERROR: overflow when computing euclidean distance')
     return dists
 
-def dist_gower(datamtx, strict=True):
+def dist_gower(datamtx, strict=True, block_size=None, dtype='d'):
     """returns a row-row gower dist matrix
     
     see for example, Faith et al., 1987
@@ -496,37 +652,22 @@ def dist_gower(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict, allow_negative=True)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    coldiffs = datamtx.max(axis=0) - datamtx.min(axis=0)
-    for i in range(numcols):
-        if coldiffs[i] == 0.0:
-            coldiffs[i] = 1.0 # numerator will be zero anyway
-
-    for i in range(numrows):
-        r1 = datamtx[i]
-        for j in range(i):
-            r2 = datamtx[j]
-            rowdiff = r2 - r1
-            dist = sum(abs(r1 - r2) / coldiffs)
-            dists[i,j] = dists[j,i] = dist
 
-    return dists
-
-def dist_hellinger(datamtx, strict=True):
+    colmax = _reduce_columns(datamtx, lambda m: m.max(axis=0), maximum)
+    colmin = _reduce_columns(datamtx, lambda m: m.min(axis=0), minimum)
+    coldiffs = colmax - colmin
+    coldiffs[coldiffs == 0.0] = 1.0 # numerator will be zero anyway
+    def row_f(block, rows, columns):
+        return block / (coldiffs if columns is None else coldiffs[columns])
+    def pair_f(a, b, ia, ib):
+        return _summed_terms(_abs_diff_terms, a, b)[0]
+    return _pairwise(datamtx, pair_f, block_size, dtype, row_f, 
+        compress=True)
+
+def dist_hellinger(datamtx, strict=True, block_size=None, dtype='d'):
     """returns a row-row hellinger dist matrix
     
     * comparisons are between rows (samples)
@@ -542,40 +683,21 @@ def dist_hellinger(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i]
-        r1sum = sum(r1)
-        for j in range(i):
-            r2 = datamtx[j]
-            r2sum = sum(r2)
-            if r1sum == 0.0 or r2sum == 0.0:
-                if r1sum == 0.0 and r2sum == 0.0:
-                    dist = 0.0
-                else: dist = 1.0
-            else:
-                dist = norm(sqrt(r1/r1sum) - sqrt(r2/r2sum))
-            dists[i,j] = dists[j,i] = dist
 
-    return dists
-
-def dist_kulczynski(datamtx, strict=True):
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    empty = rowsums == 0.0
+    scale_f = _scaled_rows(rowsums)
+    def row_f(block, rows, columns):
+        return sqrt(scale_f(block, rows, columns))
+    def pair_f(a, b, ia, ib):
+        dists = _euclidean_pairs(a, b, ia, ib)
+        return _with_empty_rows(dists, empty[ia], empty[ib])
+    return _pairwise(datamtx, pair_f, block_size, dtype, row_f)
+
+def dist_kulczynski(datamtx, strict=True, block_size=None, dtype='d'):
     """ calculates the kulczynski distances between rows of a matrix
     
     see for example Faith et al., composiitonal dissimilarity, 1987
@@ -595,43 +717,18 @@ def dist_kulczynski(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    rowsums = datamtx.sum(axis=1)
-    # rowsum: the sum of elements in a row
-    # cache to avoid recalculating for each pair
-    for i in range(numrows):
-        irowsum = rowsums[i]
-        r1 = datamtx[i]
-        for j in range(i):
-            r2 = datamtx[j]
-            jrowsum = rowsums[j]
-            rowminsum = float(sum(where(r1<r2, r1,r2)))
-            if (irowsum == 0.0 and jrowsum == 0.0):
-                cur_d = 0.0 # => two rows of zeros
-            elif (irowsum == 0.0 or jrowsum == 0.0):
-                cur_d = 1.0 # one row zeros, one not all zeros
-            else:
-                cur_d = 1.0 - (((rowminsum/irowsum) + (rowminsum/jrowsum))/2.0)
-            dists[i][j] = dists[j][i] = cur_d
-    return dists
 
-def dist_manhattan(datamtx, strict=True):
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    empty = rowsums == 0.0
+    minsums = _min_sums(datamtx, block_size, dtype)
+    dists = 1.0 - (_ratio(minsums, rowsums[:,newaxis]) + 
+        _ratio(minsums, rowsums[newaxis,:]))/2.0
+    return _finished(_with_empty_rows(dists, empty, empty), dtype)
+
+def dist_manhattan(datamtx, strict=True, block_size=None, dtype='d'):
     """ returns manhattan (city block) distance between rows
 
     dist(a,b) = sum on i( abs(a_i - b_i) )
@@ -648,29 +745,20 @@ def dist_manhattan(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict, allow_negative=True)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i] # cache here
-        for j in range(i):
-            dists[i,j] = dists[j,i] = sum(abs(r1 - datamtx[j]))
-            
-    return dists
 
-def dist_abund_jaccard(datamtx, strict=True):
+    def pair_f(a, b, ia, ib):
+        return _summed_terms(_abs_diff_terms, a, b)[0]
+    if not _use_cooccurrence(datamtx):
+        return _pairwise(datamtx, pair_f, block_size, dtype, compress=True)
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    minsums = _min_sums(datamtx, block_size, dtype)
+    dists = rowsums[:,newaxis] + rowsums[newaxis,:] - 2*minsums
+    return _finished(dists, dtype)
+
+def dist_abund_jaccard(datamtx, strict=True, block_size=None, dtype='d'):
     """Calculate abundance-based Jaccard distance between rows
 
     The abundance-based Jaccard index is defined in Chao et. al.,
@@ -696,52 +784,21 @@ def dist_abund_jaccard(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    
-    rowsums = datamtx.sum(axis=1, dtype='float')
-
-    for i in range(numrows):
-        row1 = datamtx[i]
-        N1 = rowsums[i]
-
-        for j in range(i):
-            row2 = datamtx[j]
-            N2 = rowsums[j]
-
-            if N1 == 0.0 and N2 == 0.0:
-                similarity = 1.0
-            elif N1 == 0.0 or N2 == 0.0:
-                similarity = 0.0
-            else:
-                shared = logical_and(row1, row2)
-                u = sum(row1[shared]) / N1
-                v = sum(row2[shared]) / N2
-                # Verified by graphical inspection
-                if u == 0.0 and v == 0.0:
-                    similarity = 0.0
-                else:
-                    similarity = (u * v) / (u + v - (u * v))
-
-            dists[i][j] = dists[j][i] = 1 - similarity
-    return dists
 
-def dist_morisita_horn(datamtx, strict=True):
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1, dtype='float'))
+    empty = rowsums == 0.0
+    def pair_f(a, b, ia, ib):
+        u = _ratio(dot(a, (b != 0).T), rowsums[ia,newaxis])
+        v = _ratio(dot(a != 0, b.T), rowsums[newaxis,ib])
+        # Verified by graphical inspection
+        similarity = _ratio(u * v, u + v - (u * v))
+        return _with_empty_rows(1 - similarity, empty[ia], empty[ib])
+    return _pairwise(datamtx, pair_f, block_size, dtype)
+
+def dist_morisita_horn(datamtx, strict=True, block_size=None, dtype='d'):
     """ returns morisita-horn distance between rows
 
     dist(a,b) = 1 - 2*sum(a_i * b_i) /( (d_a + d_b)* N_a * N_b )
@@ -761,52 +818,23 @@ def dist_morisita_horn(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    
-    rowsums = datamtx.sum(axis=1, dtype='float')
-    row_ds = (datamtx**2).sum(axis=1, dtype='float') # these are d_a, etc
-    
-    for i in range(numrows):
-        if row_ds[i] !=0.:
-            row_ds[i] = row_ds[i] / rowsums[i]**2
-    # this leaves row_ds zero if actually 0/0
-    for i in range(numrows):
-        row1 = datamtx[i]
-        N1 = rowsums[i]
-        d1 = row_ds[i]
-        for j in range(i):
-            row2 = datamtx[j]
-            N2 = rowsums[j]
-            d2 = row_ds[j]
-            if N2 == 0.0 and N1==0.0:
-                dist = 0.0
-            elif N2 == 0.0 or N1==0.0:
-                dist = 1.0
-            else:
-            # d's zero only if N's zero, and we already checked for that
-                similarity = 2*sum(row1*row2)
-                similarity = similarity / ( (d1 + d2) * N1 * N2 )
-                dist = 1 - similarity
-            dists[i][j] = dists[j][i] = dist
-    return dists
 
-def dist_pearson(datamtx, strict=True):
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1, dtype='float'))
+    # these are d_a, etc; left zero if actually 0/0
+    row_ds = _ratio(_reduce_rows(datamtx, 
+        lambda m: (m**2).sum(axis=1, dtype='float')), rowsums**2)
+    empty = rowsums == 0.0
+    def pair_f(a, b, ia, ib):
+        # d's zero only if N's zero, and those are set by _with_empty_rows
+        similarity = _ratio(2*dot(a, b.T), (row_ds[ia,newaxis] + 
+            row_ds[newaxis,ib]) * rowsums[ia,newaxis] * rowsums[newaxis,ib])
+        return _with_empty_rows(1 - similarity, empty[ia], empty[ib])
+    return _pairwise(datamtx, pair_f, block_size, dtype)
+
+def dist_pearson(datamtx, strict=True, block_size=None, dtype='d'):
     """ Calculates pearson distance (1-r) between rows
 
     
@@ -833,52 +861,24 @@ def dist_pearson(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict, allow_negative=True)
+    if datamtx is None:
         return zeros((0,0),'d')
 
-    rowmeans =  mean(datamtx, axis=1)
-    rowstds =  std(datamtx, axis=1)
-
-    dists = zeros((numrows,numrows),'d')
-    n = float(numrows)
-
-    for i in range(numrows):
-        r1 = datamtx[i,:]
-        r1m = rowmeans[i]
-        r1dev = r1 - r1m
-        for j in range(i):
-            r2 = datamtx[j,:]
-            r2m = rowmeans[j]
-            r2dev = r2 - r2m
-            top = sum(r1dev*r2dev)
-            sum1 = sum(r1dev**2)
-            sum2 = sum(r2dev**2)
-
-            if (sum1 == 0.0 and sum2 == 0.0):
-                r = 1.0
-            elif (sum1 == 0.0 or sum2 == 0.0):
-                r = 0.0
-            else:
-                bottom = sqrt(sum1 * sum2)
-                r = top/bottom
-                
-            dists[i][j] = dists[j][i] = 1.0 - r
-            
-    return dists
-
-def dist_soergel(datamtx, strict=True):
+    rowmeans = _reduce_rows(datamtx, lambda m: mean(m, axis=1))
+    def row_f(block, rows, columns):
+        return block - rowmeans[rows,newaxis]
+    devsums = _reduce_rows(datamtx, 
+        lambda m: ((m - mean(m, axis=1)[:,newaxis])**2).sum(axis=1))
+    flat = devsums == 0.0
+    def pair_f(a, b, ia, ib):
+        bottom = sqrt(devsums[ia,newaxis] * devsums[newaxis,ib])
+        r = _ratio(dot(a, b.T), bottom)
+        r[flat[ia,newaxis] & flat[newaxis,ib]] = 1.0
+        return 1.0 - r
+    return _pairwise(datamtx, pair_f, block_size, dtype, row_f)
+
+def dist_soergel(datamtx, strict=True, block_size=None, dtype='d'):
     """ Calculate soergel distance between rows of a matrix
     
     see for example Evaluation of Distance Metrics..., Fechner 2004
@@ -897,37 +897,18 @@ def dist_soergel(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i,:]
-        for j in range(i):
-            r2 = datamtx[j,:]
-            top = float(sum(abs(r1 - r2)))
-            bot = float(sum(where(r1>r2, r1,r2)))
-            if bot <= 0.0:
-                cur_d = 0.0
-            else:
-                cur_d = top/bot
-            dists[i][j] = dists[j][i] = cur_d
-    return dists
 
-def dist_spearman_approx(datamtx, strict=True):
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    totals = rowsums[:,newaxis] + rowsums[newaxis,:]
+    minsums = _min_sums(datamtx, block_size, dtype)
+    # abs(a_i - b_i) = a_i + b_i - 2*min, and max(a_i, b_i) = a_i + b_i - min
+    top, bot = totals - 2*minsums, totals - minsums
+    return _finished(where(bot <= 0.0, 0.0, _ratio(top, bot)), dtype)
+
+def dist_spearman_approx(datamtx, strict=True, block_size=None, dtype='d'):
     """ Calculate spearman rank distance (1-r) using an approximation formula
     
     considers only rank order of elements in a row, averaging ties 
@@ -949,41 +930,27 @@ def dist_spearman_approx(datamtx, strict=True):
     If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-        if numcols < 2:
-            raise ValueError("input matrix has < 2 colunms")
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    checked = _prepare(datamtx, strict, allow_negative=True)
+    if strict and shape(datamtx)[1] < 2:
+        raise ValueError("input matrix has < 2 colunms")
+    datamtx = checked
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    
-    if numcols < 2:
-        return dists # formula fails for < 2 elements per row
-    
-    for i in range(numrows):
-        r1 = datamtx[i,:]
-        rank1 = _rankdata(r1)
-        for j in range(i):
-            r2 = datamtx[j,:]
-            rank2 = _rankdata(r2)
-            rankdiff = rank1 - rank2
-            dsqsum = sum((rankdiff)**2)
-            dist = 6*dsqsum / float(numcols*(numcols**2-1))
-            
-            dists[i][j] = dists[j][i] = dist
-    return dists
 
-def dist_specprof(datamtx, strict=True):
+    numrows, numcols = datamtx.shape
+    if numcols < 2:
+        return zeros((numrows,numrows),'d') # formula fails for < 2 elements
+
+    def row_f(block, rows, columns):
+        return array([_rankdata(row) for row in block], block.dtype)
+    ranksq = _reduce_rows(datamtx, 
+        lambda m: square(row_f(m, None, None)).sum(axis=1))
+    def pair_f(a, b, ia, ib):
+        dsqsum = ranksq[ia,newaxis] + ranksq[newaxis,ib] - 2*dot(a, b.T)
+        return 6*dsqsum / float(numcols*(numcols**2-1))
+    return _pairwise(datamtx, pair_f, block_size, dtype, row_f)
+
+def dist_specprof(datamtx, strict=True, block_size=None, dtype='d'):
     """returns a row-row species profile distance matrix
     
     * comparisons are between rows (samples)
@@ -999,69 +966,57 @@ def dist_specprof(datamtx, strict=True):
     entries.  If rank of input data is < 2, returns an empty 2d array (shape:
     (0, 0) ).  If 0 rows or 0 colunms, also returns an empty 2d array.
     """
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    for i in range(numrows):
-        r1 = datamtx[i]
-        r1sum = sum(r1)
-        for j in range(i):
-            r2 = datamtx[j]
-            r2sum = sum(r2)
-            if r1sum == 0.0 or r2sum == 0.0:
-                if r1sum == 0.0 and r2sum == 0.0:
-                    dist = 0.0
-                else: dist = 1.0
-            else:
-                dist = norm((r1/r1sum) - (r2/r2sum))
-            dists[i,j] = dists[j,i] = dist
 
-    return dists
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    empty = rowsums == 0.0
+    def pair_f(a, b, ia, ib):
+        dists = _euclidean_pairs(a, b, ia, ib)
+        return _with_empty_rows(dists, empty[ia], empty[ib])
+    return _pairwise(datamtx, pair_f, block_size, dtype, 
+        _scaled_rows(rowsums))
 
-def binary_dist_otu_gain(otumtx):
+def binary_dist_otu_gain(otumtx, strict=True, block_size=None, dtype=None):
     """ Calculates number of new OTUs observed in sample A wrt sample B
     
         This is an non-phylogenetic distance matrix analagous to unifrac_g. 
         The number of OTUs gained in each sample is computed with respect to
         each other sample.
+
+        result[i,j] is the number of OTUs present (> 0) in row i but not in
+        row j, so unlike the other metrics the result is not symmetric.  It
+        is an int array unless dtype is given.
     
     """
-    result = []
-    for i in otumtx:
-        row = []
-        for j in otumtx:
-            gain = 0
-            for i_val, j_val in zip(i, j):
-                if i_val > 0 and j_val == 0:
-                    gain += 1
-            row.append(gain)
-        result.append(row)
-    return array(result)
-
-def binary_dist_chisq(datamtx, strict=True):
+    otumtx = _prepare(otumtx, strict, allow_negative=True)
+    if otumtx is None:
+        return zeros((0,0), dtype or int)
+
+    present = _reduce_rows(otumtx, lambda m: (m > 0).sum(axis=1))
+    def row_f(block, rows, columns):
+        return (block > 0).astype(block.dtype)
+    def pair_f(a, b, ia, ib):
+        return dot(a, b.T)
+    # the OTUs shared by each pair are symmetric, the gains are not
+    shared = _pairwise(otumtx, pair_f, block_size, dtype or 'd', row_f,
+        compress=True)
+    gains = present[:,newaxis] - shared
+    fill_diagonal(gains, 0)
+    return gains.astype(dtype or int)
+
+def binary_dist_chisq(datamtx, strict=True, block_size=None, dtype='d'):
     """Calculates binary chi-square dist between rows, returns dist matrix.
 
     converts input array to bool, then uses dist_chisq
     """
     datamtx = datamtx.astype(bool)
     datamtx = datamtx.astype(float)
-    return dist_chisq(datamtx, strict=True)
+    return dist_chisq(datamtx, strict=True, block_size=block_size,
+        dtype=dtype)
 
-def binary_dist_chord(datamtx, strict=True):
+def binary_dist_chord(datamtx, strict=True, block_size=None, dtype='d'):
     """Calculates binary chord dist between rows, returns dist matrix.
 
     converts input array to bool, then uses dist_chisq
@@ -1069,9 +1024,11 @@ def binary_dist_chord(datamtx, strict=True):
     """
     datamtx = datamtx.astype(bool)
     datamtx = datamtx.astype(float)
-    return dist_chord(datamtx, strict=True)
+    return dist_chord(datamtx, strict=True, block_size=block_size,
+        dtype=dtype)
 
-def binary_dist_sorensen_dice(datamtx, strict=True):
+def binary_dist_sorensen_dice(datamtx, strict=True, block_size=None,
+    dtype='d'):
     """Calculates Sorensen-Dice distance btw rows, returning distance matrix.
 
     Note: Treats array as bool. This distance = 1 - dice's coincidence index
@@ -1100,46 +1057,27 @@ def binary_dist_sorensen_dice(datamtx, strict=True):
     """
     datamtx = datamtx.astype(bool)
     datamtx = datamtx.astype(float)
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    rowsums = datamtx.sum(axis=1)
-    
-    for i in range(numrows):
-        row1 = datamtx[i]
-        for j in range(i):
-            row2 = datamtx[j]
-            bottom = float(rowsums[i] + rowsums[j])
-            cur_d = 0.0
-            if bottom:
-                cur_d = 1-(2*logical_and(row1,row2).sum()/bottom)
-            dists[i][j] = dists[j][i] = cur_d
-    return dists
 
-def binary_dist_euclidean(datamtx, strict=True):
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    def pair_f(a, b, ia, ib):
+        bottom = rowsums[ia,newaxis] + rowsums[newaxis,ib]
+        return where(bottom == 0, 0.0, 1 - _ratio(2*dot(a, b.T), bottom))
+    return _pairwise(datamtx, pair_f, block_size, dtype)
+
+def binary_dist_euclidean(datamtx, strict=True, block_size=None, dtype='d'):
     """Calculates binary euclidean distance between rows, returns dist matrix.
 
     converts input array to bool, then uses dist_euclidean
     """
     datamtx = datamtx.astype(bool)
     datamtx = datamtx.astype(float)
-    return dist_euclidean(datamtx, strict=True)
+    return dist_euclidean(datamtx, strict=True, block_size=block_size,
+        dtype=dtype)
 
-def binary_dist_hamming(datamtx, strict=True):
+def binary_dist_hamming(datamtx, strict=True, block_size=None, dtype='d'):
     """Calculates hamming distance btw rows, returning distance matrix.
 
     Note: Treats array as bool. 
@@ -1167,37 +1105,16 @@ def binary_dist_hamming(datamtx, strict=True):
     """
     datamtx = datamtx.astype(bool)
     datamtx = datamtx.astype(float)
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    rowsums = datamtx.sum(axis=1)
-    
-    for i in range(numrows):
-        first = datamtx[i]
-        a = rowsums[i]
-        for j in range(i):
-            second = datamtx[j]
-            b = rowsums[j]
-            c = float(logical_and(first, second).sum())
-            dist = a + b - (2.0*c)
-            dists[i][j] = dists[j][i] = dist
-    return dists
-    
-def binary_dist_jaccard(datamtx, strict=True):
+
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    def pair_f(a, b, ia, ib):
+        return rowsums[ia,newaxis] + rowsums[newaxis,ib] - 2.0*dot(a, b.T)
+    return _pairwise(datamtx, pair_f, block_size, dtype)
+
+def binary_dist_jaccard(datamtx, strict=True, block_size=None, dtype='d'):
     """Calculates jaccard distance between rows, returns distance matrix.
 
     converts matrix to boolean.  jaccard dist = 1 - jaccard index
@@ -1225,40 +1142,18 @@ def binary_dist_jaccard(datamtx, strict=True):
     """
     datamtx = datamtx.astype(bool)
     datamtx = datamtx.astype(float)
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    
-    rowsums = datamtx.sum(axis=1)
-    for i in range(numrows):
-        first = datamtx[i]
-        a = rowsums[i]
-        for j in range(i):
-            second = datamtx[j]
-            b = rowsums[j]
-            c = float(logical_and(first, second).sum())
-            if a==0.0 and b==0.0:
-                dist = 0.0
-            else:
-                dist = 1.0 - (c/(a+b-c))
-            dists[i][j] = dists[j][i] = dist
-    return dists
 
-def binary_dist_lennon(datamtx, strict=True):
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    def pair_f(a, b, ia, ib):
+        c = dot(a, b.T)
+        union = rowsums[ia,newaxis] + rowsums[newaxis,ib] - c
+        return where(union == 0.0, 0.0, 1.0 - _ratio(c, union))
+    return _pairwise(datamtx, pair_f, block_size, dtype)
+
+def binary_dist_lennon(datamtx, strict=True, block_size=None, dtype='d'):
     """Calculates lennon distance between rows, returns distance matrix.
 
     converts matrix to boolean.  jaccard dist = 1 - lennon similarity
@@ -1286,42 +1181,21 @@ def binary_dist_lennon(datamtx, strict=True):
     """
     datamtx = datamtx.astype(bool)
     datamtx = datamtx.astype(float)
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    
-    rowsums = datamtx.sum(axis=1)
-    for i in range(numrows):
-        first = datamtx[i]
-        a = rowsums[i]
-        for j in range(i):
-            second = datamtx[j]
-            b = rowsums[j]
-            c = float(logical_and(first, second).sum())
-            if a==0.0 and b==0.0:
-                dist = 0.0
-            elif c==0.0:
-                dist = 1.0
-            else:
-                dist = 1.0 - (c/(c + min([a-c,b-c])))
-            dists[i][j] = dists[j][i] = dist
-    return dists
 
-def binary_dist_ochiai(datamtx, strict=True):
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    def pair_f(a, b, ia, ib):
+        c = dot(a, b.T)
+        a, b = rowsums[ia,newaxis], rowsums[newaxis,ib]
+        dists = 1.0 - _ratio(c, c + minimum(a-c, b-c))
+        dists[c == 0.0] = 1.0
+        dists[(a == 0.0) & (b == 0.0)] = 0.0
+        return dists
+    return _pairwise(datamtx, pair_f, block_size, dtype)
+
+def binary_dist_ochiai(datamtx, strict=True, block_size=None, dtype='d'):
     """Calculates ochiai distance btw rows, returning distance matrix.
 
     Note: Treats array as bool. 
@@ -1349,42 +1223,19 @@ def binary_dist_ochiai(datamtx, strict=True):
     """
     datamtx = datamtx.astype(bool)
     datamtx = datamtx.astype(float)
-    if strict:
-        if not all(isfinite(datamtx)):
-            raise ValueError("non finite number in input matrix")
-        if any(datamtx<0.0):
-            raise ValueError("negative value in input matrix")
-        if rank(datamtx) != 2:
-            raise ValueError("input matrix not 2D")
-        numrows, numcols = shape(datamtx)
-    else:
-        try:
-            numrows, numcols = shape(datamtx)
-        except ValueError:
-            return zeros((0,0),'d')
-
-    if numrows == 0 or numcols == 0:
+    datamtx = _prepare(datamtx, strict)
+    if datamtx is None:
         return zeros((0,0),'d')
-    dists = zeros((numrows,numrows),'d')
-    rowsums = datamtx.sum(axis=1)
-    
-    for i in range(numrows):
-        first = datamtx[i]
-        a = rowsums[i]
-        for j in range(i):
-            second = datamtx[j]
-            b = rowsums[j]
-            c = float(logical_and(first, second).sum())
-            if a==0.0 and b==0.0:
-                dist = 0.0
-            elif a==0.0 or b==0.0:
-                dist = 1.0
-            else:
-                dist = 1.0 - (c/sqrt(a*b))
-            dists[i][j] = dists[j][i] = dist
-    return dists
-    
-def binary_dist_pearson(datamtx, strict=True):
+
+    rowsums = _reduce_rows(datamtx, lambda m: m.sum(axis=1))
+    empty = rowsums == 0.0
+    def pair_f(a, b, ia, ib):
+        dists = 1.0 - _ratio(dot(a, b.T), 
+            sqrt(rowsums[ia,newaxis] * rowsums[newaxis,ib]))
+        return _with_empty_rows(dists, empty[ia], empty[ib])
+    return _pairwise(datamtx, pair_f, block_size, dtype)
+
+def binary_dist_pearson(datamtx, strict=True, block_size=None, dtype='d'):
     """Calculates binary pearson distance between rows, returns distance matrix
 
     converts input array to bool, then uses dist_pearson
@@ -1392,7 +1243,8 @@ def binary_dist_pearson(datamtx, strict=True):
 
     datamtx = datamtx.astype(bool)
     datamtx = datamtx.astype(float)
-    return dist_pearson(datamtx, strict=True)
+    return dist_pearson(datamtx, strict=True, block_size=block_size,
+        dtype=dtype)
 
 
 if __name__ == "__main__":
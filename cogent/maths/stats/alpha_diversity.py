@@ -3,7 +3,8 @@ from __future__ import division
 from cogent.maths.stats.special import lgam
 from cogent.maths.optimisers import minimise
 from math import ceil, e
-from numpy import array, zeros, concatenate, arange, log, sqrt, exp, asarray
+from numpy import array, zeros, concatenate, arange, log, sqrt, exp, asarray, \
+    bincount, repeat, diff, lexsort, unique, maximum, where, seterr, nan
 from cogent.maths.scipy_optimize import fmin_powell
 import cogent.maths.stats.rarefaction as rarefaction
 
@@ -493,3 +494,211 @@ def diversity(indices,f=chao1,step=1,start=None,verbose=False):
         i=j
     return array(result)
 
+class _TableCells(object):
+    """Nonzero cells of a samples x OTUs table, with per-sample reductions.
+
+    Reductions (Totals, Observed, Singles, ...) are computed on first use and
+    then shared between the table-level metrics.
+    """
+    def __init__(self, table):
+        if hasattr(table, 'tocsr'):
+            table = table.tocsr()
+            num_samples, num_otus = table.shape
+            rows = repeat(arange(num_samples), diff(table.indptr))
+            cols, values = table.indices, table.data
+        else:
+            table = asarray(table)
+            num_samples, num_otus = table.shape
+            rows, cols = table.nonzero()
+            values = table[rows, cols]
+        nonzero = values != 0
+        self.Rows, self.Cols = rows[nonzero], cols[nonzero]
+        self.Values = values[nonzero]
+        self.NumSamples, self.NumOtus = num_samples, num_otus
+
+    def __getattr__(self, name):
+        calc_f = getattr(type(self), '_calc_' + name, None)
+        if calc_f is None:
+            raise AttributeError(name)
+        value = calc_f(self)
+        setattr(self, name, value)
+        return value
+
+    def rowSums(self, values):
+        """Returns sum of values (one per cell) for each sample."""
+        return bincount(self.Rows, values, minlength=self.NumSamples)
+
+    def row(self, i):
+        """Returns the count vector of sample i."""
+        result = zeros(self.NumOtus, self.Values.dtype)
+        start = self.RowStarts[i]
+        in_row = slice(start, start + self.Observed[i])
+        result[self.Cols[in_row]] = self.Values[in_row]
+        return result
+
+    def _calc_Totals(self):
+        return self.rowSums(self.Values)
+
+    def _calc_Observed(self):
+        return bincount(self.Rows, minlength=self.NumSamples)
+
+    def _calc_Singles(self):
+        return self.rowSums(self.Values == 1)
+
+    def _calc_Doubles(self):
+        return self.rowSums(self.Values == 2)
+
+    def _calc_SumSquares(self):
+        return self.rowSums(self.Values**2)
+
+    def _calc_PLogP(self):
+        freqs = self.Values / self.Totals[self.Rows]
+        result = self.rowSums(freqs*log(freqs))
+        #undefined, not zero, for an empty sample
+        result[self.Observed == 0] = nan
+        return result
+
+    def _calc_RowStarts(self):
+        return concatenate(([0], self.Observed.cumsum()[:-1]))
+
+    def _calc_Ascending(self):
+        return self.Values[lexsort((self.Values, self.Rows))]
+
+    def _calc_Max(self):
+        result = zeros(self.NumSamples, self.Values.dtype)
+        occupied = self.Observed > 0
+        ends = self.RowStarts + self.Observed - 1
+        result[occupied] = self.Ascending[ends[occupied]]
+        return result
+
+    def orderStatistic(self, k):
+        """Returns k'th smallest count (from 0, including zeros) per sample."""
+        num_zeros = self.NumOtus - self.Observed
+        result = zeros(self.NumSamples, self.Values.dtype)
+        nonzero = k >= num_zeros
+        index = (self.RowStarts + k - num_zeros)[nonzero]
+        result[nonzero] = self.Ascending[index]
+        return result
+
+def _lgam_array(a):
+    """Returns lgam of each item of a, evaluated once per distinct value."""
+    values, inverse = unique(a, return_inverse=True)
+    return array(map(lgam, values))[inverse]
+
+def _brillouin_d_table(cells):
+    n = cells.Totals
+    return (_lgam_array(n+1) - cells.rowSums(_lgam_array(cells.Values+1)))/n
+
+def _kempton_taylor_q_table(cells, lower_quantile=.25, upper_quantile=.75):
+    n = cells.NumOtus
+    lower = int(ceil(n*lower_quantile))
+    upper = int(n*upper_quantile)
+    return (upper-lower)/log(cells.orderStatistic(upper) / 
+        cells.orderStatistic(lower))
+
+def _strong_table(cells):
+    #the max over sorted counts is reached before the zeros, where terms < 0
+    values = cells.Values[lexsort((-cells.Values, cells.Rows))]
+    rows = cells.Rows
+    cumsums = values.cumsum()
+    before_row = (cumsums - values)[cells.RowStarts][rows]
+    ranks = arange(len(rows)) - cells.RowStarts[rows] + 1
+    terms = (cumsums - before_row)/cells.Totals[rows] - \
+        ranks/cells.Observed[rows].astype(float)
+    result = zeros(cells.NumSamples)
+    result.fill(nan)
+    occupied = cells.Observed > 0
+    if occupied.any():
+        result[occupied] = maximum.reduceat(terms, 
+            cells.RowStarts[occupied])
+    return result
+
+def _ace_table(cells, rare_threshold=10):
+    values = cells.Values
+    freq_counts = zeros((rare_threshold+1, cells.NumSamples))
+    for i in range(1, rare_threshold+1):
+        freq_counts[i] = cells.rowSums(values == i)
+    singletons = freq_counts[1]
+    #as in ACE, only counts below the threshold decide the special cases
+    below_threshold = freq_counts[1:rare_threshold].sum(0)
+    s_rare = freq_counts.sum(0)
+    s_abun = cells.Observed - s_rare
+    weights = arange(rare_threshold+1)[:,None]
+    n_rare = (weights*freq_counts).sum(0)
+    c_ace = 1 - singletons/n_rare
+    top = s_rare*(weights*(weights-1)*freq_counts).sum(0)
+    bottom = c_ace*n_rare*(n_rare-1.0)
+    gamma_ace = maximum(top/bottom - 1.0, 0)
+    result = s_abun + s_rare/c_ace + singletons/c_ace*gamma_ace
+    result[singletons == below_threshold] = nan
+    return where(below_threshold == 0, s_abun, result)
+
+#table-level metrics: f(_TableCells) -> one value per sample
+TABLE_METRICS = {
+    'singles': lambda c: c.Singles,
+    'doubles': lambda c: c.Doubles,
+    'observed_species': lambda c: c.Observed,
+    'margalef': lambda c: (c.Observed - 1)/log(c.Totals),
+    'menhinick': lambda c: c.Observed/sqrt(c.Totals),
+    'dominance': lambda c: c.SumSquares/c.Totals**2,
+    'simpson': lambda c: 1 - c.SumSquares/c.Totals**2,
+    'reciprocal_simpson': lambda c: 1/(1 - c.SumSquares/c.Totals**2),
+    'simpson_reciprocal': lambda c: c.Totals**2/c.SumSquares,
+    'shannon': lambda c: -c.PLogP/log(2),
+    'equitability': lambda c: -c.PLogP/log(c.Observed),
+    'berger_parker_d': lambda c: c.Max/c.Totals,
+    'mcintosh_d': lambda c: (c.Totals - sqrt(c.SumSquares)) / \
+        (c.Totals - sqrt(c.Totals)),
+    'brillouin_d': _brillouin_d_table,
+    'kempton_taylor_q': _kempton_taylor_q_table,
+    'strong': _strong_table,
+    'mcintosh_e': lambda c: sqrt(c.SumSquares) / \
+        sqrt((c.Totals - c.Observed + 1)**2 + c.Observed - 1),
+    'heip_e': lambda c: exp(-c.PLogP - 1)/(c.Observed - 1),
+    'simpson_e': lambda c: 1/(1 - c.SumSquares/c.Totals**2)/c.Observed,
+    'robbins': lambda c: c.Singles/c.Totals,
+    'chao1': lambda c: c.Observed + c.Singles*(c.Singles-1) / \
+        (2.0*(c.Doubles+1)),
+    'ACE': _ace_table,
+}
+
+def table_diversity(table, metrics=('observed_species', 'shannon', 'chao1')):
+    """Returns samples x metrics array of alpha diversity for an OTU table.
+
+    table: samples x OTUs counts, either an array or a sparse matrix (any
+    object with a tocsr method, e.g. from scipy.sparse).
+    metrics: names of diversity functions in this module, or functions
+    f(counts) -> diversity measure.
+
+    Metrics in TABLE_METRICS (with their default parameters) are computed for
+    every sample at once, sharing totals, singleton/doubleton counts and
+    p*log(p) sums between them. Others, e.g. fisher_alpha and
+    michaelis_menten_fit, are applied to one sample at a time. Values that
+    are undefined for a sample (e.g. ACE when only singletons are rare) are
+    nan rather than raising.
+    """
+    cells = _TableCells(table)
+    result = zeros((cells.NumSamples, len(metrics)))
+    oldstate = seterr(divide='ignore', invalid='ignore')
+    try:
+        for i, metric in enumerate(metrics):
+            if metric in TABLE_METRICS:
+                result[:,i] = TABLE_METRICS[metric](cells)
+                continue
+            if isinstance(metric, str):
+                metric = globals()[metric]
+            for j in range(cells.NumSamples):
+                try:
+                    result[j,i] = metric(cells.row(j))
+                except (ZeroDivisionError, ValueError, RuntimeError):
+                    result[j,i] = nan
+    finally:
+        seterr(**oldstate)
+    return result
+
+def table_metric(metric):
+    """Returns f(table) -> metric for each sample, e.g. for rarefaction_alpha.
+    
+    metric is anything table_diversity accepts in its metrics list.
+    """
+    return lambda table: table_diversity(table, [metric])[:,0]
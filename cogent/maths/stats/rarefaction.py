@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 from numpy import concatenate, repeat, array, zeros, histogram, arange, uint, zeros
-from numpy.random import permutation, randint, sample, multinomial
+from numpy import asarray, minimum, newaxis, bincount, diff, empty, where
+from numpy.random import permutation, randint, sample, multinomial, \
+    hypergeometric, RandomState
 from random import Random, _ceil, _log
 
 """Given array of objects (counts or indices), perform rarefaction analyses."""
@@ -14,6 +16,7 @@ __maintainer__ = "Rob Knight"
 __email__ = "rob@spot.colorado.edu"
 __status__ = "Development"
 
+MAX_RAREFACTION_ELEMENTS = 2**24
 
 class MyRandom(Random):
     """Adding a method to sample from array only"""
@@ -82,6 +85,47 @@ _inst = MyRandom()
 sample = _inst.sample_array
 
 
+def _hypergeometric(good, bad, n, hypergeometric_f=hypergeometric):
+    """Returns hypergeometric_f draws, skipping those that are certain."""
+    result = where(bad == 0, n, 0)
+    to_draw = (n > 0) & (good > 0) & (bad > 0)
+    if to_draw.any():
+        result[to_draw] = hypergeometric_f(good[to_draw], bad[to_draw], 
+            n[to_draw])
+    return result
+
+def multivariate_hypergeometric(counts, n, hypergeometric_f=hypergeometric):
+    """Draws n items without replacement from each row of counts.
+
+    counts is a 2D array of counts, n the number of items to draw from each
+    row (a scalar or one per row).  Rows with no more than n items are
+    returned whole.
+
+    Items are split between the two halves of each group of columns with one
+    hypergeometric draw, so all rows are drawn with log2(columns) calls.
+    """
+    counts = asarray(counts, dtype=int)
+    num_rows, num_cols = counts.shape
+    width = 1
+    while width < num_cols:
+        width *= 2
+    padded = zeros((num_rows, width), dtype=int)
+    padded[:,:num_cols] = counts
+    #sums of the groups of columns, from single columns up to whole rows
+    sums = [padded]
+    while sums[-1].shape[1] > 1:
+        sums.append(sums[-1].reshape(num_rows, -1, 2).sum(axis=2))
+    drawn = minimum(n, sums.pop()[:,0])[:,newaxis]
+    while sums:
+        group_sums = sums.pop()
+        left, right = group_sums[:,0::2], group_sums[:,1::2]
+        drawn_left = _hypergeometric(left, right, drawn, hypergeometric_f)
+        split = empty(group_sums.shape, dtype=int)
+        split[:,0::2] = drawn_left
+        split[:,1::2] = drawn - drawn_left
+        drawn = split
+    return drawn[:,:num_cols]
+
 def subsample(counts, n):
     """Subsamples new vector from vector of orig items.
     
@@ -89,13 +133,7 @@ def subsample(counts, n):
     """
     if counts.sum() <= n:
         return counts
-    nz = counts.nonzero()[0]
-    unpacked = concatenate([repeat(array(i,), counts[i]) for i in nz])
-    permuted = permutation(unpacked)[:n]
-    result = zeros(len(counts))
-    for p in permuted:
-        result[p] += 1
-    return result
+    return multivariate_hypergeometric(counts[newaxis], n)[0].astype(float)
 
 def subsample_freq_dist_nonzero(counts, n, dtype=uint):
     """Subsamples new vector from vector of orig items.
@@ -218,3 +256,118 @@ def rarefaction(data, start=0, stop=None, stride=1, histogram_f=None, \
         yield result
         start += stride
 
+def _compressed_rows(table, start, end):
+    """Returns OTU indices and counts of the nonzero cells of rows start:end.
+
+    Both are (end-start, k) arrays, k the most OTUs in any of the rows; rows
+    with fewer OTUs are padded with index 0 and count 0.
+    """
+    if hasattr(table, 'tocsr'):
+        lo, hi = table.indptr[start], table.indptr[end]
+        rows = repeat(arange(end-start), diff(table.indptr[start:end+1]))
+        cols, vals = table.indices[lo:hi], table.data[lo:hi]
+    else:
+        block = table[start:end]
+        rows, cols = block.nonzero()
+        vals = block[rows, cols]
+    row_lengths = bincount(rows, minlength=end-start)
+    row_starts = concatenate(([0], row_lengths.cumsum()[:-1]))
+    positions = arange(len(rows)) - row_starts[rows]
+    width = row_lengths.max() if len(rows) else 0
+    otus = zeros((end-start, width), dtype=int)
+    counts = zeros((end-start, width), dtype=int)
+    otus[rows, positions] = cols
+    counts[rows, positions] = vals
+    return otus, counts
+
+def rarefy_table_iter(table, depths, iterations=1, seed=None, 
+    block_size=None):
+    """Yields (depth_index, samples, rarefied) rarefactions of an OTU table.
+
+    table: samples x OTUs array of counts; may be sparse (anything with a
+    tocsr method, such as a scipy.sparse matrix).
+    depths: the numbers of items to subsample from each sample.  Samples with
+    fewer items than a depth are returned whole, as in subsample.
+    iterations: the number of subsamples drawn per sample at each depth.
+    seed: seed for the random draws; if None, uses numpy's global state.
+    block_size: number of samples rarefied at once; by default enough to
+    keep each result under MAX_RAREFACTION_ELEMENTS.
+
+    rarefied is an (iterations, len(samples), OTUs) array for the slice
+    samples of the table, subsampled to depths[depth_index] by multivariate
+    hypergeometric sampling (without replacement).  Each sample is drawn at
+    its deepest depth first and then thinned, so within an iteration the
+    subsample at each depth is a subsample of the one at the next depth up.
+    """
+    if hasattr(table, 'tocsr'):
+        table = table.tocsr()
+    else:
+        table = asarray(table)
+    num_samples, num_otus = table.shape
+    hypergeometric_f = hypergeometric
+    if seed is not None:
+        hypergeometric_f = RandomState(seed).hypergeometric
+    if block_size is None:
+        block_size = max(1, MAX_RAREFACTION_ELEMENTS // 
+            max(1, iterations * num_otus))
+    by_depth = sorted(range(len(depths)), key=lambda i: depths[i], 
+        reverse=True)
+    for start in range(0, num_samples, block_size):
+        end = min(start + block_size, num_samples)
+        otus, counts = _compressed_rows(table, start, end)
+        #one row per iteration and sample, for all of the samples at once
+        otus = repeat(otus[newaxis], iterations, axis=0).reshape(
+            -1, otus.shape[1])
+        drawn = repeat(counts[newaxis], iterations, axis=0).reshape(
+            -1, counts.shape[1])
+        occupied = drawn > 0
+        rows = arange(len(drawn))[:,newaxis].repeat(drawn.shape[1], axis=1)
+        rows, otus = rows[occupied], otus[occupied]
+        for depth_index in by_depth:
+            drawn = multivariate_hypergeometric(drawn, depths[depth_index],
+                hypergeometric_f)
+            rarefied = zeros((iterations * (end-start), num_otus), dtype=int)
+            rarefied[rows, otus] = drawn[occupied]
+            yield depth_index, slice(start, end), rarefied.reshape(
+                iterations, end-start, num_otus)
+
+def rarefy_table(table, depths, iterations=1, seed=None, block_size=None):
+    """Returns (len(depths), iterations, samples, OTUs) array of rarefactions.
+
+    See rarefy_table_iter, which yields the same results a block of samples
+    at a time, for the parameters.
+    """
+    result = zeros((len(depths), iterations) + tuple(table.shape), dtype=int)
+    for depth_index, samples, rarefied in rarefy_table_iter(table, depths,
+        iterations, seed, block_size):
+        result[depth_index,:,samples] = rarefied
+    return result
+
+def per_row(f):
+    """Returns function applying f, which takes a count vector, to 2D rows."""
+    def row_f(counts):
+        return array([f(row) for row in counts])
+    return row_f
+
+def rarefaction_alpha(table, depths, metrics, iterations=1, seed=None, 
+    block_size=None):
+    """Returns alpha diversity of rarefactions of an OTU table.
+
+    metrics: dict of {name:f}, where f takes a 2D array of count vectors (one
+    per row) and returns one value per row; use per_row to wrap functions
+    that take a single count vector, e.g. per_row(alpha_diversity.chao1).
+
+    Returns {name:array} where each array is (len(depths), iterations,
+    samples); the rarefied tables are not kept.  See rarefy_table_iter for
+    the other parameters.
+    """
+    num_samples = table.shape[0]
+    result = dict([(name, zeros((len(depths), iterations, num_samples)))
+        for name in metrics])
+    for depth_index, samples, rarefied in rarefy_table_iter(table, depths,
+        iterations, seed, block_size):
+        rows = rarefied.reshape(-1, rarefied.shape[2])
+        for name, f in metrics.items():
+            result[name][depth_index,:,samples] = asarray(f(rows)).reshape(
+                iterations, -1)
+    return result
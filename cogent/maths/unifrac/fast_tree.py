@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 """ Fast tree and support functions for fast implementation of UniFrac """
 
+import os
+from hashlib import md5
 from numpy import (logical_and, logical_or, sum, take, nonzero, repeat, 
     array, concatenate, zeros, put, transpose, flatnonzero, newaxis,
-    logical_xor, logical_not)
-from numpy.random import permutation
+    logical_xor, logical_not, asarray, dot, packbits, unpackbits, minimum,
+    maximum, tensordot, fill_diagonal, arange, diff, bincount, unique,
+    searchsorted)
+from numpy.random import permutation, random_sample
+from numpy.lib.format import open_memmap
 from cogent.core.tree import PhyloNode
+from cogent.util import parallel
 
 __author__ = "Rob Knight and Micah Hamady"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -124,6 +130,116 @@ def index_envs(env_counts, tree_index, array_constructor=int):
     #return all the data structures we created; will be useful for other tasks
     return result, unique_envs, env_to_index, node_to_index
 
+class SparseCounts(object):
+    """Node x env counts stored by column (compressed sparse column form).
+
+    The rows (nodes) with nonzero counts in column (env) j are
+    Indices[IndPtr[j]:IndPtr[j+1]], in increasing order, and the counts are
+    the matching slice of Data. Used in place of the dense count array when
+    each env touches only a small fraction of a large tree.
+    """
+    def __init__(self, indptr, indices, data, shape):
+        """Returns new SparseCounts from already compressed columns."""
+        self.IndPtr = asarray(indptr)
+        self.Indices = asarray(indices)
+        self.Data = asarray(data)
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        """Returns the number of rows, as for a dense array."""
+        return self.shape[0]
+
+    def coordinates(self):
+        """Returns (rows, cols, values) of the nonzero entries."""
+        cols = repeat(arange(self.shape[1]), diff(self.IndPtr))
+        return self.Indices, cols, self.Data
+
+    def toarray(self):
+        """Returns the counts as a dense array."""
+        result = zeros(self.shape, self.Data.dtype)
+        rows, cols, values = self.coordinates()
+        result[rows, cols] = values
+        return result
+
+    def astype(self, dtype):
+        """Returns copy with data converted to dtype."""
+        return SparseCounts(self.IndPtr, self.Indices, 
+            self.Data.astype(dtype), self.shape)
+
+    def weightedColumnSums(self, weights):
+        """Returns dot(weights, m) for a vector of per-row weights."""
+        rows, cols, values = self.coordinates()
+        return bincount(cols, weights=asarray(weights)[rows]*values,
+            minlength=self.shape[1])[:self.shape[1]]
+
+    def occupiedRows(self, start, end):
+        """Returns the sorted rows that are nonzero in any of cols start:end."""
+        return unique(self.Indices[self.IndPtr[start]:self.IndPtr[end]])
+
+    def block(self, start, end, rows=None):
+        """Returns (rows, dense counts of cols start:end at those rows).
+
+        rows must be sorted; defaults to the occupied rows of the block.
+        """
+        if rows is None:
+            rows = self.occupiedRows(start, end)
+        first, last = self.IndPtr[start], self.IndPtr[end]
+        indices = self.Indices[first:last]
+        cols = repeat(arange(end-start), diff(self.IndPtr[start:end+1]))
+        result = zeros((len(rows), end-start), self.Data.dtype)
+        if len(rows):
+            positions = searchsorted(rows, indices).clip(0, len(rows)-1)
+            found = rows[positions] == indices
+            result[positions[found], cols[found]] = \
+                self.Data[first:last][found]
+        return rows, result
+
+def _sum_duplicates(num_rows, rows, cols, values):
+    """Returns (rows, cols, values) with repeated positions summed.
+
+    Result is sorted by column, then row, and has zeros removed.
+    """
+    keys = asarray(cols, int)*num_rows + asarray(rows, int)
+    keys, inverse = unique(keys, return_inverse=True)
+    values = asarray(values)
+    values = bincount(inverse, weights=values).astype(values.dtype)
+    nonzero_values = flatnonzero(values)
+    keys, values = keys[nonzero_values], values[nonzero_values]
+    return keys % num_rows, keys // num_rows, values
+
+def sparse_counts_from_coordinates(rows, cols, values, shape):
+    """Returns SparseCounts from (row, col, value) triples.
+
+    Values at repeated (row, col) positions are summed; zeros are dropped.
+    """
+    rows, cols, values = _sum_duplicates(shape[0], rows, cols, values)
+    indptr = concatenate([[0], bincount(cols, 
+        minlength=shape[1])[:shape[1]].cumsum()])
+    return SparseCounts(indptr, rows, values, shape)
+
+def index_envs_sparse(env_counts, tree_index, array_constructor=int):
+    """Returns SparseCounts of taxon x env with counts of taxon in each env.
+
+    As for index_envs, but never allocates the dense (nodes x envs) array.
+    """
+    num_nodes = len(tree_index)
+    unique_envs, num_envs = get_unique_envs(env_counts)
+    env_to_index = dict([(e, i) for i, e in enumerate(unique_envs)])
+    node_to_index = {}
+    for i, node in tree_index.items():
+        if node.Name is not None:
+            node_to_index[node.Name] = i
+    rows, cols, values = [], [], []
+    for name in env_counts:
+        curr_row_index = node_to_index[name]
+        for env, count in env_counts[name].items():
+            rows.append(curr_row_index)
+            cols.append(env_to_index[env])
+            values.append(count)
+    result = sparse_counts_from_coordinates(rows, cols, 
+        array(values, array_constructor), (num_nodes, num_envs))
+    return result, unique_envs, env_to_index, node_to_index
+
 def get_branch_lengths(tree_index):
     """Returns array of branch lengths, in tree index order."""
     result = zeros(len(tree_index), float)
@@ -227,6 +343,64 @@ def sum_descendants(bound_indices):
     """For each internal node, sets col to sum of values in descendants."""
     traverse_reduce(bound_indices, sum)
 
+def index_parents(t):
+    """Returns arrays of parent index and height for each node of t.
+
+    t must already be indexed by index_tree. The parent of the root is -1;
+    the height of a node is the number of branches on the longest path from
+    it down to a tip.
+    """
+    num_nodes = t._leaf_index + 1   #the root gets the last index
+    parents = zeros(num_nodes, int) - 1
+    heights = zeros(num_nodes, int)
+    for n in t.traverse(self_before=False, self_after=True):
+        if n is not t:
+            parent_index = n.Parent._leaf_index
+            parents[n._leaf_index] = parent_index
+            heights[parent_index] = max(heights[parent_index], 
+                heights[n._leaf_index] + 1)
+    return parents, heights
+
+def sparse_sum_descendants(m, parents, heights):
+    """Returns SparseCounts in which each node holds the sum of its subtree.
+
+    Sparse counterpart of sum_descendants. m is SparseCounts, parents and
+    heights come from index_parents. Nodes are completed in order of height,
+    so each nonzero entry is passed up to its parent exactly once.
+    """
+    num_rows = m.shape[0]
+    pending = {}
+    def add_pending(rows, cols, values):
+        levels = heights[rows]
+        for level in unique(levels):
+            selected = levels == level
+            pending.setdefault(level, []).append((rows[selected], 
+                cols[selected], values[selected]))
+    add_pending(*m.coordinates())
+    done = []
+    while pending:
+        #parents are always higher than children, so the lowest pending
+        #level has received everything from below
+        level = min(pending)
+        rows, cols, values = _sum_duplicates(num_rows, 
+            *map(concatenate, zip(*pending.pop(level))))
+        done.append((rows, cols, values))
+        parent_rows = parents[rows]
+        has_parent = parent_rows >= 0
+        add_pending(parent_rows[has_parent], cols[has_parent], 
+            values[has_parent])
+    if not done:
+        return m
+    rows, cols, values = map(concatenate, zip(*done))
+    return sparse_counts_from_coordinates(rows, cols, values, m.shape)
+
+def sparse_bool_descendants(m, parents, heights):
+    """Returns SparseCounts that are True where any descendant is nonzero.
+
+    Sparse counterpart of bool_descendants.
+    """
+    return sparse_sum_descendants(m.astype(bool), parents, heights)
+
 class FitchCounterDense(object):
     """Returns parsimony result for set of child states, counting changes.
     
@@ -276,6 +450,31 @@ class FitchCounter(object):
         return result
 
 
+class FitchCounterBatch(object):
+    """Fitch parsimony counter over a batch of independent state sets.
+
+    As for FitchCounter, but each node row has shape (batch, num_envs) and
+    Changes holds one count per member of the batch. Expects bool states.
+    """
+    def __init__(self):
+        """Returns new FitchCounterBatch, with Changes = 0."""
+        self.Changes = 0
+
+    def __call__(self, a, ignored):
+        """Returns intersection(a), or, if empty, union(a), per batch member.
+        
+        Children with no state are ignored, as in FitchCounter.
+        """
+        has_state = a.any(-1)
+        any_state = has_state.any(0)
+        result = lar(a | logical_not(has_state)[...,newaxis], 0)
+        result &= any_state[...,newaxis]
+        is_empty = logical_not(result.any(-1))
+        changed = is_empty & any_state
+        result[changed] = lor(a, 0)[changed]
+        self.Changes = self.Changes + changed
+        return result
+
 def fitch_descendants(bound_indices, counter=FitchCounter):
     """Sets each internal node to Fitch parsimony assignment, returns # changes."""
     f = counter()
@@ -304,6 +503,40 @@ def permute_selected_rows(rows, orig, new, permutation_f=permutation):
     for r, s in zip(rows, shuffled):
         new[s] = orig[r]
 
+def permutation_indices(num_items, num_permutations, permutation_f=None,
+    random_state=None):
+    """Returns (num_permutations, num_items) array, each row a permutation.
+
+    If permutation_f is given, each row is permutation_f(num_items);
+    otherwise rows are drawn from random_state (a numpy RandomState, 
+    defaulting to the global numpy.random state) in a single call.
+    """
+    if permutation_f is not None:
+        return array([permutation_f(num_items) for i in \
+            range(num_permutations)], int).reshape(num_permutations, 
+            num_items)
+    if random_state is None:
+        draws = random_sample((num_permutations, num_items))
+    else:
+        draws = random_state.random_sample((num_permutations, num_items))
+    return draws.argsort(1)
+
+def permute_selected_rows_batch(rows, orig, permutations):
+    """Returns orig with selected rows permuted once per row of permutations.
+
+    Batch counterpart of permute_selected_rows: result has shape 
+    (len(orig), len(permutations)) + orig.shape[1:], with result[:,k] the
+    array permute_selected_rows would produce from permutations[k]. Rows not
+    in rows are zero.
+    """
+    rows = asarray(rows)
+    permutations = asarray(permutations)
+    result = zeros((len(orig), len(permutations)) + orig.shape[1:], 
+        orig.dtype)
+    result[rows[permutations].T, arange(len(permutations))] = \
+        orig[rows][:,newaxis]
+    return result
+
 def prep_items_for_jackknife(col):
     """Takes column of a, returns vector with multicopy states unpacked.
     
@@ -486,6 +719,21 @@ def env_unique_fraction(branch_lengths, m):
     
     return env_bl_sums, env_bl_sums/total_bl 
 
+def env_unique_fraction_batch(branch_lengths, m):
+    """Calculates unique branch length fraction for each env in a batch.
+
+    Batch counterpart of env_unique_fraction for m of shape (nodes, batch,
+    envs); returns (batch, envs) arrays of unique branch length and unique
+    fraction.
+    """
+    total_bl = branch_lengths.sum()
+    if total_bl <= 0:
+        raise ValueError, "total branch length in tree must be > 0"
+    col_sum = m.sum(-1)
+    unique_to_env = (m == col_sum[...,newaxis]) & (m != 0)
+    env_bl_sums = tensordot(branch_lengths, unique_to_env, axes=(0,0))
+    return env_bl_sums, env_bl_sums/total_bl
+
 def unifrac_vector(branch_lengths, m, metric=unifrac):
     """Calculates unifrac(i, others) for each column i of m.
 
@@ -617,3 +865,410 @@ def weighted_unifrac_vector(branch_lengths, m, tip_indices, bl_correct=False,
             rest_col, i_sum, rest_sum)
         result.append(curr)
     return array(result)
+
+def sparse_unifrac_vector(branch_lengths, m):
+    """Calculates unifrac(i, others) for each column i of SparseCounts m.
+
+    Sparse counterpart of unifrac_vector with the default unifrac metric;
+    ancestral states must already have been set by sparse_bool_descendants.
+    """
+    presence = m.astype(bool)
+    rows, cols, values = presence.coordinates()
+    envs_per_node = bincount(rows, minlength=m.shape[0])
+    union = branch_lengths[envs_per_node > 0].sum()
+    shared = presence.weightedColumnSums(branch_lengths*(envs_per_node > 1))
+    return 1 - shared/union
+
+def sparse_weighted_unifrac_vector(branch_lengths, m, tip_indices, 
+    bl_correct=False, tip_distances=None):
+    """Calculates weighted_unifrac(i,rest) for i in SparseCounts m.
+
+    Sparse counterpart of weighted_unifrac_vector with the default 
+    _weighted_unifrac: nodes absent from column i only contribute their share
+    of the rest, so only the nonzero entries of each column are visited.
+    """
+    num_cols = m.shape[1]
+    rows, cols, values = m.coordinates()
+    sum_of_cols = bincount(rows, weights=values, minlength=m.shape[0])
+    is_tip = zeros(m.shape[0])
+    is_tip[tip_indices] = 1
+    sums = m.weightedColumnSums(is_tip)
+    rest_sums = sums.sum() - sums
+    i_rel = values/sums[cols]
+    rest_rel = (sum_of_cols[rows] - values)/rest_sums[cols]
+    in_col = bincount(cols, weights=branch_lengths[rows]*abs(i_rel-rest_rel),
+        minlength=num_cols)
+    #nodes not in column i: |0 - rest| = sum_of_cols/rest_sum
+    weighted_totals = branch_lengths*sum_of_cols
+    not_in_col = weighted_totals.sum() - \
+        bincount(cols, weights=weighted_totals[rows], minlength=num_cols)
+    result = in_col + not_in_col/rest_sums
+    if bl_correct:
+        tip_distances = asarray(tip_distances).ravel()
+        i_correct = m.weightedColumnSums(tip_distances)
+        result /= i_correct/sums + \
+            (dot(tip_distances, sum_of_cols) - i_correct)/rest_sums
+    return result
+
+# Batched (blocked) evaluation of the UniFrac matrices.
+#
+# Instead of evaluating the metric on one pair of columns at a time, the
+# environments are split into blocks of columns and each pair of blocks is
+# evaluated with a single matrix product. Only rows (nodes) occupied in a
+# block take part in the products for that block, and presence/absence
+# data is held bitpacked so that the whole node x env table costs one bit
+# per cell. Block pairs are independent of one another and are farmed out
+# through cogent.util.parallel, so they run on as many CPUs as the current
+# parallel context provides (e.g. COGENT_CPUS=8 or use_multiprocessing()).
+
+DEFAULT_BLOCK_SIZE = 512
+#the weighted metric needs a node x block x block temporary rather than a
+#matrix product, so smaller blocks keep it cheap
+DEFAULT_WEIGHTED_BLOCK_SIZE = 32
+#upper bound on the number of elements in the node x block x block
+#temporary used by the weighted metric
+MAX_BLOCK_ELEMENTS = 2**22
+
+def _shared_unifrac(shared, pd_i, pd_j, total):
+    """unifrac in terms of shared branch length and per-env branch length"""
+    return 1 - shared/(pd_i + pd_j - shared)
+
+def _shared_unnormalized_unifrac(shared, pd_i, pd_j, total):
+    """unnormalized_unifrac in terms of shared and per-env branch length"""
+    return (pd_i + pd_j - 2*shared)/total
+
+def _shared_G(shared, pd_i, pd_j, total):
+    """G in terms of shared and per-env branch length"""
+    return (pd_i - shared)/(pd_i + pd_j - shared)
+
+def _shared_unnormalized_G(shared, pd_i, pd_j, total):
+    """unnormalized_G in terms of shared and per-env branch length"""
+    return (pd_i - shared)/total
+
+#metrics with a closed form in terms of the shared branch length matrix
+SHARED_LENGTH_METRICS = {
+    unifrac: _shared_unifrac,
+    unnormalized_unifrac: _shared_unnormalized_unifrac,
+    G: _shared_G,
+    unnormalized_G: _shared_unnormalized_G,
+    }
+
+def _round_block_size(block_size):
+    """Rounds block_size up to whole bytes of packed presence data."""
+    return ((block_size + 7) // 8) * 8
+
+def _block_bounds(num_cols, block_size, default=DEFAULT_BLOCK_SIZE):
+    """Returns [(start, end)] column blocks; starts are multiples of 8."""
+    if block_size is None:
+        block_size = default
+    if block_size < 1:
+        raise ValueError, "block_size must be > 0"
+    block_size = _round_block_size(block_size)
+    return [(start, min(start+block_size, num_cols)) for start in \
+        range(0, num_cols, block_size)]
+
+def _block_pairs(bounds, is_symmetric):
+    """Returns the pairs of column blocks that have to be evaluated."""
+    num_blocks = len(bounds)
+    if is_symmetric:
+        return [(bounds[i], bounds[j]) for i in range(num_blocks) \
+            for j in range(i, num_blocks)]
+    return [(bounds[i], bounds[j]) for i in range(num_blocks) \
+        for j in range(num_blocks)]
+
+def _fill_blocks(result, block_results, is_symmetric):
+    """Fills the (num_cols, num_cols) result from evaluated block pairs."""
+    for (i_start, i_end), (j_start, j_end), values in block_results:
+        result[i_start:i_end, j_start:j_end] = values
+        if is_symmetric:
+            result[j_start:j_end, i_start:i_end] = values.T
+    return result
+
+def _block_getter(m, columns):
+    """Returns get_block(start, end, rows=None) for a dense array m.
+
+    columns(start, end) must return the dense columns start:end of m; the
+    result mirrors SparseCounts.block, returning (rows, block[rows]) where
+    rows defaults to the rows occupied in the block.
+    """
+    def get_block(start, end, rows=None):
+        block = columns(start, end)
+        if rows is None:
+            rows = flatnonzero(block.any(1))
+        return rows, block[rows]
+    return get_block
+
+def pack_presence(m):
+    """Returns presence/absence of m bitpacked along the env (column) axis.
+
+    The result is a uint8 array of shape (num_rows, ceil(num_cols/8)).
+    """
+    return packbits(asarray(m).astype(bool), axis=1)
+
+def unpack_presence(packed, start, end):
+    """Returns presence/absence of columns start:end from pack_presence.
+
+    start must be a multiple of 8.
+    """
+    block = unpackbits(packed[:, start//8:(end+7)//8], axis=1)
+    return block[:, :end-start]
+
+def _unifrac_block_f(branch_lengths, m, metric):
+    """Returns f(block_pair) evaluating metric for one pair of env blocks."""
+    try:
+        shared_f = SHARED_LENGTH_METRICS[metric]
+    except KeyError:
+        raise ValueError, "No batched form for metric %s" % metric
+    branch_lengths = asarray(branch_lengths, float)
+    total = branch_lengths.sum()
+    if isinstance(m, SparseCounts):
+        presence = m.astype(bool)
+        get_block = presence.block
+        pd = presence.weightedColumnSums(branch_lengths)
+    else:
+        packed = pack_presence(m)
+        get_block = _block_getter(packed, lambda start, end: 
+            unpack_presence(packed, start, end))
+        pd = dot(branch_lengths, asarray(m).astype(bool))
+    
+    def block_shared(block_pair):
+        (i_start, i_end), (j_start, j_end) = block_pair
+        rows, first = get_block(i_start, i_end)
+        weighted_first = first * branch_lengths[rows][:,newaxis]
+        ignored, second = get_block(j_start, j_end, rows)
+        shared = dot(weighted_first.T, second)
+        values = shared_f(shared, pd[i_start:i_end][:,newaxis],
+            pd[j_start:j_end][newaxis], total)
+        if i_start == j_start:
+            #a column against itself is at distance 0 under all metrics
+            fill_diagonal(values, 0)
+        return (i_start, i_end), (j_start, j_end), values
+    return block_shared
+
+def batch_unifrac_matrix(branch_lengths, m, metric=unifrac, 
+        is_symmetric=True, block_size=None):
+    """Calculates unifrac(i,j) for all i,j in m using blocked matrix products.
+
+    Arguments as for unifrac_matrix, except that m may also be SparseCounts;
+    metric must be one of the metrics in SHARED_LENGTH_METRICS (unifrac,
+    unnormalized_unifrac, G or unnormalized_G). block_size is the number of
+    envs per block (rounded up to a multiple of 8) and bounds the size of the
+    intermediate arrays.
+    """
+    block_f = _unifrac_block_f(branch_lengths, m, metric)
+    num_cols = m.shape[-1]
+    block_pairs = _block_pairs(_block_bounds(num_cols, block_size), 
+        is_symmetric)
+    return _fill_blocks(zeros((num_cols, num_cols), float), 
+        parallel.imap(block_f, block_pairs), is_symmetric)
+
+def _block_weighted_overlap(branch_lengths, first, second):
+    """Returns sum(branch_lengths*min(first[:,i], second[:,j])) for all i,j.
+
+    Rows are processed in chunks so that the rows x i x j temporary never
+    exceeds MAX_BLOCK_ELEMENTS.
+    """
+    result = zeros((first.shape[1], second.shape[1]), float)
+    step = max(1, MAX_BLOCK_ELEMENTS // max(1, first.shape[1]*second.shape[1]))
+    for start in range(0, len(branch_lengths), step):
+        end = start + step
+        smallest = minimum(first[start:end,:,newaxis], 
+            second[start:end,newaxis,:])
+        result += tensordot(branch_lengths[start:end], smallest, axes=(0,0))
+    return result
+
+def _weighted_unifrac_block_f(branch_lengths, m, tip_indices, bl_correct,
+        tip_distances):
+    """Returns f(block_pair) evaluating weighted UniFrac for a block pair."""
+    branch_lengths = asarray(branch_lengths, float)
+    if isinstance(m, SparseCounts):
+        get_block = m.block
+        column_sums = m.weightedColumnSums
+    else:
+        get_block = _block_getter(m, lambda start, end: m[:, start:end])
+        column_sums = lambda weights: dot(weights, m)
+    is_tip = zeros(m.shape[0])
+    is_tip[tip_indices] = 1
+    sums = column_sums(is_tip)
+    #relative abundances are only formed a block at a time
+    total_by_env = column_sums(branch_lengths) / sums
+    if bl_correct:
+        correction = column_sums(asarray(tip_distances).ravel()) / sums
+
+    def block_distances(block_pair):
+        (i_start, i_end), (j_start, j_end) = block_pair
+        rows, first = get_block(i_start, i_end)
+        ignored, second = get_block(j_start, j_end, rows)
+        in_both = second.any(1)
+        rows = rows[in_both]
+        overlap = _block_weighted_overlap(branch_lengths[rows], 
+            first[in_both] / sums[i_start:i_end], 
+            second[in_both] / sums[j_start:j_end])
+        #clip rounding error for (near) identical envs
+        values = maximum(total_by_env[i_start:i_end][:,newaxis] + \
+            total_by_env[j_start:j_end][newaxis] - 2*overlap, 0)
+        if bl_correct:
+            values /= correction[i_start:i_end][:,newaxis] + \
+                correction[j_start:j_end][newaxis]
+        if i_start == j_start:
+            fill_diagonal(values, 0)
+        return (i_start, i_end), (j_start, j_end), values
+    return block_distances
+
+def batch_weighted_unifrac_matrix(branch_lengths, m, tip_indices, 
+        bl_correct=False, tip_distances=None, block_size=None):
+    """Calculates weighted_unifrac(i,j) for all i,j in m using blocks.
+
+    Arguments as for weighted_unifrac_matrix, using the default
+    _weighted_unifrac, except that m may also be SparseCounts. Uses
+    sum(bl*|a-b|) = sum(bl*a) + sum(bl*b) - 2*sum(bl*min(a,b)), where only
+    nodes occupied in both envs contribute to the last term.
+    """
+    block_f = _weighted_unifrac_block_f(branch_lengths, m, tip_indices,
+        bl_correct, tip_distances)
+    num_cols = m.shape[-1]
+    block_pairs = _block_pairs(_block_bounds(num_cols, block_size, 
+        DEFAULT_WEIGHTED_BLOCK_SIZE), True)
+    return _fill_blocks(zeros((num_cols, num_cols), float), 
+        parallel.imap(block_f, block_pairs), True)
+
+# Striped evaluation with the result on disk.
+#
+# The block grid is walked in diagonal stripes: stripe s holds the block
+# pairs (b, b+s), so stripe 0 is the block diagonal and later stripes move
+# away from it. Each completed stripe is written into a memory-mapped .npy
+# file and recorded in a progress file alongside it, so only one stripe of
+# results is ever held in memory and an interrupted run continues from the
+# first unrecorded stripe.
+
+def _stripes(bounds, is_symmetric):
+    """Returns list of stripes, each a list of block pairs."""
+    num_blocks = len(bounds)
+    result = []
+    for offset in range(num_blocks):
+        stripe = [(bounds[b], bounds[b+offset]) for b in \
+            range(num_blocks-offset)]
+        if offset and not is_symmetric:
+            stripe.extend([(bounds[b+offset], bounds[b]) for b in \
+                range(num_blocks-offset)])
+        result.append(stripe)
+    return result
+
+def _read_stripe_progress(progress_filename, header):
+    """Returns set of stripes completed according to progress_filename.
+
+    Raises ValueError if the file was written for a different matrix or
+    block layout.
+    """
+    lines = open(progress_filename, 'U').read().splitlines()
+    if not lines or lines[0] != header:
+        raise ValueError, "%s was written for a different run (%s)" % \
+            (progress_filename, lines and lines[0])
+    return set([int(line) for line in lines[1:] if line.strip()])
+
+def _run_fingerprint(*parts):
+    """Returns hex digest identifying the inputs of a striped run.
+
+    parts may be arrays, SparseCounts or anything with a stable repr.
+    """
+    digest = md5()
+    for part in parts:
+        if isinstance(part, SparseCounts):
+            part = (part.shape, part.IndPtr, part.Indices, part.Data)
+        else:
+            part = (part,)
+        for item in part:
+            if hasattr(item, 'dtype'):
+                item = asarray(item)
+                digest.update('%s %s ' % (item.dtype.str, item.shape))
+                digest.update(item.tostring())
+            else:
+                digest.update(repr(item))
+            digest.update('|')
+    return digest.hexdigest()
+
+def _write_striped_matrix(block_f, num_cols, filename, block_size, 
+        is_symmetric=True, resume=False, fingerprint=''):
+    """Evaluates block_f over the block grid stripe by stripe into filename.
+
+    block_f: returns ((i_start, i_end), (j_start, j_end), values) for a
+        block pair, as made by _unifrac_block_f.
+    num_cols: number of envs; the result is (num_cols, num_cols) float.
+    filename: .npy file holding the result. Completed stripes are listed
+        in filename + '.stripes'.
+    block_size: number of envs per block; must match between resumed runs.
+    resume: if True and filename exists with a progress file, stripes
+        already recorded there are skipped; otherwise (the default) every
+        stripe is computed afresh.
+    fingerprint: identifies the metric and data, as from _run_fingerprint;
+        resuming a run with a different fingerprint raises ValueError.
+
+    Returns the result as a read-only memory-mapped array.
+    """
+    bounds = _block_bounds(num_cols, block_size)
+    progress_filename = filename + '.stripes'
+    header = "%s %s %s %s" % (num_cols, _round_block_size(block_size), 
+        is_symmetric, fingerprint)
+    if resume and os.path.exists(filename) and \
+            os.path.exists(progress_filename):
+        done = _read_stripe_progress(progress_filename, header)
+        result = open_memmap(filename, mode='r+')
+        if result.shape != (num_cols, num_cols):
+            raise ValueError, "%s has shape %s, expected %s" % (filename,
+                result.shape, (num_cols, num_cols))
+    else:
+        done = set()
+        result = open_memmap(filename, mode='w+', dtype=float, 
+            shape=(num_cols, num_cols))
+        progress = open(progress_filename, 'w')
+        progress.write(header + '\n')
+        progress.close()
+    for stripe_index, stripe in enumerate(_stripes(bounds, is_symmetric)):
+        if stripe_index in done:
+            continue
+        _fill_blocks(result, parallel.imap(block_f, stripe), is_symmetric)
+        result.flush()
+        #only record the stripe once its values are safely on disk
+        progress = open(progress_filename, 'a')
+        progress.write('%s\n' % stripe_index)
+        progress.close()
+    del result
+    return open_memmap(filename, mode='r')
+
+def striped_unifrac_matrix(branch_lengths, m, filename, metric=unifrac,
+        is_symmetric=True, block_size=None, resume=False):
+    """Calculates unifrac(i,j) for all i,j in m stripe by stripe on disk.
+
+    As for batch_unifrac_matrix, but the result is written to the .npy file
+    filename one stripe at a time and returned memory-mapped. Completed
+    stripes are listed in filename + '.stripes'; if resume is True (default:
+    False), a run that was interrupted carries on from the first stripe not
+    listed there.
+    Resuming with a different metric, branch lengths or counts raises
+    ValueError.
+    """
+    if block_size is None:
+        block_size = DEFAULT_BLOCK_SIZE
+    block_f = _unifrac_block_f(branch_lengths, m, metric)
+    fingerprint = _run_fingerprint(getattr(metric, '__name__', metric),
+        branch_lengths, m)
+    return _write_striped_matrix(block_f, m.shape[-1], filename, 
+        block_size, is_symmetric, resume, fingerprint)
+
+def striped_weighted_unifrac_matrix(branch_lengths, m, tip_indices, 
+        filename, bl_correct=False, tip_distances=None, block_size=None, 
+        resume=False):
+    """Calculates weighted_unifrac(i,j) for all i,j in m stripe by stripe.
+
+    As for batch_weighted_unifrac_matrix, but the result is written to the
+    .npy file filename one stripe at a time and returned memory-mapped;
+    resume as for striped_unifrac_matrix.
+    """
+    if block_size is None:
+        block_size = DEFAULT_WEIGHTED_BLOCK_SIZE
+    block_f = _weighted_unifrac_block_f(branch_lengths, m, tip_indices,
+        bl_correct, tip_distances)
+    fingerprint = _run_fingerprint('weighted', bl_correct, branch_lengths, 
+        m, asarray(tip_indices), tip_distances)
+    return _write_striped_matrix(block_f, m.shape[-1], filename, 
+        block_size, True, resume, fingerprint)
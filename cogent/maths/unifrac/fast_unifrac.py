@@ -2,8 +2,8 @@
 """Fast implementation of UniFrac for use with very large datasets"""
 
 from random import shuffle
-from numpy import ones, ma, where
-from numpy.random import permutation
+from numpy import ones, ma, where, dot
+from numpy.random import permutation, RandomState
 from cogent.maths.unifrac.fast_tree import *
 # not imported by import *
 from cogent.maths.unifrac.fast_tree import _weighted_unifrac, _branch_correct 
@@ -12,6 +12,8 @@ from cogent.cluster.metric_scaling import *
 from cogent.core.tree import PhyloNode, TreeError
 from cogent.cluster.UPGMA import UPGMA_cluster
 from cogent.phylo.nj import nj
+from cogent.maths.stats.distribution import bdtri
+from cogent.util import parallel
 from StringIO import StringIO
 
 __author__ = "Rob Knight and Micah Hamady"
@@ -34,6 +36,17 @@ UNIFRAC_VALID_MODES = set([UNIFRAC_DIST_MATRIX, UNIFRAC_PCOA,
 UNIFRAC_DEFAULT_MODES = set([UNIFRAC_DIST_MATRIX, UNIFRAC_PCOA,
     UNIFRAC_CLUST_ENVS])
 
+#dense node x env count arrays at least this big are held as SparseCounts
+#by default
+SPARSE_MIN_CELLS = 10**7
+
+#permutations evaluated together by one set of array operations
+DEFAULT_PERMUTATION_BATCH = 100
+#upper bound on the elements of a (nodes x batch x envs) permutation array
+MAX_PERMUTATION_ELEMENTS = 2**24
+#confidence of the p-value interval used to stop permutation tests early
+EARLY_STOP_CONFIDENCE = 0.99
+
 TEST_ON_PAIRWISE = "Pairwise"
 TEST_ON_TREE = "Tree"
 TEST_ON_ENVS = "Envs"
@@ -74,6 +87,81 @@ def mcarlo_sig(real_val, sim_vals, num_comps, tail='low'):
         cor_pval = "<=%.1e" % (1.0/pop_size)
     return (raw_pval, cor_pval)
 
+def mcarlo_sig_interval(real_val, sim_vals, tail='low', confidence=0.95):
+    """ Calc exact confidence interval on a Monte Carlo significance value
+
+    real_val, sim_vals and tail as for mcarlo_sig.
+    confidence: coverage of the (Clopper-Pearson) binomial interval
+
+    returns (lower, upper) bounds on the raw pval
+    """
+    sim_vals = array(sim_vals)
+    num_sims = len(sim_vals)
+    if tail == 'low':
+        out_count = (sim_vals < real_val).sum()
+    elif tail == 'high':
+        out_count = (sim_vals > real_val).sum()
+    else:
+        raise ValueError, "tail must be 'low' or 'high'"
+    tail_prob = (1.0 - confidence) / 2
+    if out_count == 0:
+        lower = 0.0
+    else:
+        lower = bdtri(out_count - 1, num_sims, 1.0 - tail_prob)
+    if out_count == num_sims:
+        upper = 1.0
+    else:
+        upper = bdtri(out_count, num_sims, tail_prob)
+    return (lower, upper)
+
+def _mcarlo_stop_f(real_val, alpha, tail):
+    """Returns f(sim_vals) that is True once the pval is clearly not alpha."""
+    def stop_f(sim_vals):
+        lower, upper = mcarlo_sig_interval(real_val, sim_vals, tail, 
+            EARLY_STOP_CONFIDENCE)
+        return upper < alpha or lower > alpha
+    return stop_f
+
+def _permutation_batch_size(num_nodes, num_cols, batch_size):
+    """Returns batch_size, reduced to respect MAX_PERMUTATION_ELEMENTS."""
+    return max(1, min(batch_size, 
+        MAX_PERMUTATION_ELEMENTS // max(1, num_nodes*num_cols)))
+
+def _run_permutation_batches(batch_f, num_items, num_iters, batch_size,
+    permutation_f=None, random_state=None, stop_f=None):
+    """Returns list of batch_f results over num_iters permutations.
+
+    Permutations of num_items are drawn here, batch_size at a time, and 
+    batch_f gets each (batch, num_items) index array and returns one value
+    per permutation. Rounds of as many batches as the current parallel
+    context has CPUs are mapped with cogent.util.parallel; drawing the
+    permutations here keeps them independent of the number of CPUs. After
+    each round stop_f, if given, is called on all values so far and ends
+    the run early if True.
+    """
+    result = []
+    remaining = num_iters
+    while remaining > 0:
+        batches = []
+        for i in range(parallel.getContext().size):
+            if remaining <= 0:
+                break
+            curr_size = min(batch_size, remaining)
+            batches.append(permutation_indices(num_items, curr_size, 
+                permutation_f, random_state))
+            remaining -= curr_size
+        for values in parallel.map(batch_f, batches):
+            result.extend(values)
+        if stop_f is not None and stop_f(result):
+            break
+    return result
+
+def _random_state(seed):
+    """Returns RandomState for seed, or None to use the global state."""
+    if seed is None:
+        return None
+    return RandomState(seed)
+
 def fast_unifrac_file(tree_in, envs_in, weighted=False, metric=unifrac, is_symmetric=True, modes=UNIFRAC_DEFAULT_MODES):
     """Takes tree and envs file and returns fast_unifrac() results
 
@@ -88,8 +176,14 @@ def fast_unifrac_file(tree_in, envs_in, weighted=False, metric=unifrac, is_symme
     return fast_unifrac(tree, envs, weighted, metric, is_symmetric=is_symmetric, modes=modes)
 
 def fast_unifrac_permutations_file(tree_in, envs_in, weighted=False, 
-    num_iters=1000, verbose=False, test_on=TEST_ON_PAIRWISE):
-    """ Wrapper to read tree and envs from files. """
+    num_iters=1000, verbose=False, test_on=TEST_ON_PAIRWISE, seed=None,
+    alpha=None):
+    """ Wrapper to read tree and envs from files. 
+    
+    seed: seeds the permutations (see fast_unifrac_permutations)
+    alpha: if given, pairwise tests stop early once their raw p-value is
+        clearly above or below the Bonferroni-corrected alpha
+    """
     result = []
     t = DndParser(tree_in, UniFracTreeNode)
     envs = count_envs(envs_in)
@@ -105,8 +199,13 @@ def fast_unifrac_permutations_file(tree_in, envs_in, weighted=False,
             for j in range(i+1, num_uenvs): 
                 second_env = unique_envs[j]
                 real = real_env_mat[i][j]
+                if alpha is None:
+                    raw_alpha = None
+                else:
+                    raw_alpha = alpha / cur_num_comps
                 sim = fast_unifrac_permutations(t, envs, weighted, num_iters, 
-                    first_env=first_env, second_env=second_env)
+                    first_env=first_env, second_env=second_env, seed=seed,
+                    real_value=real, alpha=raw_alpha)
                 raw_pval, cor_pval = mcarlo_sig(real, sim, cur_num_comps, 
                     tail='high')
                 result.append((first_env, second_env, raw_pval, cor_pval))
@@ -116,13 +215,15 @@ def fast_unifrac_permutations_file(tree_in, envs_in, weighted=False,
     # calculate single p-value for whole tree
     elif test_on == TEST_ON_TREE:
         # will be using env_unique_fraction
-        real_ufracs, sim_ufracs = fast_unifrac_whole_tree(t, envs, num_iters)
+        real_ufracs, sim_ufracs = fast_unifrac_whole_tree(t, envs, num_iters,
+            seed=seed)
         raw_pval, cor_pval = mcarlo_sig(sum(real_ufracs), [sum(x) for x in sim_ufracs], 1, tail='high')
         result.append(('whole tree', raw_pval, cor_pval))
     # calculate one p-value per env 
     elif test_on == TEST_ON_ENVS:
         unique_envs, num_uenvs = get_unique_envs(envs)
-        real_ufracs, sim_ufracs = fast_unifrac_whole_tree(t, envs, num_iters)
+        real_ufracs, sim_ufracs = fast_unifrac_whole_tree(t, envs, num_iters,
+            seed=seed)
         sim_m = array(sim_ufracs) 
         # for each env, cal paval
         for i in range(len(real_ufracs)):
@@ -134,8 +235,11 @@ def fast_unifrac_permutations_file(tree_in, envs_in, weighted=False,
     return result
 
 def fast_p_test_file(tree_in, envs_in, num_iters=1000, verbose=False, 
-    test_on=TEST_ON_PAIRWISE):
-    """ Wrapper to read tree and envs from files. """
+    test_on=TEST_ON_PAIRWISE, seed=None, alpha=None):
+    """ Wrapper to read tree and envs from files. 
+    
+    seed, alpha: as for fast_unifrac_permutations_file
+    """
     result = []
     t = DndParser(tree_in, UniFracTreeNode)
     envs = count_envs(envs_in)
@@ -149,8 +253,13 @@ def fast_p_test_file(tree_in, envs_in, num_iters=1000, verbose=False,
                 second_env = unique_envs[j]
                 real = fast_p_test(t, envs, num_iters=1, first_env=first_env, 
                     second_env=second_env, permutation_f=identity)[0]
+                if alpha is None:
+                    raw_alpha = None
+                else:
+                    raw_alpha = alpha / cur_num_comps
                 sim = fast_p_test(t, envs, num_iters, first_env=first_env, 
-                    second_env=second_env)
+                    second_env=second_env, seed=seed, real_value=real, 
+                    alpha=raw_alpha)
                 raw_pval, cor_pval = mcarlo_sig(real, sim, cur_num_comps, 
                     tail='low')
                 result.append((first_env, second_env, raw_pval, cor_pval))
@@ -160,7 +269,8 @@ def fast_p_test_file(tree_in, envs_in, num_iters=1000, verbose=False,
     # calculate real, sim vals and p-vals for whole tree
     elif test_on == TEST_ON_TREE:
         real = fast_p_test(t, envs, num_iters=1, permutation_f=identity)[0]
-        sim = fast_p_test(t, envs, num_iters)
+        sim = fast_p_test(t, envs, num_iters, seed=seed, real_value=real,
+            alpha=alpha)
         raw_pval, cor_pval = mcarlo_sig(real, sim, 1, tail='low')
         result.append(('Whole Tree', raw_pval))
     else:
@@ -168,8 +278,13 @@ def fast_p_test_file(tree_in, envs_in, num_iters=1000, verbose=False,
 
     return result
 
-def _fast_unifrac_setup(t, envs, make_subtree=True):
-    """Setup shared by fast_unifrac and by significance tests."""
+def _fast_unifrac_setup(t, envs, make_subtree=True, sparse=False):
+    """Setup shared by fast_unifrac and by significance tests.
+    
+    If sparse is True, the returned count_array is SparseCounts rather than
+    a dense array; if None, SparseCounts is used once the dense array would 
+    have at least SPARSE_MIN_CELLS cells.
+    """
     if make_subtree:
         t2 = t.copy()
         wanted = set(envs.keys())
@@ -186,7 +301,15 @@ def _fast_unifrac_setup(t, envs, make_subtree=True):
     #get good nodes, defined as those that are in the env file.
     good_nodes=dict([(i.Name,envs[i.Name]) for i in t.tips() if i.Name in envs])
     envs = good_nodes
-    count_array, unique_envs, env_to_index, node_to_index = index_envs(envs, node_index)
+    if sparse is None:
+        num_cells = len(node_index) * get_unique_envs(envs)[1]
+        sparse = num_cells >= SPARSE_MIN_CELLS
+    if sparse:
+        count_array, unique_envs, env_to_index, node_to_index = \
+            index_envs_sparse(envs, node_index)
+    else:
+        count_array, unique_envs, env_to_index, node_to_index = \
+            index_envs(envs, node_index)
     env_names = sorted(unique_envs)
     #Note: envs get sorted at the step above
     branch_lengths = get_branch_lengths(node_index)
@@ -194,27 +317,34 @@ def _fast_unifrac_setup(t, envs, make_subtree=True):
         raise ValueError, "No valid samples/environments found. Check whether tree tips match otus/taxa present in samples/environments"
     return envs, count_array, unique_envs, env_to_index, node_to_index, env_names, branch_lengths, nodes, t
 
-def fast_unifrac_whole_tree(t, envs, num_iters, permutation_f=permutation):
-    """Performs UniFrac permutations on whole tree """
-    sim_ufracs = []
+def fast_unifrac_whole_tree(t, envs, num_iters, permutation_f=None, 
+    seed=None, batch_size=DEFAULT_PERMUTATION_BATCH):
+    """Performs UniFrac permutations on whole tree 
+    
+    permutation_f, seed and batch_size as for fast_unifrac_permutations.
+    """
     envs, count_array, unique_envs, env_to_index, node_to_index, env_names, \
         branch_lengths, nodes, t = _fast_unifrac_setup(t, envs)
     
     bound_indices = bind_to_array(nodes, count_array)
-    orig_count_array = count_array.copy()
+    presence = count_array.astype(bool)
 
     # calculate real values 
     bool_descendants(bound_indices)
     real_bl_sums, real_bl_ufracs = env_unique_fraction(branch_lengths, 
         count_array)
     tip_indices = [n._leaf_index for n in t.tips()]
-    for i in range(num_iters):
-        permute_selected_rows(tip_indices, orig_count_array, count_array, 
-            permutation_f)
-        bool_descendants(bound_indices)
-        cur_bl_sums, cur_bl_ufracs = env_unique_fraction(branch_lengths, 
-            count_array)
-        sim_ufracs.append(cur_bl_ufracs)
+
+    def batch_f(permutations):
+        batch = permute_selected_rows_batch(tip_indices, presence, 
+            permutations)
+        bool_descendants(bind_to_array(nodes, batch))
+        return list(env_unique_fraction_batch(branch_lengths, batch)[1])
+
+    batch_size = _permutation_batch_size(len(presence), len(unique_envs), 
+        batch_size)
+    sim_ufracs = _run_permutation_batches(batch_f, len(tip_indices), 
+        num_iters, batch_size, permutation_f, _random_state(seed))
     return real_bl_ufracs, sim_ufracs 
 
 def PD_whole_tree(t, envs):
@@ -248,21 +378,36 @@ def PD_generic_whole_tree(t, envs, metric=PD):
     return unique_envs, result
 
 def fast_unifrac_permutations(t, envs, weighted, num_iters, first_env, 
-    second_env, permutation_f=permutation, unifrac_f=_weighted_unifrac):
+    second_env, permutation_f=None, unifrac_f=_weighted_unifrac, seed=None,
+    batch_size=DEFAULT_PERMUTATION_BATCH, real_value=None, alpha=None):
     """Performs UniFrac permutations between specified pair of environments.
     
     NOTE: this function just gives you the result of the permutations, need to 
     compare to real values from doing a single unifrac.
+
+    Permutations are evaluated batch_size at a time with array operations,
+    and batches are spread over the CPUs of the current cogent.util.parallel
+    context.
+
+    permutation_f: if given, makes each permutation of the tips (as for
+        permute_selected_rows); otherwise all permutations are drawn from a
+        numpy RandomState seeded with seed (the global numpy random state if
+        seed is None).
+    real_value, alpha: if both are given, stops as soon as an 
+        EARLY_STOP_CONFIDENCE interval on the (high tail) p-value of 
+        real_value lies wholly above or below alpha, in which case fewer
+        than num_iters values are returned.
     """
-    result = []
     envs, count_array, unique_envs, env_to_index, node_to_index, env_names, branch_lengths, nodes, t = _fast_unifrac_setup(t, envs)
 
     first_index,second_index = env_to_index[first_env], env_to_index[second_env]
     count_array = count_array[:,[first_index,second_index]] #ditch rest of array
-    bound_indices = bind_to_array(nodes, count_array)
-    orig_count_array = count_array.copy()
-    first_col, second_col = count_array[:,0], count_array[:,1]
     tip_indices = [n._leaf_index for n in t.tips()]
+    batch_size = _permutation_batch_size(len(count_array), 2, batch_size)
+    if real_value is not None and alpha is not None:
+        stop_f = _mcarlo_stop_f(real_value, alpha, 'high')
+    else:
+        stop_f = None
 
     #figure out whether doing weighted or unweighted analysis: for weighted,
     #need to figure out root-to-tip distances, but can skip this step if
@@ -276,40 +421,55 @@ def fast_unifrac_permutations(t, envs, weighted, num_iters, first_env,
         else:
             bl_correct = False
         first_sum, second_sum = [sum(take(count_array[:,i], tip_indices)) for i in range(2)]
-        for i in range(num_iters):
-            permute_selected_rows(tip_indices, orig_count_array, count_array, permutation_f)
-            sum_descendants(bound_indices)
-            curr = unifrac_f(branch_lengths, first_col, second_col, first_sum, second_sum)
+        def batch_f(permutations):
+            batch = permute_selected_rows_batch(tip_indices, count_array, 
+                permutations)
+            sum_descendants(bind_to_array(nodes, batch))
+            first_cols, second_cols = batch[:,:,0], batch[:,:,1]
+            if unifrac_f is not _weighted_unifrac:
+                result = []
+                for first_col, second_col in zip(first_cols.T, second_cols.T):
+                    curr = unifrac_f(branch_lengths, first_col, second_col, 
+                        first_sum, second_sum)
+                    if bl_correct:
+                        curr /= _branch_correct(tip_ds, first_col, 
+                            second_col, first_sum, second_sum)
+                    result.append(curr)
+                return result
+            first_rel = first_cols/float(first_sum)
+            second_rel = second_cols/float(second_sum)
+            result = dot(branch_lengths, abs(first_rel - second_rel))
             if bl_correct:
-                curr /= _branch_correct(tip_ds, first_col, second_col, first_sum, second_sum)
-            result.append(curr)
+                result /= dot(tip_ds.ravel(), first_rel + second_rel)
+            return list(result)
     else:
-        for i in range(num_iters):
-            permute_selected_rows(tip_indices, orig_count_array, count_array, permutation_f)
-
-            # commenting out these (??)
-            #first = count_array.copy()
-            #permute_selected_rows(tip_indices, orig_count_array, count_array, permutation_f)
-            #second = count_array.copy()
-
-            bool_descendants(bound_indices)
-            curr = unifrac(branch_lengths, first_col, second_col)
-            result.append(curr)
-    return result
+        presence = count_array.astype(bool)
+        def batch_f(permutations):
+            batch = permute_selected_rows_batch(tip_indices, presence, 
+                permutations)
+            bool_descendants(bind_to_array(nodes, batch))
+            first_cols, second_cols = batch[:,:,0], batch[:,:,1]
+            return list(1 - dot(branch_lengths, first_cols & second_cols)/\
+                dot(branch_lengths, first_cols | second_cols))
+    return _run_permutation_batches(batch_f, len(tip_indices), num_iters, 
+        batch_size, permutation_f, _random_state(seed), stop_f)
 
 def fast_p_test(t, envs, num_iters, first_env=None, second_env=None, 
-    permutation_f=permutation):
+    permutation_f=None, seed=None, batch_size=DEFAULT_PERMUTATION_BATCH,
+    real_value=None, alpha=None):
     """Performs Andy Martin's p test between specified pair of environments.
 
     t: tree 
     envs: envs 
     first_env: name of first env, or None if doing whole tree
     second_env: name of second env, or None if doing whole tree
+    permutation_f, seed, batch_size: as for fast_unifrac_permutations.
+    real_value, alpha: as for fast_unifrac_permutations, but using the low
+        tail (fewer changes than real_value).
 
     NOTE: this function just gives you the result of the permutations, need to 
     compare to real Fitch parsimony values. Sleazy way to get the real values 
     is to set num_iters to 1, permutation_f to identity."""
-    result = []
     envs, count_array, unique_envs, env_to_index, node_to_index, env_names, branch_lengths, nodes, t = _fast_unifrac_setup(t, envs)
 
     # check if doing pairwise
@@ -320,16 +480,24 @@ def fast_p_test(t, envs, num_iters, first_env=None, second_env=None,
     elif not (first_env is None and second_env is None):
         raise ValueError, "Both envs must either have a value or be None."
 
-    bound_indices = bind_to_array(nodes, count_array)
-    orig_count_array = count_array.copy()
+    presence = count_array.astype(bool)
     tip_indices = [n._leaf_index for n in t.tips()]
-    for i in range(num_iters):
-        count_array *= 0
-        permute_selected_rows(tip_indices, orig_count_array, count_array, 
-            permutation_f=permutation_f)
-        curr = fitch_descendants(bound_indices)
-        result.append(curr)
-    return result
+    def batch_f(permutations):
+        batch = permute_selected_rows_batch(tip_indices, presence, 
+            permutations)
+        changes = fitch_descendants(bind_to_array(nodes, batch), 
+            counter=FitchCounterBatch)
+        #a tree with no internal nodes never changes
+        return list(zeros(len(permutations), int) + changes)
+
+    batch_size = _permutation_batch_size(len(presence), presence.shape[1], 
+        batch_size)
+    if real_value is not None and alpha is not None:
+        stop_f = _mcarlo_stop_f(real_value, alpha, 'low')
+    else:
+        stop_f = None
+    return _run_permutation_batches(batch_f, len(tip_indices), num_iters, 
+        batch_size, permutation_f, _random_state(seed), stop_f)
 
 def shared_branch_length(t, envs, env_count=1):
     """Returns the shared branch length env_count combinations of envs
@@ -418,7 +586,8 @@ def shared_branch_length_to_root(t, envs):
     return result
 
 def fast_unifrac(t, envs, weighted=False, metric=unifrac, is_symmetric=True, 
-    modes=UNIFRAC_DEFAULT_MODES, weighted_unifrac_f=_weighted_unifrac,make_subtree=True):
+    modes=UNIFRAC_DEFAULT_MODES, weighted_unifrac_f=_weighted_unifrac,make_subtree=True,
+    block_size=None, sparse=None, stripe_filename=None, resume=False):
     """ Run fast unifrac.
     
     t: phylogenetic tree relating the sequences.  pycogent phylonode object
@@ -433,6 +602,24 @@ def fast_unifrac(t, envs, weighted=False, metric=unifrac, is_symmetric=True,
     is_symmetric: if the desired distance matrix is symmetric 
         (dist(sampleA, sampleB) == dist(sampleB, sampleA)), then set this True
         to prevent calculating the same number twice
+    block_size: number of envs per block when the distance matrix is
+        computed in blocks (see batch_unifrac_matrix), which is done for the
+        built-in metrics and the default weighted_unifrac_f. Blocks are
+        spread over the CPUs of the current cogent.util.parallel context.
+    sparse: if True, counts are held and propagated up the tree as 
+        SparseCounts instead of a dense (nodes x envs) array; only possible
+        for the batched metrics above. If None (default), sparse storage is
+        used for those metrics when the dense array would have at least 
+        SPARSE_MIN_CELLS cells.
+    stripe_filename: if given, the distance matrix is computed in diagonal
+        stripes of blocks and written to this .npy file as each stripe 
+        completes, and is returned memory-mapped from it. Only possible 
+        for the batched metrics above.
+    resume: if True, a striped run carries on from the stripes already
+        recorded for stripe_filename by an earlier, interrupted run. That
+        run must have had the same metric, weighting, tree and counts, 
+        else ValueError is raised. If False (default) the file is 
+        overwritten.
 
     using default modes, returns a dictionary with the following (key:value) pairs:
 
@@ -463,8 +650,22 @@ def fast_unifrac(t, envs, weighted=False, metric=unifrac, is_symmetric=True,
     if not modes or modes - UNIFRAC_VALID_MODES:
         raise ValueError, "Invalid run modes: %s, valid: %s" % (str(modes),str(UNIFRAC_VALID_MODES))
 
-    envs, count_array, unique_envs, env_to_index, node_to_index, env_names, branch_lengths, nodes, t = _fast_unifrac_setup(t, envs, make_subtree)
-    bound_indices = bind_to_array(nodes, count_array)
+    if weighted:
+        batched = weighted_unifrac_f is _weighted_unifrac
+    else:
+        batched = metric in SHARED_LENGTH_METRICS
+    if not batched:
+        if sparse or stripe_filename:
+            raise ValueError, "Sparse counts and striping need a built-in " +\
+                "metric and the default weighted_unifrac_f"
+        sparse = False
+
+    envs, count_array, unique_envs, env_to_index, node_to_index, env_names, branch_lengths, nodes, t = _fast_unifrac_setup(t, envs, make_subtree, sparse)
+    sparse = isinstance(count_array, SparseCounts)
+    if sparse:
+        parents, heights = index_parents(t)
+    else:
+        bound_indices = bind_to_array(nodes, count_array)
     #initialize result
     result = {}
     
@@ -473,7 +674,11 @@ def fast_unifrac(t, envs, weighted=False, metric=unifrac, is_symmetric=True,
     #doing unweighted analysis.
     if weighted:
         tip_indices = [n._leaf_index for n in t.tips()]
-        sum_descendants(bound_indices)
+        if sparse:
+            count_array = sparse_sum_descendants(count_array, parents, 
+                heights)
+        else:
+            sum_descendants(bound_indices)
         tip_ds = branch_lengths.copy()[:,newaxis]
         bindings = bind_to_parent_array(t, tip_ds)
         tip_distances(tip_ds, bindings, tip_indices)
@@ -481,19 +686,49 @@ def fast_unifrac(t, envs, weighted=False, metric=unifrac, is_symmetric=True,
             bl_correct = True
         else:
             bl_correct = False
-        u = weighted_unifrac_matrix(branch_lengths, count_array, tip_indices, \
-            bl_correct=bl_correct, tip_distances=tip_ds, \
-            unifrac_f=weighted_unifrac_f)
+        if stripe_filename:
+            u = striped_weighted_unifrac_matrix(branch_lengths, count_array,
+                tip_indices, stripe_filename, bl_correct=bl_correct, 
+                tip_distances=tip_ds, block_size=block_size, resume=resume)
+        elif batched:
+            u = batch_weighted_unifrac_matrix(branch_lengths, count_array, 
+                tip_indices, bl_correct=bl_correct, tip_distances=tip_ds,
+                block_size=block_size)
+        else:
+            u = weighted_unifrac_matrix(branch_lengths, count_array, 
+                tip_indices, bl_correct=bl_correct, tip_distances=tip_ds,
+                unifrac_f=weighted_unifrac_f)
         #figure out if we need the vector
-        if UNIFRAC_DIST_VECTOR in modes:
+        if UNIFRAC_DIST_VECTOR in modes and sparse:
+            result[UNIFRAC_DIST_VECTOR] = (sparse_weighted_unifrac_vector(
+                branch_lengths, count_array, tip_indices, 
+                bl_correct=bl_correct, tip_distances=tip_ds), env_names)
+        elif UNIFRAC_DIST_VECTOR in modes:
             result[UNIFRAC_DIST_VECTOR] = (weighted_unifrac_vector(
                 branch_lengths, count_array, tip_indices, 
                 bl_correct=bl_correct, tip_distances=tip_ds, 
                 unifrac_f=weighted_unifrac_f), env_names)
     else:
-        bool_descendants(bound_indices)
-        u = unifrac_matrix(branch_lengths, count_array, metric=metric, is_symmetric=is_symmetric)
-        if UNIFRAC_DIST_VECTOR in modes:
+        if sparse:
+            count_array = sparse_bool_descendants(count_array, parents, 
+                heights)
+        else:
+            bool_descendants(bound_indices)
+        if stripe_filename:
+            u = striped_unifrac_matrix(branch_lengths, count_array, 
+                stripe_filename, metric=metric, is_symmetric=is_symmetric,
+                block_size=block_size, resume=resume)
+        elif batched:
+            u = batch_unifrac_matrix(branch_lengths, count_array, 
+                metric=metric, is_symmetric=is_symmetric, 
+                block_size=block_size)
+        else:
+            u = unifrac_matrix(branch_lengths, count_array, metric=metric, 
+                is_symmetric=is_symmetric)
+        if UNIFRAC_DIST_VECTOR in modes and sparse:
+            result[UNIFRAC_DIST_VECTOR] = (sparse_unifrac_vector(
+                branch_lengths, count_array), env_names)
+        elif UNIFRAC_DIST_VECTOR in modes:
             result[UNIFRAC_DIST_VECTOR] = (unifrac_vector(branch_lengths, 
                 count_array), env_names)
     
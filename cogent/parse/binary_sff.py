@@ -11,9 +11,12 @@ __email__ = 'kylebittinger@gmail.com'
 __status__ = 'Prototype'
 
 from cStringIO import StringIO
+import mmap
 import string
 import struct
 
+import numpy
+
 # Sections were inspired by, but not derived from, several other implementations:
 # * BioPython (biopython.org)
 # * sff_extract (www.melogen.upv.es/sff_extract)
@@ -231,8 +234,8 @@ def parse_read_data(sff_file, number_of_bases, number_of_flows=400):
     of the Read Header section.
     """
     data = {}
-    flow_fmt = '>' + ('H' * number_of_flows)
-    base_fmt = '>' + ('B' * number_of_bases)
+    flow_fmt = '>%dH' % number_of_flows
+    base_fmt = '>%dB' % number_of_bases
     flow_fmt_size = struct.calcsize(flow_fmt)
     base_fmt_size = struct.calcsize(base_fmt)
 
@@ -397,6 +400,183 @@ def format_binary_sff(sff_file, output_file=None):
     return output_file
 
 
+def _read_data_length(number_of_bases, number_of_flows):
+    """Size in bytes of a padded Read Data section."""
+    size = 2 * number_of_flows + 3 * number_of_bases
+    return size + (-size % 8)
+
+
+def parse_roche_index(buff, offset, length):
+    """Return (names, offsets) from the Roche index of an SFF file.
+
+    buff is a string or buffer holding the whole file; offset and length
+    are taken from the common header.  Both the manifest (.mft) and the
+    plain sorted (.srt) index formats are understood.  Read offsets are
+    stored as four base-255 digits, each entry terminated by 0xFF.
+    """
+    magic = buff[offset:offset + 4]
+    version = buff[offset + 4:offset + 8]
+    if version != '1.00':
+        raise UnsupportedSffError('Unsupported index version: %r' % version)
+    if magic == '.mft':
+        xml_length, data_length = struct.unpack(
+            '>II', buff[offset + 8:offset + 16])
+        start = offset + 16 + xml_length
+    elif magic == '.srt':
+        start = offset + 12
+        data_length = length - 12
+    else:
+        raise UnsupportedSffError('Unsupported index type: %r' % magic)
+    entries = buff[start:start + data_length].split('\xff')[:-1]
+    names = [entry[:-5] for entry in entries]
+    digits = numpy.fromstring(
+        ''.join([entry[-4:] for entry in entries]), dtype=numpy.uint8)
+    digits = digits.reshape((len(entries), 4)).astype(numpy.int64)
+    offsets = numpy.dot(digits, [255 ** 3, 255 ** 2, 255, 1])
+    return names, offsets
+
+
+class SffFile(object):
+    """Random access to the reads of a binary SFF file.
+
+    Reads are located by name through the Roche index stored in the
+    file, or through an index built by scanning the read headers if
+    there is none.  Read data are decoded straight from a memory map of
+    the file, with flowgrams, flow indexes and quality scores returned
+    as numpy arrays.
+    """
+
+    def __init__(self, filename, native_flowgram_values=False):
+        self.Filename = filename
+        self.NativeFlowgramValues = native_flowgram_values
+        self._file = open(filename, 'rb')
+        self.Header = parse_common_header(self._file)
+        validate_common_header(self.Header)
+        self._data = mmap.mmap(
+            self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._number_of_flows = self.Header['number_of_flows_per_read']
+        names, offsets = self._readIndex()
+        names = numpy.array(names, dtype=str)
+        order = names.argsort(kind='mergesort')
+        self._names = names[order]
+        self._offsets = numpy.asarray(offsets, dtype=numpy.int64)[order]
+
+    def _readIndex(self):
+        header = self.Header
+        if header['index_length']:
+            try:
+                names, offsets = parse_roche_index(self._data,
+                    header['index_offset'], header['index_length'])
+            except UnsupportedSffError:
+                pass
+            else:
+                if len(names) == header['number_of_reads']:
+                    return names, offsets
+        names = []
+        offsets = []
+        for offset in self.iterOffsets():
+            offsets.append(offset)
+            names.append(self._readHeader(offset)['Name'])
+        return names, offsets
+
+    def iterOffsets(self):
+        """Yield the offset of each read, in file order."""
+        header = self.Header
+        offset = header['header_length']
+        for i in xrange(header['number_of_reads']):
+            if offset == header['index_offset']:
+                offset += header['index_length'] + (
+                    -header['index_length'] % 8)
+            yield offset
+            read_header = read_header_struct.unpack(
+                self._data[offset:offset + read_header_struct.size])
+            offset += read_header['read_header_length'] + _read_data_length(
+                read_header['number_of_bases'], self._number_of_flows)
+
+    def _readHeader(self, offset):
+        read = read_header_struct.unpack(
+            self._data[offset:offset + read_header_struct.size])
+        start = offset + read_header_struct.size
+        read['Name'] = self._data[start:start + read['name_length']]
+        return read
+
+    def readAt(self, offset):
+        """Return the read starting at offset as a dict of arrays."""
+        read = self._readHeader(offset)
+        number_of_bases = read['number_of_bases']
+        offset += read['read_header_length']
+        flowgram = numpy.frombuffer(self._data, dtype='>u2',
+            count=self._number_of_flows, offset=offset)
+        if self.NativeFlowgramValues:
+            read['flowgram_values'] = flowgram.astype(numpy.uint16)
+        else:
+            read['flowgram_values'] = flowgram * 0.01
+        offset += 2 * self._number_of_flows
+        read['flow_index_per_base'] = numpy.frombuffer(self._data,
+            dtype=numpy.uint8, count=number_of_bases, offset=offset).copy()
+        offset += number_of_bases
+        read['Bases'] = self._data[offset:offset + number_of_bases]
+        offset += number_of_bases
+        read['quality_scores'] = numpy.frombuffer(self._data,
+            dtype=numpy.uint8, count=number_of_bases, offset=offset).copy()
+        return read
+
+    def _offsetOf(self, name):
+        i = self._names.searchsorted(name)
+        if i == len(self._names) or self._names[i] != name:
+            raise KeyError(name)
+        return self._offsets[i]
+
+    def _getNames(self):
+        return list(self._names)
+
+    Names = property(_getNames)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        try:
+            self._offsetOf(name)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, name):
+        return self.readAt(self._offsetOf(name))
+
+    def __iter__(self):
+        for offset in self.iterOffsets():
+            yield self.readAt(offset)
+
+    def getReads(self, names):
+        """Return a list of the named reads, in the order given."""
+        return [self[name] for name in names]
+
+    def iterBatches(self, names=None, batch_size=10000):
+        """Yield lists of reads, batch_size at a time.
+
+        Reads are visited in file order so that the memory map is read
+        sequentially.  If names is given only those reads are included.
+        """
+        if names is None:
+            offsets = self.iterOffsets()
+        else:
+            offsets = sorted([self._offsetOf(name) for name in names])
+        batch = []
+        for offset in offsets:
+            batch.append(self.readAt(offset))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+
 def base36_encode(n):
     """Convert a positive integer to a base36 string.
 
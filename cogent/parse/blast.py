@@ -5,6 +5,8 @@ from cogent.parse.record_finder import LabeledRecordFinder, \
     DelimitedRecordFinder, never_ignore
 from cogent.parse.record import RecordError
 from string import strip, upper
+from numpy import array, empty, flatnonzero, lexsort, arange, repeat, diff, \
+    concatenate, cumsum, fromstring
 
 __author__ = "Micah Hamady"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -397,8 +399,9 @@ class BlastResult(dict):
             else:
                 hits.append(dict(zip(rec_data[0], ['' for x in rec_data[0]])))
             
-            # get blast version of query id
-            query_id = hits[0][self.QUERY_ID]
+            # get blast version of query id; records without hits only
+            # have it in props
+            query_id = hits[0][self.QUERY_ID] or props.get('QUERY', '')
 
             if query_id not in self: 
                 self[query_id] = [] 
@@ -468,6 +471,161 @@ class BlastResult(dict):
     
     #raise error if both field and f passed, uses same dict as filterByField
 
+#columns of tabular (-m 8 or -m 9) BLAST and BLAT output
+BLAST_TABLE_FIELDS = [('query', 'S'), ('subject', 'S'), ('pident', 'f8'),
+    ('length', 'i8'), ('mismatches', 'i8'), ('gapopen', 'i8'),
+    ('qstart', 'i8'), ('qend', 'i8'), ('sstart', 'i8'), ('send', 'i8'),
+    ('evalue', 'f8'), ('bitscore', 'f8')]
+
+#whether larger values are better, for fields hits can be ranked on
+HIT_FIELD_LARGER_BETTER = {'pident':True, 'length':True, 'mismatches':False,
+    'evalue':False, 'bitscore':True}
+
+def _text_chunks(lines, chunk_size):
+    """Yields text of whole lines from a file, filename or lines.
+    
+    Files are read chunk_size characters at a time.
+    """
+    if isinstance(lines, str):
+        lines = open(lines, 'U')
+    if hasattr(lines, 'read'):
+        tail = ''
+        while True:
+            text = lines.read(chunk_size)
+            if not text:
+                break
+            text = tail + text
+            end = text.rfind('\n') + 1
+            tail = text[end:]
+            if end:
+                yield text[:end]
+        if tail:
+            yield tail
+    else:
+        batch = []
+        size = 0
+        for line in lines:
+            batch.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield '\n'.join([l.rstrip('\n') for l in batch])
+                batch = []
+                size = 0
+        if batch:
+            yield '\n'.join([l.rstrip('\n') for l in batch])
+
+def _hits_from_rows(rows, fields):
+    """Returns structured array from list of tab-delimited rows."""
+    num_fields = len(fields)
+    cells = '\t'.join(rows).split('\t')
+    if len(cells) != len(rows) * num_fields:
+        raise RecordError, "Expected %s fields in each row of:\n%s" % \
+            (num_fields, '\n'.join(rows[:10]))
+    columns = []
+    dtypes = []
+    for i, (name, dtype) in enumerate(fields):
+        column = cells[i::num_fields]
+        if dtype == 'S':
+            column = array(column)
+        else:   #parse numbers in C rather than one at a time
+            column = fromstring('\t'.join(column), dtype=dtype, sep='\t')
+            if len(column) != len(rows):
+                raise RecordError, "Bad %s value in rows:\n%s" % \
+                    (name, '\n'.join(rows[:10]))
+        columns.append(column)
+        dtypes.append((name, column.dtype))
+    hits = empty(len(rows), dtype=dtypes)
+    for (name, dtype), column in zip(dtypes, columns):
+        hits[name] = column
+    return hits
+
+def _query_starts(queries):
+    """Returns indices where each run of equal queries starts."""
+    if not len(queries):
+        return flatnonzero(queries)
+    return concatenate([[0], flatnonzero(queries[1:] != queries[:-1]) + 1])
+
+def BlastTableChunks(lines, chunk_size=2**24, fields=BLAST_TABLE_FIELDS):
+    """Yields structured arrays of hits from tabular BLAST or BLAT output.
+
+    lines: file object, filename or lines of -m 8 or -m 9 output.
+    chunk_size: characters to read at a time.
+    fields: (name, dtype) for each column; strings ('S') are sized to fit.
+
+    Each array holds all the hits for one or more queries, in file order.
+    Comment lines are skipped, so queries without hits are left out.
+    """
+    carry = []
+    texts = _text_chunks(lines, chunk_size)
+    text = next(texts, None)
+    while text is not None:
+        if '#' in text:
+            rows = [line for line in text.split('\n') 
+                if line and not line.startswith('#')]
+        else:
+            rows = filter(None, text.split('\n'))
+        rows = carry + rows
+        text = next(texts, None)
+        if not rows:
+            continue
+        hits = _hits_from_rows(rows, fields)
+        if text is None:
+            yield hits
+            break
+        #the last query may continue in the next chunk
+        last = _query_starts(hits[fields[0][0]])[-1]
+        carry = rows[last:]
+        if last:
+            yield hits[:last]
+
+def BlastTableParser(lines, chunk_size=2**24, fields=BLAST_TABLE_FIELDS):
+    """Yields (query, hits) from tabular BLAST or BLAT output.
+
+    hits is a structured array with a row per hit: see BlastTableChunks.
+    """
+    for hits in BlastTableChunks(lines, chunk_size, fields):
+        queries = hits[fields[0][0]]
+        starts = _query_starts(queries)
+        ends = concatenate([starts[1:], [len(hits)]])
+        for start, end in zip(starts, ends):
+            yield queries[start], hits[start:end]
+
+def best_hits(hits, n=1, field='bitscore', return_self=False):
+    """Returns the best n hits for each query in structured array hits.
+
+    hits must have each query's hits together, as from BlastTableChunks.
+    return_self: if False, hits of a query to itself are left out.
+    Ties keep the order of hits.
+    """
+    if field not in HIT_FIELD_LARGER_BETTER:
+        raise ValueError, "Invalid field: %s. You must specify one of: %s" \
+                          % (field, str(HIT_FIELD_LARGER_BETTER.keys()))
+    if not return_self:
+        hits = hits[hits['query'] != hits['subject']]
+    if not len(hits):
+        return hits
+    group = cumsum(concatenate([[0], hits['query'][1:] != hits['query'][:-1]]))
+    values = hits[field]
+    if HIT_FIELD_LARGER_BETTER[field]:
+        values = -values
+    order = lexsort((values, group))
+    starts = _query_starts(group)
+    run_lengths = diff(concatenate([starts, [len(hits)]]))
+    rank = arange(len(hits)) - repeat(starts, run_lengths)
+    return hits[order[rank < n]]
+
+def filter_hits(hits, field='evalue', threshold=0.001):
+    """Returns the hits in structured array hits where field beats threshold.
+    
+    Uses HIT_FIELD_LARGER_BETTER to figure out which direction to compare.
+    """
+    if field not in HIT_FIELD_LARGER_BETTER:
+        raise ValueError, "Invalid field: %s. You must specify one of: %s" \
+                          % (field, str(HIT_FIELD_LARGER_BETTER.keys()))
+    if HIT_FIELD_LARGER_BETTER[field]:
+        return hits[hits[field] > threshold]
+    return hits[hits[field] < threshold]
+
 fastacmd_taxonomy_splitter = DelimitedRecordFinder(delimiter='', \
     ignore=never_ignore)
 fasta_field_map = { 'NCBI sequence id':'seq_id',
@@ -13,12 +13,18 @@ __email__ = "krother@rubor.de"
 __status__ = "Prototype"
 
 import xml.dom.minidom
+from xml.etree.cElementTree import iterparse
+from StringIO import StringIO
+import re
+from numpy import array
 
 """
 CAUTION:
-This XML BLAST PARSER uses minidom. This means a bad performance for 
+MinimalBlastParser7 uses minidom. This means a bad performance for 
 big files (>5MB), and huge XML files will for sure crash the program!
 (06/2009 Kristian)
+IterativeBlastParser7 and BlastXmlTableParser read the file incrementally,
+keeping only one <Iteration> (query) in memory at a time.
 
 Possible improvements:
 - convert some values into floats automatically (feature request)
@@ -28,7 +34,8 @@ Possible improvements:
 - consider high speed parser for standard output
 """
 
-from cogent.parse.blast import BlastResult
+from cogent.parse.blast import BlastResult, MinimalBlastParser9, \
+    MinimalPsiBlastParser9, BLAST_TABLE_FIELDS
 
 # field names used to parse tags and create dict.
 HIT_XML_FIELDNAMES = ['QUERY ID','SUBJECT_ID','HIT_DEF','HIT_ACCESSION',\
@@ -151,6 +158,161 @@ def MinimalBlastParser7(lines, include_column_names=False, format='xml'):
         yield props,hits
 
 
+class _LineReader(object):
+    """File-like wrapper reading from an iterable of lines."""
+    def __init__(self, lines):
+        self._lines = iter(lines)
+
+    def read(self, size=-1):
+        return next(self._lines, '')
+
+def get_element_text(elem, name, default=None):
+    """Returns text of the first child of elem named name, else default.
+
+    ElementTree counterpart of get_tag.
+    """
+    text = elem.findtext(name)
+    if text:
+        return text
+    return default
+
+def parse_header_element(elem):
+    """Parses a 'BlastOutput' ElementTree element, like parse_header."""
+    result = {}
+    result['application'] = get_element_text(elem, 'BlastOutput_program')
+    result['version'] = get_element_text(elem, 'BlastOutput_version')
+    result['reference'] = get_element_text(elem, 'BlastOutput_reference')
+    result['query'] = get_element_text(elem, 'BlastOutput_query-def')
+    query_letters = get_element_text(elem, 'BlastOutput_query-len')
+    if query_letters is not None:
+        query_letters = int(query_letters)
+    result['query_letters'] = query_letters
+    result['database'] = get_element_text(elem, 'BlastOutput_db')
+    for param_tag in elem.findall('BlastOutput_param/Parameters'):
+        result['matrix'] = get_element_text(param_tag, 'Parameters_matrix')
+        result['expect'] = get_element_text(param_tag, 'Parameters_expect')
+        result['gap_open_penalty'] = \
+            float(get_element_text(param_tag, 'Parameters_gap-open'))
+        result['gap_extend_penalty'] = \
+            float(get_element_text(param_tag, 'Parameters_gap-extend'))
+        result['filter'] = get_element_text(param_tag, 'Parameters_filter')
+    return result
+
+def BlastXmlIterations(lines):
+    """Yields (header, query_id, iteration) for each <Iteration> in lines.
+
+    lines: XML BLAST output as a string, file object or lines.
+    header: dict from parse_header_element.
+    query_id: Iteration_query-def, else Iteration_query-ID, else the number
+        of the iteration counting from 1.
+    iteration: the <Iteration> element, cleared once the next is requested.
+    """
+    if isinstance(lines, basestring):
+        source = StringIO(lines)
+    elif hasattr(lines, 'read'):
+        source = lines
+    else:
+        source = _LineReader(lines)
+    root = None
+    header = {}
+    count = 0
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            elif elem.tag == 'BlastOutput_iterations':
+                #the header has been read by now
+                header = parse_header_element(root)
+            continue
+        if elem.tag != 'Iteration':
+            continue
+        count += 1
+        query_id = get_element_text(elem, 'Iteration_query-def') or \
+            get_element_text(elem, 'Iteration_query-ID') or count
+        yield header, query_id, elem
+        #drop parsed iterations, so memory is bounded by the largest one
+        elem.clear()
+        for parent in root.findall('BlastOutput_iterations'):
+            parent.clear()
+
+def parse_hit_element(hit, query_id=1):
+    """Parses a 'Hit' ElementTree element, like parse_hit."""
+    length = get_element_text(hit, 'Hit_len')
+    hit_data = [query_id, get_element_text(hit, 'Hit_id'), 
+        get_element_text(hit, 'Hit_def'), 
+        get_element_text(hit, 'Hit_accession'),
+        int(length) if length else None]
+    result = []
+    for hsp in hit.getiterator('Hsp'):
+        result.append(hit_data + [get_element_text(hsp, tag_name, 0) 
+            if tag_name else 0 for tag_name in HSP_XML_TAGNAMES])
+    return result
+
+def IterativeBlastParser7(lines, include_column_names=False):
+    """Yields successive records (props, data list), one per <Iteration>.
+
+    lines must be XML BLAST output format, as a string, file or lines.
+    Records are as from MinimalBlastParser7, except that there is one for
+    each query (or PSI-BLAST iteration) rather than one for the file, and
+    props also has the 'ITERATION' number and 'QUERY'.
+    """
+    for header, query_id, iteration in BlastXmlIterations(lines):
+        props = header.copy()
+        number = get_element_text(iteration, 'Iteration_iter-num')
+        if number is not None:
+            props['ITERATION'] = int(number)
+        props['QUERY'] = query_id
+        if include_column_names:
+            hits = [HIT_XML_FIELDNAMES + HSP_XML_FIELDNAMES]
+        else:
+            hits = []
+        for hit in iteration.getiterator('Hit'):
+            hits += parse_hit_element(hit, query_id)
+        yield props, hits
+
+_gap_run = re.compile('-+')
+
+def _count_gap_openings(seq):
+    """Returns number of runs of '-' in seq."""
+    if not seq:
+        return 0
+    return len(_gap_run.findall(seq))
+
+def BlastXmlTableParser(lines):
+    """Yields (query_id, hits) for each query in XML BLAST output.
+
+    hits is a structured array with the fields of tabular BLAST output
+    (BLAST_TABLE_FIELDS), a row per HSP, so can be filtered like those from
+    BlastTableParser. Percent identity, mismatches and gap openings are
+    worked out from the HSP's identities, gaps and alignment.
+    """
+    for header, query_id, iteration in BlastXmlIterations(lines):
+        rows = []
+        for hit in iteration.getiterator('Hit'):
+            subject = get_element_text(hit, 'Hit_id', '')
+            for hsp in hit.getiterator('Hsp'):
+                value = lambda name: get_element_text(hsp, name, 0)
+                length = int(value('Hsp_align-len'))
+                identity = int(value('Hsp_identity'))
+                gaps = int(value('Hsp_gaps'))
+                gap_openings = \
+                    _count_gap_openings(get_element_text(hsp, 'Hsp_qseq')) + \
+                    _count_gap_openings(get_element_text(hsp, 'Hsp_hseq'))
+                rows.append((str(query_id), subject, 
+                    100.0 * identity / length if length else 0.0, length, 
+                    length - identity - gaps, gap_openings, 
+                    int(value('Hsp_query-from')), int(value('Hsp_query-to')),
+                    int(value('Hsp_hit-from')), int(value('Hsp_hit-to')),
+                    float(value('Hsp_evalue')), float(value('Hsp_bit-score'))))
+        if not rows:
+            continue
+        dtypes = []
+        for (name, dtype), column in zip(BLAST_TABLE_FIELDS, zip(*rows)):
+            if dtype == 'S':
+                dtype = 'S%s' % max(1, max(map(len, column)))
+            dtypes.append((name, dtype))
+        yield str(query_id), array(rows, dtype=dtypes)
+
 class BlastXMLResult(BlastResult):
     """the BlastResult objects have the query sequence as keys,
     and the values are lists of lists of dictionaries.
@@ -199,7 +361,7 @@ class BlastXMLResult(BlastResult):
 
         if not parser:
             if xml:
-                parser = MinimalBlastParser7
+                parser = IterativeBlastParser7
             elif psiblast:
                 parser = MinimalPsiBlastParser9
             else:
@@ -222,8 +384,9 @@ class BlastXMLResult(BlastResult):
             else:
                 hits.append(dict(zip(rec_data[0], ['' for x in rec_data[0]])))
             
-            # get blast version of query id
-            query_id = hits[0][self.QUERY_ID]
+            # get blast version of query id; records without hits only
+            # have it in props
+            query_id = hits[0][self.QUERY_ID] or props.get('QUERY', '')
 
             if query_id not in self: 
                 self[query_id] = [] 
@@ -7,8 +7,14 @@ from cogent.core.info import Info, DbRef
 from cogent.core.moltype import BYTES, ASCII
 
 from string import strip
+from bisect import bisect_right
+from struct import unpack, pack
 import cogent
 import re
+import os
+import mmap
+import gzip
+import zlib
 
 __author__ = "Rob Knight"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -265,3 +271,297 @@ def GroupFastaParser(data, label_to_name, group_key="Group", aligned=False,
     seqs.Info = info
     yield seqs
     
+
+
+def is_bgzf(filename):
+    """Checks if filename is BGZF (bgzip) compressed."""
+    infile = open(filename, 'rb')
+    try:
+        header = infile.read(18)
+    finally:
+        infile.close()
+    return len(header) == 18 and header[:4] == '\x1f\x8b\x08\x04' and \
+        header[12:14] == 'BC'
+
+class BgzfReader(object):
+    """Random access to the uncompressed bytes of a BGZF (bgzip) file.
+
+    Block offsets are read from a samtools .gzi index, if present, or else
+    from the block headers (writing the .gzi if write_index is True).
+    """
+    MaxCachedBlocks = 16
+
+    def __init__(self, filename, write_index=True):
+        self.Filename = filename
+        self._file = open(filename, 'rb')
+        gzi_filename = filename + '.gzi'
+        if os.path.exists(gzi_filename):
+            self._readGzi(gzi_filename)
+        else:
+            self._scanBlocks()
+            if write_index:
+                self._writeGzi(gzi_filename)
+        self._cache = {}
+
+    def _readGzi(self, gzi_filename):
+        data = open(gzi_filename, 'rb').read()
+        (count,) = unpack('<Q', data[:8])
+        offsets = unpack('<%sQ' % (2 * count), data[8:8 + 16 * count])
+        self._compressed = [0] + list(offsets[0::2])
+        self._uncompressed = [0] + list(offsets[1::2])
+
+    def _writeGzi(self, gzi_filename):
+        count = len(self._compressed) - 1
+        pairs = []
+        for compressed, uncompressed in zip(self._compressed[1:], 
+                self._uncompressed[1:]):
+            pairs.extend([compressed, uncompressed])
+        try:
+            outfile = open(gzi_filename, 'wb')
+        except IOError:     #can't write beside the file: rescan next time
+            return
+        outfile.write(pack('<Q', count) + pack('<%sQ' % len(pairs), *pairs))
+        outfile.close()
+
+    def _scanBlocks(self):
+        """Reads block sizes from the headers and footers of each block."""
+        infile = self._file
+        compressed, uncompressed = [], []
+        c_offset = u_offset = 0
+        while True:
+            infile.seek(c_offset)
+            header = infile.read(12)
+            if not header:
+                break
+            if header[:4] != '\x1f\x8b\x08\x04':
+                raise RecordError, "Not a BGZF block at offset %s" % c_offset
+            (xlen,) = unpack('<H', header[10:12])
+            extra = infile.read(xlen)
+            block_size = None
+            i = 0
+            while i < xlen:
+                (slen,) = unpack('<H', extra[i+2:i+4])
+                if extra[i:i+2] == 'BC':
+                    (block_size,) = unpack('<H', extra[i+4:i+6])
+                    block_size += 1
+                i += 4 + slen
+            if block_size is None:
+                raise RecordError, "No BGZF block size at offset %s" % c_offset
+            infile.seek(c_offset + block_size - 4)
+            (isize,) = unpack('<I', infile.read(4))
+            compressed.append(c_offset)
+            uncompressed.append(u_offset)
+            c_offset += block_size
+            u_offset += isize
+        self._compressed = compressed or [0]
+        self._uncompressed = uncompressed or [0]
+
+    def _block(self, i):
+        """Returns the uncompressed data of block i."""
+        if i in self._cache:
+            return self._cache[i]
+        start = self._compressed[i]
+        if i + 1 < len(self._compressed):
+            size = self._compressed[i + 1] - start
+        else:
+            size = -1
+        self._file.seek(start)
+        data = zlib.decompress(self._file.read(size), 31)
+        if len(self._cache) >= self.MaxCachedBlocks:
+            self._cache.clear()
+        self._cache[i] = data
+        return data
+
+    def read(self, offset, length):
+        """Returns length bytes from uncompressed offset."""
+        i = bisect_right(self._uncompressed, offset) - 1
+        chunks = []
+        skip = offset - self._uncompressed[i]
+        while length > 0 and i < len(self._compressed):
+            data = self._block(i)[skip:skip + length]
+            chunks.append(data)
+            length -= len(data)
+            skip = 0
+            i += 1
+        return ''.join(chunks)
+
+    def close(self):
+        self._file.close()
+
+class IndexedFasta(object):
+    """Random access to the sequences in a FASTA file, plain or bgzipped.
+
+    Uses a samtools faidx index (filename + '.fai'), building it if absent
+    (and writing it if write_index is True). Behaves as a read-only dict of
+    {name: Sequence}, names being the first word of each label; like a 
+    SequenceCollection it has Names, getSeq and takeSeqs. getRegion reads 
+    only the bases asked for.
+
+    All lines of a sequence, except the last, must be the same length.
+    """
+    def __init__(self, filename, moltype=None, write_index=True):
+        self.Filename = filename
+        self.MolType = moltype or BYTES
+        if is_bgzf(filename):
+            self._reader = BgzfReader(filename, write_index)
+            self._read = self._reader.read
+        else:
+            self._reader = open(filename, 'rb')
+            if os.path.getsize(filename):
+                self._mmap = mmap.mmap(self._reader.fileno(), 0, 
+                    access=mmap.ACCESS_READ)
+            else:   #can't map an empty file
+                self._mmap = ''
+            self._read = lambda offset, length: \
+                self._mmap[offset:offset + length]
+        fai_filename = filename + '.fai'
+        if os.path.exists(fai_filename):
+            self._readFai(fai_filename)
+        else:
+            self._buildIndex()
+            if write_index:
+                self._writeFai(fai_filename)
+
+    def _readFai(self, fai_filename):
+        self.Names = []
+        self._index = {}
+        for line in open(fai_filename):
+            fields = line.split('\t')
+            if len(fields) < 5:
+                continue
+            self.Names.append(fields[0])
+            self._index[fields[0]] = tuple(map(int, fields[1:5]))
+
+    def _writeFai(self, fai_filename):
+        try:
+            outfile = open(fai_filename, 'w')
+        except IOError:     #can't write beside the file: rebuild next time
+            return
+        for name in self.Names:
+            outfile.write('%s\t%s\t%s\t%s\t%s\n' % ((name,) + 
+                self._index[name]))
+        outfile.close()
+
+    def _buildIndex(self):
+        """Reads the file once, noting where each sequence's lines are."""
+        if isinstance(self._reader, BgzfReader):
+            lines = gzip.open(self.Filename, 'rb')
+        else:
+            lines = open(self.Filename, 'rb')
+        names = []
+        index = {}
+        name = None
+        position = 0
+        for line in lines:
+            if line.startswith('>'):
+                if name is not None:
+                    index[name] = (length, offset, line_bases, line_width)
+                fields = line[1:].split()
+                if not fields:
+                    raise RecordError, "Found FASTA label without name at " \
+                        "offset %s" % position
+                name = fields[0]
+                if name in index:
+                    raise RecordError, "Duplicate sequence name %s" % name
+                names.append(name)
+                offset = position + len(line)
+                length = line_bases = line_width = 0
+                short_line = False
+            elif name is not None:
+                bases = len(line.rstrip('\r\n'))
+                if short_line and bases:
+                    raise RecordError, "Different line lengths in sequence " \
+                        "%s: can't index" % name
+                if not line_width:
+                    line_bases, line_width = bases, len(line)
+                elif bases > line_bases or (bases == line_bases and 
+                        len(line) != line_width):
+                    raise RecordError, "Different line lengths in sequence " \
+                        "%s: can't index" % name
+                short_line = bases < line_bases or not bases
+                length += bases
+            position += len(line)
+        if name is not None:
+            index[name] = (length, offset, line_bases, line_width)
+        lines.close()
+        self.Names = names
+        self._index = index
+
+    def __len__(self):
+        return len(self.Names)
+
+    def __iter__(self):
+        return iter(self.Names)
+
+    def keys(self):
+        return self.Names[:]
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def items(self):
+        return [(name, self[name]) for name in self.Names]
+
+    def iteritems(self):
+        for name in self.Names:
+            yield name, self[name]
+
+    def getLength(self, name):
+        """Returns the length of sequence name."""
+        return self._index[name][0]
+
+    def getString(self, name, start=None, end=None):
+        """Returns the bases of name from start to end as a string.
+
+        start and end are zero-based and count from the end if negative.
+        """
+        try:
+            length, offset, line_bases, line_width = self._index[name]
+        except KeyError:
+            raise KeyError, "No sequence named %s in %s" % (name, 
+                self.Filename)
+        start, end, step = slice(start, end).indices(length)
+        if start >= end:
+            return ''
+        first = offset + start // line_bases * line_width + \
+            start % line_bases
+        last = offset + (end - 1) // line_bases * line_width + \
+            (end - 1) % line_bases + 1
+        data = self._read(first, last - first)
+        if line_width != line_bases:
+            data = data.replace('\n', '').replace('\r', '')
+        return data
+
+    def getSeq(self, name):
+        """Returns sequence name as a Sequence."""
+        return self.MolType.makeSequence(self.getString(name), Name=name)
+
+    __getitem__ = getSeq
+
+    def getRegion(self, name, start=None, end=None):
+        """Returns bases of name from start to end as a Sequence.
+
+        The Sequence is named name:start-end.
+        """
+        start, end, step = slice(start, end).indices(self.getLength(name))
+        return self.MolType.makeSequence(self.getString(name, start, end),
+            Name='%s:%s-%s' % (name, start, end))
+
+    def _get_named_seqs(self):
+        return self
+    NamedSeqs = property(_get_named_seqs)
+
+    def takeSeqs(self, names, aligned=False, **kwargs):
+        """Returns collection of the sequences in names, in that order.
+
+        aligned and kwargs are passed to LoadSeqs.
+        """
+        return cogent.LoadSeqs(data=[(name, self.getString(name)) 
+            for name in names], moltype=self.MolType, aligned=aligned, 
+            **kwargs)
+
+    def close(self):
+        """Closes the FASTA file."""
+        if getattr(self, '_mmap', None):
+            self._mmap.close()
+        self._reader.close()
@@ -1,8 +1,18 @@
 #!/usr/bin/env python
 """Extracts data from NCBI nodes.dmp and names.dmp files.
+
+NcbiTaxonomyFromFiles builds a tree of NcbiTaxonNode objects. For the full
+NCBI taxonomy, CompiledNcbiTaxonomyFromFiles instead writes the taxonomy once
+as arrays in a directory; CompiledNcbiTaxonomy then memory-maps them, so that
+loading is immediate and lineage, last common ancestor, rank and name queries
+need no per-taxon objects.
 """
+import os
 from cogent.core.tree import TreeNode
 from string import strip
+from numpy import array, zeros, empty, arange, argsort, bincount, \
+    concatenate, cumsum, load, save, memmap, asarray, atleast_1d, where, \
+    nonzero
 
 __author__ = "Jason Carnes"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -253,3 +263,332 @@ def NcbiTaxonomyFromFiles(nodes_file, names_file, strict=False):
     taxa = NcbiTaxonLookup(NcbiTaxonParser(nodes_file))
     names = NcbiNameLookup(NcbiNameParser(names_file))
     return NcbiTaxonomy(taxa, names, strict)
+
+#positions of the Euler tour per block of the LCA range minimum index
+EULER_BLOCK_SIZE = 32
+
+def _compile_euler_tour(parents):
+    """Returns euler, depths, first, preorder, ends for a forest.
+
+    parents: parent index of each node, -1 for roots.
+    euler: nodes in the order a depth-first walk visits them, 2n - r long
+    for r roots; first: position of each node's first visit in euler;
+    preorder: nodes in preorder; ends: for each node, the preorder position
+    after its last descendant.
+    """
+    num_nodes = len(parents)
+    has_parent = parents >= 0
+    children = nonzero(has_parent)[0]
+    children = children[argsort(parents[children], kind='mergesort')]
+    child_ends = cumsum(bincount(parents[children], minlength=num_nodes))
+    child_starts = concatenate(([0], child_ends[:-1]))
+    children, child_starts, child_ends = map(list, 
+        [children, child_starts, child_ends])
+    depths = zeros(num_nodes, int)
+    first = zeros(num_nodes, int)
+    ends = zeros(num_nodes, int)
+    euler = []
+    preorder = []
+    for root in nonzero(~has_parent)[0]:
+        first[root] = len(euler)
+        euler.append(root)
+        preorder.append(root)
+        stack = [root]
+        positions = [child_starts[root]]
+        while stack:
+            node = stack[-1]
+            position = positions[-1]
+            if position < child_ends[node]:
+                positions[-1] = position + 1
+                child = children[position]
+                depths[child] = len(stack)
+                first[child] = len(euler)
+                euler.append(child)
+                preorder.append(child)
+                stack.append(child)
+                positions.append(child_starts[child])
+            else:
+                ends[node] = len(preorder)
+                stack.pop()
+                positions.pop()
+                if stack:
+                    euler.append(stack[-1])
+    return array(euler, int), depths, first, array(preorder, int), ends
+
+def _compile_block_minima(depths, block_size):
+    """Returns sparse table of positions of least depth over blocks.
+
+    Row k, column b is the position of the least depth in blocks b to 
+    b + 2**k - 1 (truncated at the end).
+    """
+    num_blocks = (len(depths) - 1) // block_size + 1
+    padded = empty(num_blocks*block_size, int)
+    padded.fill(depths.max() + 1)
+    padded[:len(depths)] = depths
+    blocks = padded.reshape((num_blocks, block_size))
+    rows = [blocks.argmin(1) + arange(num_blocks)*block_size]
+    width = 1
+    while width < num_blocks:
+        last = rows[-1]
+        shifted = concatenate((last[width:], last[-width:]))
+        rows.append(where(padded[shifted] < padded[last], shifted, last))
+        width *= 2
+    return array(rows)
+
+def CompiledNcbiTaxonomyFromFiles(nodes_file, names_file, dirname, 
+    strict=False):
+    """Writes compiled taxonomy from nodes and names files to dirname.
+
+    Returns the CompiledNcbiTaxonomy read back from dirname.
+
+    strict, if True, raises an error on finding taxa whose parents don't
+    exist. Otherwise they become extra roots.
+    """
+    taxon_ids, parent_ids, rank_codes = [], [], []
+    rank_names = []
+    rank_lookup = {}
+    for line in nodes_file:
+        if line.strip():
+            fields = line.split('|', 3)
+            taxon_ids.append(int(fields[0]))
+            parent_ids.append(int(fields[1]))
+            rank = fields[2].strip()
+            if rank not in rank_lookup:
+                rank_lookup[rank] = len(rank_names)
+                rank_names.append(rank)
+            rank_codes.append(rank_lookup[rank])
+    order = argsort(taxon_ids, kind='mergesort')
+    taxon_ids = array(taxon_ids, int)[order]
+    parent_ids = array(parent_ids, int)[order]
+    ranks = array(rank_codes, 'uint8')[order]
+    max_id = max(taxon_ids.max(), parent_ids.max())
+    index = empty(max_id + 1, 'int32')
+    index.fill(-1)
+    index[taxon_ids] = arange(len(taxon_ids))
+    parents = index[parent_ids]
+    missing = parents < 0
+    if strict and missing.any():
+        t_id = taxon_ids[missing][0]
+        raise MissingParentError, \
+            "Node %s has parent %s, which isn't in taxa." % \
+            (t_id, parent_ids[missing][0])
+    parents[parent_ids == taxon_ids] = -1
+
+    names = ['Unknown'] * len(taxon_ids)
+    for line in names_file:
+        fields = line.split('|')
+        if len(fields) > 3 and fields[3].strip() == 'scientific name':
+            i = index[int(fields[0])]
+            if i >= 0:
+                names[i] = fields[1].strip()
+    name_ends = cumsum(map(len, names))
+    name_order = sorted(range(len(names)), key=names.__getitem__)
+
+    euler, depths, first, preorder, ends = _compile_euler_tour(parents)
+    euler_depths = depths[euler]
+    block_minima = _compile_block_minima(euler_depths, EULER_BLOCK_SIZE)
+    preorder_positions = empty(len(preorder), int)
+    preorder_positions[preorder] = arange(len(preorder))
+
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    for name, data, dtype in [
+        ('taxon_ids', taxon_ids, 'int32'),
+        ('index', index, 'int32'),
+        ('parents', parents, 'int32'),
+        ('ranks', ranks, 'uint8'),
+        ('depths', depths, 'int32'),
+        ('name_ends', name_ends, 'int64'),
+        ('name_order', name_order, 'int32'),
+        ('euler', euler, 'int32'),
+        ('euler_depths', euler_depths, 'int32'),
+        ('first', first, 'int32'),
+        ('block_minima', block_minima, 'int32'),
+        ('preorder', preorder, 'int32'),
+        ('preorder_positions', preorder_positions, 'int32'),
+        ('ends', ends, 'int32')]:
+        save(os.path.join(dirname, name + '.npy'), asarray(data, dtype))
+    outfile = open(os.path.join(dirname, 'names.txt'), 'wb')
+    outfile.write(''.join(names))
+    outfile.close()
+    outfile = open(os.path.join(dirname, 'ranks.txt'), 'w')
+    outfile.write(''.join([r + '\n' for r in rank_names]))
+    outfile.close()
+    return CompiledNcbiTaxonomy(dirname)
+
+class CompiledNcbiTaxonomy(object):
+    """Memory-mapped NCBI taxonomy written by CompiledNcbiTaxonomyFromFiles.
+
+    Taxa are referred to by NCBI taxon id throughout. Looking up a taxon id
+    is O(1) and a name O(log n); lineages are as long as the taxon is deep,
+    and last common ancestors take constant time via an Euler tour of the 
+    tree with a range minimum index over its depths.
+    """
+    def __init__(self, dirname):
+        """Returns new CompiledNcbiTaxonomy, mapping the arrays in dirname."""
+        def mapped(name):
+            return load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+        self.TaxonIds = mapped('taxon_ids')
+        self.Parents = mapped('parents')
+        self.Ranks = mapped('ranks')
+        self.Depths = mapped('depths')
+        self._index = mapped('index')
+        self._name_ends = mapped('name_ends')
+        self._name_order = mapped('name_order')
+        self._euler = mapped('euler')
+        self._euler_depths = mapped('euler_depths')
+        self._first = mapped('first')
+        self._block_minima = mapped('block_minima')
+        self._preorder = mapped('preorder')
+        self._preorder_positions = mapped('preorder_positions')
+        self._ends = mapped('ends')
+        names_path = os.path.join(dirname, 'names.txt')
+        if os.path.getsize(names_path):
+            self._names = memmap(names_path, 'uint8', 'r')
+        else:
+            self._names = zeros(0, 'uint8')
+        self.RankNames = open(os.path.join(dirname, 
+            'ranks.txt')).read().splitlines()
+        self._rank_codes = dict([(r, i) for i, r in 
+            enumerate(self.RankNames)])
+
+    def __len__(self):
+        return len(self.TaxonIds)
+
+    def __contains__(self, taxon_id):
+        return 0 <= taxon_id < len(self._index) and self._index[taxon_id] >= 0
+
+    def _node(self, taxon_id):
+        """Returns index of taxon_id, raising KeyError if absent."""
+        if taxon_id not in self:
+            raise KeyError(taxon_id)
+        return self._index[taxon_id]
+
+    def _nodes(self, taxon_ids):
+        """Returns indices of taxon_ids, -1 where absent."""
+        taxon_ids = atleast_1d(asarray(taxon_ids, int))
+        result = empty(len(taxon_ids), int)
+        result.fill(-1)
+        valid = (taxon_ids >= 0) & (taxon_ids < len(self._index))
+        result[valid] = self._index[taxon_ids[valid]]
+        return result
+
+    def _node_name(self, node):
+        start = self._name_ends[node-1] if node else 0
+        return self._names[start:self._name_ends[node]].tostring()
+
+    def getName(self, taxon_id):
+        """Returns scientific name of taxon_id ('Unknown' if none given)."""
+        return self._node_name(self._node(taxon_id))
+
+    def getRank(self, taxon_id):
+        """Returns rank of taxon_id, e.g. 'genus'."""
+        return self.RankNames[self.Ranks[self._node(taxon_id)]]
+
+    def getParentId(self, taxon_id):
+        """Returns taxon id of parent of taxon_id, None for a root."""
+        parent = self.Parents[self._node(taxon_id)]
+        if parent < 0:
+            return None
+        return int(self.TaxonIds[parent])
+
+    def getTaxonId(self, name):
+        """Returns taxon id with scientific name name.
+
+        If several taxa share the name, returns the lowest of their ids.
+        Raises KeyError if no taxon has the name.
+        """
+        low, high = 0, len(self._name_order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._node_name(self._name_order[middle]) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self._name_order):
+            node = self._name_order[low]
+            if self._node_name(node) == name:
+                return int(self.TaxonIds[node])
+        raise KeyError(name)
+
+    def lineage(self, taxon_id):
+        """Returns list of taxon ids from the root down to taxon_id."""
+        node = self._node(taxon_id)
+        result = []
+        while node >= 0:
+            result.append(int(self.TaxonIds[node]))
+            node = self.Parents[node]
+        result.reverse()
+        return result
+
+    def _least_depth(self, start, end):
+        """Returns position of least depth in Euler tour from start to end.
+        
+        end is included.
+        """
+        depths = self._euler_depths
+        block_size = EULER_BLOCK_SIZE
+        first_block, last_block = start // block_size, end // block_size
+        if last_block - first_block <= 1:
+            return start + depths[start:end+1].argmin()
+        edge = (first_block + 1) * block_size
+        candidates = [start + depths[start:edge].argmin(),
+            last_block*block_size + 
+            depths[last_block*block_size:end+1].argmin()]
+        num_blocks = last_block - first_block - 1
+        level = int(num_blocks).bit_length() - 1
+        row = self._block_minima[level]
+        candidates.append(row[first_block + 1])
+        candidates.append(row[last_block - (1 << level)])
+        return min(candidates, key=lambda i: depths[i])
+
+    def lastCommonAncestor(self, taxon_ids):
+        """Returns taxon id of the last common ancestor of taxon_ids.
+
+        Returns None if the taxa are in separate trees (only possible when
+        parents were missing from the nodes file).
+        """
+        nodes = [self._node(t) for t in taxon_ids]
+        positions = self._first[nodes]
+        node = self._euler[self._least_depth(positions.min(), 
+            positions.max())]
+        preorder_positions = self._preorder_positions[nodes]
+        if preorder_positions.min() < self._preorder_positions[node] or \
+            preorder_positions.max() >= self._ends[node]:
+            return None
+        return int(self.TaxonIds[node])
+
+    def getRankedDescendants(self, taxon_id, rank):
+        """Returns taxon ids of all descendants of taxon_id with rank.
+
+        Includes taxon_id itself if it has the rank.
+        """
+        node = self._node(taxon_id)
+        code = self._rank_codes.get(rank)
+        if code is None:
+            return []
+        start = self._preorder_positions[node]
+        subtree = self._preorder[start:self._ends[node]]
+        return self.TaxonIds[subtree[self.Ranks[subtree] == code]].tolist()
+
+    def getRankedAncestors(self, taxon_ids, rank):
+        """Returns array of the ancestor at rank of each of taxon_ids.
+
+        Each taxon counts as its own ancestor. Gives 0 where there is no
+        ancestor at rank or the taxon id is unknown. Works on all taxon_ids
+        at once, one level of the tree at a time.
+        """
+        nodes = self._nodes(taxon_ids)
+        result = zeros(len(nodes), int)
+        code = self._rank_codes.get(rank)
+        if code is None:
+            return result
+        active = nonzero(nodes >= 0)[0]
+        nodes = nodes[active]
+        while len(active):
+            found = self.Ranks[nodes] == code
+            result[active[found]] = self.TaxonIds[nodes[found]]
+            nodes = self.Parents[nodes[~found]]
+            active = active[~found][nodes >= 0]
+            nodes = nodes[nodes >= 0]
+        return result
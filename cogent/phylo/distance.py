@@ -7,6 +7,7 @@ from itertools import combinations
 from cogent.util import parallel, table, warning, progress_display as UI
 from cogent.maths.stats.util import Numbers
 from cogent import LoadSeqs, LoadTree
+from cogent.phylo.kmer_distance import kmer_distances, nearest_neighbour_pairs
 
 __author__ = "Gavin Huttley"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -55,7 +56,7 @@ class EstimateDistances(object):
     
     def __init__(self, seqs, submodel, threeway=False, motif_probs = None,
                 do_pair_align=False, rigorous_align=False, est_params=None,
-                modify_lf=None):
+                modify_lf=None, band=None, kmer_neighbours=None):
         """Arguments:
             - seqs: an Alignment or SeqCollection instance with > 1 sequence
             - submodel: substitution model object Predefined models can
@@ -75,6 +76,15 @@ class EstimateDistances(object):
               function (with alignment set) and modifies it. Can be used to
               configure local_params, set bounds, optimise using a restriction
               for faster performance.
+            - band: if not None, the pairwise alignments only consider
+              cells near a chain of shared k-mers. True for the default
+              starting width, or a half-width in positions. The band is
+              widened until no better alignment could lie outside it, so
+              the results are those of the full DP. Only faster for
+              closely related sequences.
+            - kmer_neighbours: if not None, only pairs joining each sequence
+              to its this many nearest neighbours, by k-mer distance, are
+              estimated. Ignored if threeway.
         
         Note: Unless you know a priori your alignment will be flush ended
         (meaning no sequence has terminal gaps) it is advisable to construct a
@@ -97,6 +107,8 @@ class EstimateDistances(object):
         self._combination_aligns = None
         self._do_pair_align = do_pair_align
         self._rigorous_align = rigorous_align
+        self._band = band
+        self._kmer_neighbours = kmer_neighbours
         
         # substitution model stuff
         self._sm = submodel
@@ -126,7 +138,7 @@ class EstimateDistances(object):
         if self._rigorous_align:
             lf.optimise(**opt_kwargs)
         lnL = lf.getLogLikelihood()
-        return lnL.edge.getViterbiPath().getAlignment()
+        return lnL.edge.getViterbiPath(band=self._band).getAlignment()
     
     @UI.display_wrap
     def _doset(self, sequence_names, dist_opt_args, aln_opt_args, ui):
@@ -205,6 +217,12 @@ class EstimateDistances(object):
         if self._threeway:
             combination_aligns = get_name_combinations(self._seq_collection.Names, 3)
             desc = "triplet "
+        elif self._kmer_neighbours:
+            combination_aligns = nearest_neighbour_pairs(
+                    kmer_distances(self._seq_collection,
+                        moltype=self._sm.MolType),
+                    self._seq_collection.Names, self._kmer_neighbours)
+            desc = "pair "
         else:
             combination_aligns = get_name_combinations(self._seq_collection.Names, 2)
             desc = "pair "
@@ -292,7 +310,7 @@ class EstimateDistances(object):
                 try:
                     row.append(d[(s1,s2)])
                 except KeyError:
-                    row.append(d[(s2,s1)])
+                    row.append(d.get((s2,s1), None))
             twoD.append(row)
         T = table.Table(['Seq1 \ Seq2'] + self._seqnames, twoD, row_ids = True,
                         missing_data = "*")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Alignment-free distances between sequences from their shared k-mers.
+
+Much faster than pairwise alignment, these are suitable for building guide
+trees and for choosing which pairs of sequences are worth aligning.
+"""
+from __future__ import division
+
+import numpy
+
+from cogent import DNA
+from cogent.evolve.pairwise_distance import get_moltype_index_array, \
+    seq_to_indices
+
+__author__ = "Gavin Huttley"
+__copyright__ = "Copyright 2007-2012, The Cogent Project"
+__credits__ = ["Gavin Huttley", "Peter Maxwell"]
+__license__ = "GPL"
+__version__ = "1.5.3-dev"
+__maintainer__ = "Gavin Huttley"
+__email__ = "gavin.huttley@anu.edu.au"
+__status__ = "Alpha"
+
+def default_word_length(moltype):
+    """k-mer length used if none is specified: 6 for nucleic acids, 3
+    otherwise"""
+    return [3, 6][len(list(moltype)) <= 4]
+
+def seq_to_kwords(seq, k, char_to_index):
+    """array of integer codes of the overlapping k-mers of seq, omitting
+    any k-mer containing a gap or ambiguity code.
+
+    Encoded as by ModelSequence.toKwords, with the alphabet size taken
+    from char_to_index."""
+    indices = seq_to_indices(str(seq).upper(), char_to_index)
+    alpha_len = char_to_index.max() + 1
+    num_words = len(indices) - k + 1
+    if num_words < 1:
+        return numpy.zeros(0, numpy.int64)
+    words = numpy.zeros(num_words, numpy.int64)
+    valid = numpy.ones(num_words, bool)
+    for i in range(k):
+        curr_slice = indices[i:i+num_words]
+        valid &= curr_slice >= 0
+        words *= alpha_len
+        words += curr_slice
+    return words[valid]
+
+def kmer_count_matrix(seqs, k, moltype=DNA):
+    """Returns (names, counts) where counts[i, w] is the number of times
+    the w'th distinct k-mer occurs in the sequence names[i].
+
+    Only k-mers occurring in at least one of the sequences get a column,
+    which keeps the matrix small however large the alphabet or k.
+
+    Arguments:
+        - seqs: a dict of name: sequence, or a sequence collection
+        - k: the k-mer length
+        - moltype: the MolType of the sequences
+    """
+    if hasattr(seqs, 'todict'):
+        seqs = seqs.todict()
+    names = sorted(seqs)
+    char_to_index = get_moltype_index_array(moltype)
+    words = [seq_to_kwords(seqs[name], k, char_to_index) for name in names]
+    (distinct, columns) = numpy.unique(
+            numpy.concatenate(words + [numpy.zeros(0, numpy.int64)]),
+            return_inverse=True)
+    counts = numpy.zeros([len(names), len(distinct)], numpy.int32)
+    if not len(distinct):
+        # no sequence has a complete k-mer, so nothing is shared
+        return (names, counts)
+    start = 0
+    for (i, seq_words) in enumerate(words):
+        end = start + len(seq_words)
+        counts[i] = numpy.bincount(columns[start:end],
+                minlength=len(distinct))
+        start = end
+    return (names, counts)
+
+def kmer_distance_matrix(counts, k, metric='fraction'):
+    """Square array of distances between the rows of a k-mer count matrix.
+
+    Arguments:
+        - counts: as from kmer_count_matrix
+        - k: the k-mer length
+        - metric: one of
+            'fraction': -ln(F)/k, where F is the fractional common k-mer
+             count of Edgar (2004) Nucleic Acids Res 32:1792, roughly the
+             substitutions per site
+            'muscle': 1 - F, as used by MUSCLE for its first guide tree
+            'cosine': 1 - the cosine of the angle between the count vectors
+    """
+    counts = numpy.asarray(counts)
+    n = len(counts)
+    if metric == 'cosine':
+        counts = counts.astype(float)
+        norms = numpy.sqrt((counts * counts).sum(axis=1))
+        norms[norms == 0] = 1.0
+        similarity = numpy.dot(counts, counts.T) / numpy.outer(norms, norms)
+        dists = 1.0 - similarity
+    elif metric in ['fraction', 'muscle']:
+        totals = counts.sum(axis=1)
+        shared = numpy.zeros([n, n], float)
+        for i in range(n):
+            shared[i, i+1:] = numpy.minimum(counts[i], counts[i+1:]).sum(
+                    axis=1)
+        shared += shared.T
+        fewest = numpy.minimum.outer(totals, totals).astype(float)
+        fewest[fewest == 0] = 1.0
+        F = shared / fewest
+        if metric == 'muscle':
+            dists = 1.0 - F
+        else:
+            # at least half a k-mer in common, so unrelated sequences get
+            # a large but finite distance
+            F = numpy.maximum(F, 0.5 / fewest)
+            dists = -numpy.log(F) / k
+    else:
+        raise ValueError('Unknown k-mer distance metric %r' % metric)
+    dists = numpy.clip(dists, 0.0, numpy.inf)
+    dists[numpy.arange(n), numpy.arange(n)] = 0.0
+    return dists
+
+def kmer_distances(seqs, k=None, moltype=None, metric='fraction'):
+    """Returns a dict of {(name1, name2): distance} with name1 < name2,
+    suitable for nj.nj, from the k-mer contents of seqs.
+
+    Arguments:
+        - seqs: a dict of name: sequence, or a sequence collection
+        - k: the k-mer length, defaults to default_word_length(moltype)
+        - moltype: defaults to that of seqs, or DNA
+        - metric: see kmer_distance_matrix
+    """
+    if moltype is None:
+        moltype = getattr(seqs, 'MolType', None) or DNA
+    if k is None:
+        k = default_word_length(moltype)
+    (names, counts) = kmer_count_matrix(seqs, k, moltype)
+    dists = kmer_distance_matrix(counts, k, metric)
+    result = {}
+    for i in range(len(names)):
+        for j in range(i+1, len(names)):
+            result[(names[i], names[j])] = dists[i, j]
+    return result
+
+def nearest_neighbour_pairs(dists, names, neighbours=1):
+    """Pairs of names joining each name to its nearest neighbours.
+
+    Arguments:
+        - dists: a dict of {(name1, name2): distance}, in either order
+        - names: the names, pairs are ordered as in this list
+        - neighbours: how many nearest neighbours of each name to include
+    """
+    position = dict((name, i) for (i, name) in enumerate(names))
+    by_name = dict((name, []) for name in names)
+    for ((a, b), dist) in dists.items():
+        by_name[a].append((dist, position[b], b))
+        by_name[b].append((dist, position[a], a))
+    pairs = set()
+    for name in names:
+        for (dist, i, other) in sorted(by_name[name])[:neighbours]:
+            pairs.add(tuple(sorted([name, other], key=position.get)))
+    return sorted(pairs, key=lambda pair: map(position.get, pair))
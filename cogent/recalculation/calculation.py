@@ -3,6 +3,8 @@ from __future__ import division, with_statement
 import numpy
 Float = numpy.core.numerictypes.sctype2char(float)
 import time, warnings
+import multiprocessing
+from collections import OrderedDict
 from cogent.maths.solve import find_root
 from cogent.util import parallel
 from cogent.maths.optimisers import maximise, ParameterOutOfBoundsError
@@ -92,13 +94,17 @@ class LogOptPar(OptPar):
 class EvaluatedCell(object):
     __slots__ = ['client_ranks', 'rank', 'calc', 'args', 'is_constant',
         'clients', 'failure_count', 'name', 'arg_ranks',
-        'consequences', 'recycled', 'default']
+        'consequences', 'recycled', 'default', 'batch_calc']
     
-    def __init__(self, name, calc, args, recycling=None, default=None):
+    def __init__(self, name, calc, args, recycling=None, default=None,
+            batch_calc=None):
         self.name = name
         self.rank = None
         self.calc = calc
         self.default = default
+        # batch_calc(list of argument lists) -> list of results, for when
+        # several cells sharing it are updated together
+        self.batch_calc = batch_calc
         self.args = tuple(args)
         
         self.recycled = recycling
@@ -145,6 +151,43 @@ class EvaluatedCell(object):
                 print '%s: ' % i + repr(data[arg])
     
 
+def _nbytes(value):
+    """Memory held by the arrays in a cell value, 0 for scalars"""
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    nbytes = getattr(value, 'nbytes', 0)
+    return nbytes if isinstance(nbytes, (int, long)) else 0
+
+def _cell_kind(cell):
+    """What does the calculating for a cell, eg: the Defn class, or the
+    method of a model"""
+    calc = cell.calc
+    owner = getattr(calc, 'im_self', None)
+    if owner is None:
+        return getattr(calc, '__name__', type(calc).__name__)
+    elif 'Defn' in type(owner).__name__:
+        return type(owner).__name__
+    else:
+        return '%s.%s' % (type(owner).__name__, calc.__name__)
+
+def profile_table(stats, by_cell=False):
+    """A Table of the time spent on each Defn, or each cell, from
+    Calculator.getProfileStats(), slowest first"""
+    from cogent.util.table import Table
+    key = ['defns', 'cells'][by_cell]
+    columns = ['name', 'kind', 'cells', 'calls', 'time', 'mean_time',
+            'memo_hits', 'bytes']
+    if by_cell:
+        columns[2] = 'rank'
+    rows = [[row[c] for c in columns] for row in
+            sorted(stats[key], key=lambda row: -row['time'])]
+    title = ('%(evaluations)s evaluations in %(elapsed_time).3fs, '
+            'update programs reused %(program_hits)s of %(program_uses)s '
+            'times, %(undo_steps)s undo steps, %(memo_hits)s memo hits'
+            % stats)
+    return Table(header=columns, rows=rows, title=title,
+            column_templates={'mean_time':'%.3e', 'time':'%.4f'})
+
 class ConstCell(object):
     __slots__ = ['name', 'scope', 'value', 'rank', 'consequences', 'clients']
     
@@ -166,7 +209,8 @@ class Calculator(object):
     for each change of inputs.  Made by a ParameterController."""
     
     def __init__(self, cells, defns, remaining_parallel_context=None,
-                overall_parallel_context=None, trace=None, with_undo=True):
+                overall_parallel_context=None, trace=None, with_undo=True,
+                profile=False, memo_depth=0, memo_bytes=None):
         if trace is None:
             trace = TRACE_DEFAULT
         self.overall_parallel_context = overall_parallel_context
@@ -224,6 +268,8 @@ class Calculator(object):
                 arg.consequences.update(cell.consequences)
         
         self._programs = {}
+        self._batched_programs = {}
+        self.program_hits = self.program_misses = self.undo_steps = 0
         # Just for timings pre-calc these
         for opt_par in self.opt_pars:
             self.cellsChangedBy([(opt_par.rank, None)])
@@ -233,6 +279,8 @@ class Calculator(object):
         self.elapsed_time = 0.0
         self.evaluations = 0
         self.setTracing(trace)
+        self.setMemo(memo_depth, memo_bytes)
+        self.setProfiling(profile)
         self.optimised = False
     
     def _graphviz(self):
@@ -347,6 +395,129 @@ class Calculator(object):
                 print '-' * width, '|',
             print
     
+    def setMemo(self, depth=4, max_bytes=None):
+        """Remember up to 'depth' previous results of each cell, keyed by
+        its input values, so that returning to any recently visited inputs
+        (as during line searches) reuses results rather than recalculating
+        them.  Least recently used results are forgotten first, including
+        when their arrays total more than 'max_bytes'.  depth=0 turns
+        this off, which is the default as it costs memory and a little time."""
+        
+        self.memo_depth = depth
+        self.memo_max_bytes = max_bytes
+        self._memo = [{} for cell in self._cells]
+        # least recently used first, within each cell and, if there is a
+        # byte limit, across all cells
+        self._memo_lru = [[] for cell in self._cells]
+        self._memo_order = OrderedDict()
+        self._memo_held = {}
+        self.memo_bytes = 0
+        self.memo_hits = self.memo_misses = self.memo_evictions = 0
+        self._memo_cell_hits = [0] * len(self._cells)
+        # outputs of recycled cells are overwritten in place, so are only
+        # safe to remember while the memo keeps them from being recycled
+        self._memo_key_args = [
+            slice(1, None) if cell.recycled else slice(None)
+            for cell in self._cells]
+    
+    def _memoRecall(self, rank, key):
+        lru = self._memo_lru[rank]
+        if lru[-1] != key:
+            lru.remove(key)
+            lru.append(key)
+        if self.memo_max_bytes is not None:
+            self._memo_order[(rank, key)] = self._memo_order.pop((rank, key))
+        return self._memo[rank][key][1]
+    
+    def _memoStore(self, rank, key, args, result):
+        entry = (args, result, _nbytes(result))
+        self._memo[rank][key] = entry
+        self._memo_lru[rank].append(key)
+        held = self._memo_held
+        for obj in args + (result,):
+            if not isinstance(obj, float):
+                held[id(obj)] = held.get(id(obj), 0) + 1
+        self.memo_bytes += entry[2]
+        if len(self._memo_lru[rank]) > self.memo_depth:
+            self._memoForget(rank, self._memo_lru[rank][0])
+        if self.memo_max_bytes is not None:
+            self._memo_order[(rank, key)] = True
+            while self._memo_order and self.memo_bytes > self.memo_max_bytes:
+                self._memoForget(*self._memo_order.iterkeys().next())
+    
+    def _memoForget(self, rank, key):
+        (args, result, nbytes) = self._memo[rank].pop(key)
+        self._memo_lru[rank].remove(key)
+        if self.memo_max_bytes is not None:
+            del self._memo_order[(rank, key)]
+        for obj in args + (result,):
+            if not isinstance(obj, float):
+                count = self._memo_held[id(obj)] - 1
+                if count:
+                    self._memo_held[id(obj)] = count
+                else:
+                    del self._memo_held[id(obj)]
+        self.memo_bytes -= nbytes
+        self.memo_evictions += 1
+    
+    def setProfiling(self, profile=True):
+        """With 'profile' true the number of calls and time taken by each
+        cell are accumulated, for getProfile() and getProfileStats().
+        Restarts all the counts."""
+        
+        self.profile = profile
+        self._profile_calls = [0] * len(self._cells)
+        self._profile_times = [0.0] * len(self._cells)
+        self._profile_start = (self.evaluations, self.elapsed_time)
+        self.program_hits = self.program_misses = self.undo_steps = 0
+        self.memo_hits = self.memo_misses = self.memo_evictions = 0
+        self._memo_cell_hits = [0] * len(self._cells)
+    
+    def getProfileStats(self):
+        """Counts and times accumulated since setProfiling() as a dict of
+        simple types, suitable for json.dump.  'cells' and 'defns' are lists
+        of dicts with the calls, total and mean time and result size in
+        bytes of each cell, and summed over the cells of each Defn"""
+        cells = []
+        by_defn = {}
+        for cell in self._cells:
+            if not isinstance(cell, EvaluatedCell) or cell.is_constant:
+                continue
+            calls = self._profile_calls[cell.rank]
+            elapsed = self._profile_times[cell.rank]
+            row = dict(rank=cell.rank, name=cell.name, kind=_cell_kind(cell),
+                    calls=calls, time=elapsed,
+                    mean_time=calls and elapsed / calls,
+                    memo_hits=self._memo_cell_hits[cell.rank],
+                    bytes=_nbytes(self._getCurrentCellValue(cell)))
+            cells.append(row)
+            key = (row['name'], row['kind'])
+            if key not in by_defn:
+                by_defn[key] = dict(name=row['name'], kind=row['kind'],
+                        cells=0, calls=0, time=0.0, memo_hits=0, bytes=0)
+            total = by_defn[key]
+            total['cells'] += 1
+            for field in ['calls', 'time', 'memo_hits', 'bytes']:
+                total[field] += row[field]
+        defns = sorted(by_defn.values(), key=lambda row: -row['time'])
+        for row in defns:
+            row['mean_time'] = row['calls'] and row['time'] / row['calls']
+        (evaluations, elapsed_time) = self._profile_start
+        program_uses = self.program_hits + self.program_misses
+        return dict(evaluations=self.evaluations - evaluations,
+                elapsed_time=self.elapsed_time - elapsed_time,
+                program_hits=self.program_hits, program_uses=program_uses,
+                program_reuse=program_uses and self.program_hits/program_uses,
+                undo_steps=self.undo_steps, memo_hits=self.memo_hits,
+                memo_misses=self.memo_misses,
+                memo_evictions=self.memo_evictions,
+                memo_bytes=self.memo_bytes, defns=defns, cells=cells)
+    
+    def getProfile(self, by_cell=False):
+        """A Table of the accumulated time spent on each Defn (or each cell
+        if 'by_cell'), slowest first.  See setProfiling()"""
+        return profile_table(self.getProfileStats(), by_cell)
+    
     def getValueArray(self):
         """This being a caching function, you can ask it for its current
         input!  Handy for initialising the optimiser."""
@@ -418,6 +589,7 @@ class Calculator(object):
                     break
             else:
                 changes = [ch for ch in changes if ch not in self.last_undo]
+                self.undo_steps += 1
                 self._switch = not self._switch
                 for (i, v) in self.last_undo:
                     self.last_values[i] = v
@@ -439,6 +611,10 @@ class Calculator(object):
                 if cell.recycled:
                     if data[cell.rank] is base[cell.rank]:
                         data[cell.rank]=self.spare[cell.rank]
+                        if self.memo_depth and (
+                                data[cell.rank] is base[cell.rank]):
+                            # both remembered, see memoUpdate
+                            data[cell.rank] = None
                         assert data[cell.rank] is not base[cell.rank]
         else:
             data = self.cell_values[self._switch]
@@ -456,8 +632,13 @@ class Calculator(object):
         
         with parallel.parallel_context(self.remaining_parallel_context):
             try:
+                self.remoteUpdate(changes, data)
                 if self.trace:
                     self.tracingUpdate(changes, program, data)
+                elif self.memo_depth:
+                    self.memoUpdate(program, data)
+                elif self.profile:
+                    self.profilingUpdate(program, data)
                 else:
                     self.plainUpdate(program, data)
                 
@@ -488,8 +669,10 @@ class Calculator(object):
         change_key.sort()
         change_key = tuple(change_key)
         if change_key in self._programs:
+            self.program_hits += 1
             program = self._programs[change_key]
         else:
+            self.program_misses += 1
             # Make a list of the cells to update and cache it.
             consequences = {}
             for i in change_key:
@@ -498,10 +681,43 @@ class Calculator(object):
                 [cell for cell in self._cells if cell.rank in consequences])
         return program
     
+    def remoteUpdate(self, changes, data):
+        # Cells calculated elsewhere would be updated here, see
+        # ForkedCalculator.
+        pass
+    
+    def _batchedProgram(self, program):
+        """'program' with each run of cells sharing a batch_calc replaced by
+        a tuple of those cells"""
+        cached = self._batched_programs.get(id(program))
+        if cached is not None and cached[0] is program:
+            return cached[1]
+        steps = []
+        for cell in program:
+            batch_calc = cell.batch_calc
+            if batch_calc is not None and steps and (
+                    steps[-1][0].batch_calc == batch_calc):
+                steps[-1].append(cell)
+            else:
+                steps.append([cell])
+        steps = [tuple(step) if len(step) > 1 else step[0] for step in steps]
+        # keeping 'program' stops its id being reused
+        self._batched_programs[id(program)] = (program, steps)
+        return steps
+    
     def plainUpdate(self, program, data):
         try:
-            for cell in program:
-                data[cell.rank] = cell.calc(*[data[a] for a in cell.arg_ranks])
+            for step in self._batchedProgram(program):
+                if type(step) is tuple:
+                    cell = step[0]
+                    values = cell.batch_calc([[data[a] for a in c.arg_ranks]
+                            for c in step])
+                    for (c, value) in zip(step, values):
+                        data[c.rank] = value
+                else:
+                    cell = step
+                    data[cell.rank] = cell.calc(
+                            *[data[a] for a in cell.arg_ranks])
         except ParameterOutOfBoundsError, detail:
             # Non-fatal error, just cancel this calculation.
             raise CalculationInterupted(cell, detail)
@@ -510,6 +726,60 @@ class Calculator(object):
             cell.reportError(detail, data)
             raise CalculationInterupted(cell, detail)
     
+    def profilingUpdate(self, program, data):
+        # Does the same thing as plainUpdate, but also accumulates the
+        # number of calls and time taken for each cell.
+        calls = self._profile_calls
+        times = self._profile_times
+        now = time.time
+        try:
+            for cell in program:
+                t0 = now()
+                data[cell.rank] = cell.calc(*[data[a] for a in cell.arg_ranks])
+                times[cell.rank] += now() - t0
+                calls[cell.rank] += 1
+        except ParameterOutOfBoundsError, detail:
+            raise CalculationInterupted(cell, detail)
+        except ArithmeticError, detail:
+            cell.reportError(detail, data)
+            raise CalculationInterupted(cell, detail)
+    
+    def memoUpdate(self, program, data):
+        # Does the same thing as plainUpdate, but first looks for each cell's
+        # inputs in the memo.  Floats (OptPar values) are compared by value,
+        # anything else by identity, which is safe as the memo holds a
+        # reference to each input and no remembered array is ever recycled.
+        memo = self._memo
+        held = self._memo_held
+        key_args = self._memo_key_args
+        profile = self.profile
+        try:
+            for cell in program:
+                rank = cell.rank
+                args = tuple([data[a] for a in cell.arg_ranks])
+                key = tuple([a if isinstance(a, float) else id(a)
+                        for a in args[key_args[rank]]])
+                if key in memo[rank]:
+                    data[rank] = self._memoRecall(rank, key)
+                    self.memo_hits += 1
+                    self._memo_cell_hits[rank] += 1
+                    continue
+                if cell.recycled and id(args[0]) in held:
+                    args = (None,) + args[1:]
+                if profile:
+                    t0 = time.time()
+                data[rank] = result = cell.calc(*args)
+                if profile:
+                    self._profile_times[rank] += time.time() - t0
+                    self._profile_calls[rank] += 1
+                self.memo_misses += 1
+                self._memoStore(rank, key, args[key_args[rank]], result)
+        except ParameterOutOfBoundsError, detail:
+            raise CalculationInterupted(cell, detail)
+        except ArithmeticError, detail:
+            cell.reportError(detail, data)
+            raise CalculationInterupted(cell, detail)
+    
     def tracingUpdate(self, changes, program, data):
         # Does the same thing as plainUpdate, but also produces lots of
         # output showing how long each step of the calculation takes.
@@ -637,3 +907,172 @@ class Calculator(object):
         return tuple(triple)
         
     
+
+
+class ForkedCalculator(Calculator):
+    """A Calculator which spreads independent parts of the calculation, eg:
+    the likelihoods of different loci and rate bins, over persistent worker
+    processes forked from this one.
+    
+    Each worker is given some of the cells named in 'split_at' and keeps
+    its own copy of every cell those depend on, so that bulky intermediate
+    values such as partial likelihoods never leave it.  On each change the
+    workers are sent the new parameter values and send back whichever of
+    their 'split_at' cells changed, the rest of the calculation being done
+    here.  Values of cells owned by the workers are not kept up to date in
+    this process.  Call close() when done."""
+    
+    def __init__(self, cells, defns, split_at, processes=None, **kw):
+        self._local_ranks = None
+        self._workers = []
+        Calculator.__init__(self, cells, defns, **kw)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        targets = [cell for cell in self._cells
+                if isinstance(cell, EvaluatedCell) and cell.name in split_at
+                and not cell.is_constant]
+        processes = min(processes, len(targets))
+        if processes < 2:
+            return
+        
+        upstream = {}
+        for target in targets:
+            upstream[target.rank] = self._upstreamOf([target])
+        
+        # share the targets out, keeping down the number of cells calculated
+        # by each process
+        shares = [[] for i in range(processes)]
+        owned = [set() for i in range(processes)]
+        for target in targets:
+            i = min(range(processes), key=lambda i: (
+                    len(owned[i] | upstream[target.rank]), len(shares[i])))
+            shares[i].append(target.rank)
+            owned[i] |= upstream[target.rank]
+        
+        target_ranks = set(t.rank for t in targets)
+        remote = set.union(*owned)
+        downstream = [cell for cell in self._cells if cell.rank not in remote]
+        local = self._upstreamOf(downstream, stop=target_ranks)
+        self._remote_values = dict(
+                (rank, self._getCurrentCellValue(self._cells[rank]))
+                for rank in target_ranks)
+        
+        for (share, ranks) in zip(shares, owned):
+            (conn, child_conn) = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=self._serve,
+                    args=(child_conn, share, ranks))
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+            self._workers.append((worker, conn))
+        self._local_ranks = local - target_ranks
+        self._local_programs = {}
+        self._remote_ranks = remote
+    
+    def _upstreamOf(self, cells, stop=()):
+        """Ranks of the non-constant cells which the values of 'cells' depend
+        on, not looking beyond cells in 'stop'"""
+        found = set()
+        todo = [cell for cell in cells if not cell.is_constant]
+        while todo:
+            cell = todo.pop()
+            if cell.rank in found:
+                continue
+            found.add(cell.rank)
+            if cell.rank in stop:
+                continue
+            for arg in cell.args:
+                if not arg.is_constant and arg.rank not in found:
+                    todo.append(arg)
+        return found
+    
+    def _serve(self, conn, targets, ranks):
+        # The loop run by each worker process
+        self._workers = []
+        self._local_ranks = ranks
+        self._local_programs = {}
+        self.setTracing(False)
+        sent = dict((rank, self._getCurrentCellValue(self._cells[rank]))
+                for rank in targets)
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            (values, other_changes) = request
+            changes = [(i, new) for (i, (old, new))
+                    in enumerate(zip(self.last_values, values)) if old != new]
+            try:
+                self.change(changes + other_changes)
+            except (ParameterOutOfBoundsError, ArithmeticError), detail:
+                conn.send(('error', detail))
+                continue
+            except Exception, detail:
+                conn.send(('fatal', detail))
+                continue
+            changed = {}
+            for rank in targets:
+                value = self._getCurrentCellValue(self._cells[rank])
+                if value is not sent[rank]:
+                    changed[rank] = sent[rank] = value
+            conn.send(('ok', changed))
+        conn.close()
+    
+    def cellsChangedBy(self, changes):
+        program = Calculator.cellsChangedBy(self, changes)
+        if self._local_ranks is not None:
+            # programs are cached, so have fixed ids
+            if id(program) not in self._local_programs:
+                self._local_programs[id(program)] = [cell for cell in program
+                        if cell.rank in self._local_ranks]
+            program = self._local_programs[id(program)]
+        return program
+    
+    def remoteUpdate(self, changes, data):
+        if not self._workers:
+            return
+        other_changes = [(i, v) for (i, v) in changes
+                if i >= len(self.opt_pars)]
+        for (worker, conn) in self._workers:
+            conn.send((list(self.last_values), other_changes))
+        failure = None
+        for (worker, conn) in self._workers:
+            (status, result) = conn.recv()
+            if status == 'ok':
+                self._remote_values.update(result)
+            elif failure is None or status == 'fatal':
+                failure = (status, result)
+        for (rank, value) in self._remote_values.items():
+            data[rank] = value
+        if failure is not None:
+            (status, detail) = failure
+            if status == 'fatal':
+                raise detail
+            raise CalculationInterupted(None, detail)
+    
+    def close(self):
+        """Stop the worker processes.  The calculator remains usable, with
+        the cells they owned calculated here again."""
+        if not self._workers:
+            return
+        for (worker, conn) in self._workers:
+            conn.send(None)
+            conn.close()
+        for (worker, conn) in self._workers:
+            worker.join()
+        self._workers = []
+        self._local_ranks = None
+        self._local_programs = {}
+        # bring the cells the workers owned up to date, discarding the
+        # undo buffer as it too lacks them
+        program = [cell for cell in self._cells
+                if cell.rank in self._remote_ranks
+                and isinstance(cell, EvaluatedCell)]
+        data = self.cell_values[self._switch]
+        try:
+            self.plainUpdate(program, data)
+        except CalculationInterupted, detail:
+            (cell, exception) = detail.args
+            raise exception
+        if self.with_undo:
+            self.cell_values[not self._switch][:] = data[:]
+        self.last_undo = []
@@ -112,12 +112,22 @@ class CalculationDefn(_NonLeafDefn):
     def makeCalcFunction(self):
         return self.calc
     
+    def makeBatchCalcFunction(self):
+        # Optionally a function which does the calc for a list of argument
+        # lists at once, eg: to share numpy overheads between many cells.
+        return None
+    
     def makeCell(self, *args):
         calc = self.makeCalcFunction()
+        if self.recycling:
+            batch_calc = None
+        else:
+            batch_calc = self.makeBatchCalcFunction()
         # can't calc outside correct parallel context, so can't do
         # if [arg for arg in args if not arg.is_constant]:
         cell = EvaluatedCell(self.name, calc, args,
-                recycling=self.recycling, default=self.default)
+                recycling=self.recycling, default=self.default,
+                batch_calc=batch_calc)
         return cell
         
     def makeCells(self, input_soup, variable=None):
@@ -137,15 +147,22 @@ class CalculationDefn(_NonLeafDefn):
 class _FuncDefn(CalculationDefn):
     def __init__(self, calc, *args, **kw):
         self.calc = calc
+        self.batch_calc = kw.pop('batch_calc', None)
         CalculationDefn.__init__(self, *args, **kw)
     
+    def makeBatchCalcFunction(self):
+        return self.batch_calc
+    
 
 # Use this rather than having to subclass CalculationDefinition
 # just to supply the 'calc' method.
 class CalcDefn(object):
-    """CalcDefn(function)(arg1, arg2)"""
-    def __init__(self, calc, name=None, **kw):
+    """CalcDefn(function)(arg1, arg2), or with batch_calc=g where
+    g([[a1, a2], [b1, b2]]) == [function(a1, a2), function(b1, b2)]"""
+    def __init__(self, calc, name=None, batch_calc=None, **kw):
         self.calc = calc
+        if batch_calc is not None:
+            kw['batch_calc'] = batch_calc
         
         if name is None:
             name = self.calc.__name__
@@ -4,7 +4,7 @@ import warnings
 import numpy
 from contextlib import contextmanager
 from .setting import Var, ConstVal
-from .calculation import Calculator
+from .calculation import Calculator, ForkedCalculator, profile_table
 from cogent.util import parallel
 from cogent.maths.stats.distribution import chdtri
 from cogent.maths.optimisers import MaximumEvaluationsReached
@@ -773,7 +773,13 @@ class ParameterController(object):
             cells.extend(newcells)
             input_soup[id(defn)] = outputs
         if calculatorClass is None:
-            calculatorClass = Calculator
+            if 'split_at' in kw:
+                calculatorClass = ForkedCalculator
+            else:
+                # without independent parts to split there is nothing
+                # for worker processes to do
+                kw.pop('processes', None)
+                calculatorClass = Calculator
         kw['overall_parallel_context'] = self.overall_parallel_context
         kw['remaining_parallel_context'] = self.remaining_parallel_context
         return calculatorClass(cells, input_soup, **kw)
@@ -796,13 +802,20 @@ class ParameterController(object):
         """Find input values that optimise this function.
         'local' controls the choice of optimiser, the default being to run
         both the global and local optimisers. 'filename' and 'interval'
-        control checkpointing.  Unknown keyword arguments get passed on to
-        the optimiser(s)."""
+        control checkpointing.  'profile' keeps per-Defn timings of the
+        optimisation, see getOptimisationProfile().  'memo_depth' and
+        'memo_bytes' set up a memo of previous results, see Calculator.setMemo.
+        'processes' spreads the calculation over that many worker processes,
+        see ForkedCalculator.  Unknown keyword arguments get passed on to the
+        optimiser(s)."""
         return_calculator = kw.pop('return_calculator', False) # only for debug
+        profile = kw.pop('profile', False)
+        calc_kw = dict((n, kw.pop(n)) for n in
+                ['memo_depth', 'memo_bytes', 'processes'] if n in kw)
         for n in ['local', 'filename', 'interval', 'max_evaluations', 
                 'tolerance', 'global_tolerance']:
             kw[n] = locals()[n]
-        lc = self.makeCalculator()
+        lc = self.makeCalculator(profile=profile, **calc_kw)
         try:
             lc.optimise(**kw)
         except MaximumEvaluationsReached, detail:
@@ -816,9 +829,19 @@ class ParameterController(object):
                 raise ArithmeticError(err_msg)    
         finally:
             self.updateFromCalculator(lc)
+            if profile:
+                self.last_profile_stats = lc.getProfileStats()
+            if isinstance(lc, ForkedCalculator):
+                lc.close()
         if return_calculator:
             return lc
     
+    def getOptimisationProfile(self, by_cell=False):
+        """A Table of the time spent on each Defn (or each cell if 'by_cell')
+        during the last optimise(profile=True).  The same numbers are in the
+        dict .last_profile_stats, eg: for saving with json.dump"""
+        return profile_table(self.last_profile_stats, by_cell)
+    
     def graphviz(self, **kw):
         lc = self.makeCalculator()
         return lc.graphviz(**kw)
@@ -9,7 +9,9 @@ dna_model = cogent.evolve.substitution_model.Nucleotide(
         model_gaps=False, equal_motif_probs=True)
 
 import cogent.align.progressive
+import cogent.util.parallel
 
+import random
 import unittest
 
 __author__ = "Peter Maxwell"
@@ -90,6 +92,39 @@ class AlignmentTestCase(unittest.TestCase):
         self.assertEqual(matchedColumns(a), 6)
         self.assertEqual(len(a), 9)
     
+    def test_banded(self):
+        """banded alignment should match full DP, widening as needed"""
+        S = make_dna_scoring_dict(10, -1, -8)
+        s1 = DNA.makeSequence('TGTGGCACAAATGCTCATGCCAGCTCTTTACAGCATGAGAACA'
+                'GCAGTTTATTATACACTAATTAGTGCTCCCGTGAACAAGC')
+        s2 = DNA.makeSequence('TGTGGCACAGATACTCATGCCAGCTCATTACATGAGAACA'
+                'GCAGTTTATTATACACTAATTCCATAGTGCTCCCGTGAACAGC')
+        (full, full_score) = global_pairwise(s1, s2, S, 10, 2,
+                return_score=True)
+        for band in [1, 4, True]:
+            (aln, score) = global_pairwise(s1, s2, S, 10, 2,
+                    return_score=True, band=band)
+            self.assertEqual(str(aln), str(full))
+            self.assertAlmostEqual(score, full_score)
+    
+    def test_banded_divergent(self):
+        """banded alignment should find the best path even if outside the
+        band, without touching its edge"""
+        S = make_dna_scoring_dict(10, -1, -8)
+        pairs = [('CGCGG', 'CGAATGGTATAAGTCGCGG')]
+        rng = random.Random(5)
+        for i in range(20):
+            pairs.append([''.join(rng.choice('ACGT')
+                    for k in range(rng.randint(3, 40))) for s in 'ab'])
+        for (s1, s2) in pairs:
+            (s1, s2) = (DNA.makeSequence(s1), DNA.makeSequence(s2))
+            (full, full_score) = global_pairwise(s1, s2, S, 10, 2,
+                    return_score=True)
+            for band in [1, 3, True]:
+                (aln, score) = global_pairwise(s1, s2, S, 10, 2,
+                        return_score=True, band=band)
+                self.assertAlmostEqual(score, full_score)
+    
     def test_local_tiebreak(self):
         """Should pick the first best-equal hit rather than the last one"""
         # so that the Pyrex and Python versions give the same result.
@@ -161,6 +196,19 @@ class MultipleAlignmentTestCase(unittest.TestCase):
                   'B': 'TGTGGCACAGATACTCATGCCAGCTCATTACAGCATGAGAACAGCAGTTT'}
         self.assertEqual(aln.todict(), expect)
     
+    def test_progressive_kmer_guide_tree(self):
+        """progressive alignment with a guide tree from k-mer distances"""
+        seqs = LoadSeqs(data={'A': "TGTGGCACAAATGCTCATGCCAGCTCTTTACAGCATGAGAACA",
+                            'B': "TGTGGCACAGATACTCATGCCAGCTCATTACAGCATGAGAACAGCAGTTT",
+                            'C': "TGTGGCACAAGTACTCATGCCAGCTCAGTACAGCATGAGAACAGCAGTTT"}, aligned=False)
+        aln, tree = cogent.align.progressive.TreeAlign(HKY85(), seqs,
+                show_progress=False, param_vals={'kappa': 4.0},
+                guide_distances='kmer')
+        expect = {'A': 'TGTGGCACAAATGCTCATGCCAGCTCTTTACAGCATGAGAACA-------',
+                  'C': 'TGTGGCACAAGTACTCATGCCAGCTCAGTACAGCATGAGAACAGCAGTTT',
+                  'B': 'TGTGGCACAGATACTCATGCCAGCTCATTACAGCATGAGAACAGCAGTTT'}
+        self.assertEqual(aln.todict(), expect)
+    
     def test_progressive_params(self):
         """excercise progressive alignment providing model params"""
         self._test_aln({
@@ -170,6 +218,21 @@ class MultipleAlignmentTestCase(unittest.TestCase):
                 'D': 'cac-cta',
                 }, model=HKY85(), param_vals=[('kappa',2.0)])
     
+    def test_progressive_multiprocessing(self):
+        """subtrees aligned in other processes should give the same result"""
+        seqs = {
+                'A': 'tacagta', 
+                'B': 'tac-gtc',
+                'C': 'ta---ta', 
+                'D': 'tac-gtc',
+                }
+        orig = dict((n,s.replace('-', '')) for (n,s) in seqs.items())
+        serial = self._make_aln(orig).todict()
+        context = cogent.util.parallel.MultiprocessingParallelContext(2)
+        with cogent.util.parallel.parallel_context(context):
+            result = self._make_aln(orig).todict()
+        self.assertEqual(result, serial)
+    
     def test_TreeAlign_does_pairs(self):
         """test TreeAlign handles pairs of sequences"""
         self._test_aln({
@@ -242,6 +305,13 @@ class HirschbergTestCase(MultipleAlignmentTestCase):
         return result
 
 
+
+class BandedTestCase(MultipleAlignmentTestCase):
+    # Start from a band too narrow for the alignments
+    
+    def _make_aln(self, orig, **kw):
+        return MultipleAlignmentTestCase._make_aln(self, orig, band=1, **kw)
+
     
 if __name__ == '__main__':
     unittest.main()
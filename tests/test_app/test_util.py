@@ -4,9 +4,16 @@ from cogent.util.unit_test import TestCase, main
 from cogent.app.util import Application, CommandLineApplication, \
     CommandLineAppResult, ResultPath, ApplicationError, ParameterIterBase,\
     ParameterCombinations, cmdline_generator, ApplicationNotFoundError,\
-    get_tmp_filename, guess_input_handler
+    get_tmp_filename, guess_input_handler, ApplicationPool, ApplicationJob, \
+    ApplicationTimeoutError, ApplicationCancelledError, split_seqs
 from cogent.app.parameters import *
-from os import remove,system,mkdir,rmdir,removedirs,getcwd, walk
+from cogent.parse.fasta import MinimalFastaParser
+from os import remove,system,mkdir,rmdir,removedirs,getcwd, walk, listdir,\
+    chmod
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
+import sys
 
 __author__ = "Greg Caporaso and Sandra Smit"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -1051,6 +1058,126 @@ class ConvenienceFunctionTests(TestCase):
         
         
 
+pool_script = """
+import sys, time
+args = sys.argv[1:]
+if args[0] == '--sleep':
+    time.sleep(float(args[1]))
+    args = args[2:]
+if args[0] == '--fail':
+    sys.stderr.write('bad input\\n')
+    sys.exit(2)
+for line in open(args[0]):
+    sys.stdout.write(line.upper())
+"""
+
+class PoolTester(CommandLineApplication):
+    """Stand-in tool: upper-cases its input file, optionally after a wait"""
+    _parameters = {
+        '--sleep':ValuedParameter(Prefix='--',Name='sleep',Delimiter=' '),
+        '--fail':FlagParameter(Prefix='--',Name='fail')}
+    _input_handler = '_input_as_lines'
+
+    def _accept_exit_status(self, exit_status):
+        return exit_status == 0
+
+class ApplicationPoolTests(TestCase):
+    """Tests of running applications concurrently"""
+    def setUp(self):
+        self.dirname = mkdtemp()
+        script = self.dirname + '/pool_tester.py'
+        f = open(script, 'w')
+        f.write('#!%s\n%s' % (sys.executable, pool_script))
+        f.close()
+        chmod(script, 0755)
+        PoolTester._command = script
+        self.tmp_dir = self.dirname + '/tmp'
+        self.app = PoolTester(TmpDir=self.tmp_dir, WorkingDir=self.dirname)
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def test_map(self):
+        """ApplicationPool.map should return results in order"""
+        data = [['a%s' % i, 'b'] for i in range(10)]
+        pool = ApplicationPool(max_workers=3)
+        self.assertEqual(pool.map(self.app, data), 
+            ['A%s\nB' % i for i in range(10)])
+        #stdout goes straight to parser; generators are read
+        count = lambda lines: (len(line) for line in lines)
+        self.assertEqual(pool.map(self.app, data[:2], parser=count), 
+            [[3, 1], [3, 1]])
+        pool.shutdown()
+        #input files are removed
+        self.assertEqual(listdir(self.tmp_dir), [])
+
+    def test_map_seqs(self):
+        """ApplicationPool.mapSeqs should run app on chunks of seqs"""
+        seqs = [('s%s' % i, 'acgt'[:i%4+1]) for i in range(7)]
+        self.assertEqual(split_seqs(seqs, 5)[1], '>s5\nac\n>s6\nacg')
+        self.assertEqual(split_seqs(dict(seqs[1:2]), 5), ['>s1\nac'])
+        with ApplicationPool(max_workers=2) as pool:
+            result = pool.mapSeqs(self.app, seqs, chunk_size=3, 
+                parser=MinimalFastaParser)
+        self.assertEqual([len(r) for r in result], [3, 3, 1])
+        self.assertEqual(sum(result, []), 
+            [(n.upper(), s.upper()) for n, s in seqs])
+
+    def test_concurrent(self):
+        """ApplicationPool should run up to max_workers apps at once"""
+        self.app.Parameters['--sleep'].on(0.5)
+        start = time()
+        with ApplicationPool(max_workers=4) as pool:
+            self.assertEqual(pool.map(self.app, [['x']]*4), ['X']*4)
+        self.assertLessThan(time() - start, 1.5)
+
+    def test_timeout(self):
+        """ApplicationJob should kill apps that run too long"""
+        self.app.Parameters['--sleep'].on(30)
+        start = time()
+        with ApplicationPool(timeout=0.5) as pool:
+            job = pool.submit(self.app, ['x'])
+            self.assertRaises(ApplicationTimeoutError, job.result)
+        self.assertLessThan(time() - start, 10)
+        #waiting on a job can also time out
+        job = ApplicationJob(self.app, ['x'])
+        self.assertRaises(ApplicationTimeoutError, job.result, 0.01)
+
+    def test_cancel(self):
+        """ApplicationJob.cancel should stop running and queued jobs"""
+        self.app.Parameters['--sleep'].on(30)
+        start = time()
+        pool = ApplicationPool(max_workers=1)
+        running = pool.submit(self.app, ['x'])
+        queued = pool.submit(self.app, ['y'])
+        self.assertTrue(queued.cancel())
+        self.assertRaises(ApplicationCancelledError, queued.result)
+        while running._process is None:
+            running._done.wait(0.01)
+        self.assertTrue(running.cancel())
+        self.assertRaises(ApplicationCancelledError, running.result)
+        self.assertFalse(running.cancel())
+        pool.shutdown()
+        self.assertLessThan(time() - start, 10)
+
+    def test_errors(self):
+        """ApplicationPool.map should raise errors of failed jobs"""
+        self.app.Parameters['--fail'].on()
+        pool = ApplicationPool()
+        try:
+            pool.map(self.app, [['x'], ['y']])
+        except ApplicationError, e:
+            assert 'bad input' in str(e)
+            assert 'exit status: 2' in str(e)
+        else:
+            raise AssertionError, "ApplicationError not raised"
+        #errors in parsers are raised too
+        self.app.Parameters['--fail'].off()
+        def parser(lines):
+            raise ValueError
+        self.assertRaises(ValueError, pool.map, self.app, [['x']], parser)
+        pool.shutdown()
+
 class RemoveTests(TestCase):
     def test_remove(self):
         """This will remove the test script. Not actually a test!"""
@@ -6,7 +6,9 @@ from numpy import array
 import numpy
 Float = numpy.core.numerictypes.sctype2char(float)
 from cogent.cluster.UPGMA import find_smallest_index, condense_matrix, \
-        condense_node_order, UPGMA_cluster, inputs_from_dict2D, upgma
+        condense_node_order, UPGMA_cluster, inputs_from_dict2D, upgma, \
+        condensed_index, condensed_from_square, nn_chain_linkage, \
+        tree_from_merges, cluster
 from cogent.util.dict2d import Dict2D
 
 __author__ = "Rob Knight"
@@ -144,6 +146,46 @@ class UPGMATests(TestCase):
         self.assertEqual(PhyloNode_order[0].Name, '3')
         self.assertEqual(PhyloNode_order[2].Name, '1')
 
+    def test_condensed_from_square(self):
+        """condensed_from_square keeps the upper triangle row by row"""
+        condensed = condensed_from_square(self.matrix)
+        self.assertEqual(condensed, [1,4,20,22,5,21,23,10,12,2])
+        self.assertEqual(condensed[condensed_index(5, 2, 4)], 12)
+        self.assertEqual(condensed[condensed_index(5, 0, 1)], 1)
+
+    def test_nn_chain_linkage(self):
+        """nn_chain_linkage joins clusters into the lower position"""
+        merges = nn_chain_linkage(condensed_from_square(self.matrix), 5, 
+            'wpgma')
+        self.assertEqual(sorted(merges), 
+            [(0,1,1.0), (0,2,4.5), (0,3,16.25), (3,4,2.0)])
+        tree = tree_from_merges(merges, self.node_order)
+        self.assertEqual(str(tree), 
+            '(((a:0.5,b:0.5):1.75,c:2.25):5.875,(d:1.0,e:1.0):7.125);')
+
+    def test_cluster(self):
+        """cluster should accept dicts, square or condensed arrays"""
+        self.assertEqual(str(cluster(self.pairwise_distances, 
+            method='wpgma')), str(upgma(self.pairwise_distances)))
+        names = list('abcde')
+        square = cluster(self.matrix_zeros, names, method='wpgma')
+        condensed = cluster(condensed_from_square(self.matrix), names, 
+            method='wpgma')
+        self.assertEqual(str(square), str(condensed))
+        self.assertEqual(str(square), '(((a:0.5,b:0.5)edge.1:1.75,'
+            'c:2.25)edge.0:5.875,(d:1.0,e:1.0)edge.2:7.125)root;')
+        #average linkage weights clusters by size: abc to de is 54/3
+        self.assertEqual(str(cluster(self.matrix_zeros, names)), 
+            '(((a:0.5,b:0.5)edge.1:1.75,c:2.25)edge.0:6.75,'
+            '(d:1.0,e:1.0)edge.2:8.0)root;')
+        self.assertEqual(str(cluster(self.matrix_zeros, names, 'single')),
+            '(((a:0.5,b:0.5)edge.1:1.5,c:2.0)edge.0:3.0,'
+            '(d:1.0,e:1.0)edge.2:4.0)root;')
+        self.assertEqual(str(cluster(self.matrix_zeros, names, 'complete')),
+            '(((a:0.5,b:0.5)edge.1:2.0,c:2.5)edge.0:9.0,'
+            '(d:1.0,e:1.0)edge.2:10.5)root;')
+        self.assertEqual(str(cluster(array([[0.0]]), ['a'])), 'root;')
+
 #run if called from command line
 if __name__ == '__main__':
        main()
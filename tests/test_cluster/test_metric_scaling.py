@@ -3,7 +3,8 @@
 from cogent.util.unit_test import TestCase, main
 from cogent.cluster.metric_scaling import make_E_matrix, \
         make_F_matrix, run_eig, get_principal_coordinates, \
-        principal_coordinates_analysis, output_pca, PCoA
+        principal_coordinates_analysis, output_pca, PCoA, \
+        truncated_principal_coordinates_analysis
 from numpy import array
 import numpy
 Float = numpy.core.numerictypes.sctype2char(float)
@@ -95,6 +96,39 @@ class MetricScalingTests(TestCase):
         self.assertEqual(result[7,1], 'a')
         self.assertFloatEqual(abs(result[7,2]), 0.240788133045)
 
+    def test_truncated_principal_coordinates_analysis(self):
+        """truncated PCoA should match the leading axes of the full PCoA"""
+        matrix = self.real_matrix
+        pcs, eigvals = principal_coordinates_analysis(matrix)
+        order = eigvals.argsort()[::-1]
+        pcs, eigvals, total = pcs[order], eigvals[order], eigvals.sum()
+        result = truncated_principal_coordinates_analysis(matrix, 3, seed=0)
+        top_pcs, top_eigvals, proportions = result
+        self.assertEqual(top_pcs.shape, (3, 14))
+        self.assertFloatEqual(top_eigvals, eigvals[:3])
+        self.assertFloatEqual(abs(top_pcs), abs(pcs[:3]))
+        self.assertFloatEqual(proportions, eigvals[:3]/total)
+        #in place overwrites the input with the F matrix
+        copy = matrix.copy()
+        result = truncated_principal_coordinates_analysis(copy, 3, 
+            in_place=True, seed=0)
+        self.assertFloatEqual(result[1], top_eigvals)
+        self.assertFloatEqual(copy, make_F_matrix(make_E_matrix(matrix)))
+
+    def test_PCoA_num_axes(self):
+        """PCoA with num_axes reports only the leading axes"""
+        names = 'abcdefghijklmn'
+        pairwise_dist = {}
+        for i, name1 in enumerate(names):
+            for j, name2 in enumerate(names[i+1:]):
+                pairwise_dist[name1, name2] = self.real_matrix[i,i+j+1]
+        full = PCoA(pairwise_dist)
+        result = PCoA(pairwise_dist, num_axes=2)
+        self.assertEqual(result.Header, full.Header[:4])
+        self.assertFloatEqualAbs(
+            abs(array(result[:,2:].getRawData(), float)),
+            abs(array(full[:,2:4].getRawData(), float)), eps=1e-4)
+
     def test_make_E_matrix(self):
         """make_E_matrix converts a distance matrix to an E matrix"""
         matrix = self.matrix
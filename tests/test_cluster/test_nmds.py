@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
 from cogent.util.unit_test import TestCase, main
-from numpy import array, sqrt, size
-from cogent.cluster.nmds import NMDS, metaNMDS
+from numpy import array, sqrt, size, arange, concatenate
+from cogent.cluster.nmds import NMDS, metaNMDS, monotone_regression
 from cogent.maths.distance_transform import dist_euclidean
 
 __author__ = "Justin Kuczynski"
@@ -122,5 +122,41 @@ class NMDSTests(TestCase):
         nm = metaNMDS(1, distmtx, verbosity=0)
         self.assertLessThan(nm.getStress(), .13)
 
+    def test_monotone_regression(self):
+        """monotone_regression should pool adjacent violators"""
+        self.assertEqual(monotone_regression([]), [])
+        self.assertEqual(monotone_regression([1,2,3]), [1,2,3])
+        self.assertFloatEqual(monotone_regression([1,3,2,4,0,8]), 
+            [1,2.25,2.25,2.25,2.25,8])
+        #one early large value is pooled with many later ones
+        values = concatenate(([1000.], arange(100.)))
+        self.assertFloatEqual(monotone_regression(values), 
+            [1946/45.]*45 + range(44,100))
+
+    def test_stress_gradient(self):
+        """stress gradients should match finite differences"""
+        nm = NMDS(self.mtx, verbosity=0, setup_only=True, 
+            initial_pts='random', rand_seed=1)
+        pts = nm.getPoints().ravel().copy()
+        gradient = nm._calc_stress_gradients(pts)
+        eps = 1e-6
+        for k in range(len(pts)):
+            moved = pts.copy()
+            moved[k] += eps
+            high = nm._recalc_stress_from_pts(moved)
+            moved = pts.copy()
+            moved[k] -= eps
+            low = nm._recalc_stress_from_pts(moved)
+            self.assertFloatEqualAbs(gradient[k], (high-low)/(2*eps), 1e-6)
+        self.assertEqual(nm.order[0], [1,2])
+        self.assertEqual(len(nm.dists), 6)
+
+    def test_metaNMDS_seed(self):
+        """metaNMDS should be repeatable with rand_seed"""
+        first = metaNMDS(2, self.mtx, verbosity=0, rand_seed=5)
+        second = metaNMDS(2, self.mtx, verbosity=0, rand_seed=5)
+        self.assertEqual(first.getStress(), second.getStress())
+        self.assertFloatEqual(first.getPoints(), second.getPoints())
+
 if __name__ == '__main__':
        main()
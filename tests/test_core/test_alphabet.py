@@ -3,6 +3,8 @@
 
 Note: individual Alphabets are typically in MolType and are tested there.
 """
+import pickle
+
 from cogent.core.alphabet import Enumeration, get_array_type, \
     uint8, uint16, uint32, array, JointEnumeration, CharAlphabet, \
     _make_translation_tables, _make_complement_array
@@ -289,6 +291,15 @@ class JointEnumerationTests(TestCase):
         self.assertEqual(a._sub_enum_factors, \
             array([[4],[1]])) #note: _not_ [3,1]
 
+    def test_pickle(self):
+        """JointEnumeration should survive pickling with any protocol"""
+        a = JointEnumeration(['TCA', 'UCAG'])
+        for protocol in [0, 2]:
+            b = pickle.loads(pickle.dumps(a, protocol))
+            self.assertEqual(b, a)
+            self.assertEqual(b.Shape, (3,4))
+            self.assertEqual(b.toIndices([('A','G')]), [11])
+
     def test_toIndices(self):
         """JointEnumeration toIndices should convert tuples correctly"""
         a = JointEnumeration(['TCAG','UCAG'])
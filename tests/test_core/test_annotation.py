@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 import unittest
+import numpy
 
 from cogent import DNA, LoadSeqs
-from cogent.core.annotation import Feature, Variable, _Feature
+from cogent.core.annotation import Feature, Variable, _Feature, \
+    AnnotationIndex
 from cogent.core.location import Map, Span, as_map
 
 __author__ = "Gavin Huttley"
@@ -183,6 +185,61 @@ class TestAnnotations(unittest.TestCase):
                 assert str(observed) == expected, ("-", annot_type, name, expected,
                                                     observed)
 
+class TestAnnotationIndex(unittest.TestCase):
+    """AnnotationIndex should find the annotations a linear scan would"""
+    def setUp(self):
+        rng = numpy.random.RandomState(3)
+        self.seq = DNA.makeSequence('ACGT' * 2500)
+        for i in range(300):
+            length = int(rng.choice([5, 50, 500, 5000]) * rng.uniform(0.5, 1))
+            start = rng.randint(0, len(self.seq) - length)
+            spans = [(start, start + length // 3), 
+                     (start + length // 2, start + length)][:rng.randint(1, 3)]
+            self.seq.addFeature(['gene', 'exon'][i % 2], 'f%s' % i, spans)
+    
+    def linear(self, start, end, annotation_type=None):
+        return [a for a in self.seq.annotations if (annotation_type is None 
+                or a.type == annotation_type) and a.map.Start < end and
+                a.map.End > start]
+    
+    def test_overlapping(self):
+        """should find overlapping annotations in order"""
+        index = self.seq.getAnnotationIndex()
+        for (start, end) in [(0, 1), (0, 10000), (995, 1005), (4000, 4001),
+                (2500, 7500), (9999, 10000), (10000, 10100), (-50, 0)]:
+            for annotation_type in [None, 'exon', 'gene', 'intron']:
+                self.assertEqual(
+                    index.overlapping(start, end, annotation_type),
+                    self.linear(start, end, annotation_type))
+    
+    def test_slicing(self):
+        """slices should keep the same annotations as before"""
+        for (start, end) in [(100, 600), (3000, 3200), (0, 10000)]:
+            names = [a.Name for a in self.seq[start:end].annotations]
+            # features with no span in the slice are dropped
+            self.assertEqual(names, [a.Name for a in self.linear(start, end)
+                    if [span for span in a.map.spans 
+                        if span.Start < end and span.End > start]])
+        exons = self.seq.getAnnotationsMatching('exon')
+        self.assertEqual([a.Name for a in exons], 
+                ['f%s' % i for i in range(1, 300, 2)])
+        self.assertEqual(
+                len(self.seq.getAnnotationsMatching('exon', Name='f3')), 1)
+    
+    def test_kept_up_to_date(self):
+        """the index should follow attached and detached annotations"""
+        index = self.seq.getAnnotationIndex()
+        self.assertTrue(self.seq.getAnnotationIndex() is index)
+        feature = self.seq.addFeature('repeat', 'r', [(10, 20)])
+        self.assertEqual(self.seq.getAnnotationsMatching('repeat'), [feature])
+        assert feature in self.seq.getAnnotationIndex().overlapping(0, 11)
+        feature.detach()
+        self.assertEqual(self.seq.getAnnotationsMatching('repeat'), [])
+        self.assertEqual(self.seq.getAnnotationIndex().overlapping(0, 11),
+                self.linear(0, 11))
+        self.assertEqual(len(AnnotationIndex([])), 0)
+    
+
 class TestMapSpans(unittest.TestCase):
     """Test attributes of Map & Spans classes critical to annotation
     manipulation."""
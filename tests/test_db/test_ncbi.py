@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 """Tests of data retrieval from NCBI."""
 from cogent.util.unit_test import TestCase, main
+from cogent.db import ncbi
 from cogent.db.ncbi import EUtils, ESearch, EFetch, ELink, ESearchResultParser,\
     ELinkResultParser, get_primary_ids, ids_to_taxon_ids, \
     taxon_lineage_extractor, taxon_ids_to_lineages, taxon_ids_to_names, \
@@ -8,6 +9,9 @@ from cogent.db.ncbi import EUtils, ESearch, EFetch, ELink, ESearchResultParser,\
     get_unique_lineages, get_unique_taxa, parse_taxonomy_using_elementtree_xml_parse
 from string import strip
 from StringIO import StringIO
+from urlparse import urlsplit, parse_qsl
+from tempfile import mkdtemp
+from shutil import rmtree
 
 __author__ = "Mike Robeson"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -18,7 +22,16 @@ __maintainer__ = "Mike Robeson"
 __email__ = "mike.robeson@colorado.edu"
 __status__ = "Production"
 
-class EUtilsTests(TestCase):
+class NetworkTestCase(TestCase):
+    """Retries quickly, so that these tests fail fast when offline."""
+    def setUp(self):
+        self._backoff = ncbi.default_backoff
+        ncbi.default_backoff = 0.01
+
+    def tearDown(self):
+        ncbi.default_backoff = self._backoff
+
+class EUtilsTests(NetworkTestCase):
     """Tests of the EUtils class."""
     def test_simple_get(self):
         """EUtils simple access of an item should work"""
@@ -116,6 +129,65 @@ class EUtilsTests(TestCase):
         self.assertEqual(len(result), 5)
 
 
+class FakeNcbi(object):
+    """Stand-in for the EUtils server: records are numbered from 0."""
+    def __init__(self, count):
+        self.Count = count
+        self.Requests = []
+        self.Sessions = 0
+
+    def __call__(self, url):
+        self.Requests.append(url)
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        params = dict(parse_qsl(query))
+        if path.endswith('esearch.fcgi'):
+            self.Sessions += 1
+            return ('<?xml version="1.0"?>\n<eSearchResult><Count>%s</Count>'
+                '<RetMax>0</RetMax><RetStart>0</RetStart>'
+                '<QueryKey>1</QueryKey><WebEnv>S%s</WebEnv>'
+                '</eSearchResult>' % (self.Count, self.Sessions))
+        if params['WebEnv'] != 'S%s' % self.Sessions:
+            return 'expired'
+        start = int(params['retstart'])
+        stop = start + int(params['retmax'])
+        return '\n'.join(['>%s' % i for i in range(start, stop)])
+
+class EUtilsOfflineTests(TestCase):
+    """Tests of EUtils against a stand-in server."""
+    def setUp(self):
+        self.dirname = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def test_windows(self):
+        """EUtils should fetch all records in windows, in order"""
+        ncbi = FakeNcbi(25)
+        g = EUtils(retmax=10, wait=0, transport=ncbi)
+        result = g['x'].read()
+        self.assertEqual(result.split(), ['>%s' % i for i in range(25)])
+        self.assertEqual(len(ncbi.Requests), 4)
+        ncbi = FakeNcbi(25)
+        g = EUtils(retmax=10, wait=0, max_recs=12, transport=ncbi)
+        self.assertEqual(g['x'].read().split(), ['>%s' % i for i in range(12)])
+
+    def test_cache(self):
+        """EUtils should answer repeated queries from the cache"""
+        ncbi = FakeNcbi(25)
+        g = EUtils(retmax=10, wait=0, transport=ncbi, cache=self.dirname)
+        expected = ['>%s' % i for i in range(25)]
+        self.assertEqual(g['x'].read().split(), expected)
+        count = len(ncbi.Requests)
+        g = EUtils(retmax=10, wait=0, transport=ncbi, cache=self.dirname)
+        self.assertEqual(g['x'].read().split(), expected)
+        self.assertEqual(len(ncbi.Requests), count)
+        #new windows need a new session, as the cached one has expired
+        ncbi.Sessions += 1
+        g = EUtils(retmax=5, wait=0, transport=ncbi, cache=self.dirname)
+        self.assertEqual(g['x'].read().split(), expected)
+        #one new search and four new windows: the last is already cached
+        self.assertEqual(len(ncbi.Requests), count + 5)
+
 class ESearchTests(TestCase):
     """Tests of the ESearch class: gets primary ids from search."""
     def test_simple_search(self):
@@ -154,10 +226,11 @@ class EFetchTests(TestCase):
         assert result[0].startswith('>')
         assert result[1].startswith('madaemaafg'.upper())
 
-class NcbiTests(TestCase):
+class NcbiTests(NetworkTestCase):
     """Tests of top-level convenience wrappers."""
     def setUp(self):
         """Define some lengthy data."""
+        NetworkTestCase.setUp(self)
         self.mouse_taxonomy = map(strip, 'cellular organisms; Eukaryota; Opisthokonta; Metazoa; Eumetazoa; Bilateria; Coelomata; Deuterostomia; Chordata; Craniata; Vertebrata; Gnathostomata; Teleostomi; Euteleostomi; Sarcopterygii; Tetrapoda; Amniota; Mammalia; Theria; Eutheria; Euarchontoglires; Glires; Rodentia; Sciurognathi; Muroidea; Muridae; Murinae; Mus; Mus'.split(';'))
         self.human_taxonomy = map(strip, 'cellular organisms; Eukaryota; Opisthokonta; Metazoa; Eumetazoa; Bilateria; Coelomata; Deuterostomia; Chordata; Craniata; Vertebrata; Gnathostomata; Teleostomi; Euteleostomi; Sarcopterygii; Tetrapoda; Amniota; Mammalia; Theria; Eutheria; Euarchontoglires; Primates; Haplorrhini; Simiiformes; Catarrhini; Hominoidea; Hominidae; Homininae; Homo'.split(';'))
 
@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 """Tests of the db utility functions and classes."""
 from cogent.util.unit_test import TestCase, main
-from cogent.db.util import UrlGetter, expand_slice, last_nondigit_index,make_lists_of_expanded_slices_of_set_size,make_lists_of_accessions_of_set_size
-from os import remove
+from cogent.db.util import UrlGetter, expand_slice, last_nondigit_index,make_lists_of_expanded_slices_of_set_size,make_lists_of_accessions_of_set_size,\
+    read_url, normalised_url, ResponseCache, RateLimiter, UrlFetcher, \
+    ErrorResponse
+from os import remove, utime
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 __author__ = "Rob Knight"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -70,5 +77,166 @@ class UrlGetterTests(TestCase):
         g_text.close()
         remove(fname)
 
+class StandInHandler(BaseHTTPRequestHandler):
+    """Echoes the request path, failing the first request to /flaky."""
+    def do_GET(self):
+        server = self.server
+        server.Requests.append(self.path)
+        if self.path.startswith('/flaky') and len(server.Requests) == 1:
+            self.send_error(503)
+            return
+        if self.path.startswith('/missing'):
+            self.send_error(404)
+            return
+        body = 'got ' + self.path
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class UrlFetcherTests(TestCase):
+    """Tests of caching, rate limiting and retrying URL fetches"""
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.requests = []
+        self.sleeps = []
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def transport(self, url):
+        """Fake transport recording requests"""
+        self.requests.append(url)
+        return 'body of ' + url
+
+    def test_normalised_url(self):
+        """normalised_url should sort parameters and drop ignored ones"""
+        self.assertEqual(normalised_url('http://a.org/f?b=2&a=1+2&tool=x'),
+            'http://a.org/f?a=1+2&b=2')
+        self.assertEqual(normalised_url('http://a.org/f?b=2&a=1+2&tool=x'),
+            normalised_url('http://a.org/f?tool=y&a=1%202&b=2'))
+        self.assertEqual(normalised_url('http://a.org/f?b=2&a=1', ['b']),
+            'http://a.org/f?a=1')
+
+    def test_cache(self):
+        """ResponseCache should store responses until they expire"""
+        c = ResponseCache(self.dirname + '/cache', ttl=100)
+        self.assertEqual(c.get('x'), None)
+        self.assertFalse('x' in c)
+        c.put('x', 'data\n\x00')
+        self.assertTrue('x' in c)
+        self.assertEqual(c.get('x'), 'data\n\x00')
+        #new instances see stored responses
+        self.assertEqual(ResponseCache(self.dirname + '/cache').get('x'),
+            'data\n\x00')
+        #expired
+        old = time() - 200
+        utime(c._path('x'), (old, old))
+        self.assertEqual(c.get('x', 'gone'), 'gone')
+        self.assertEqual(ResponseCache(self.dirname + '/cache').get('x'),
+            'data\n\x00')
+
+    def test_rate_limiter(self):
+        """RateLimiter should space requests"""
+        r = RateLimiter(4, sleep=self.sleeps.append)
+        for i in range(3):
+            r.wait()
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertFloatEqualAbs(self.sleeps, [0.25, 0.5], eps=0.05)
+
+    def test_read_cached(self):
+        """UrlFetcher should read through the cache"""
+        f = UrlFetcher(self.transport, cache=ResponseCache(self.dirname))
+        url = 'http://a.org/f?a=1&tool=x'
+        self.assertFalse(f.isCached(url))
+        self.assertEqual(f.read(url), 'body of ' + url)
+        self.assertTrue(f.isCached(url))
+        self.assertEqual(f.read('http://a.org/f?tool=y&a=1'), 'body of ' + url)
+        self.assertEqual(len(self.requests), 1)
+        f.read(url, refresh=True)
+        self.assertEqual(len(self.requests), 2)
+        #keys override urls
+        f.read('http://a.org/g', key='k')
+        self.assertTrue(f.isCached(None, 'k'))
+        self.assertEqual(f.read('http://a.org/h', key='k'), 
+            'body of http://a.org/g')
+
+    def test_retries(self):
+        """UrlFetcher should retry failures with backoff"""
+        failures = [IOError('down')] * 2
+        def transport(url):
+            if failures:
+                raise failures.pop()
+            return 'ok'
+        f = UrlFetcher(transport, retries=3, backoff=0.5, 
+            sleep=self.sleeps.append)
+        self.assertEqual(f.read('http://a.org/'), 'ok')
+        self.assertEqual(self.sleeps, [0.5, 1.0])
+        failures[:] = [IOError('down')] * 3
+        f = UrlFetcher(transport, retries=2, sleep=self.sleeps.append)
+        self.assertRaises(IOError, f.read, 'http://a.org/')
+
+    def test_error_not_cached(self):
+        """UrlFetcher should return but not cache error responses"""
+        def transport(url):
+            self.requests.append(url)
+            return ErrorResponse('not found', 404)
+        f = UrlFetcher(transport, cache=ResponseCache(self.dirname))
+        self.assertEqual(f.read('http://a.org/'), 'not found')
+        self.assertFalse(f.isCached('http://a.org/'))
+        f.read('http://a.org/')
+        self.assertEqual(len(self.requests), 2)
+
+    def test_read_many(self):
+        """UrlFetcher.readMany should keep order and report errors"""
+        urls = ['http://a.org/%s' % i for i in range(20)]
+        f = UrlFetcher(self.transport, max_workers=4)
+        self.assertEqual(f.readMany(urls), ['body of ' + u for u in urls])
+        self.assertEqualItems(self.requests, urls)
+        def transport(url):
+            if url.endswith('7'):
+                raise IOError(url)
+            return url
+        f = UrlFetcher(transport, max_workers=4, retries=0)
+        self.assertRaises(IOError, f.readMany, urls)
+
+    def test_stand_in_server(self):
+        """UrlFetcher should fetch from a local server, retrying 5xx"""
+        server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+        server.Requests = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            base = 'http://127.0.0.1:%s' % server.server_address[1]
+            self.assertRaises(IOError, read_url, base + '/flaky')
+            f = UrlFetcher(cache=ResponseCache(self.dirname), max_workers=2,
+                backoff=0.01)
+            self.assertEqual(f.read(base + '/flaky?x=1'), 'got /flaky?x=1')
+            #4xx bodies are returned, as by urllib.urlopen, but not cached
+            body = f.read(base + '/missing')
+            assert '404' in body
+            self.assertEqual(body.Code, 404)
+            self.assertFalse(f.isCached(base + '/missing'))
+            urls = [base + '/r?i=%s' % i for i in range(5)]
+            self.assertEqual(f.readMany(urls), 
+                ['got /r?i=%s' % i for i in range(5)])
+            count = len(server.Requests)
+            self.assertEqual(f.readMany(urls), 
+                ['got /r?i=%s' % i for i in range(5)])
+            self.assertEqual(len(server.Requests), count)
+            #UrlGetter reads through a fetcher when given one
+            class Local(UrlGetter):
+                BaseUrl = base + '/r?'
+                PrintedFields = {'i':None}
+            self.assertEqual(Local(i=3, fetcher=f).read(), 'got /r?i=3')
+            self.assertEqual(len(server.Requests), count)
+        finally:
+            server.shutdown()
+            server.server_close()
+
 if __name__ == '__main__':
     main()
@@ -175,6 +175,46 @@ class LikelihoodCalcs(TestCase):
         self.assertEqual(len(values), 3)
         shape = lf.getParamValue('rate_shape')
     
+    def test_memo(self):
+        """remembering previous results doesn't change the optimisation"""
+        submod = substitution_model.Nucleotide(
+            predicates={'kappa': 'transition'}, ordered_param='rate',
+            distribution='gamma')
+        results = []
+        for memo_depth in [0, 1, 4]:
+            lf = self._makeLikelihoodFunction(submod, bins=3)
+            lf.setParamRule('length', is_constant=False)
+            lf.optimise(local=True, show_progress=False, max_evaluations=200,
+                    limit_action='ignore', memo_depth=memo_depth, profile=True)
+            results.append(lf.getLogLikelihood())
+            self.assertEqual(lf.last_profile_stats['memo_hits'] > 0,
+                    memo_depth > 0)
+        self.assertEqual(results[1:], results[:1] * 2)
+    
+    def test_processes(self):
+        """loci and bins calculated in other processes give the same result"""
+        submod = substitution_model.Nucleotide(
+            predicates={'kappa': 'transition'}, ordered_param='rate',
+            distribution='gamma')
+        loci = [self.alignment[:21], self.alignment[21:]]
+        results = []
+        for processes in [None, 3]:
+            lf = submod.makeLikelihoodFunction(self.tree, bins=2,
+                    loci=['a', 'b'])
+            lf.setParamRule('kappa', is_independent=True)
+            lf.setAlignment(loci)
+            kw = {'processes': processes} if processes else {}
+            lf.optimise(local=True, show_progress=False, max_evaluations=100,
+                    limit_action='ignore', **kw)
+            results.append(lf.getLogLikelihood())
+        self.assertEqual(results[0], results[1])
+        # the calculator is still good once its workers are gone
+        lc = lf.optimise(local=True, show_progress=False, max_evaluations=5,
+                limit_action='ignore', processes=3, return_calculator=True)
+        x = lc.getValueArray()
+        x[0] *= 1.5
+        self.assertFloatEqual(lc(x), lf.makeCalculator()(x))
+    
     def test_binned_partition(self):
         submod = substitution_model.Codon(
             predicates={'kappa': 'transition', 'omega': 'replacement'},
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
 import os
+import numpy
 
-from cogent import LoadSeqs, CodonAlphabet, DNA, LoadTable
+from cogent import LoadSeqs, LoadTree, CodonAlphabet, DNA, LoadTable
 from cogent.core import genetic_code
 from cogent.evolve import substitution_model, substitution_calculation
 from cogent.util.unit_test import TestCase, main
@@ -214,6 +215,82 @@ class ModelDataInteractionTestMethods(TestCase):
     
     # need to ensure entering motif probs that sum to 1, that motif sets are the same
 
+
+class RateMatrixTests(TestCase):
+    def setUp(self):
+        self.model = substitution_model.Codon(model_gaps=False,
+            predicates=['kappa:transition', 'omega:replacement'],
+            mprob_model='tuple')
+        N = len(self.model.getAlphabet())
+        self.word_probs = numpy.arange(1, N+1) / (N*(N+1)/2.0)
+        self.mprobs_matrix = numpy.tile(self.word_probs, (N, 1))
+        self.params = [[4.0, 0.5], [1.0, 1.0], [2.0, 0.1]]
+    
+    def _maskedQ(self, params):
+        """Q computed directly from the predicate masks"""
+        R = self.model._instantaneous_mask_f.copy()
+        for (pred, par) in zip(self.model.parameter_order, params):
+            R[self.model.predicate_masks[pred] != 0] *= par
+        Q = R * self.mprobs_matrix
+        row_totals = Q.sum(axis=1)
+        Q -= numpy.diag(row_totals)
+        return Q / (self.word_probs * row_totals).sum()
+    
+    def test_calcQ(self):
+        """calcQ matches Q built from the predicate masks"""
+        for params in self.params:
+            Q = self.model.calcQ(self.word_probs, self.mprobs_matrix, *params)
+            self.assertFloatEqual(Q, self._maskedQ(params))
+        # motif probs as a vector of column weights
+        Q = self.model.calcQ(self.word_probs, self.word_probs, 4.0, 0.5)
+        self.assertFloatEqual(Q, self._maskedQ([4.0, 0.5]))
+    
+    def test_calcQs(self):
+        """calcQs builds one Q per row of parameters"""
+        Qs = self.model.calcQs(self.word_probs, self.mprobs_matrix,
+                self.params)
+        self.assertEqual(Qs.shape, (3, 61, 61))
+        for (Q, params) in zip(Qs, self.params):
+            self.assertFloatEqual(Q, self._maskedQ(params))
+    
+    def test_calcQBatch(self):
+        """calcQBatch gives calcQ for each argument list"""
+        other_probs = self.word_probs[::-1].copy()
+        arg_lists = [[self.word_probs, self.mprobs_matrix] + params
+                for params in self.params]
+        arg_lists.insert(1, [other_probs, other_probs, 4.0, 0.5])
+        Qs = self.model.calcQBatch(arg_lists)
+        self.assertEqual(len(Qs), 4)
+        for (Q, args) in zip(Qs, arg_lists):
+            self.assertFloatEqual(Q, self.model.calcQ(*args))
+    
+    def test_batched_likelihood(self):
+        """a likelihood function gives the same result with its Qs batched"""
+        aln = LoadSeqs(data={'a': 'ATGAAACCC', 'b': 'ATGAAGCCT',
+                'c': 'ATGCAACCC'}, moltype=DNA)
+        lf = self.model.makeLikelihoodFunction(LoadTree(tip_names='abc'))
+        lf.setAlignment(aln)
+        lf.setParamRule('omega', is_independent=True)
+        lf.setParamRule('omega', edge='b', init=2.0)
+        calc = lf.makeCalculator()
+        x = list(calc.getValueArray())
+        kappa = calc.opt_pars.index([p for p in calc.opt_pars
+                if p.name == 'kappa'][0])
+        x[kappa] += 0.5
+        lnL = calc(x)
+        # that recalculated the Q of every edge in one go
+        batches = [step for (program, steps) 
+                in calc._batched_programs.values()
+                for step in steps if type(step) is tuple]
+        self.assertEqual([[cell.name for cell in step] for step in batches],
+                [['Q'] * 3])
+        unbatched = lf.makeCalculator()
+        for cell in unbatched._cells:
+            if hasattr(cell, 'batch_calc'):
+                cell.batch_calc = None
+        self.assertFloatEqual(unbatched(x), lnL)
+
+
 if __name__ == '__main__':
         main()
 
@@ -4,7 +4,9 @@
 from __future__ import division
 from cogent.util.unit_test import TestCase, main
 from cogent.maths.distance_transform import *
-from numpy import array, sqrt, shape, ones, diag
+from numpy import array, sqrt, shape, ones, diag, cumsum, flatnonzero
+from numpy.random import seed, random, randint
+import cogent.maths.distance_transform as distance_transform
             
             
 __author__ = "Justin Kuczynski"
@@ -20,6 +22,22 @@ __status__ = "Prototype"
 
 
 
+class CsrMatrix(object):
+    """minimal stand-in for a scipy.sparse csr matrix"""
+    def __init__(self, dense):
+        self.Dense = dense
+        self.shape = dense.shape
+        nonzero_cols = [flatnonzero(row) for row in dense]
+        self.indptr = concatenate([[0], cumsum(map(len, nonzero_cols))])
+        self.indices = concatenate([[]] + nonzero_cols).astype(int)
+        self.data = dense[dense != 0]
+
+    def tocsr(self):
+        return self
+
+    def astype(self, dtype):
+        return CsrMatrix(self.Dense.astype(dtype))
+
 class functionTests(TestCase):
     """Tests of top-level functions."""
     def setUp(self):
@@ -260,6 +278,25 @@ class functionTests(TestCase):
                           [1, 1, 0, 1],
                           [1, 0, 1, 0]])
         self.assertEqual(actual,expected)
+        self.assertEqual(actual.dtype, int)
+
+    def test_binary_dist_otu_gain_blocks_and_sparse(self):
+        """binary_dist_otu_gain should not depend on blocks or sparsity"""
+        seed(0)
+        data = randint(0, 5, (23,17)) * (random((23,17)) < 0.3)
+        data[3] = 0
+        data[5] = data[6]
+        present = data > 0
+        expected = array([[(a & ~b).sum() for b in present] 
+            for a in present])
+        self.assertEqual(binary_dist_otu_gain(data), expected)
+        self.assertEqual(binary_dist_otu_gain(data, block_size=4), expected)
+        self.assertEqual(binary_dist_otu_gain(CsrMatrix(data), 
+            block_size=5), expected)
+        obs = binary_dist_otu_gain(data, dtype='f')
+        self.assertEqual(obs.dtype, numpy.float32)
+        self.assertEqual(obs, expected)
+        self.assertEqual(binary_dist_otu_gain(zeros((0,3))), zeros((0,0)))
 
     def test_binary_dist_chisq(self):
         """tests binary_dist_chisq
@@ -531,6 +568,50 @@ class functionTests(TestCase):
                         [1-.4,1-4/11,0],
                         ]))
     
+    def test_blocks_sparse_and_dtype(self):
+        """distances should not depend on blocks, sparsity or path taken"""
+        seed(0)
+        data = randint(0, 5, (23,17)) * (random((23,17)) < 0.3)
+        data[3] = 0
+        data[5] = data[6]
+        dist_fs = [dist_bray_curtis, dist_bray_curtis_magurran, 
+            dist_canberra, dist_chisq, dist_chord, dist_euclidean, 
+            dist_gower, dist_hellinger, dist_kulczynski, dist_manhattan,
+            dist_abund_jaccard, dist_morisita_horn, dist_pearson, 
+            dist_soergel, dist_spearman_approx, dist_specprof, 
+            binary_dist_chisq, binary_dist_chord, binary_dist_sorensen_dice,
+            binary_dist_euclidean, binary_dist_hamming, binary_dist_jaccard,
+            binary_dist_lennon, binary_dist_ochiai, binary_dist_pearson]
+        orig_density = distance_transform.SPARSE_DENSITY
+        try:
+            for dist_f in dist_fs:
+                exp = dist_f(data)
+                self.assertEqual(exp.dtype, numpy.float64)
+                self.assertEqual(diag(exp), zeros(23))
+                for density in [0, 1]:
+                    distance_transform.SPARSE_DENSITY = density
+                    self.assertFloatEqual(dist_f(data, block_size=4), exp)
+                    self.assertFloatEqual(dist_f(CsrMatrix(data), 
+                        block_size=5), exp)
+                obs = dist_f(data, dtype='f')
+                self.assertEqual(obs.dtype, numpy.float32)
+                self.assertFloatEqualAbs(obs, exp, eps=1e-4)
+        finally:
+            distance_transform.SPARSE_DENSITY = orig_density
+
+    def test_sparse_strict(self):
+        """sparse input should get the same checks as dense input"""
+        self.assertRaises(ValueError, dist_bray_curtis, 
+            CsrMatrix(-self.sparse1))
+        self.assertEqual(dist_bray_curtis(CsrMatrix(zeros((0,3)))), 
+            zeros((0,0)))
+
+    def test_euclidean_duplicates(self):
+        """dist_euclidean should give exactly 0 for duplicate rows"""
+        data = array([[1e8, 1.1, 3.3], [1e8, 1.1, 3.3], [1, 2, 3]])
+        self.assertEqual(dist_euclidean(data)[0,1], 0.0)
+        self.assertEqual(dist_chord(data)[0,1], 0.0)
+
     #def test_no_dupes(self):
         #""" here we check all distance functions in distance_transform for 
         #duplicate
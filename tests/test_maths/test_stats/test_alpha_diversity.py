@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 #file test_alpha_diversity.py
 from __future__ import division
-from numpy import array, log, sqrt, exp
+from numpy import array, log, sqrt, exp, isnan, nonzero, arange, cumsum, \
+    nan, seterr
 from math import e
 from cogent.util.unit_test import TestCase, main
 from cogent.maths.stats.alpha_diversity import expand_counts, counts, observed_species, singles, \
@@ -11,7 +12,8 @@ from cogent.maths.stats.alpha_diversity import expand_counts, counts, observed_s
     strong, kempton_taylor_q, fisher_alpha, \
     mcintosh_e, heip_e, simpson_e, robbins, robbins_confidence, \
     chao1_uncorrected, chao1_bias_corrected, chao1, chao1_var, \
-    chao1_confidence, ACE, michaelis_menten_fit
+    chao1_confidence, ACE, michaelis_menten_fit, TABLE_METRICS, \
+    table_diversity, table_metric
 
 __author__ = "Rob Knight"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -268,6 +270,72 @@ class diversity_tests(TestCase):
         res =  michaelis_menten_fit([70,70],num_repeats=5)
         self.assertFloatEqual(res,2.0,eps=.01)
 
+    def test_table_diversity(self):
+        """table_diversity should match the single-sample metrics"""
+        table = array([self.TestData, [12,3,6,1,10,2,1,4,5,0],
+            [1,9,1,3,2,1,7,2,2,3], [3,1,4,1,5,9,2,6,5,3]])
+        names = sorted(TABLE_METRICS) + ['chao1_var']
+        result = table_diversity(table, names)
+        self.assertEqual(result.shape, (4, len(names)))
+        for i, name in enumerate(names):
+            f = globals()[name]
+            for j, row in enumerate(table):
+                self.assertFloatEqual(result[j,i], f(row))
+        #functions are applied per sample
+        self.assertFloatEqual(table_diversity(table, [sum])[:,0], 
+            table.sum(1))
+        self.assertFloatEqual(table_metric('shannon')(table), 
+            [shannon(row) for row in table])
+
+    def test_table_diversity_sparse(self):
+        """table_diversity should give the same results for sparse tables"""
+        class CsrTable(object):
+            def __init__(self, dense):
+                rows, cols = nonzero(dense)
+                self.shape = dense.shape
+                self.indptr = cumsum([0] + [(rows == i).sum() 
+                    for i in range(dense.shape[0])])
+                self.indices, self.data = cols, dense[rows, cols]
+            def tocsr(self):
+                return self
+        table = array([self.TestData, self.NoDoubles, [0]*10, 
+            [0,0,0,0,0,0,0,0,0,7]])
+        names = ['observed_species', 'shannon', 'strong', 'kempton_taylor_q',
+            'brillouin_d', 'chao1']
+        dense = table_diversity(table, names)
+        sparse = table_diversity(CsrTable(table), names)
+        self.assertEqual(isnan(dense), isnan(sparse))
+        self.assertFloatEqual(dense[~isnan(dense)], sparse[~isnan(sparse)])
+        self.assertEqual(dense[2,0], 0)
+
+    def test_table_diversity_undefined(self):
+        """table_diversity should give nan where a metric raises"""
+        table = array([[12,1,1,0], [12,3,6,1]])
+        self.assertRaises(ValueError, ACE, table[0])
+        result = table_diversity(table, ['ACE', ACE])
+        self.assertTrue(isnan(result[0]).all())
+        self.assertFloatEqual(result[1], [ACE(table[1])]*2)
+
+    def test_table_diversity_empty(self):
+        """table_diversity should give nan for an empty sample as per sample"""
+        table = array([[0]*6, [3,1,0,2,0,5]])
+        names = sorted(TABLE_METRICS)
+        result = table_diversity(table, names)
+        oldstate = seterr(all='ignore')
+        try:
+            for i, name in enumerate(names):
+                try:
+                    exp = globals()[name](table[0])
+                except ZeroDivisionError:
+                    exp = nan
+                if isnan(exp):
+                    self.assertTrue(isnan(result[0,i]), name)
+                else:
+                    self.assertFloatEqual(result[0,i], exp)
+        finally:
+            seterr(**oldstate)
+        for name in ['shannon', 'equitability', 'heip_e']:
+            self.assertTrue(isnan(result[0,names.index(name)]))
 
 if __name__ == '__main__':
     main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 #file test_parse.py
-from numpy import array
+from numpy import array, minimum, repeat, zeros
 from cogent.util.unit_test import TestCase, main
 from cogent.maths.stats.rarefaction import (subsample,
                                             naive_histogram,
@@ -8,7 +8,12 @@ from cogent.maths.stats.rarefaction import (subsample,
                                             rarefaction,
                                             subsample_freq_dist_nonzero,
                                             subsample_random,
-                                            subsample_multinomial)
+                                            subsample_multinomial,
+                                            multivariate_hypergeometric,
+                                            rarefy_table,
+                                            rarefy_table_iter,
+                                            rarefaction_alpha,
+                                            per_row)
 
 __author__ = "Rob Knight"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -27,6 +32,7 @@ class TopLevelTests(TestCase):
         a = array([0,5,0])
         self.assertEqual(subsample(a,5), array([0,5,0]))
         self.assertEqual(subsample(a,2), array([0,2,0]))
+        self.assertEqual(subsample(a,2).dtype, float)
         b = array([2,0,1])
         
         # selecting 2 counts from the vector 1000 times yields each of the 
@@ -168,6 +174,58 @@ class TopLevelTests(TestCase):
         #when we get to end should recapture orig vals
         self.assertEqual(r, orig_vals)
 
+    def test_multivariate_hypergeometric(self):
+        """multivariate_hypergeometric should draw without replacement"""
+        counts = array([[2,0,1,2,1,8,6,0,3,3,5,0,0,0,5],
+                        [0,0,0,0,0,0,0,0,0,0,0,0,0,0,1],
+                        [0,9,0,0,0,0,0,0,0,0,0,0,0,0,0]])
+        result = multivariate_hypergeometric(counts, 4)
+        self.assertEqual(result.sum(1), [4,1,4])
+        self.assertTrue((result <= counts).all())
+        self.assertEqual(result[1:], [[0]*14+[1], [0,4]+[0]*13])
+        result = multivariate_hypergeometric(counts, array([35,0,9]))
+        self.assertEqual(result[0].sum(), 35)
+        self.assertEqual(result[1:], counts[1:]*[[0],[1]])
+        #each possible draw of 2 from [2,0,1] turns up
+        draws = multivariate_hypergeometric(repeat([[2,0,1]], 1000, 0), 2)
+        self.assertEqual(set(map(tuple, draws)), set([(1,0,1),(2,0,0)]))
+        self.assertFloatEqualAbs(draws.mean(0), [4/3., 0, 2/3.], eps=0.1)
+
+    def test_rarefy_table(self):
+        """rarefy_table should subsample each sample at each depth"""
+        table = array([[5,0,0,3,0,10],
+                       [0,1,0,0,0,0],
+                       [0,0,7,2,0,0]])
+        result = rarefy_table(table, [4,9,2], iterations=5, seed=1)
+        self.assertEqual(result.shape, (3,5,3,6))
+        for depth, rarefied in zip([4,9,2], result):
+            self.assertEqual(rarefied.sum(2), 
+                [minimum(table.sum(1), depth)]*5)
+            self.assertTrue((rarefied <= table).all())
+        #depths are nested, and seeded results repeatable
+        self.assertTrue((result[2] <= result[0]).all())
+        self.assertTrue((result[0] <= result[1]).all())
+        self.assertEqual(result[1,:,2], [table[2]]*5)
+        self.assertEqual(rarefy_table(table, [4,9,2], 5, seed=1), result)
+        #blocks of samples cover the whole table
+        blocks = list(rarefy_table_iter(table, [4,9], block_size=2))
+        self.assertEqual([(i, s.start, s.stop) for i, s, r in blocks],
+            [(1,0,2),(0,0,2),(1,2,3),(0,2,3)])
+        self.assertEqual(blocks[-1][2].shape, (1,1,6))
+
+    def test_rarefaction_alpha(self):
+        """rarefaction_alpha should match metrics on the rarefied tables"""
+        table = array([[5,0,0,3,0,10],
+                       [0,1,0,0,0,0],
+                       [0,0,7,2,0,0]])
+        observed = lambda counts: (counts > 0).sum(1)
+        biggest = per_row(max)
+        result = rarefaction_alpha(table, [4,9], {'obs':observed,
+            'max':biggest}, iterations=3, seed=2, block_size=2)
+        rarefied = rarefy_table(table, [4,9], 3, seed=2, block_size=2)
+        self.assertEqual(result['obs'], (rarefied > 0).sum(3))
+        self.assertEqual(result['max'], rarefied.max(3))
+
 
 if __name__ =='__main__':
     main()
@@ -12,10 +12,19 @@ from cogent.maths.unifrac.fast_tree import (count_envs, sum_env_dict,
     jackknife_int, unifrac, unnormalized_unifrac, PD, G, unnormalized_G, 
     unifrac_matrix, unifrac_vector, PD_vector, weighted_unifrac, 
     weighted_unifrac_matrix, weighted_unifrac_vector, jackknife_array, 
-    env_unique_fraction, unifrac_one_sample, weighted_one_sample)
+    env_unique_fraction, unifrac_one_sample, weighted_one_sample,
+    pack_presence, unpack_presence, batch_unifrac_matrix, 
+    batch_weighted_unifrac_matrix, SparseCounts, index_envs_sparse,
+    sparse_counts_from_coordinates, index_parents, sparse_sum_descendants,
+    sparse_bool_descendants, sparse_unifrac_vector, 
+    sparse_weighted_unifrac_vector, striped_unifrac_matrix, 
+    striped_weighted_unifrac_matrix, FitchCounterBatch, permutation_indices,
+    permute_selected_rows_batch, env_unique_fraction_batch)
+from cogent.app.util import get_tmp_filename
+from cogent.util.misc import remove_files
 from numpy import (arange, reshape, zeros, logical_or, array, sum, nonzero, 
-    flatnonzero, newaxis)
-from numpy.random import permutation    
+    flatnonzero, newaxis, load, ones, concatenate)
+from numpy.random import permutation, randint, random, RandomState
 
 __author__ = "Rob Knight and Micah Hamady"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -135,6 +144,34 @@ b   A   99
             array([[1,0,2],[1,1,0],[0,3,0],[0,0,1], \
             [0,1,0],[0,0,0],[0,0,0],[0,0,0],[0,0,0]]))
 
+    def test_index_envs_sparse(self):
+        """index_envs_sparse should match index_envs"""
+        counts, unique_envs, env_to_index, node_to_index = \
+            index_envs_sparse(self.env_counts, self.node_index)
+        self.assertEqual(counts.toarray(), self.count_array)
+        self.assertEqual(unique_envs, self.unique_envs)
+        self.assertEqual(env_to_index, self.env_to_index)
+        self.assertEqual(node_to_index, self.node_to_index)
+
+    def test_sparse_counts(self):
+        """SparseCounts should support the column operations UniFrac needs"""
+        m = array([[0,2,0],[1,0,0],[0,0,0],[3,4,0],[0,1,5]])
+        counts = sparse_counts_from_coordinates([3,1,3,0,4,4,0], 
+            [0,0,1,1,1,2,1], [3,1,4,1,1,5,1], m.shape)
+        self.assertEqual(counts.toarray(), m)
+        self.assertEqual(counts.IndPtr, [0,2,5,6])
+        self.assertEqual(counts.Indices, [1,3,0,3,4,4])
+        self.assertEqual(len(counts), 5)
+        self.assertEqual(counts.weightedColumnSums([1,2,3,4,5]), 
+            [14,23,25])
+        self.assertEqual(counts.occupiedRows(0, 2), [0,1,3,4])
+        rows, block = counts.block(1, 3)
+        self.assertEqual(rows, [0,3,4])
+        self.assertEqual(block, m[[0,3,4], 1:3])
+        rows, block = counts.block(0, 2, array([1,2,4]))
+        self.assertEqual(block, m[[1,2,4], 0:2])
+        self.assertEqual(counts.astype(bool).toarray(), m > 0)
+
     def test_get_branch_lengths(self):
         """get_branch_lengths should make array of branch lengths from index"""
         result = get_branch_lengths(self.node_index)
@@ -300,6 +337,25 @@ b   A   99
             [0,0,1],[0,1,0],[1,3,0],[0,1,1],[1,4,1]])
         )
 
+    def test_index_parents(self):
+        """index_parents should return parent indices and node heights"""
+        parents, heights = index_parents(self.t)
+        self.assertEqual(parents, [6,6,5,5,7,7,8,8,-1])
+        self.assertEqual(heights, [0,0,0,0,0,1,1,2,3])
+
+    def test_sparse_sum_descendants(self):
+        """sparse_sum_descendants should match sum_descendants"""
+        parents, heights = index_parents(self.t)
+        counts = index_envs_sparse(self.env_counts, self.node_index)[0]
+        exp = self.count_array.copy()
+        sum_descendants(bind_to_array(self.nodes, exp))
+        self.assertEqual(sparse_sum_descendants(counts, parents, 
+            heights).toarray(), exp)
+        exp = self.count_array.copy()
+        bool_descendants(bind_to_array(self.nodes, exp))
+        self.assertEqual(sparse_bool_descendants(counts, parents, 
+            heights).toarray(), exp.astype(bool))
+
     def test_fitch_descendants(self):
         """fitch_descendants should assign states by fitch parsimony, ret. #"""
         id_, child = index_tree(self.t3)
@@ -348,6 +404,28 @@ f   D"""
         #check that the two versions fill the array with the same values
         self.assertEqual(orig_result, new_result)
 
+    def test_fitch_descendants_batch(self):
+        """FitchCounterBatch should count changes for each batch member"""
+        t_str = '(((a:1,b:2):4,(c:3,d:1):2):1,(e:2,f:1):3);'
+        t = DndParser(t_str, UniFracTreeNode)
+        node_index, nodes = index_tree(t)
+        count_array = randint(0, 2, (len(node_index), 5, 3)).astype(bool)
+        tip_indices = [n._leaf_index for n in t.tips()]
+        internal = [i for i in range(len(node_index)) if i not in tip_indices]
+        count_array[internal] = False
+        count_array[tip_indices[0], 0] = False  #a tip with no envs
+        exp_states, exp_changes = [], []
+        for k in range(5):
+            single = count_array[:,k].astype(int)
+            exp_changes.append(fitch_descendants(bind_to_array(nodes, 
+                single), counter=FitchCounter))
+            exp_states.append(single.astype(bool))
+        changes = fitch_descendants(bind_to_array(nodes, count_array),
+            counter=FitchCounterBatch)
+        self.assertEqual(changes, exp_changes)
+        for k in range(5):
+            self.assertEqual(count_array[:,k], exp_states[k])
+
     def test_tip_distances(self):
         """tip_distances should set tips to correct distances."""
         t = self.t
@@ -370,6 +448,43 @@ f   D"""
         #make sure we didn't change orig
         self.assertEqual(orig, reshape(arange(8), (4,2)))
 
+    def test_permutation_indices(self):
+        """permutation_indices should return one permutation per row"""
+        fake_permutation = lambda a: range(a)[::-1]
+        self.assertEqual(permutation_indices(3, 2, fake_permutation), 
+            [[2,1,0],[2,1,0]])
+        result = permutation_indices(6, 4, random_state=RandomState(1))
+        self.assertEqual(result.shape, (4, 6))
+        for row in result:
+            self.assertEqual(sorted(row), range(6))
+        #draws don't depend on how the permutations are split up
+        whole = permutation_indices(6, 4, random_state=RandomState(1))
+        r = RandomState(1)
+        split = [permutation_indices(6, 1, random_state=r), 
+            permutation_indices(6, 3, random_state=r)]
+        self.assertEqual(whole, concatenate(split))
+
+    def test_permute_selected_rows_batch(self):
+        """permute_selected_rows_batch should match permute_selected_rows"""
+        orig = reshape(arange(10),(5,2))
+        permutations = permutation_indices(3, 4)
+        result = permute_selected_rows_batch([0,2,3], orig, permutations)
+        self.assertEqual(result.shape, (5,4,2))
+        for k, p in enumerate(permutations):
+            new = zeros((5,2), int)
+            permute_selected_rows([0,2,3], orig, new, lambda n: p)
+            self.assertEqual(result[:,k], new)
+
+    def test_env_unique_fraction_batch(self):
+        """env_unique_fraction_batch should match env_unique_fraction"""
+        bl = self.branch_lengths
+        batch = randint(0, 2, (len(bl), 4, 3))
+        sums, fracs = env_unique_fraction_batch(bl, batch)
+        for k in range(4):
+            exp_sums, exp_fracs = env_unique_fraction(bl, batch[:,k])
+            self.assertFloatEqual(sums[k], exp_sums)
+            self.assertFloatEqual(fracs[k], exp_fracs)
+
     def test_prep_items_for_jackknife(self):
         """prep_items_for_jackknife should expand indices of repeated counts"""
         a = array([0,1,0,1,2,0,3])
@@ -625,6 +740,162 @@ f   D"""
             abs(2./3-3./7)*4,
             abs(1./3-4./7)*3]))
 
+    def test_pack_presence(self):
+        """pack_presence and unpack_presence should round-trip blocks"""
+        m = randint(0, 3, (7, 21))
+        packed = pack_presence(m)
+        self.assertEqual(packed.shape, (7, 3))
+        self.assertEqual(unpack_presence(packed, 0, 21), m.astype(bool))
+        self.assertEqual(unpack_presence(packed, 8, 19), m[:,8:19] > 0)
+
+    def test_batch_unifrac_matrix(self):
+        """batch_unifrac_matrix should match unifrac_matrix"""
+        m = array([[1,0,1],[1,1,0],[0,1,0],[0,0,1],[0,1,0],[0,1,1],[1,1,1],\
+            [0,1,1],[1,1,1]])
+        bl = self.branch_lengths
+        self.assertFloatEqual(batch_unifrac_matrix(bl, m), 
+            unifrac_matrix(bl, m))
+        for metric in [unifrac, unnormalized_unifrac, G, unnormalized_G]:
+            self.assertFloatEqual(batch_unifrac_matrix(bl, m, metric=metric,
+                is_symmetric=False), unifrac_matrix(bl, m, metric=metric, 
+                is_symmetric=False))
+        #blocks that do not divide the number of envs evenly
+        bl = random(40)
+        m = randint(0, 2, (40, 30))
+        m[0] = 1
+        exp = unifrac_matrix(bl, m)
+        for block_size in [1, 8, 13, 64]:
+            self.assertFloatEqual(batch_unifrac_matrix(bl, m, 
+                block_size=block_size), exp)
+        exp = unifrac_matrix(bl, m, metric=G, is_symmetric=False)
+        self.assertFloatEqual(batch_unifrac_matrix(bl, m, metric=G, 
+            is_symmetric=False, block_size=8), exp)
+        #no batched form for arbitrary metrics
+        self.assertRaises(ValueError, batch_unifrac_matrix, bl, m, 
+            lambda bl, i, j: 0)
+
+    def test_batch_weighted_unifrac_matrix(self):
+        """batch_weighted_unifrac_matrix should match weighted_unifrac_matrix"""
+        envs = self.count_array
+        bound_indices = bind_to_array(self.nodes, envs)
+        sum_descendants(bound_indices)
+        bl = self.branch_lengths
+        tip_indices = [n._leaf_index for n in self.t.tips()]
+        self.assertFloatEqual(batch_weighted_unifrac_matrix(bl, envs, 
+            tip_indices), weighted_unifrac_matrix(bl, envs, tip_indices))
+        td = bl.copy()[:,newaxis]
+        tip_bindings = bind_to_parent_array(self.t, td)
+        tip_distances(td, tip_bindings, tip_indices)
+        exp = weighted_unifrac_matrix(bl, envs, tip_indices, bl_correct=True,
+            tip_distances=td)
+        for block_size in [1, 2, None]:
+            self.assertFloatEqual(batch_weighted_unifrac_matrix(bl, envs, 
+                tip_indices, bl_correct=True, tip_distances=td, 
+                block_size=block_size), exp)
+        #larger random count table
+        bl = random(50)
+        m = randint(0, 5, (50, 20))
+        tip_indices = range(50)
+        self.assertFloatEqual(batch_weighted_unifrac_matrix(bl, m, 
+            tip_indices, block_size=8), 
+            weighted_unifrac_matrix(bl, m, tip_indices))
+
+
+    def test_batch_sparse(self):
+        """batch matrices and sparse vectors should accept SparseCounts"""
+        parents, heights = index_parents(self.t)
+        counts = index_envs_sparse(self.env_counts, self.node_index)[0]
+        bl = self.branch_lengths
+        tip_indices = [n._leaf_index for n in self.t.tips()]
+        td = bl.copy()[:,newaxis]
+        tip_distances(td, bind_to_parent_array(self.t, td), tip_indices)
+        presence = sparse_bool_descendants(counts, parents, heights)
+        dense = presence.toarray()
+        for metric in [unifrac, G]:
+            self.assertFloatEqual(batch_unifrac_matrix(bl, presence, 
+                metric=metric, is_symmetric=False, block_size=1),
+                unifrac_matrix(bl, dense, metric=metric, is_symmetric=False))
+        self.assertFloatEqual(sparse_unifrac_vector(bl, presence),
+            unifrac_vector(bl, dense))
+        totals = sparse_sum_descendants(counts, parents, heights)
+        dense = totals.toarray()
+        for bl_correct in [False, True]:
+            self.assertFloatEqual(batch_weighted_unifrac_matrix(bl, totals, 
+                tip_indices, bl_correct=bl_correct, tip_distances=td), 
+                weighted_unifrac_matrix(bl, dense, tip_indices, 
+                bl_correct=bl_correct, tip_distances=td))
+            self.assertFloatEqual(sparse_weighted_unifrac_vector(bl, totals,
+                tip_indices, bl_correct=bl_correct, tip_distances=td),
+                weighted_unifrac_vector(bl, dense, tip_indices, 
+                bl_correct=bl_correct, tip_distances=td))
+
+
+    def test_striped_unifrac_matrix(self):
+        """striped_unifrac_matrix should write batch results to disk"""
+        bl = random(40)
+        m = randint(0, 2, (40, 30))
+        m[0] = 1
+        filename = get_tmp_filename(prefix='test_striped', suffix='.npy',
+            result_constructor=str)
+        progress_filename = filename + '.stripes'
+        try:
+            result = striped_unifrac_matrix(bl, m, filename, block_size=8)
+            self.assertFloatEqual(result, unifrac_matrix(bl, m))
+            #4 blocks give 4 stripes
+            self.assertEqual(open(progress_filename).read().split('\n')[1:],
+                ['0', '1', '2', '3', ''])
+            result = striped_unifrac_matrix(bl, m, filename, metric=G,
+                is_symmetric=False, block_size=8, resume=False)
+            self.assertFloatEqual(result, unifrac_matrix(bl, m, metric=G,
+                is_symmetric=False))
+            #resuming only computes stripes not yet recorded
+            exp = result.copy()
+            on_disk = load(filename, mmap_mode='r+')
+            on_disk[:] = -1
+            on_disk.flush()
+            del on_disk
+            lines = open(progress_filename).read().splitlines()
+            open(progress_filename, 'w').write('\n'.join(lines[:3])+'\n')
+            result = striped_unifrac_matrix(bl, m, filename, metric=G,
+                is_symmetric=False, block_size=8, resume=True)
+            self.assertEqual(result[:8,:16], -ones((8,16)))
+            self.assertFloatEqual(result[:8,16:], exp[:8,16:])
+            self.assertFloatEqual(result[24:,:8], exp[24:,:8])
+            #can't resume with a different block layout
+            self.assertRaises(ValueError, striped_unifrac_matrix, bl, m, 
+                filename, metric=G, is_symmetric=False, block_size=16,
+                resume=True)
+            #or a different metric or data
+            self.assertRaises(ValueError, striped_unifrac_matrix, bl, m, 
+                filename, metric=unnormalized_G, is_symmetric=False, 
+                block_size=8, resume=True)
+            self.assertRaises(ValueError, striped_unifrac_matrix, bl*2, m, 
+                filename, metric=G, is_symmetric=False, block_size=8,
+                resume=True)
+            #by default an existing stripe file is overwritten, not resumed
+            result = striped_unifrac_matrix(bl, m, filename, metric=G,
+                is_symmetric=False, block_size=8)
+            self.assertFloatEqual(result, exp)
+        finally:
+            remove_files([filename, progress_filename], 
+                error_on_missing=False)
+
+    def test_striped_weighted_unifrac_matrix(self):
+        """striped_weighted_unifrac_matrix should match batch results"""
+        bl = random(50)
+        m = randint(0, 5, (50, 20))
+        tip_indices = range(50)
+        filename = get_tmp_filename(prefix='test_striped', suffix='.npy',
+            result_constructor=str)
+        try:
+            result = striped_weighted_unifrac_matrix(bl, m, tip_indices, 
+                filename, block_size=8)
+            self.assertFloatEqual(result, 
+                weighted_unifrac_matrix(bl, m, tip_indices))
+        finally:
+            remove_files([filename, filename + '.stripes'], 
+                error_on_missing=False)
+
 
 if __name__ == '__main__':    #run if called from command-line
     main()
@@ -2,11 +2,12 @@
 """Unit tests for fast unifrac."""
 from __future__ import division
 
-from numpy import array, logical_not, argsort
+from numpy import array, logical_not, argsort, load
 from cogent.util.unit_test import TestCase, main
 from cogent.parse.tree import DndParser
 from cogent.maths.unifrac.fast_tree import (count_envs, index_tree, index_envs,
-    get_branch_lengths)
+    get_branch_lengths, bind_to_array, bool_descendants, fitch_descendants,
+    permute_selected_rows, unifrac, unnormalized_unifrac, permutation_indices)
 from cogent.maths.unifrac.fast_unifrac import (reshape_by_name,
     meta_unifrac, shuffle_tipnames, weight_equally, weight_by_num_tips, 
     weight_by_branch_length, weight_by_num_seqs, get_all_env_names,
@@ -15,8 +16,11 @@ from cogent.maths.unifrac.fast_unifrac import (reshape_by_name,
     UniFracTreeNode, mcarlo_sig, num_comps, fast_unifrac, 
     fast_unifrac_whole_tree, PD_whole_tree, PD_generic_whole_tree,
     TEST_ON_TREE, TEST_ON_ENVS, TEST_ON_PAIRWISE, shared_branch_length,
-    shared_branch_length_to_root, fast_unifrac_one_sample)
+    shared_branch_length_to_root, fast_unifrac_one_sample, 
+    fast_unifrac_permutations, fast_p_test, mcarlo_sig_interval, identity)
 from numpy.random import permutation 
+from cogent.app.util import get_tmp_filename
+from cogent.util.misc import remove_files
 
 __author__ = "Rob Knight and Micah Hamady"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -152,6 +156,62 @@ f B 1
         self.assertRaises(ValueError,  fast_unifrac, self.t, \
             self.wrong_tip_counts)
             
+    def test_fast_unifrac_sparse(self):
+        """fast_unifrac should give the same results with sparse counts"""
+        modes = ['distance_matrix', 'distance_vector']
+        for tree, envs in zip(self.trees + [self.old_t], 
+                self.envs + [self.old_env_counts]):
+            for weighted in [False, True, 'correct']:
+                dense = fast_unifrac(tree, envs, weighted=weighted, 
+                    modes=modes, sparse=False)
+                sparse = fast_unifrac(tree, envs, weighted=weighted, 
+                    modes=modes, sparse=True)
+                for mode in modes:
+                    self.assertFloatEqual(sparse[mode][0], dense[mode][0])
+                    self.assertEqual(sparse[mode][1], dense[mode][1])
+        #sparse storage is only supported for the batched metrics
+        self.assertRaises(ValueError, fast_unifrac, self.t, self.env_counts,
+            metric=lambda bl, i, j: 0, sparse=True)
+        self.assertRaises(ValueError, fast_unifrac, self.t, self.env_counts,
+            weighted=True, weighted_unifrac_f=lambda *args: 0, sparse=True)
+
+    def test_fast_unifrac_striped(self):
+        """fast_unifrac should write the matrix to disk in striped mode"""
+        filename = get_tmp_filename(prefix='test_fast_unifrac', 
+            suffix='.npy', result_constructor=str)
+        try:
+            for weighted in [False, True]:
+                exp = fast_unifrac(self.t, self.env_counts, 
+                    weighted=weighted)
+                obs = fast_unifrac(self.t, self.env_counts, 
+                    weighted=weighted, stripe_filename=filename, 
+                    block_size=1)
+                self.assertFloatEqual(obs['distance_matrix'][0], 
+                    exp['distance_matrix'][0])
+                self.assertEqual(obs['distance_matrix'][1], 
+                    exp['distance_matrix'][1])
+                self.assertFloatEqual(load(filename), 
+                    exp['distance_matrix'][0])
+                remove_files([filename, filename + '.stripes'])
+            #a different metric overwrites the file unless resuming
+            fast_unifrac(self.t, self.env_counts, stripe_filename=filename)
+            exp = fast_unifrac(self.t, self.env_counts, 
+                metric=unnormalized_unifrac)
+            obs = fast_unifrac(self.t, self.env_counts, 
+                metric=unnormalized_unifrac, stripe_filename=filename)
+            self.assertFloatEqual(obs['distance_matrix'][0], 
+                exp['distance_matrix'][0])
+            self.assertRaises(ValueError, fast_unifrac, self.t, 
+                self.env_counts, stripe_filename=filename, resume=True)
+            obs = fast_unifrac(self.t, self.env_counts, 
+                metric=unnormalized_unifrac, stripe_filename=filename, 
+                resume=True)
+            self.assertFloatEqual(obs['distance_matrix'][0], 
+                exp['distance_matrix'][0])
+        finally:
+            remove_files([filename, filename + '.stripes'], 
+                error_on_missing=False)
+
     def test_fast_unifrac_one_sample(self):
         """ fu one sample should match whole unifrac result, for env 'B'"""
         # first get full unifrac matrix
@@ -215,6 +275,70 @@ f B 1
             result.append(rawp)
         self.assertSimilarMeans(result, 0.047)
 
+    def test_fast_unifrac_permutations(self):
+        """fast_unifrac_permutations should match one permutation at a time"""
+        real = fast_unifrac(self.t, self.env_counts, 
+            modes=['distance_matrix'])['distance_matrix'][0]
+        self.assertFloatEqual(fast_unifrac_permutations(self.t, 
+            self.env_counts, False, 3, 'A', 'C', permutation_f=identity), 
+            [real[0,2]]*3)
+        real = fast_unifrac(self.t, self.env_counts, weighted='correct',
+            modes=['distance_matrix'])['distance_matrix'][0]
+        self.assertFloatEqual(fast_unifrac_permutations(self.t, 
+            self.env_counts, 'correct', 2, 'A', 'B', permutation_f=identity,
+            batch_size=1), [real[0,1]]*2)
+        #compare against permuting the count array directly
+        permutations = permutation_indices(5, 7)
+        perms = iter(permutations)
+        obs = fast_unifrac_permutations(self.t, self.env_counts, False, 7, 
+            'B', 'C', permutation_f=lambda n: perms.next(), batch_size=3)
+        node_index, nodes = index_tree(self.t)
+        count_array = index_envs(self.env_counts, node_index)[0][:,1:]
+        bl = get_branch_lengths(node_index)
+        tip_indices = [n._leaf_index for n in self.t.tips()]
+        for p, o in zip(permutations, obs):
+            new = count_array.copy()
+            permute_selected_rows(tip_indices, count_array, new, lambda n: p)
+            bool_descendants(bind_to_array(nodes, new))
+            self.assertFloatEqual(o, unifrac(bl, new[:,0], new[:,1]))
+        #seeded runs are repeatable whatever the batch size
+        first = fast_unifrac_permutations(self.t, self.env_counts, True, 
+            50, 'A', 'C', seed=3)
+        second = fast_unifrac_permutations(self.t, self.env_counts, True, 
+            50, 'A', 'C', seed=3, batch_size=7)
+        self.assertEqual(len(first), 50)
+        self.assertFloatEqual(first, second)
+
+    def test_fast_unifrac_permutations_early_stop(self):
+        """fast_unifrac_permutations should stop once the pval is clear"""
+        #no permutation can exceed a distance of 2
+        obs = fast_unifrac_permutations(self.t, self.env_counts, False, 
+            5000, 'A', 'C', batch_size=100, seed=1, real_value=2, 
+            alpha=0.05)
+        self.assertTrue(len(obs) < 5000)
+        self.assertEqual(len(obs) % 100, 0)
+        obs = fast_unifrac_permutations(self.t, self.env_counts, False, 
+            500, 'A', 'C', seed=1)
+        self.assertEqual(len(obs), 500)
+
+    def test_fast_p_test(self):
+        """fast_p_test should count parsimony changes for each permutation"""
+        node_index, nodes = index_tree(self.t)
+        count_array = index_envs(self.env_counts, node_index)[0]
+        exp = fitch_descendants(bind_to_array(nodes, count_array))
+        self.assertEqual(fast_p_test(self.t, self.env_counts, 4, 
+            permutation_f=identity), [exp]*4)
+        count_array = index_envs(self.env_counts, node_index)[0][:,:2]
+        exp = fitch_descendants(bind_to_array(nodes, count_array))
+        self.assertEqual(fast_p_test(self.t, self.env_counts, 2, 'A', 'B',
+            permutation_f=identity, batch_size=1), [exp]*2)
+        first = fast_p_test(self.t, self.env_counts, 30, seed=5)
+        second = fast_p_test(self.t, self.env_counts, 30, seed=5, 
+            batch_size=4)
+        self.assertEqual(first, second)
+        self.assertRaises(ValueError, fast_p_test, self.t, self.env_counts,
+            5, 'A')
+
     def test_unifrac_explicit(self):
         """unifrac should correctly compute correct values.
         
@@ -371,6 +495,19 @@ f B 1
         self.assertEqual(mcarlo_sig(0, self.mc_1, 1, 'low'), (0.0, "<=%.1e" % (1.0/10)))
         self.assertEqual(mcarlo_sig(100, self.mc_1, 10, 'high'), (0.0, "<=%.1e" % (1.0/10)))
 
+
+    def test_mcarlo_sig_interval(self):
+        """mcarlo_sig_interval should give exact binomial bounds on pval"""
+        lower, upper = mcarlo_sig_interval(.5, self.mc_1, 'high')
+        self.assertTrue(lower < 0.5 < upper)
+        self.assertFloatEqual((lower, upper), (0.187086, 0.812914), eps=1e-5)
+        lower, upper = mcarlo_sig_interval(100, [0]*100, 'high')
+        self.assertEqual(lower, 0)
+        self.assertFloatEqual(upper, 1-0.025**(1/100))
+        lower, upper = mcarlo_sig_interval(100, [0]*100, 'low', 0.99)
+        self.assertFloatEqual(lower, 0.005**(1/100))
+        self.assertEqual(upper, 1)
+        self.assertRaises(ValueError, mcarlo_sig_interval, 1, [0], 'x')
     
     def test_num_comps(self):
         """ test num comps """
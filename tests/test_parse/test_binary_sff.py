@@ -5,6 +5,8 @@ import os
 import tempfile
 from unittest import TestCase, main
 
+import numpy
+
 from cogent.parse.binary_sff import (
     seek_pad, parse_common_header, parse_read_header, parse_read_data,
     validate_common_header, parse_read, parse_binary_sff, UnsupportedSffError,
@@ -12,6 +14,7 @@ from cogent.parse.binary_sff import (
     write_read, write_binary_sff, format_common_header, format_read_header,
     format_read_data, format_binary_sff, base36_encode, base36_decode,
     decode_location, decode_timestamp, decode_accession, decode_sff_filename,
+    parse_roche_index, SffFile,
     )
 
 __author__ = "Kyle Bittinger"
@@ -194,6 +197,79 @@ class ParsingFunctionTests(TestCase):
         self.assertEqual(counter, 20)
 
 
+class SffFileTests(TestCase):
+    def setUp(self):
+        self.sff = SffFile(SFF_FP, native_flowgram_values=True)
+
+    def tearDown(self):
+        self.sff.close()
+
+    def test_parse_roche_index(self):
+        data = open(SFF_FP, 'rb').read()
+        names, offsets = parse_roche_index(data, 33464, 900)
+        self.assertEqual(len(names), 20)
+        self.assertEqual(names, sorted(names))
+        i = names.index(READ_HEADER['Name'])
+        self.assertEqual(offsets[i], 440)
+
+    def test_getitem(self):
+        self.assertEqual(len(self.sff), 20)
+        self.assertTrue(READ_HEADER['Name'] in self.sff)
+        self.assertFalse('GA202I001ER3QLX' in self.sff)
+        self.assertRaises(KeyError, self.sff.__getitem__, 'x')
+        read = self.sff[READ_HEADER['Name']]
+        for key, value in READ_HEADER.items() + READ_DATA.items():
+            if key in ('Name', 'Bases'):
+                self.assertEqual(read[key], value)
+            else:
+                self.assertEqual(list(numpy.ravel(read[key])),
+                    list(numpy.ravel(value)))
+
+    def test_matches_sequential_parser(self):
+        header, reads = parse_binary_sff(open(SFF_FP), True)
+        reads = list(reads)
+        self.assertEqual([r['Name'] for r in self.sff],
+            [r['Name'] for r in reads])
+        for read in reads:
+            observed = self.sff[read['Name']]
+            self.assertEqual(list(observed['flowgram_values']),
+                list(read['flowgram_values']))
+            self.assertEqual(list(observed['quality_scores']),
+                list(read['quality_scores']))
+
+    def test_flowgram_values(self):
+        sff = SffFile(SFF_FP)
+        read = sff[READ_HEADER['Name']]
+        self.assertEqual(list(read['flowgram_values'][:3]),
+            [x * 0.01 for x in READ_DATA['flowgram_values'][:3]])
+        sff.close()
+
+    def test_iterBatches(self):
+        batches = list(self.sff.iterBatches(batch_size=8))
+        self.assertEqual([len(b) for b in batches], [8, 8, 4])
+        names = self.sff.Names[:5]
+        batches = list(self.sff.iterBatches(names=names[::-1], batch_size=3))
+        self.assertEqual(sorted(r['Name'] for b in batches for r in b),
+            names)
+        offsets = [self.sff._offsetOf(r['Name']) for r in batches[0]]
+        self.assertEqual(offsets, sorted(offsets))
+
+    def test_without_index(self):
+        read = READ_HEADER.copy()
+        read.update(READ_DATA)
+        header = COMMON_HEADER.copy()
+        header.update(number_of_reads=2, index_offset=0, index_length=0)
+        other = read.copy()
+        other['Name'] = 'GA202I001AAAAA'
+        output_file = tempfile.NamedTemporaryFile()
+        write_binary_sff(output_file, header, [read, other])
+        output_file.flush()
+        sff = SffFile(output_file.name)
+        self.assertEqual(sff.Names, ['GA202I001AAAAA', READ_HEADER['Name']])
+        self.assertEqual(sff['GA202I001AAAAA']['Bases'], READ_DATA['Bases'])
+        sff.close()
+
+
 class FormattingFunctionTests(TestCase):
     def setUp(self):
         self.output_file = tempfile.TemporaryFile()
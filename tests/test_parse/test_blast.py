@@ -8,7 +8,10 @@ from cogent.parse.blast import iter_finder, query_finder, iteration_set_finder,\
     TableToValues, \
     PsiBlastTableParser, PsiBlastFinder, GenericBlastParser9, \
     PsiBlastParser9, LastProteinIds9, QMEBlast9, QMEPsiBlast9, \
-    fastacmd_taxonomy_splitter, FastacmdTaxonomyParser
+    fastacmd_taxonomy_splitter, FastacmdTaxonomyParser, BlastTableChunks, \
+    BlastTableParser, best_hits, filter_hits, BlastResult
+from cogent.parse.record import RecordError
+from StringIO import StringIO
 
 __author__ = "Micah Hamady"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -281,5 +284,85 @@ Scientific name: cf. Acremonium sp. KR21-2
 
         
                             
+class BlastTableTests(TestCase):
+    """Tests of the streaming tabular reader"""
+
+    def setUp(self):
+        """Define -m 9 output for three queries"""
+        self.lines = """# BLASTN 2.2.16 [Mar-25-2007]
+# Query: a
+# Database: db
+# Fields: Query id, Subject id, % identity, alignment length, mismatches, gap openings, q. start, q. end, s. start, s. end, e-value, bit score
+a\ta\t100.00\t50\t0\t0\t1\t50\t1\t50\t1e-20\t 99.0
+a\tx\t90.00\t50\t5\t0\t1\t50\t11\t60\t2e-10\t 60.5
+a\ty\t95.00\t40\t2\t0\t1\t40\t5\t44\t1e-15\t 70.2
+# BLASTN 2.2.16 [Mar-25-2007]
+# Query: b
+# Database: db
+# BLASTN 2.2.16 [Mar-25-2007]
+# Query: long_query_name
+# Database: db
+long_query_name\tz\t80.00\t30\t6\t1\t1\t30\t1\t29\t0.5\t20.1
+long_query_name\tx\t85.00\t30\t4\t1\t1\t30\t1\t29\t0.001\t30.1
+""".splitlines(True)
+
+    def test_chunks(self):
+        """BlastTableChunks should give typed arrays of whole queries"""
+        chunks = list(BlastTableChunks(self.lines))
+        self.assertEqual(len(chunks), 1)
+        hits = chunks[0]
+        self.assertEqual(list(hits['query']), ['a']*3 + ['long_query_name']*2)
+        self.assertEqual(list(hits['subject']), ['a', 'x', 'y', 'z', 'x'])
+        self.assertFloatEqual(hits['bitscore'], [99, 60.5, 70.2, 20.1, 30.1])
+        self.assertFloatEqual(hits['evalue'], [1e-20,2e-10,1e-15,0.5,0.001])
+        self.assertEqual(list(hits['sstart']), [1, 11, 5, 1, 1])
+        #small chunks never split a query, from files or lines
+        for lines in [self.lines, StringIO(''.join(self.lines))]:
+            chunks = list(BlastTableChunks(lines, chunk_size=10))
+            self.assertEqual([list(c['query']) for c in chunks], 
+                [['a']*3, ['long_query_name']*2])
+            self.assertEqual(chunks[0].tolist(), hits[:3].tolist())
+
+    def test_parser(self):
+        """BlastTableParser should give hits by query"""
+        result = list(BlastTableParser(StringIO(''.join(self.lines)), 
+            chunk_size=100))
+        self.assertEqual([q for q, hits in result], ['a', 'long_query_name'])
+        self.assertEqual(list(result[1][1]['subject']), ['z', 'x'])
+        self.assertRaises(RecordError, list, 
+            BlastTableParser(['a\tb\t1.0\n']))
+
+    def test_best_hits(self):
+        """best_hits should pick the best hits for each query"""
+        hits = list(BlastTableChunks(self.lines))[0]
+        best = best_hits(hits)
+        self.assertEqual(list(best['subject']), ['y', 'x'])
+        best = best_hits(hits, n=2, return_self=True)
+        self.assertEqual(list(best['subject']), ['a', 'y', 'x', 'z'])
+        best = best_hits(hits, n=5, field='evalue')
+        self.assertEqual(list(best['subject']), ['y', 'x', 'x', 'z'])
+        self.assertRaises(ValueError, best_hits, hits, field='xyz')
+        self.assertEqual(len(best_hits(hits[:1])), 0)
+
+    def test_result_without_hits(self):
+        """BlastResult should key queries without hits by their name"""
+        fields = '# Fields: Query id, Subject id, % identity, alignment ' \
+            'length, mismatches, gap openings, q. start, q. end, s. start, ' \
+            's. end, e-value, bit score\n'
+        lines = [line for line in self.lines if not line.startswith('# F')]
+        lines = ''.join([line + fields * line.startswith('# Database')
+            for line in lines])
+        result = BlastResult(lines.splitlines())
+        self.assertEqualItems(result.keys(), ['a', 'b', 'long_query_name'])
+        self.assertEqual(result['b'][0][0]['SUBJECT ID'], '')
+        self.assertEqual(len(result['a'][0]), 3)
+
+    def test_filter_hits(self):
+        """filter_hits should keep hits better than threshold"""
+        hits = list(BlastTableChunks(self.lines))[0]
+        self.assertEqual(list(filter_hits(hits)['subject']), ['a', 'x', 'y'])
+        self.assertEqual(list(filter_hits(hits, 'pident', 90)['subject']),
+            ['a', 'y'])
+
 if __name__ == "__main__":
     main()
@@ -17,7 +17,10 @@ __status__ = "Prototype"
 from cogent.util.unit_test import main, TestCase
 from cogent.parse.blast_xml import BlastXMLResult, MinimalBlastParser7,\
      get_tag, parse_hsp, parse_hit, parse_header, parse_parameters,\
-     HSP_XML_FIELDNAMES, HIT_XML_FIELDNAMES
+     HSP_XML_FIELDNAMES, HIT_XML_FIELDNAMES, IterativeBlastParser7, \
+     BlastXmlIterations, BlastXmlTableParser
+from cogent.parse.blast import best_hits
+from StringIO import StringIO
 
 import xml.dom.minidom
 
@@ -190,6 +193,59 @@ class BlastXmlResultTests(TestCase):
             self.assertEqual(gap_hsp['GAP_OPENINGS'],'33')
 
 
+class IterativeBlastParser7Tests(TestCase):
+    """Tests of incremental parsing of XML output."""
+    def test_same_as_minimal(self):
+        """IterativeBlastParser7 should give the records of the DOM parser"""
+        [(props, hits)] = list(MinimalBlastParser7(COMPLETE_XML, True))
+        for data in [COMPLETE_XML, StringIO(COMPLETE_XML), 
+            COMPLETE_XML.splitlines(True)]:
+            [(iter_props, iter_hits)] = list(IterativeBlastParser7(data, True))
+            self.assertEqual(iter_hits, hits)
+            self.assertEqual(iter_props['QUERY'], 1)
+            for key in props:
+                self.assertEqual(iter_props[key], props[key])
+
+    def test_queries(self):
+        """IterativeBlastParser7 should give a record per query"""
+        records = list(IterativeBlastParser7(MULTI_QUERY_XML))
+        self.assertEqual([p['QUERY'] for p, h in records], 
+            ['q1', 'q2', 'q3'])
+        self.assertEqual([p['ITERATION'] for p, h in records], [1, 2, 3])
+        self.assertEqual([len(h) for p, h in records], [1, 0, 2])
+        self.assertEqual(records[2][1][0][0], 'q3')
+        result = BlastXMLResult(MULTI_QUERY_XML, xml=True)
+        self.assertEqualItems(result.keys(), ['q1', 'q2', 'q3'])
+        self.assertEqual(result['q2'][0][0]['QUERY ID'], '')
+        self.assertEqual(len(result['q3'][0]), 2)
+
+    def test_clears_iterations(self):
+        """BlastXmlIterations should drop each iteration once read"""
+        seen = []
+        for header, query_id, iteration in BlastXmlIterations(MULTI_QUERY_XML):
+            seen.append(iteration)
+            self.assertEqual(header['application'], 'my Grandma')
+        self.assertEqual(len(seen), 3)
+        for iteration in seen:
+            self.assertEqual(len(iteration), 0)
+
+    def test_table(self):
+        """BlastXmlTableParser should give typed hits per query"""
+        result = list(BlastXmlTableParser(MULTI_QUERY_XML))
+        self.assertEqual([q for q, hits in result], ['q1', 'q3'])
+        hits = result[1][1]
+        self.assertEqual(list(hits['query']), ['q3', 'q3'])
+        self.assertEqual(list(hits['subject']), 
+            ['gi|148670104|gb|EDL02051.1|'] * 2)
+        self.assertFloatEqual(hits['pident'], [100 * 55 / 14., 100 * 55 / 18.])
+        self.assertEqual(list(hits['mismatches']), [14-55-33, 18-55])
+        #runs of gaps in both sequences
+        self.assertEqual(list(hits['gapopen']), [2, 4])
+        self.assertEqual(list(hits['qstart']), [4, 6])
+        self.assertEqual(list(hits['send']), [19, 23])
+        self.assertFloatEqual(hits['evalue'], [0.333, 0.333])
+        self.assertFloatEqual(hits['bitscore'], [1023.46, 1023.46])
+        self.assertEqual(len(best_hits(hits)), 1)
                 
 HSP_XML = """
         <Hsp>
@@ -294,6 +350,18 @@ COMPLETE_XML = """<?xml version="1.0"?>
 <!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">
 """+HEADER_COMPLETE
 
+ITERATION_XML = """
+    <Iteration>
+      <Iteration_iter-num>%s</Iteration_iter-num>
+      <Iteration_query-ID>Query_%s</Iteration_query-ID>
+      <Iteration_query-def>q%s</Iteration_query-def>
+      <Iteration_hits>%s</Iteration_hits>
+    </Iteration>
+"""
+MULTI_QUERY_XML = """<?xml version="1.0"?>
+"""+HEADER_XML%(PARAM_XML+"<BlastOutput_iterations>"+\
+    ITERATION_XML%(1, 1, 1, HIT_WITH_ONE_HSP)+ITERATION_XML%(2, 2, 2, '')+\
+    ITERATION_XML%(3, 3, 3, HIT_WITH_TWO_HSPS)+"</BlastOutput_iterations>")
 
 if __name__ == '__main__':
     main()
@@ -2,7 +2,14 @@
 """Unit tests for FASTA and related parsers.
 """
 from cogent.parse.fasta import FastaParser, MinimalFastaParser, \
-    NcbiFastaLabelParser, NcbiFastaParser, RichLabel, LabelParser, GroupFastaParser
+    NcbiFastaLabelParser, NcbiFastaParser, RichLabel, LabelParser, GroupFastaParser,\
+    IndexedFasta, BgzfReader, is_bgzf
+from cogent import DNA
+from tempfile import mkdtemp
+from shutil import rmtree
+from struct import pack
+import os
+import zlib
 from cogent.core.sequence import DnaSequence, Sequence, ProteinSequence as Protein
 from cogent.core.info import Info
 from cogent.parse.record import RecordError
@@ -406,5 +413,108 @@ class GroupFastaParsingTest(TestCase):
         
     
 
+def bgzf_compress(data, block_size):
+    """Returns data as BGZF blocks of block_size uncompressed bytes."""
+    blocks = []
+    for i in range(0, len(data), block_size) + [len(data)]:
+        chunk = data[i:i+block_size]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed = compressor.compress(chunk) + compressor.flush()
+        total = 18 + len(compressed) + 8
+        blocks.append('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' + 
+            pack('<H', 6) + 'BC' + pack('<HH', 2, total - 1) + compressed + 
+            pack('<II', zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+    return ''.join(blocks)
+
+class IndexedFastaTests(TestCase):
+    """Tests of random access to FASTA files."""
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.seqs = [('s1', 'ACGTACGTTTGCA'), ('s2', 'GGGGCCC'), ('s3', ''), 
+            ('s4', 'TTTTTTTTTTTTTTTTTTTTTAAAA')]
+        lines = []
+        for name, seq in self.seqs:
+            lines.append('>%s some description' % name)
+            lines.extend([seq[i:i+7] for i in range(0, len(seq), 7)])
+        self.text = '\n'.join(lines) + '\n'
+        self.filename = self.write('seqs.fasta', self.text)
+        #as from samtools faidx
+        self.fai = ('s1\t13\t21\t7\t8\n'
+            's2\t7\t57\t7\t8\n'
+            's3\t0\t86\t0\t0\n'
+            's4\t25\t107\t7\t8\n')
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def write(self, name, data):
+        filename = os.path.join(self.dirname, name)
+        outfile = open(filename, 'wb')
+        outfile.write(data)
+        outfile.close()
+        return filename
+
+    def check(self, fasta):
+        self.assertEqual(fasta.Names, ['s1', 's2', 's3', 's4'])
+        self.assertEqual(len(fasta), 4)
+        for name, seq in self.seqs:
+            self.assertEqual(str(fasta[name]), seq)
+            self.assertEqual(fasta.getLength(name), len(seq))
+            for start in range(len(seq) + 1):
+                for end in range(start, len(seq) + 2):
+                    self.assertEqual(fasta.getString(name, start, end), 
+                        seq[start:end])
+        self.assertEqual(fasta.getString('s4', -5), 'TAAAA')
+        region = fasta.getRegion('s1', 5, 12)
+        self.assertEqual(region.Name, 's1:5-12')
+        self.assertEqual(str(region), 'CGTTTGC')
+        self.assertRaises(KeyError, fasta.getSeq, 'xyz')
+
+    def test_index(self):
+        """IndexedFasta should build a samtools-compatible index"""
+        fasta = IndexedFasta(self.filename)
+        self.check(fasta)
+        fasta.close()
+        self.assertEqual(open(self.filename + '.fai').read(), self.fai)
+        #an existing index is used
+        fasta = IndexedFasta(self.filename, moltype=DNA)
+        self.check(fasta)
+        self.assertEqual(fasta['s2'].MolType, DNA)
+        collection = fasta.takeSeqs(['s2', 's1'])
+        self.assertEqual(collection.Names, ['s2', 's1'])
+        self.assertEqual(str(collection.getSeq('s1')), 'ACGTACGTTTGCA')
+        fasta.close()
+
+    def test_line_endings(self):
+        """IndexedFasta should handle CRLF and reject ragged lines"""
+        fasta = IndexedFasta(self.write('crlf.fasta', 
+            self.text.replace('\n', '\r\n')), write_index=False)
+        self.check(fasta)
+        fasta.close()
+        ragged = self.write('ragged.fasta', '>a\nACG\nAC\nACG\n')
+        self.assertRaises(RecordError, IndexedFasta, ragged)
+        self.assertFalse(os.path.exists(ragged + '.fai'))
+        duplicated = self.write('dup.fasta', '>a\nACG\n>a\nAC\n')
+        self.assertRaises(RecordError, IndexedFasta, duplicated)
+
+    def test_bgzf(self):
+        """IndexedFasta should read bgzipped files"""
+        filename = self.write('seqs.fasta.gz', bgzf_compress(self.text, 10))
+        self.assertTrue(is_bgzf(filename))
+        self.assertFalse(is_bgzf(self.filename))
+        fasta = IndexedFasta(filename)
+        self.check(fasta)
+        fasta.close()
+        self.assertEqual(open(filename + '.fai').read(), self.fai)
+        #with the .gzi index
+        assert os.path.exists(filename + '.gzi')
+        fasta = IndexedFasta(filename)
+        self.check(fasta)
+        fasta.close()
+        reader = BgzfReader(filename)
+        self.assertEqual(reader.read(5, 30), self.text[5:35])
+        self.assertEqual(reader.read(0, len(self.text) + 10), self.text)
+        reader.close()
+
 if __name__ == '__main__':
     main()
@@ -2,10 +2,13 @@
 """Tests of parsers for dealing with NCBI Taxonomy files.
 """
 
+import tempfile, shutil
+from os import path
 from cogent.parse.ncbi_taxonomy import MissingParentError, NcbiTaxon, \
     NcbiTaxonParser, NcbiTaxonLookup, NcbiName, NcbiNameParser, \
     NcbiNameLookup, \
-    NcbiTaxonomy, NcbiTaxonNode, NcbiTaxonomyFromFiles
+    NcbiTaxonomy, NcbiTaxonNode, NcbiTaxonomyFromFiles, \
+    CompiledNcbiTaxonomy, CompiledNcbiTaxonomyFromFiles
 from cogent.util.unit_test import TestCase, main
 
 __author__ = "Jason Carnes"
@@ -259,6 +262,75 @@ class NcbiTaxonomyTests(TestCase):
         assert self.tx[9].lastCommonAncestor(self.tx[10]) is self.tx[6]
         assert self.tx[9].lastCommonAncestor(self.tx[1]) is self.tx[1]
 
+class CompiledNcbiTaxonomyTests(TestCase):
+    """Tests of the CompiledNcbiTaxonomy class."""
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.dirname = path.join(self.temp_dir, 'taxonomy')
+        self.tx = CompiledNcbiTaxonomyFromFiles(good_nodes, good_names, 
+            self.dirname)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_init(self):
+        """CompiledNcbiTaxonomy should read back what was compiled"""
+        tx = CompiledNcbiTaxonomy(self.dirname)
+        self.assertEqual(len(tx), 6)
+        assert 7 in tx
+        assert 8 not in tx
+        assert 1000 not in tx
+        self.assertEqual(tx.getName(10), 'Fakus namus')
+        self.assertEqual(tx.getName(1), 'root')
+        self.assertEqual(tx.getRank(2), 'superkingdom')
+        self.assertEqual(tx.getParentId(7), 6)
+        self.assertEqual(tx.getParentId(1), None)
+        self.assertEqual(tx.getTaxonId('Azorhizobium caulinodans'), 7)
+        self.assertRaises(KeyError, tx.getTaxonId, 'Monera')
+        self.assertRaises(KeyError, tx.getName, 8)
+
+    def test_init_strict(self):
+        """CompiledNcbiTaxonomyFromFiles should fail if strict and parents
+        are missing"""
+        dirname = path.join(self.temp_dir, 'bad')
+        self.assertRaises(MissingParentError, CompiledNcbiTaxonomyFromFiles,
+            bad_nodes, good_names, dirname, strict=True)
+        tx = CompiledNcbiTaxonomyFromFiles(bad_nodes, good_names, dirname)
+        self.assertEqual(tx.lineage(9), [9])
+        self.assertEqual(tx.lastCommonAncestor([9, 10]), None)
+
+    def test_lineage(self):
+        """CompiledNcbiTaxonomy lineage should run from the root down"""
+        self.assertEqual(self.tx.lineage(9), [1, 2, 6, 7, 9])
+        self.assertEqual(self.tx.lineage(1), [1])
+
+    def test_lastCommonAncestor(self):
+        """CompiledNcbiTaxonomy should match NcbiTaxonomy lastCommonAncestor
+        """
+        tree = NcbiTaxonomyFromFiles(good_nodes, good_names)
+        for first in [1, 2, 6, 7, 9, 10]:
+            for second in [1, 2, 6, 7, 9, 10]:
+                self.assertEqual(
+                    self.tx.lastCommonAncestor([first, second]),
+                    tree[first].lastCommonAncestor(tree[second]).TaxonId)
+        self.assertEqual(self.tx.lastCommonAncestor([9, 7, 10]), 6)
+        self.assertEqual(self.tx.lastCommonAncestor([9]), 9)
+
+    def test_getRankedDescendants(self):
+        """CompiledNcbiTaxonomy getRankedDescendants should give taxon ids"""
+        self.assertEqual(self.tx.getRankedDescendants(1, 'species'), [7, 10])
+        self.assertEqual(self.tx.getRankedDescendants(7, 'species'), [7])
+        self.assertEqual(self.tx.getRankedDescendants(7, 'genus'), [])
+        self.assertEqual(self.tx.getRankedDescendants(7, 'tribe'), [])
+
+    def test_getRankedAncestors(self):
+        """CompiledNcbiTaxonomy getRankedAncestors should work on arrays"""
+        self.assertEqual(self.tx.getRankedAncestors([9, 10, 6, 2, 8], 
+            'genus'), [6, 6, 6, 0, 0])
+        self.assertEqual(self.tx.getRankedAncestors([9, 7, 1], 'species'),
+            [7, 7, 0])
+        self.assertEqual(self.tx.getRankedAncestors([9], 'tribe'), [0])
+
 class NcbiTaxonNodeTests(TestCase):
     """Tests of the NcbiTaxonNode class.
 
@@ -5,6 +5,8 @@ from numpy import log, exp
 warnings.filterwarnings('ignore', 'Not using MPI as mpi4py not found')
 
 from cogent.phylo.distance import EstimateDistances
+from cogent.phylo.kmer_distance import kmer_distances, kmer_count_matrix, \
+    nearest_neighbour_pairs
 from cogent.phylo.nj import nj, gnj
 from cogent.phylo.least_squares import wls
 from cogent import LoadSeqs, LoadTree
@@ -288,6 +290,70 @@ class DistancesTests(unittest.TestCase):
         for pair in expect:
             for param in expect[pair]:
                 self.assertAlmostEqual(got[pair][param], expect[pair][param])
+    
+    def test_EstimateDistances_kmer_neighbours(self):
+        """only nearest k-mer neighbours are pair aligned"""
+        d = EstimateDistances(self.collection, JC69(), do_pair_align=True,
+                                kmer_neighbours=1)
+        d.run()
+        result = d.getPairwiseDistances()
+        self.assertTrue(len(result) < 6)
+        expect = {('a', 'c'): 0.088337, ('b', 'c'): 0.0883373}
+        self.assertDistsAlmostEqual(expect, result)
+        str(d.getTable())
+
+class KmerDistanceTests(unittest.TestCase):
+    def setUp(self):
+        self.seqs = {'a':'GTACGTACGATC', 'b':'GTACGTACGTAC',
+                'c':'GTACGTACGTTC', 'e':'GTACGTACTGGT'}
+    
+    def test_kmer_count_matrix(self):
+        """k-mers containing gaps or ambiguities are not counted"""
+        (names, counts) = kmer_count_matrix(
+                {'x':'ACGTAC', 'y':'AC-GN', 'z':'a'}, 2)
+        self.assertEqual(names, ['x', 'y', 'z'])
+        self.assertEqual(counts.shape, (3, 4))
+        self.assertEqual(list(counts.sum(axis=1)), [5, 1, 0])
+        # columns ordered by word code, alphabet order TCAG
+        self.assertEqual(list(counts[0]), [1, 1, 2, 1])
+    
+    def test_kmer_distances(self):
+        """k-mer distances use the fraction of k-mers in common"""
+        d = kmer_distances(self.seqs, k=4, metric='muscle')
+        self.assertEqual(len(d), 6)
+        self.assertAlmostEqual(d[('a', 'b')], 1 - 6/9.)
+        d = kmer_distances(self.seqs, k=4)
+        self.assertAlmostEqual(d[('a', 'b')], -log(6/9.)/4)
+        self.assertEqual(kmer_distances({'x':'ACGTA', 'y':'ACGTA'},
+                k=3, metric='cosine'), {('x', 'y'): 0.0})
+        self.assertRaises(ValueError, kmer_distances, self.seqs,
+                metric='xxx')
+
+    def test_kmer_distances_no_words(self):
+        """sequences without any complete k-mer share nothing"""
+        seqs = {'a':'ACGTNNNNACGT', 'b':'ACG'}
+        (names, counts) = kmer_count_matrix(seqs, 6)
+        self.assertEqual(counts.shape, (2, 0))
+        for metric in ['fraction', 'muscle', 'cosine']:
+            d = kmer_distances(seqs, k=6, metric=metric)
+            self.assertEqual(d.keys(), [('a', 'b')])
+            self.assertTrue(d[('a', 'b')] > 0)
+
+    def test_nearest_neighbour_pairs(self):
+        """each name is paired with its nearest neighbour"""
+        d = {('a', 'b'): 1, ('a', 'c'): 3, ('b', 'c'): 2, ('c', 'd'): 4,
+                ('a', 'd'): 5, ('b', 'd'): 6}
+        self.assertEqual(nearest_neighbour_pairs(d, 'abcd'),
+                [('a', 'b'), ('b', 'c'), ('c', 'd')])
+        self.assertEqual(len(nearest_neighbour_pairs(d, 'abcd', 3)), 6)
+    
+    def test_kmer_tree(self):
+        """k-mer distances recover an obvious tree"""
+        seqs = LoadSeqs('data/brca1_5.paml', aligned=False).degap()
+        tree = nj(kmer_distances(seqs))
+        primates = tree.getConnectingNode('Human', 'HowlerMon')
+        self.assertEqual(sorted(primates.getTipNames()),
+                ['HowlerMon', 'Human'])
 
 if __name__ == '__main__':
     unittest.main()